@@ -1,112 +1,413 @@
 import streamlit as st
-import pandas as pd
+import os
+import tempfile
+from pathlib import Path
 import folium
+from folium.plugins import Draw, VectorGridProtobuf
 from streamlit_folium import st_folium
 from datetime import datetime
 
+from config.settings import (GRID_LAYER_MIN_ZOOM, GRID_SIZE_LARGE, GRID_SIZE_SMALL, MAP_HEIGHT, MAP_WIDTH,
+                             SHARED_MAX_VISIBLE, TILE_SERVER_URL, WARD_LAYER_MIN_ZOOM)
+from utils import data_layer
+from utils.annotation_io import EXPORT_FORMATS, export_annotations, import_annotations
+from utils.annotation_layer import AnnotationChunk, AnnotationLayer, features_json
+from utils.annotation_store import SOURCE_CLICK, AnnotationStore, frame_columns, new_session_id, session_path
+from utils.app_state import load_app_state
+from utils.instrumentation import start_metrics_server, track
+from utils.map_layers import bounds_from_map_data
+
+# Vector tile styling, evaluated in the browser per feature and layer
+VECTOR_TILE_OPTIONS = """{
+    "interactive": true,
+    "vectorTileLayerStyles": {
+        "wards": function(properties, zoom) {
+            var treatment = properties.status === "treatment";
+            return {color: treatment ? "red" : "black", weight: treatment ? 2 : 1, fill: false};
+        },
+        "grid_500m": function(properties, zoom) {
+            return {color: properties.status === "treatment" ? "red" : "gray", weight: 0.5, fill: true, fillOpacity: 0.05};
+        },
+        "grid_100m": function(properties, zoom) {
+            return {color: properties.status === "treatment" ? "red" : "gray", weight: 0.3, fill: false};
+        }
+    }
+}"""
+
+
+# Time the whole script run; stopped at the end or just before a st.rerun()
+run_step = track('app.rerun').start()
+start_metrics_server()  # only when METRICS_PORT is set; once per server process
+
+
+def rerun():
+    run_step.stop()
+    st.rerun()
+
 
 # Page config
 st.set_page_config(page_title="Treatment area  Annotation Tool", layout="wide")
 st.title("🌳 Deforestation Annotation Tool")
 
-# Initialize session state for annotations
+# Annotations are journaled per session; the session id is kept in the URL so a
+# browser refresh reloads the same annotations
+try:
+    journal = session_path(st.query_params.get('session', ''))
+except ValueError:
+    st.query_params['session'] = new_session_id()
+    journal = session_path(st.query_params['session'])
+session_id = st.query_params['session']
+# Every session also writes to the store shared by all annotators
+shared_store = data_layer.shared_store()
 if 'annotations' not in st.session_state:
-    st.session_state.annotations = []
+    st.session_state.annotations = AnnotationStore(journal)
+    # Journals from before the shared store existed are published once
+    if len(st.session_state.annotations) and not shared_store.count(session_id):
+        shared_store.add(frame_columns(st.session_state.annotations.to_frame()), 'anonymous', session_id)
+annotations = st.session_state.annotations
+
+# Annotation markers serialized so far; only new annotations are added on a rerun
+if 'annotation_layer' not in st.session_state:
+    st.session_state.annotation_layer = AnnotationLayer()
+
+# Last map viewport reported by st_folium, used to load only the visible boundary features
+if 'viewport' not in st.session_state:
+    st.session_state.viewport = {'bounds': None, 'zoom': None, 'center': None}
+if 'last_processed_click' not in st.session_state:
+    st.session_state.last_processed_click = None
+if 'last_processed_drawing' not in st.session_state:
+    st.session_state.last_processed_drawing = None
+
+# Map view and layer index precomputed by the pipeline; the wards themselves are
+# only read on the code paths that need them, so the first run reads no geodata
+app_state = load_app_state()
+layers = app_state['layers']
+
+
+def offer_download(name, version, build, label, file_name, mime):
+    """
+    Download button for a file that is only built when the user asks for it.
+
+    The file is written by ``build(path)`` to a temporary file and reused until
+    ``version`` changes, so reruns do not regenerate it.
+    """
+    downloads = st.session_state.setdefault('downloads', {})
+    prepared = downloads.get(name)
+    if prepared is None or prepared['version'] != version:
+        if not st.button(f"Prepare {label}", key=f"prepare_{name}"):
+            return
+        if prepared is not None:
+            Path(prepared['path']).unlink(missing_ok=True)
+        fd, path = tempfile.mkstemp(suffix=Path(file_name).suffix)
+        os.close(fd)
+        with st.spinner(f"Writing {label}..."):
+            build(path)
+        prepared = downloads[name] = {'version': version, 'path': path}
+    with open(prepared['path'], 'rb') as f:
+        st.download_button(label=f"Download {label}", data=f, file_name=file_name, mime=mime, key=f"download_{name}")
 
 # Sidebar controls
 st.sidebar.header("Controls")
 
+# Annotations are attributed to this name in the shared store; kept in the URL next to the session
+annotator = st.sidebar.text_input("Annotator", value=st.query_params.get('annotator', ''),
+                                  placeholder="Your name").strip() or 'anonymous'
+if annotator != st.query_params.get('annotator', 'anonymous'):
+    st.query_params['annotator'] = annotator
+    shared_store.reassign(session_id, annotator)
+# One writer per session, so undo can find the batches it wrote
+if annotations.shared is None:
+    annotations.shared = shared_store.writer(annotator, session_id)
+annotations.shared.annotator = annotator
+# Writes to the shared store run in the background; report the ones that failed since the last rerun
+for error in annotations.shared.failures():
+    st.sidebar.warning(f"⚠️ Could not save annotations to the shared store: {error}")
+
 # File upload for continuing previous work
 uploaded_file = st.sidebar.file_uploader("Upload previous annotations (optional)", type=['csv'])
-if uploaded_file is not None:
-    df = pd.read_csv(uploaded_file)
-    st.session_state.annotations = df.to_dict('records')
-    st.sidebar.success(f"Loaded {len(df)} previous annotations")
+if uploaded_file is not None and uploaded_file.file_id != st.session_state.get('loaded_upload'):
+    # The uploader keeps returning the file on every rerun; load it only once
+    progress = st.sidebar.progress(0.0, text="Loading annotations...")
+    try:
+        result = import_annotations(
+            uploaded_file, annotations, snapper=data_layer.snapper(),
+            progress=lambda fraction, rows: progress.progress(fraction or 0.0, text=f"Loaded {rows:,} annotations"),
+        )
+    except ValueError as e:
+        st.sidebar.error(str(e))
+    else:
+        st.sidebar.success(f"Loaded {result['rows_loaded']:,} previous annotations")
+        if result['rows_rejected']:
+            st.sidebar.warning(f"Skipped {result['rows_rejected']:,} rows with an invalid location or treatment flag")
+    progress.empty()
+    st.session_state.loaded_upload = uploaded_file.file_id
 
 # Mode selection
 mode = st.sidebar.radio("Annotation Mode:", ["Treatment Area", "Control Area"])
 is_treatment = mode == "Treatment Area"
 
+# Bulk labels: everything inside a drawn polygon or rectangle, or a picked ward, in one batch
+BULK_TARGETS = {f"{GRID_SIZE_SMALL}m grid cells": GRID_SIZE_SMALL, f"{GRID_SIZE_LARGE}m grid cells": GRID_SIZE_LARGE,
+                "Wards": None}
+labeling = st.sidebar.radio("Labeling:", ["Click points", "Draw areas"],
+                            help="Draw a polygon or rectangle on the map to label every grid cell or ward in it")
+draw_mode = labeling == "Draw areas" and 'wards' in layers
+if labeling == "Draw areas" and not draw_mode:
+    st.sidebar.warning("Bulk labels need the ward layer - run 01_explore_districts.py first")
+if draw_mode:
+    # Bulk labels need shapely and pyproj, which are only imported in draw mode
+    from utils import bulk_labels
+
+    snapper = data_layer.snapper()
+
+
+def label_area(polygon, description):
+    """Label all cells or wards in a TARGET_CRS polygon as one batch, then rerun."""
+    cell_size = BULK_TARGETS[bulk_target]
+    try:
+        with track('app.bulk_label', target=bulk_target) as step:
+            if cell_size is None:
+                frame = bulk_labels.select_wards(polygon, snapper, is_treatment)
+            else:
+                frame = bulk_labels.select_cells(polygon, cell_size, snapper, is_treatment)
+            annotations.extend(frame)
+            step.rows = len(frame)
+    except ValueError as e:
+        st.error(str(e))
+        return
+    st.success(f"Labelled {len(frame):,} {bulk_target.lower()} in {description} as {mode}")
+    rerun()
+
+
+if draw_mode:
+    bulk_target = st.sidebar.selectbox("Label all", list(BULK_TARGETS))
+    labels = bulk_labels.ward_labels(snapper)
+    picked_ward = st.sidebar.selectbox("...in a ward", sorted(range(len(labels)), key=labels.__getitem__),
+                                       index=None, format_func=labels.__getitem__, placeholder="Pick a ward")
+    if picked_ward is not None and st.sidebar.button(f"Label {bulk_target.lower()} in this ward"):
+        label_area(bulk_labels.ward_polygon(snapper, picked_ward), labels[picked_ward])
+
+
+def layer_help(name, unit):
+    """Size of a layer, from the app state's layer index."""
+    layer = layers.get(name)
+    if layer is None:
+        return "Not built yet - run `python -m spatial_prep.pipeline`"
+    return f"{layer['features']:,} {unit}, {layer['treatment']:,} treatment" if 'features' in layer else None
+
+
+# Boundary layers, loaded per viewport
+st.sidebar.subheader("Layers")
+grid_name = f"grid_{GRID_SIZE_LARGE}m"
+show_wards = st.sidebar.checkbox(f"Ward boundaries (zoom ≥ {WARD_LAYER_MIN_ZOOM})", value=True,
+                                 disabled='wards' not in layers, help=layer_help('wards', "wards"))
+show_grid = st.sidebar.checkbox(f"{GRID_SIZE_LARGE}m grid (zoom ≥ {GRID_LAYER_MIN_ZOOM})", value=False,
+                                disabled=grid_name not in layers, help=layer_help(grid_name, "cells"))
+use_vector_tiles = st.sidebar.checkbox(
+    "Use vector tiles (local tile server)",
+    value=False,
+    help="Requires `python -m utils.tile_server`; wards and grids are then drawn from tiles in the browser.",
+)
+offline_basemaps = data_layer.basemaps()
+basemap = st.sidebar.selectbox(
+    "Basemap",
+    [None, *offline_basemaps],
+    format_func=lambda name: "OpenStreetMap (online)" if name is None else f"{name} (offline)",
+    help="Offline basemaps come from `python -m utils.basemap_tiles` and are served by `python -m utils.tile_server`.",
+)
+show_others = st.sidebar.checkbox("Other annotators' annotations", value=True,
+                                  help=f"The {SHARED_MAX_VISIBLE:,} most recent in the map view")
+# A layer is only built once the map has reported a viewport at its zoom levels
+viewport = st.session_state.viewport
+zoom = viewport['zoom'] or 0
+ward_layer = data_layer.ward_layer() if show_wards and not use_vector_tiles and zoom >= WARD_LAYER_MIN_ZOOM else None
+grid_layer = data_layer.grid_layer() if show_grid and not use_vector_tiles and zoom >= GRID_LAYER_MIN_ZOOM else None
+boundaries_wanted = not use_vector_tiles and ((show_wards and 'wards' in layers) or (show_grid and grid_name in layers))
+# Layers are shared by all sessions and reload by themselves when data/processed changes
+if st.sidebar.button("🔄 Reload data", help="Drop the shared boundary layers and read them again"):
+    data_layer.clear()
+    rerun()
+
 # Create the map
-st.subheader("Click on the map to annotate areas")
-
-# Initialize map - you can change these coordinates to your area of interest
-m = folium.Map(location=[0, 0], zoom_start=5)
-
-# Add existing annotations to map
-for ann in st.session_state.annotations:
-    color = 'red' if ann['is_treatment'] else 'blue'
-    folium.CircleMarker(
-        location=[ann['latitude'], ann['longitude']],
-        radius=8,
-        popup=f"{'Treatment' if ann['is_treatment'] else 'Control'} Area<br>Lat: {ann['latitude']:.6f}<br>Lng: {ann['longitude']:.6f}",
-        color=color,
-        fillColor=color,
-        fillOpacity=0.7
+st.subheader("Draw an area on the map to label it" if draw_mode else "Click on the map to annotate areas")
+
+map_build = track('app.map_build').start()
+# Initialize map over the study area (fitted by the pipeline, or DEFAULT_MAP_CENTER / DEFAULT_ZOOM)
+m = folium.Map(location=app_state['center'], zoom_start=app_state['zoom'], tiles=None if basemap else 'OpenStreetMap')
+if basemap:
+    # Outside the prefetched zoom levels Leaflet scales the nearest cached tiles
+    metadata = offline_basemaps[basemap]
+    folium.TileLayer(
+        f"{TILE_SERVER_URL}/basemap/{basemap}/{{z}}/{{x}}/{{y}}.{metadata['format']}",
+        attr=metadata.get('attribution', basemap),
+        name=basemap,
+        min_native_zoom=int(metadata['minzoom']),
+        max_native_zoom=int(metadata['maxzoom']),
+        max_zoom=19,
     ).add_to(m)
 
-# Display map and capture clicks
-map_data = st_folium(m, width=700, height=500)
+if draw_mode:
+    Draw(draw_options={'polyline': False, 'circle': False, 'marker': False, 'circlemarker': False,
+                       'polygon': True, 'rectangle': True},
+         edit_options={'edit': False, 'remove': False}).add_to(m)
+
+if use_vector_tiles:
+    VectorGridProtobuf(f"{TILE_SERVER_URL}/{{z}}/{{x}}/{{y}}.pbf", "Wards & grids", VECTOR_TILE_OPTIONS).add_to(m)
+
+# Existing annotations as one batched layer; it is passed to st_folium next to the
+# boundaries so the base map stays the same and is not re-rendered on every click
+annotation_layer = st.session_state.annotation_layer
+annotation_layer.sync(annotations)
+
+# Boundary features for the current viewport only; they are sent as a separate
+# feature group so panning does not rebuild the base map
+boundary_layer = folium.FeatureGroup(name="Boundaries")
+grid_features = grid_layer.query(viewport['bounds'], viewport['zoom']) if grid_layer is not None else None
+ward_features = ward_layer.query(viewport['bounds'], viewport['zoom']) if ward_layer is not None else None
+if grid_features and grid_features['features']:
+    folium.GeoJson(
+        grid_features,
+        style_function=lambda f: {
+            'color': 'red' if f['properties']['is_treatment'] else 'gray',
+            'weight': 0.5,
+            'fillOpacity': 0.05,
+        },
+    ).add_to(boundary_layer)
+if ward_features and ward_features['features']:
+    folium.GeoJson(
+        ward_features,
+        style_function=lambda f: {
+            'color': 'red' if f['properties']['is_treatment'] else 'black',
+            'weight': 2 if f['properties']['is_treatment'] else 1,
+            'fillOpacity': 0,
+        },
+        tooltip=folium.GeoJsonTooltip(fields=['ward_name', 'dist_name', 'reg_name']),
+    ).add_to(boundary_layer)
+# Other sessions' annotations in the viewport, found through the shared store's R*Tree
+if show_others and viewport['bounds'] is not None:
+    others = shared_store.query_bbox(viewport['bounds'], exclude_session=session_id, limit=SHARED_MAX_VISIBLE)
+    if len(others):
+        boundary_layer.add_child(AnnotationChunk(
+            features_json(others['latitude'], others['longitude'], others['is_treatment']),
+            treatment_color='salmon', control_color='lightblue',
+        ))
+map_build.stop()
+
+# Display map and capture clicks (serializes the map and layers for the browser)
+with track('app.st_folium', annotations=len(annotations)):
+    map_data = st_folium(
+        m,
+        width=MAP_WIDTH,
+        height=MAP_HEIGHT,
+        center=viewport['center'],
+        zoom=viewport['zoom'],
+        feature_group_to_add=[boundary_layer, annotation_layer.feature_group()],
+        returned_objects=['last_clicked', 'last_active_drawing', 'bounds', 'zoom', 'center'],
+    )
+
+# Track the viewport; layers are re-queried on the next run when it changes
+new_bounds = bounds_from_map_data(map_data.get('bounds'))
+viewport_changed = new_bounds is not None and (new_bounds != viewport['bounds'] or map_data.get('zoom') != viewport['zoom'])
+if viewport_changed:
+    center = map_data.get('center') or {}
+    viewport.update(
+        bounds=new_bounds,
+        zoom=map_data.get('zoom'),
+        center=(center['lat'], center['lng']) if 'lat' in center else None,
+    )
+
+# Handle drawn areas (like clicks, the last drawing keeps being returned)
+drawing = map_data.get('last_active_drawing')
+if draw_mode and drawing and drawing != st.session_state.last_processed_drawing:
+    st.session_state.last_processed_drawing = drawing
+    polygon = bulk_labels.drawing_polygon(drawing, snapper)
+    if polygon is not None:
+        label_area(polygon, "the drawn area")
+if draw_mode:
+    # Clicks while drawing are not annotations
+    st.session_state.last_processed_click = map_data['last_clicked']
 
-# Handle map clicks
-if map_data['last_clicked']:
+# Handle map clicks (st_folium keeps returning the last click, so only new ones are added)
+if map_data['last_clicked'] and map_data['last_clicked'] != st.session_state.last_processed_click:
+    st.session_state.last_processed_click = map_data['last_clicked']
     lat = map_data['last_clicked']['lat']
     lng = map_data['last_clicked']['lng']
     
-    # Add new annotation
-    new_annotation = {
-        'latitude': lat,
-        'longitude': lng,
-        'is_treatment': is_treatment,
-        'timestamp': datetime.now().isoformat(),
-        'type': 'Treatment' if is_treatment else 'Control'
-    }
-    
-    st.session_state.annotations.append(new_annotation)
-    st.success(f"Added {mode} at coordinates: {lat:.6f}, {lng:.6f}")
-    st.rerun()
+    snapper = data_layer.snapper()
+    snapped = snapper.snap_one(lat, lng) if snapper is not None else {}
+    annotations.append(lat, lng, is_treatment, source=SOURCE_CLICK, **snapped)
+    ward = f" in {snapped['ward_name']} ({snapped['dist_name']})" if snapped.get('ward_name') else ""
+    st.success(f"Added {mode} at coordinates: {lat:.6f}, {lng:.6f}{ward}")
+    rerun()
+
+if viewport_changed and (boundaries_wanted or show_others):
+    rerun()
+
+
+def write_map_html(path):
+    """Write the map as shown, with the boundary and annotation layers that st_folium sends next to it."""
+    m.add_child(boundary_layer)
+    m.add_child(annotation_layer.feature_group())
+    Path(path).write_text(m._repr_html_(), encoding='utf-8')
+
 
 # Display current annotations
-st.subheader(f"Current Annotations ({len(st.session_state.annotations)})")
-if st.session_state.annotations:
-    df = pd.DataFrame(st.session_state.annotations)
-    st.dataframe(df)
-    
+st.subheader(f"Current Annotations ({len(annotations)})")
+if len(annotations):
+    # Only the latest rows are sent to the browser; use an export for the full table
+    st.dataframe(annotations.to_frame().tail(1000))
+
     col1, col2 = st.columns(2)
-    
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    version = (annotations.generation, len(annotations))
+
     with col1:
-        # CSV download
-        csv = df.to_csv(index=False)
-        st.download_button(
-            label="📊 Download Coordinates (CSV)",
-            data=csv,
-            file_name=f"coordinates_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-            mime="text/csv"
+        export_format = st.selectbox("Export format", list(EXPORT_FORMATS))
+        suffix, mime = EXPORT_FORMATS[export_format]
+        offer_download(
+            'annotations', (*version, export_format),
+            lambda path: export_annotations(annotations, path, export_format),
+            label=f"📊 Annotations ({export_format})",
+            file_name=f"coordinates_{timestamp}{suffix}",
+            mime=mime,
         )
-    
+
     with col2:
-        # Map download
-        map_html = m._repr_html_()
-        st.download_button(
-            label="🗺️ Download Map (HTML)",
-            data=map_html,
-            file_name=f"map_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html",
-            mime="text/html"
+        offer_download(
+            'map', version,
+            write_map_html,
+            label="🗺️ Map (HTML)",
+            file_name=f"map_{timestamp}.html",
+            mime="text/html",
         )
-    
+
+    # A bulk label is one batch, so undo removes all of its cells at once
+    if annotations.can_undo and st.button("↩️ Undo last batch"):
+        annotations.undo()
+        rerun()
+
     # Clear all button
     if st.button("🗑️ Clear All Annotations"):
-        st.session_state.annotations = []
-        st.rerun()
+        annotations.clear()
+        rerun()
 else:
     st.info("No annotations yet. Click on the map to start annotating!")
 
+# Progress of all annotators, counted in the shared store (cached there until the next write)
+team_counts = shared_store.annotator_counts()
+with st.expander(f"👥 All annotators ({int(team_counts[['treatment', 'control']].sum().sum()):,} annotations)"):
+    st.dataframe(team_counts, hide_index=True)
+
 # Instructions
 with st.expander("📋 Instructions"):
     st.markdown("""
     1. **Select mode**: Choose between "Treatment Area" or "Control Area" in the sidebar
     2. **Click on map**: Click anywhere on the map to place an annotation
-    3. **Download progress**: Use the download buttons to save your work
+    3. **Download progress**: Prepare and download an export to save your work
     4. **Resume work**: Upload your CSV file next time to continue where you left off
-    5. **Export**: Download both the coordinates (CSV) and visual map (HTML)
+    5. **Export**: Download the annotations (CSV, Parquet or GeoParquet) and the visual map (HTML)
+    6. **Bulk labels**: Choose "Draw areas", then draw a polygon or rectangle (or pick a ward) to label all grid cells or wards in it; "Undo last batch" takes a whole selection back
+    7. **Annotator**: Enter your name in the sidebar; your annotations are shared with the other annotators under it
     """)
+
+run_step.stop()
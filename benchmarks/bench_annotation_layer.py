@@ -0,0 +1,90 @@
+"""Benchmark drawing annotations on the app map.
+
+Usage:
+    python benchmarks/bench_annotation_layer.py [--sizes 100 1000 10000 50000]
+
+Compares, per number of annotations:
+  * markers: one folium.CircleMarker per annotation, rendered with the map (the
+    previous app behaviour, repeated on every rerun);
+  * batched (cold): the batched AnnotationLayer serialized from scratch, e.g.
+    after a page refresh;
+  * batched (click): one more annotation added to an already synced layer, i.e.
+    the work done on a normal rerun after a click.
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import folium
+import numpy as np
+import pandas as pd
+
+# Add project root to Python path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from utils.annotation_layer import AnnotationLayer
+from utils.annotation_store import AnnotationStore
+
+
+def make_annotations(n, seed=42):
+    """Random annotations around the Rubeho mountains."""
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        'latitude': rng.uniform(-7.5, -6.5, n),
+        'longitude': rng.uniform(36.5, 37.5, n),
+        'is_treatment': rng.random(n) < 0.5,
+    })
+
+
+def render_markers(annotations):
+    m = folium.Map(location=[-7.0, 37.0], zoom_start=9)
+    for ann in annotations.to_dict('records'):
+        color = 'red' if ann['is_treatment'] else 'blue'
+        folium.CircleMarker(
+            location=[ann['latitude'], ann['longitude']],
+            radius=8,
+            popup=f"{'Treatment' if ann['is_treatment'] else 'Control'} Area<br>Lat: {ann['latitude']:.6f}<br>Lng: {ann['longitude']:.6f}",
+            color=color,
+            fillColor=color,
+            fillOpacity=0.7
+        ).add_to(m)
+    return m.get_root().render()
+
+
+def render_layer(layer):
+    m = folium.Map(location=[-7.0, 37.0], zoom_start=9)
+    layer.feature_group().add_to(m)
+    return m.get_root().render()
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1_000, 10_000, 50_000])
+    parser.add_argument('--max-markers', type=int, default=50_000,
+                        help="Skip the per-marker baseline above this many annotations")
+    args = parser.parse_args()
+
+    print(f"{'annotations':>12} {'markers s':>10} {'batched cold s':>15} {'batched click s':>16} {'payload MB':>11}")
+    for n in args.sizes:
+        annotations = make_annotations(n + 1)
+        markers = timed(render_markers, annotations[:n])[0] if n <= args.max_markers else float('nan')
+
+        store = AnnotationStore()
+        store.extend(annotations[:n])
+        layer = AnnotationLayer()
+        cold, html = timed(lambda: (layer.sync(store), render_layer(layer))[1])
+        last = annotations.iloc[n]
+        click = timed(lambda: (store.append(last['latitude'], last['longitude'], last['is_treatment']),
+                               layer.sync(store), render_layer(layer))[2])[0]
+        print(f"{n:>12,} {markers:>10.3f} {cold:>15.3f} {click:>16.3f} {len(html) / 1e6:>11.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Benchmark tiled grid generation with 1..N worker processes.
+
+Usage:
+    python benchmarks/bench_parallel_grid.py [--cell-size 100] [--max-workers 8]
+
+Each run writes to a fresh temporary dataset; the script reports wall time and
+speedup per worker count and checks that every run produced the same cells.
+"""
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pandas as pd
+
+# Add project root to Python path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from benchmarks.synthetic import make_wards
+from config.settings import GRID_SIZE_SMALL
+from spatial_prep import grid, tiles
+
+
+def dataset_digest(output_dir):
+    """Order-independent digest of the cells in a dataset."""
+    cells = pd.read_parquet(output_dir, columns=['cell_id', 'ward_name', 'area_frac'])
+    cells = cells.sort_values(['cell_id', 'ward_name']).reset_index(drop=True)
+    cells['area_frac'] = cells['area_frac'].round(9)
+    return hashlib.sha256(cells.to_csv(index=False).encode()).hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cell-size', type=int, default=GRID_SIZE_SMALL)
+    parser.add_argument('--tile-size', type=int, default=20_000)
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--wards', type=int, default=400)
+    args = parser.parse_args()
+
+    wards = grid.prepare_wards(make_wards(n_wards=args.wards, bounds=(600_000, 9_100_000, 800_000, 9_200_000)))
+    worker_counts = sorted({1, *[n for n in (2, 4, 8, 16, 32) if n < args.max_workers], args.max_workers})
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for workers in worker_counts:
+            output_dir = Path(tmp) / f"workers_{workers}"
+            start = time.perf_counter()
+            summary = tiles.build_tiled_grid(wards, args.cell_size, output_dir=output_dir,
+                                             tile_size=args.tile_size, workers=workers)
+            elapsed = time.perf_counter() - start
+            results.append((workers, elapsed, summary['rows_written'], dataset_digest(output_dir)))
+
+    baseline = results[0][1]
+    print(f"\n{args.cell_size}m grid, {len(wards)} wards, {args.tile_size / 1000:.0f} km tiles")
+    print(f"{'workers':>8} {'seconds':>9} {'speedup':>8} {'rows':>10}")
+    for workers, elapsed, rows, _ in results:
+        print(f"{workers:>8} {elapsed:>9.2f} {baseline / elapsed:>7.2f}x {rows:>10,}")
+
+    digests = {digest for *_, digest in results}
+    print(f"Identical output across worker counts: {'✅' if len(digests) == 1 else '❌'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Check the import cost of starting the annotation app.
+
+Usage:
+    python benchmarks/bench_startup.py [--repeat 5] [--top 15]
+
+Imports app.py's top-level imports in fresh interpreters under
+``python -X importtime`` and sums the cumulative time of every top-level
+import, i.e. what a cold `streamlit run app.py` pays before the first line of
+the page runs. Exits with 1 (for CI) when:
+  * the median over --repeat runs exceeds STARTUP_IMPORT_BUDGET_MS, or
+  * a module in STARTUP_LAZY_MODULES (or a submodule of one) was imported; those
+    belong inside the functions that need them, see utils/app_state.py.
+
+The entry points in --modules (by default the pipeline and the tile server) are
+only checked for STARTUP_LAZY_MODULES, not timed.
+"""
+import argparse
+import ast
+import subprocess
+import sys
+from pathlib import Path
+
+PROJECT_ROOT = Path(__file__).parent.parent
+sys.path.insert(0, str(PROJECT_ROOT))
+
+from config.settings import STARTUP_IMPORT_BUDGET_MS, STARTUP_LAZY_MODULES
+
+APP_FILE = PROJECT_ROOT / 'app.py'
+
+
+def top_level_imports(path):
+    """
+    Module-level import statements of a script.
+
+    Returns:
+        (code, names): the statements as source and the names of the imported modules
+    """
+    source = path.read_text()
+    nodes = [node for node in ast.parse(source).body if isinstance(node, (ast.Import, ast.ImportFrom))]
+    names = []
+    for node in nodes:
+        names += [alias.name for alias in node.names] if isinstance(node, ast.Import) else [node.module]
+    return '\n'.join(ast.get_source_segment(source, node) for node in nodes), list(dict.fromkeys(names))
+
+
+def import_times(code):
+    """
+    Run code in a fresh interpreter with -X importtime.
+
+    Returns:
+        (total_ms, modules) with modules a dict of module name -> cumulative ms
+        for every imported module (nested imports included)
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=PROJECT_ROOT,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Import failed:\n{result.stderr[-2000:]}")
+    total_us, modules = 0, {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = int(cumulative) / 1000
+        # One space of indentation marks the imports made by the code itself, not by other modules
+        if not name.startswith('  '):
+            total_us += int(cumulative)
+    return total_us / 1000, modules
+
+
+def lazy_violations(modules):
+    """Entries of STARTUP_LAZY_MODULES that were imported (themselves or a submodule)."""
+    return [lazy for lazy in STARTUP_LAZY_MODULES
+            if any(name == lazy or name.startswith(lazy + '.') for name in modules)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help="Fresh interpreters to take the median over")
+    parser.add_argument('--top', type=int, default=15, help="Most expensive top-level imports to list")
+    parser.add_argument('--budget-ms', type=float, default=STARTUP_IMPORT_BUDGET_MS)
+    parser.add_argument('--modules', nargs='*', default=['spatial_prep.pipeline', 'utils.tile_server'],
+                        help="Other entry points that must not import STARTUP_LAZY_MODULES")
+    args = parser.parse_args()
+
+    code, names = top_level_imports(APP_FILE)
+    runs = sorted((import_times(code) for _ in range(args.repeat)), key=lambda run: run[0])
+    total, modules = runs[len(runs) // 2]
+
+    print(f"📊 app.py imports: median {total:.0f} ms over {args.repeat} runs "
+          f"(min {runs[0][0]:.0f}, max {runs[-1][0]:.0f}; budget {args.budget_ms:.0f} ms)")
+    costs = sorted(((name, modules[name]) for name in names if name in modules), key=lambda item: -item[1])
+    for name, ms in costs[:args.top]:
+        print(f"  {ms:>8.1f} ms  {name}")
+
+    failures = []
+    if total > args.budget_ms:
+        failures.append(f"start-up imports take {total:.0f} ms, over the budget of {args.budget_ms:.0f} ms")
+    checked = {'app.py': modules}
+    for module in args.modules:
+        checked[module] = import_times(f"import {module}")[1]
+    for name, imported in checked.items():
+        violations = lazy_violations(imported)
+        if violations:
+            failures.append(f"{name} imports {', '.join(violations)} at start-up")
+
+    for failure in failures:
+        print(f"❌ {failure}")
+    if failures:
+        sys.exit(1)
+    print(f"✅ Within budget; none of {', '.join(STARTUP_LAZY_MODULES)} imported at start-up")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,285 @@
+"""Benchmark suite for the key processing and app paths on Tanzania-scale synthetic data.
+
+Usage:
+    python benchmarks/bench_suite.py                       # full suite, JSON in benchmarks/results/
+    python benchmarks/bench_suite.py --steps shapefile_load dissolve_regions
+    python benchmarks/bench_suite.py --compare benchmarks/results/<previous>.json
+
+Generates about 4,000 Voronoi wards nested in districts and regions over an
+area the size of Tanzania, and annotation sets of growing size, all from a
+fixed seed. Each step records wall time, CPU time, peak RSS (sampled in a
+background thread) and the size of its output (rows, grid cell pieces or
+characters of map HTML); the steps' own progress output is suppressed.
+
+Results are written as JSON together with the git commit, so runs can be
+compared across commits: ``--compare`` reports steps that got slower than
+``--tolerance`` allows and exits with status 1 if there are any.
+
+Steps:
+  * shapefile_load: read the ward shapefile (the real one is in EPSG:4326)
+  * ward_cache_build: convert it to the GeoParquet cache with dissolved layers
+  * dissolve_regions: wards.dissolve(by='reg_name')
+  * adjacency_regions / adjacency_wards: neighbour graphs
+  * treatment_flagging: match survey names to wards and set the flags
+  * grid_500m: the 500m grid over the program and adjacent regions
+  * grid_100m: the 100m grid over the program region
+  * map_build / map_render: the app map with n annotations and the ward layer
+  * bulk_label: label the 100m cells in a drawn circle of about 100,000 cells
+    (selection, store and map layer update)
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import psutil
+
+# Add project root to Python path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from benchmarks.synthetic import TANZANIA_BOUNDS, make_annotations, make_wards
+from config.settings import DEFAULT_MAP_CENTER, DEFAULT_ZOOM, GRID_SIZE_LARGE, GRID_SIZE_SMALL, WEB_CRS
+from utils.instrumentation import PeakRss
+
+RESULTS_DIR = Path(__file__).parent / "results"
+STEPS = ['shapefile_load', 'ward_cache_build', 'dissolve_regions', 'adjacency_regions', 'adjacency_wards',
+         'treatment_flagging', 'grid_500m', 'grid_100m', 'map_build', 'map_render', 'bulk_label']
+PROGRAM_REGION = 'Region 00'
+# Arguments that change the synthetic data; runs are only compared when they match
+DATA_ARGS = ['wards', 'districts', 'regions', 'seed']
+
+
+def measure(results, name, func, **params):
+    """Run one step, append its measurements to results and return its output."""
+    with PeakRss() as rss:
+        wall, cpu = time.perf_counter(), time.process_time()
+        output = func()
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    size = output if isinstance(output, int) else len(output) if isinstance(output, pd.DataFrame) else None
+    results.append({
+        'name': name,
+        'params': params,
+        'seconds': round(wall, 4),
+        'cpu_seconds': round(cpu, 4),
+        'peak_rss_mb': round(rss.peak / 2**20, 1),
+        'rss_increase_mb': round((rss.peak - rss.start) / 2**20, 1),
+        'size': size,
+    })
+    return output
+
+
+def _format(result):
+    size = result['size'] if result['size'] is not None else '-'
+    return (f"  {result['name']:<20} {str(result['params'] or ''):<22} {result['seconds']:>8.3f}s  "
+            f"cpu {result['cpu_seconds']:>8.3f}s  peak {result['peak_rss_mb']:>7.0f} MB  size {size}")
+
+
+def survey_locations(wards, share=0.2, seed=42):
+    """
+    Treatment ward/district pairs as they come from the survey sheet: a sample of
+    program-region wards with inconsistent case and spacing, plus some that do not exist.
+    """
+    rng = np.random.default_rng(seed)
+    program = wards[wards['reg_name'] == PROGRAM_REGION]
+    sample = program.sample(frac=share, random_state=seed)
+    ward = sample['ward_name'].str.upper().str.replace(' ', '  ', regex=False)
+    district = sample['dist_name'].str.lower()
+    missing = pd.DataFrame({'Ward': [f"Forest reserve {i}" for i in range(3)],
+                            'District': rng.choice(program['dist_name'].unique(), 3)})
+    return pd.concat([pd.DataFrame({'Ward': ward.to_numpy(), 'District': district.to_numpy()}), missing],
+                     ignore_index=True)
+
+
+def flag_treatment(wards, locations, adjacent_regions):
+    from utils.name_matching import match_names
+
+    program = wards[wards['reg_name'] == PROGRAM_REGION]
+    report = match_names(locations, program, left_on=('Ward', 'District'), right_on=('ward_name', 'dist_name'))
+    flagged = wards.copy()
+    flagged['is_treatment'] = flagged.index.isin(report.loc[report['accepted'], 'right_index'])
+    flagged['is_program_region'] = flagged['reg_name'] == PROGRAM_REGION
+    flagged['is_adjacent_region'] = flagged['reg_name'].isin(adjacent_regions)
+    return flagged
+
+
+def build_map(annotations, ward_layer, bounds, zoom):
+    """The app's map: base map, the wards in the viewport and the annotation layer."""
+    import folium
+
+    from utils.annotation_layer import AnnotationLayer
+    from utils.annotation_store import AnnotationStore
+
+    store = AnnotationStore()
+    store.extend(annotations)
+    layer = AnnotationLayer()
+    layer.sync(store)
+    m = folium.Map(location=DEFAULT_MAP_CENTER, zoom_start=DEFAULT_ZOOM)
+    boundaries = folium.FeatureGroup(name="Boundaries")
+    folium.GeoJson(ward_layer.query(bounds, zoom)).add_to(boundaries)
+    boundaries.add_to(m)
+    layer.feature_group().add_to(m)
+    return m
+
+
+def bulk_label(polygon, snapper):
+    """A bulk label in the app: select the 100m cells, add them as one batch and update the map layer."""
+    from utils.annotation_layer import AnnotationLayer
+    from utils.annotation_store import AnnotationStore
+    from utils.bulk_labels import select_cells
+
+    store = AnnotationStore()
+    store.extend(select_cells(polygon, GRID_SIZE_SMALL, snapper, True))
+    AnnotationLayer().sync(store)
+    return len(store)
+
+
+def run_suite(args, steps):
+    import folium  # imported up front so that map_build does not time the import
+    import pyogrio
+
+    from spatial_prep import grid, tiles
+    from utils import ward_loader
+    from utils.geo_utils import build_adjacency, find_adjacent
+    from utils.map_layers import ViewportLayer
+
+    results = []
+    print(f"Generating {args.wards:,} wards, {args.districts} districts, {args.regions} regions (seed {args.seed})")
+    synthetic = make_wards(n_wards=args.wards, n_districts=args.districts, n_regions=args.regions,
+                           bounds=TANZANIA_BOUNDS, seed=args.seed)
+    synthetic = synthetic[['ward_name', 'dist_name', 'reg_name', 'geometry']].to_crs(WEB_CRS)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        shp_file = tmp / "wards.shp"
+        synthetic.to_file(shp_file)
+
+        # Later steps need the outputs of earlier ones, so those always run; only selected steps are recorded
+        def step(name, func, **params):
+            with contextlib.redirect_stdout(io.StringIO()):
+                if name not in steps:
+                    return func()
+                output = measure(results, name, func, **params)
+            print(_format(results[-1]))
+            return output
+
+        wards = step('shapefile_load', lambda: pyogrio.read_dataframe(shp_file, use_arrow=True))
+        if 'ward_cache_build' in steps:
+            step('ward_cache_build', lambda: ward_loader.build_cache(shp_file, tmp / "cache"))
+        regions = step('dissolve_regions', lambda: wards[['reg_name', 'geometry']].dissolve(by='reg_name').reset_index())
+        region_edges = step('adjacency_regions',
+                            lambda: build_adjacency(regions, id_column='reg_name', buffer_distance=10_000))
+        if 'adjacency_wards' in steps:
+            step('adjacency_wards', lambda: build_adjacency(wards, id_column='ward_name', buffer_distance=1000))
+        adjacent_regions = find_adjacent(region_edges, [PROGRAM_REGION], max_distance=1000)
+
+        locations = survey_locations(wards, seed=args.seed)
+        flagged = step('treatment_flagging', lambda: flag_treatment(wards, locations, adjacent_regions),
+                       locations=len(locations))
+
+        target = grid.prepare_wards(flagged[flagged['is_program_region'] | flagged['is_adjacent_region']])
+        program = target[target['is_program_region']].reset_index(drop=True)
+        for name, cell_size, layer in (('grid_500m', GRID_SIZE_LARGE, target), ('grid_100m', GRID_SIZE_SMALL, program)):
+            if name in steps:
+                step(name, lambda: tiles.build_tiled_grid(layer, cell_size, output_dir=tmp / name)['rows_written'],
+                     wards=len(layer))
+
+        if 'map_build' in steps or 'map_render' in steps:
+            ward_layer = ViewportLayer(flagged, ['ward_name', 'dist_name', 'reg_name', 'is_treatment'])
+            bounds = tuple(program.to_crs(WEB_CRS).total_bounds)
+            for n in args.annotations:
+                annotations = make_annotations(n, bounds=tuple(program.total_bounds), seed=args.seed)
+                m = step('map_build', lambda: build_map(annotations, ward_layer, bounds, zoom=9), annotations=n)
+                step('map_render', lambda: len(m.get_root().render()), annotations=n)
+
+        if 'bulk_label' in steps:
+            from utils.snapping import PointSnapper
+
+            snapper = PointSnapper(flagged)
+            cells = 100_000
+            polygon = program.union_all().centroid.buffer(np.sqrt(cells / np.pi) * GRID_SIZE_SMALL)
+            step('bulk_label', lambda: bulk_label(polygon, snapper), cells=cells)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, args, baseline_file, tolerance):
+    """Print the change per step against an earlier run; returns the steps that got slower."""
+    previous = json.loads(Path(baseline_file).read_text())
+    differing = [key for key in DATA_ARGS if previous['args'].get(key) != getattr(args, key)]
+    if differing:
+        print(f"\n⚠️ Not compared: {Path(baseline_file).name} used different data ({', '.join(differing)})")
+        return []
+    baseline = {(r['name'], json.dumps(r['params'], sort_keys=True)): r for r in previous['results']}
+    print(f"\nCompared with {Path(baseline_file).name} (commit {previous['commit']}):")
+    regressions = []
+    for result in results:
+        before = baseline.get((result['name'], json.dumps(result['params'], sort_keys=True)))
+        if before is None or not before['seconds']:
+            continue
+        ratio = result['seconds'] / before['seconds']
+        slower = ratio > 1 + tolerance
+        if slower:
+            regressions.append(result['name'])
+        print(f"  {'❌' if slower else '✅'} {result['name']:<20} {str(result['params'] or ''):<22} "
+              f"{before['seconds']:>8.3f}s -> {result['seconds']:>8.3f}s ({ratio:.2f}x), "
+              f"peak {before['peak_rss_mb']:.0f} -> {result['peak_rss_mb']:.0f} MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--steps', nargs='+', choices=STEPS, default=STEPS)
+    parser.add_argument('--wards', type=int, default=4000)
+    parser.add_argument('--districts', type=int, default=180)
+    parser.add_argument('--regions', type=int, default=26)
+    parser.add_argument('--annotations', type=int, nargs='+', default=[100, 1_000, 10_000, 100_000])
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', type=Path, help="JSON file, defaults to benchmarks/results/<commit>_<time>.json")
+    parser.add_argument('--compare', type=Path, help="Earlier results file to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed slowdown before a step is flagged")
+    args = parser.parse_args()
+
+    # Keep benchmark runs out of the step log of real runs (METRICS_LOG_FILE)
+    logging.getLogger('rubeho.metrics').disabled = True
+    commit = git_commit()
+    started = datetime.now()
+    results = run_suite(args, set(args.steps))
+
+    output = args.output or RESULTS_DIR / f"{commit or 'nogit'}_{started:%Y%m%d_%H%M%S}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps({
+        'commit': commit,
+        'started': started.isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'memory_gb': round(psutil.virtual_memory().total / 2**30, 1),
+        'args': {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()},
+        'results': results,
+    }, indent=2))
+    print(f"\n✅ Results written to {output}")
+
+    if args.compare and compare(results, args, args.compare, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
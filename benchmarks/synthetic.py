@@ -0,0 +1,82 @@
+"""Synthetic ward layers for offline benchmarks.
+
+Wards are Voronoi cells of random seed points in TARGET_CRS, with region and
+district names assigned from coarser Voronoi partitions so that the
+region > district > ward nesting of the real shapefile is preserved.
+"""
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import Transformer
+
+from config.settings import TARGET_CRS, WEB_CRS
+
+# Roughly the extent of Morogoro and its neighbours in UTM 36S
+DEFAULT_BOUNDS = (600_000, 9_000_000, 900_000, 9_300_000)
+# About the area of mainland Tanzania (~950,000 km²), kept within the UTM easting range of the grid ids
+TANZANIA_BOUNDS = (100_000, 8_750_000, 1_000_000, 9_850_000)
+
+
+def _voronoi(points, bounds):
+    extent = shapely.box(*bounds)
+    cells = shapely.get_parts(shapely.voronoi_polygons(shapely.multipoints(points), extend_to=extent))
+    return shapely.intersection(cells, extent)
+
+
+def _random_points(rng, n, bounds):
+    minx, miny, maxx, maxy = bounds
+    return shapely.points(rng.uniform(minx, maxx, n), rng.uniform(miny, maxy, n))
+
+
+def make_wards(n_wards=400, n_districts=40, n_regions=4, bounds=DEFAULT_BOUNDS, treatment_share=0.05, seed=42):
+    """
+    Build a flagged ward layer shaped like relevant_wards_with_flags.geojson.
+
+    Args:
+        n_wards: Number of ward polygons
+        n_districts: Number of districts the wards are grouped into
+        n_regions: Number of regions; the first one is the program region
+        bounds: (minx, miny, maxx, maxy) in TARGET_CRS
+        treatment_share: Fraction of program-region wards flagged as treatment
+        seed: Random seed, fixed so runs are comparable across commits
+    """
+    rng = np.random.default_rng(seed)
+    wards = _voronoi(_random_points(rng, n_wards, bounds), bounds)
+    districts = _voronoi(_random_points(rng, n_districts, bounds), bounds)
+    regions = _voronoi(_random_points(rng, n_regions, bounds), bounds)
+
+    centroids = shapely.centroid(wards)
+    district_idx = shapely.STRtree(districts).query_nearest(centroids, all_matches=False)[1]
+    region_idx = shapely.STRtree(regions).query_nearest(shapely.centroid(districts), all_matches=False)[1]
+
+    gdf = gpd.GeoDataFrame(
+        {
+            'ward_name': [f"Ward {i:04d}" for i in range(len(wards))],
+            'dist_name': [f"District {i:03d}" for i in district_idx],
+            'reg_name': [f"Region {i:02d}" for i in region_idx[district_idx]],
+        },
+        geometry=wards,
+        crs=TARGET_CRS,
+    )
+    gdf['is_program_region'] = gdf['reg_name'] == 'Region 00'
+    gdf['is_adjacent_region'] = ~gdf['is_program_region']
+    gdf['is_treatment'] = gdf['is_program_region'] & (rng.random(len(gdf)) < treatment_share)
+    return gdf
+
+
+def make_annotations(n, bounds=DEFAULT_BOUNDS, treatment_share=0.5, seed=42):
+    """
+    Random annotations (latitude, longitude, is_treatment) within bounds given in TARGET_CRS.
+
+    Args:
+        n: Number of annotations
+        bounds: (minx, miny, maxx, maxy) in TARGET_CRS, e.g. the program region
+        treatment_share: Fraction of annotations labelled treatment
+        seed: Random seed, fixed so runs are comparable across commits
+    """
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bounds
+    x, y = rng.uniform(minx, maxx, n), rng.uniform(miny, maxy, n)
+    longitude, latitude = Transformer.from_crs(TARGET_CRS, WEB_CRS, always_xy=True).transform(x, y)
+    return pd.DataFrame({'latitude': latitude, 'longitude': longitude, 'is_treatment': rng.random(n) < treatment_share})
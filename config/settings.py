@@ -1,4 +1,19 @@
 """Configuration settings for the Tanzania Rubeho mapper."""
+import os
+from pathlib import Path
+
+# Project paths
+PROJECT_ROOT = Path(__file__).parent.parent
+DATA_DIR = PROJECT_ROOT / "data"
+RAW_DATA_DIR = DATA_DIR / "raw"
+PROCESSED_DATA_DIR = DATA_DIR / "processed"
+CACHE_DIR = PROCESSED_DATA_DIR / "cache"
+SESSION_DIR = PROCESSED_DATA_DIR / "sessions"  # per-session annotation journals
+SHARED_STORE_FILE = PROCESSED_DATA_DIR / "annotations_shared.sqlite"  # annotations of all annotators
+WARDS_FILE = PROCESSED_DATA_DIR / "relevant_wards_with_flags.geojson"  # relevant wards with treatment flags
+APP_STATE_FILE = PROCESSED_DATA_DIR / "app_state.json"  # map bounds, centre and layer index read at app start-up
+WARD_SHAPEFILE_DIR = RAW_DATA_DIR / "ALL WARDS TANZANIA"
+SURVEY_FILE = RAW_DATA_DIR / "Rubeho Villages for HH survey - v2.xlsx"
 
 # Tanzania districts you want to work with (update after exploration)
 TARGET_DISTRICTS = [
@@ -18,6 +33,9 @@ TARGET_REGIONS = [
 # Grid settings
 GRID_SIZE_LARGE = 500  # meters
 GRID_SIZE_SMALL = 100  # meters
+GRID_MAX_CELLS_PER_BATCH = 250_000  # candidate cells held in memory at once during grid generation
+GRID_TILE_SIZE = 50_000  # meters, tile edge for the streamed grid datasets (multiple of both grid sizes)
+GRID_WORKERS = 1  # worker processes for grid generation (1 = run in the main process)
 # BUFFER_DISTANCE = 2000  # Remove buffer - use full regions instead
 
 # Coordinate system settings
@@ -32,4 +50,85 @@ END_DATE = '2024-12-31'
 
 # App settings
 DEFAULT_MAP_CENTER = [-6.8, 37.5]  # Approximate center of Tanzania
-DEFAULT_ZOOM = 7
\ No newline at end of file
+DEFAULT_ZOOM = 7
+MAP_WIDTH = 700  # pixels; with MAP_HEIGHT also used to fit the initial view to the study area (utils/app_state.py)
+MAP_HEIGHT = 500
+WARD_LAYER_MIN_ZOOM = 7   # ward boundaries are only drawn from this zoom level in
+GRID_LAYER_MIN_ZOOM = 12  # 500m grid cells are only drawn from this zoom level in
+GRID_SMALL_LAYER_MIN_ZOOM = 14  # 100m grid cells (vector tiles only) are drawn from this zoom level in
+VIEWPORT_CACHE_MAX_MB = 64  # memory for the (tile, zoom) query results memoized per map layer (LRU)
+ANNOTATION_CHUNK_SIZE = 1000  # annotations per pre-serialized GeoJSON chunk on the map
+ANNOTATION_IO_CHUNK_SIZE = 50_000  # rows per chunk when importing or exporting annotation files
+SHARED_STORE_BUSY_TIMEOUT = 30  # seconds a write to the shared store waits for other writers
+SHARED_MAX_VISIBLE = 5000  # other annotators' annotations drawn per viewport (the most recent)
+BULK_MAX_CELLS = 200_000  # grid cells one drawn selection may label at once
+BULK_WARD_MIN_SHARE = 0.5  # share of a ward's area a drawn selection must cover to label the ward
+
+# Name matching settings
+NAME_MATCH_THRESHOLD = 0.5  # minimum trigram similarity for fuzzy ward/district name matches
+
+# Vector tile server settings
+VECTOR_TILE_MIN_ZOOM = 6
+VECTOR_TILE_MAX_ZOOM = 14
+TILE_SERVER_HOST = "localhost"
+TILE_SERVER_PORT = 8765
+TILE_SERVER_URL = f"http://{TILE_SERVER_HOST}:{TILE_SERVER_PORT}"
+TILE_CACHE_MAX_AGE = 7 * 24 * 3600  # seconds browsers may reuse a tile without asking the tile server again
+
+# Offline basemap settings
+BASEMAP_DIR = PROCESSED_DATA_DIR / "basemaps"  # one <name>.mbtiles per basemap, served by the tile server
+BASEMAP_SOURCES = {  # xyzservices (contextily) provider name, or {z}/{x}/{y} URL template, per basemap
+    'osm': 'OpenStreetMap.Mapnik',
+    'sentinel2': 'https://tiles.maps.eox.at/wmts/1.0.0/s2cloudless-2020_3857/default/g/{z}/{y}/{x}.jpg',
+}
+BASEMAP_ATTRIBUTION = {  # for URL templates; providers bring their own
+    'sentinel2': 'Sentinel-2 cloudless - https://s2maps.eu by EOX IT Services GmbH '
+                 '(Contains modified Copernicus Sentinel data 2020)',
+}
+BASEMAP_BOUNDS = 'all_regions'  # key of spatial_bounds in region_coverage_plan.json to prefetch
+BASEMAP_MIN_ZOOM = 6
+BASEMAP_MAX_ZOOM = 12  # check the providers' tile usage policies before prefetching deeper zooms
+BASEMAP_WORKERS = 4  # concurrent tile downloads
+BASEMAP_MAX_ATTEMPTS = 4  # tries per tile before it is counted as failed
+
+# Imagery extraction settings
+GEE_PROJECT = None  # Google Cloud project for ee.Initialize (None = the default from `earthengine authenticate`)
+IMAGERY_BANDS = ['B2', 'B3', 'B4', 'B8', 'B11', 'B12', 'NDVI']  # Sentinel-2 bands (and indices) averaged per cell
+IMAGERY_MAX_CLOUD = 40  # percent; scenes above this cloud cover are left out of the composite
+IMAGERY_CELL_SIZE = GRID_SIZE_SMALL  # grid whose cells get imagery statistics
+IMAGERY_BATCH_SIZE = 500  # cells per FeatureCollection sent in one request
+IMAGERY_WORKERS = 8  # concurrent requests
+IMAGERY_MAX_ATTEMPTS = 5  # tries per batch before the run fails (exponential backoff in between)
+IMAGERY_CLIENT_URL = None  # set to an HTTP endpoint (e.g. a local stub server) to use instead of Earth Engine
+
+# Zonal statistics settings (local rasters)
+SENTINEL2_RASTER = RAW_DATA_DIR / "sentinel2_mosaic.tif"  # multi-band GeoTIFF; band descriptions B2, B3, ... name the bands
+FOREST_LOSS_RASTER = RAW_DATA_DIR / "forest_loss.tif"  # e.g. Hansen lossyear; pixels > 0 count as loss
+ZONAL_WINDOW_SIZE = 2048  # pixels per read window edge, rounded to whole raster blocks
+ZONAL_WORKERS = 1  # worker processes over raster windows (1 = run in the main process)
+
+# Treatment-control matching settings
+MATCH_CELL_SIZE = GRID_SIZE_LARGE  # grid whose cells are matched
+MATCH_COVARIATES = ['NDVI_median', 'B4_median', 'B8_median', 'B11_median', 'forest_loss_fraction']
+MATCH_METHOD = 'propensity'  # 'propensity' (logit of a logistic model) or 'covariate' (Mahalanobis distance)
+MATCH_RATIO = 1  # controls per treatment cell
+MATCH_REPLACEMENT = False  # allow a control cell to be matched to several treatment cells
+MATCH_CALIPER = 0.2  # maximum match distance, in standard deviations of the matching score
+MATCH_BLOCK_BY = None  # e.g. 'dist_name' to only match within the same district
+MATCH_CONTROL_POOL = 'all'  # 'all' non-treatment cells or only 'adjacent' region cells
+MATCH_EXCLUSION_BUFFER = 2000  # meters; controls closer than this to a treatment ward are left out (spillover)
+
+# Validation settings
+VALIDATION_DUPLICATE_DISTANCE = 10  # meters; clicks closer together than this are reported as duplicates
+VALIDATION_OVERLAP_TOLERANCE = 100  # square meters; smaller ward overlaps are digitization noise
+VALIDATION_GAP_TOLERANCE = 0.01  # share of a ward's area the grid may leave uncovered
+
+# Instrumentation settings
+METRICS_PORT = None  # e.g. 9108 to serve Prometheus metrics at http://127.0.0.1:9108/metrics
+METRICS_LOG_FILE = PROCESSED_DATA_DIR / "logs" / "metrics.jsonl"  # one JSON line per measured step; None to disable
+
+# Start-up settings
+HEADLESS = os.environ.get('RUBEHO_HEADLESS', '0') not in ('', '0')  # skip the plotting cells of the notebooks/ scripts
+STARTUP_IMPORT_BUDGET_MS = 2500  # import time allowed for app.py's top-level imports (benchmarks/bench_startup.py)
+STARTUP_LAZY_MODULES = ['geopandas', 'shapely', 'pyproj', 'matplotlib', 'rasterio', 'scipy', 'pyogrio',
+                        'pyarrow.dataset', 'pyarrow.parquet']  # only imported on the code paths that need them
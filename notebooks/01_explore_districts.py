@@ -4,9 +4,7 @@
 
 # %%
 # Setup and imports
-import geopandas as gpd
 import pandas as pd
-import matplotlib.pyplot as plt
 import json
 from pathlib import Path
 import sys
@@ -15,6 +13,13 @@ project_root = Path(__file__).parent.parent
 sys.path.insert(0, str(project_root))
 
 from config.settings import *
+from utils.geo_utils import find_adjacent, load_or_build_adjacency
+from utils.instrumentation import track
+from utils.name_matching import match_names
+from utils.ward_loader import load_regions, load_wards
+
+# Headless runs (RUBEHO_HEADLESS=1 or --headless) skip the plotting cells and never import matplotlib
+HEADLESS = HEADLESS or '--headless' in sys.argv
 
 
 # %%
@@ -33,35 +38,31 @@ print(f"Processed data: {PROCESSED_DATA_DIR}")
 
 # %%
 #load the shapefile
-shapefile_dir = RAW_DATA_DIR / "ALL WARDS TANZANIA"
-shp_files = list(shapefile_dir.glob("*.shp"))
-if shp_files:
-    shp_file = shp_files[0]  # Take the first .shp file found
-print(shapefile_dir)
-
-# %%
-if shp_files:
-    print("Loading ward shapefile...")
-    try:
-        gdf_wards = gpd.read_file(shp_file)
-        
-        print(f"Shape: {gdf_wards.shape}")
-        print(f"CRS: {gdf_wards.crs}")
-        print(f"Columns: {list(gdf_wards.columns)}")
-        print("\nFirst few rows:")
-        print(gdf_wards.head())
-        
-        print(f"\nLoaded {len(gdf_wards)} wards successfully! ✅")
-        
-    except Exception as e:
-        print(f"❌ Error loading shapefile: {e}")
-        print("This might be due to encoding issues or corrupted files")
-else:
+# The first run converts it to GeoParquet under data/processed/cache (cold load);
+# later runs read the cache directly (warm load) until the shapefile changes.
+print(WARD_SHAPEFILE_DIR)
+print("Loading ward shapefile...")
+try:
+    gdf_wards = load_wards()
+
+    print(f"Shape: {gdf_wards.shape}")
+    print(f"CRS: {gdf_wards.crs}")
+    print(f"Columns: {list(gdf_wards.columns)}")
+    print("\nFirst few rows:")
+    print(gdf_wards.head())
+
+    print(f"\nLoaded {len(gdf_wards)} wards successfully! ✅")
+
+except FileNotFoundError:
     print("❌ Cannot load shapefile - no .shp file found")
+except Exception as e:
+    print(f"❌ Error loading shapefile: {e}")
+    print("This might be due to encoding issues or corrupted files")
 
 
 # %%
-gdf_wards.plot()
+if not HEADLESS:
+    gdf_wards.plot()
 # %%
 #load data with relevant wards from programme. 
 # this is an xls sheet with some ward and district names. 
@@ -124,48 +125,20 @@ print(f"Core program regions: {sorted(program_regions)}")
 all_regions = gdf_wards['reg_name'].unique()
 print(f"Total regions in Tanzania: {len(all_regions)}")
 
-# Create region polygons for adjacency analysis
-all_regions_dissolved = gdf_wards.dissolve(by='reg_name').reset_index()
+# Region polygons for adjacency analysis (dissolved once and cached by the loader)
+all_regions_dissolved = load_regions()
 
 # %%
-# Find regions that share boundaries with program regions
-def find_adjacent_regions(target_regions, all_regions_gdf, buffer_distance=1000):
-    """
-    Find regions adjacent to target regions.
-    
-    Args:
-        target_regions: List of region names to find neighbors for
-        all_regions_gdf: GeoDataFrame with all regions dissolved
-        buffer_distance: Small buffer in meters to account for digitization gaps
-    """
-    # Get target region polygons
-    target_gdf = all_regions_gdf[all_regions_gdf['reg_name'].isin(target_regions)].copy()
-    
-    # Convert to UTM for accurate distance calculations
-    target_utm = target_gdf.to_crs(TARGET_CRS)
-    all_regions_utm = all_regions_gdf.to_crs(TARGET_CRS)
-    
-    # Create small buffer around target regions to catch near-adjacent regions
-    target_buffered = target_utm.geometry.buffer(buffer_distance).unary_union
-    
-    adjacent_regions = set()
-    
-    # Check each region for adjacency
-    for idx, region_row in all_regions_utm.iterrows():
-        region_name = region_row['reg_name']
-        
-        # Skip if it's already a program region
-        if region_name in target_regions:
-            continue
-            
-        # Check if region intersects with buffered program regions
-        if region_row.geometry.intersects(target_buffered):
-            adjacent_regions.add(region_name)
-            
-    return list(adjacent_regions)
-
-# Find adjacent regions
-adjacent_regions = find_adjacent_regions(program_regions, all_regions_dissolved)
+# Build the region and ward neighbour graphs in one spatial-index pass each.
+# Results are cached under data/processed/cache and reused while boundaries are unchanged.
+# The region graph keeps pairs up to 10km apart so nearby (non-touching) regions can be reported.
+region_edges = load_or_build_adjacency(all_regions_dissolved, id_column='reg_name', buffer_distance=10_000)
+ward_edges = load_or_build_adjacency(gdf_wards, buffer_distance=1000)
+print(f"Region adjacency edges: {len(region_edges)}")
+print(f"Ward adjacency edges: {len(ward_edges)}")
+
+# Regions within 1km of a program region (small buffer for digitization gaps)
+adjacent_regions = find_adjacent(region_edges, program_regions, max_distance=1000)
 
 print(f"\nAdjacent regions found: {sorted(adjacent_regions)}")
 
@@ -175,33 +148,11 @@ print("📏 Analyzing regional adjacency relationships...")
 
 # Create adjacency matrix for better understanding
 program_regions_gdf = all_regions_dissolved[all_regions_dissolved['reg_name'].isin(program_regions)]
-adjacent_regions_gdf = all_regions_dissolved[all_regions_dissolved['reg_name'].isin(adjacent_regions)]
 
-# Convert to UTM for distance calculations
-program_utm = program_regions_gdf.to_crs(TARGET_CRS)
-adjacent_utm = adjacent_regions_gdf.to_crs(TARGET_CRS)
-
-adjacency_info = []
-for _, prog_region in program_utm.iterrows():
-    prog_name = prog_region['reg_name']
-    
-    for _, adj_region in adjacent_utm.iterrows():
-        adj_name = adj_region['reg_name']
-        
-        # Calculate minimum distance between regions
-        distance = prog_region.geometry.distance(adj_region.geometry)
-        
-        # Check if they actually touch (distance = 0)
-        touches = prog_region.geometry.touches(adj_region.geometry)
-        
-        adjacency_info.append({
-            'program_region': prog_name,
-            'adjacent_region': adj_name,
-            'distance_km': distance / 1000,
-            'directly_adjacent': touches
-        })
-
-adjacency_df = pd.DataFrame(adjacency_info)
+adjacency_df = region_edges[
+    region_edges['source'].isin(program_regions) & region_edges['target'].isin(adjacent_regions)
+].rename(columns={'source': 'program_region', 'target': 'adjacent_region', 'touches': 'directly_adjacent'})
+adjacency_df['distance_km'] = adjacency_df['distance_m'] / 1000
 
 print("Regional adjacency summary:")
 for prog_region in program_regions:
@@ -228,8 +179,9 @@ print(f"Total extended regions ({len(extended_regions)}): {sorted(extended_regio
 extended_regions_gdf = all_regions_dissolved[all_regions_dissolved['reg_name'].isin(extended_regions)]
 
 # Convert to UTM for area calculations
-extended_utm = extended_regions_gdf.to_crs(TARGET_CRS)
-program_only_utm = program_regions_gdf.to_crs(TARGET_CRS)
+with track('coverage.to_crs', rows=len(extended_regions_gdf) + len(program_regions_gdf)):
+    extended_utm = extended_regions_gdf.to_crs(TARGET_CRS)
+    program_only_utm = program_regions_gdf.to_crs(TARGET_CRS)
 
 total_area = extended_utm.geometry.area.sum() / (1000**2)  # Convert to km²
 program_area = program_only_utm.geometry.area.sum() / (1000**2)
@@ -241,34 +193,37 @@ print(f"  Control buffer ratio: {total_area/program_area:.1f}x")
 
 # %%
 # Visualize the extended coverage area
-print("📊 Visualizing extended coverage...")
+if not HEADLESS:
+    import matplotlib.pyplot as plt
 
-fig, ax = plt.subplots(1, 1, figsize=(15, 12))
+    print("📊 Visualizing extended coverage...")
 
-# Plot all Tanzania regions in light gray
-all_regions_dissolved.plot(ax=ax, facecolor='lightgray', edgecolor='white', alpha=0.3)
+    fig, ax = plt.subplots(1, 1, figsize=(15, 12))
 
-# Plot extended coverage regions
-extended_regions_gdf.plot(ax=ax, facecolor='lightblue', edgecolor='blue', alpha=0.4, linewidth=1)
+    # Plot all Tanzania regions in light gray
+    all_regions_dissolved.plot(ax=ax, facecolor='lightgray', edgecolor='white', alpha=0.3)
 
-# Plot program regions (core areas)
-program_regions_gdf.plot(ax=ax, facecolor='red', edgecolor='black', alpha=0.7, linewidth=2)
+    # Plot extended coverage regions
+    extended_regions_gdf.plot(ax=ax, facecolor='lightblue', edgecolor='blue', alpha=0.4, linewidth=1)
 
-# Add labels
-for idx, row in extended_regions_gdf.iterrows():
-    centroid = row.geometry.centroid
-    color = 'red' if row['reg_name'] in program_regions else 'blue'
-    weight = 'bold' if row['reg_name'] in program_regions else 'normal'
-    
-    ax.annotate(row['reg_name'], 
-               xy=(centroid.x, centroid.y),
-               ha='center', va='center', fontsize=10, fontweight=weight,
-               color='white',
-               bbox=dict(boxstyle="round,pad=0.3", facecolor=color, alpha=0.8))
+    # Plot program regions (core areas)
+    program_regions_gdf.plot(ax=ax, facecolor='red', edgecolor='black', alpha=0.7, linewidth=2)
 
-ax.set_title("Extended Grid Coverage: Program Regions (Red) + Adjacent Regions (Blue)", fontsize=16)
-plt.tight_layout()
-plt.show()
+    # Add labels
+    for idx, row in extended_regions_gdf.iterrows():
+        centroid = row.geometry.centroid
+        color = 'red' if row['reg_name'] in program_regions else 'blue'
+        weight = 'bold' if row['reg_name'] in program_regions else 'normal'
+
+        ax.annotate(row['reg_name'], 
+                   xy=(centroid.x, centroid.y),
+                   ha='center', va='center', fontsize=10, fontweight=weight,
+                   color='white',
+                   bbox=dict(boxstyle="round,pad=0.3", facecolor=color, alpha=0.8))
+
+    ax.set_title("Extended Grid Coverage: Program Regions (Red) + Adjacent Regions (Blue)", fontsize=16)
+    plt.tight_layout()
+    plt.show()
 
 # %%
 # Update your target regions for grid creation
@@ -278,8 +233,7 @@ print(f"🎯 Final recommendation for grid creation:")
 print(f"Include these {len(YOUR_FINAL_TARGET_REGIONS)} regions: {sorted(YOUR_FINAL_TARGET_REGIONS)}")
 
 # Calculate estimated grid size
-extended_wards = gdf_wards[gdf_wards['reg_name'].isin(YOUR_FINAL_TARGET_REGIONS)]
-extended_area_utm = extended_wards.dissolve(by='reg_name').to_crs(TARGET_CRS)
+extended_area_utm = all_regions_dissolved[all_regions_dissolved['reg_name'].isin(YOUR_FINAL_TARGET_REGIONS)].to_crs(TARGET_CRS)
 extended_bounds = extended_area_utm.total_bounds
 
 estimated_cells_500m = ((extended_bounds[2] - extended_bounds[0]) / 500) * ((extended_bounds[3] - extended_bounds[1]) / 500)
@@ -323,60 +277,36 @@ treatment_locations = df_program[
 
 print(f"I have {len(treatment_locations)} treatment ward-district combinations")
 print("\nTreatment locations:")
-for _, row in treatment_locations.iterrows():
-    print(f"  • {row['Ward']} in {row['District']}")
+print("\n".join(f"  • {ward} in {district}"
+                for ward, district in zip(treatment_locations['Ward'], treatment_locations['District'])))
 
 # %%
 #finding matches in the shapefile.
-programme_wards_gdf = gdf_wards[
-    (gdf_wards['reg_name'].isin(program_regions)) &
-    (gdf_wards['dist_name'].isin(treatment_locations['District'].unique()))
-].copy()
-
-# confining to programme regions only. 
-
-# Get ward names from programme regions only
-programme_wards_gdf = gdf_wards[
-    (gdf_wards['reg_name'].isin(program_regions)) &
-    (gdf_wards['dist_name'].isin(treatment_locations['District'].unique()))
-].copy()
-
-print(f"Filtered to programme regions AND treatment districts: {len(programme_wards_gdf)} wards")
-print(f"Treatment districts: {treatment_locations['District'].unique().tolist()}")
-
-
-# **ADAPTATION 3: Create ward-district pairs for precise matching**
-# Create ward-district combinations from shapefile
-shapefile_ward_district = set()
-for _, row in programme_wards_gdf.iterrows():
-    ward_district_key = f"{str(row['ward_name']).strip().upper()}||{str(row['dist_name']).strip().upper()}"
-    shapefile_ward_district.add(ward_district_key)
-
-# Create ward-district combinations from treatment data
-treatment_ward_district = set()
-for _, row in treatment_locations.iterrows():
-    ward_district_key = f"{str(row['Ward']).strip().upper()}||{str(row['District']).strip().upper()}"
-    treatment_ward_district.add(ward_district_key)
-
-
-# Find exact matches using ward-district pairs
-treatment_exact_matches_pairs = treatment_ward_district.intersection(shapefile_ward_district)
-treatment_missing_pairs = treatment_ward_district - shapefile_ward_district
-
-# Extract just the ward names from successful matches for later use
-treatment_exact_matches = set()
-for pair in treatment_exact_matches_pairs:
-    ward_name = pair.split('||')[0]
-    treatment_exact_matches.add(ward_name)
-
-if treatment_missing_pairs:
-    print("These ward-district combinations are not in the shapefile:")
-    for pair in treatment_missing_pairs:
-        ward, district = pair.split('||')
-        print(f"  • {ward} in {district}")
+# Ward/district names are normalized (case, spacing, diacritics, spelling variants)
+# and matched exactly first, then by trigram similarity within the same district.
+# Rows that do not match (e.g. "TFS" forest reserves) stay in the report as unmatched.
+programme_wards_gdf = gdf_wards[gdf_wards['reg_name'].isin(program_regions)]
+match_report = match_names(
+    treatment_locations, programme_wards_gdf,
+    left_on=('Ward', 'District'), right_on=('ward_name', 'dist_name'),
+)
+treatment_matches = match_report[match_report['accepted']]
+
+print("Match report:")
+best_matches = match_report[match_report['rank'] == 1].drop_duplicates(['ward', 'district'])  # one row per pair
+print(best_matches['match_type'].value_counts().to_string())
+
+fuzzy_matches = treatment_matches[treatment_matches['match_type'] == 'fuzzy']
+if len(fuzzy_matches):
+    print("\nFuzzy matches (please check):")
+    print(fuzzy_matches[['ward', 'district', 'matched_ward', 'matched_district', 'score']].to_string(index=False))
+
+treatment_missing = match_report[(match_report['rank'] == 1) & ~match_report['accepted']]
+if len(treatment_missing):
+    print("\nThese ward-district combinations are not in the shapefile (best candidates shown):")
+    print(treatment_missing[['ward', 'district', 'matched_ward', 'score']].to_string(index=False))
 else:
     print(f"✅ All {len(treatment_locations)} treatment locations matched!")
-    print(f"Matched ward-district pairs: {len(treatment_exact_matches_pairs)}")
 
 relevant_regions = list(program_regions) + adjacent_regions
 print(f"Relevant regions: {relevant_regions}")
@@ -385,48 +315,24 @@ print(f"Relevant regions: {relevant_regions}")
 gdf_relevant = gdf_wards[gdf_wards['reg_name'].isin(relevant_regions)].copy()
 print(f"Filtered shapefile from {len(gdf_wards)} to {len(gdf_relevant)} wards in relevant regions")
 
-# **ADAPTATION 5: Create precise treatment flagging using ward-district combinations**
-gdf_relevant['is_treatment'] = False
-
-# Create ward-district key for each row in relevant shapefile
-gdf_relevant['ward_district_key'] = (
-    gdf_relevant['ward_name'].astype(str).str.strip().str.upper() + '||' + 
-    gdf_relevant['dist_name'].astype(str).str.strip().str.upper()
-)
-
-# Flag treatment wards using exact ward-district matches
-gdf_relevant.loc[
-    gdf_relevant['ward_district_key'].isin(treatment_exact_matches_pairs),
-    'is_treatment'
-] = True
+# Flag treatment wards by the shapefile rows they matched
+gdf_relevant['is_treatment'] = gdf_relevant.index.isin(treatment_matches['right_index'])
 
 # Summary of treatment flagging
 treatment_count = gdf_relevant['is_treatment'].sum()
 print(f"\nTreatment ward flagging (using ward-district pairs):")
 print(f"  • Total wards in relevant regions: {len(gdf_relevant)}")
 print(f"  • Treatment wards flagged: {treatment_count}")
-print(f"  • Expected treatment wards: {len(treatment_exact_matches_pairs)}")
-print(f"  • Match success: {'✅' if treatment_count == len(treatment_exact_matches_pairs) else '❌'}")
+print(f"  • Expected treatment wards: {treatment_matches['right_index'].nunique()}")
+print(f"  • Match success: {'✅' if treatment_count == treatment_matches['right_index'].nunique() else '❌'}")
 
-# Show treatment wards by region
-treatment_summary = gdf_relevant[gdf_relevant['is_treatment'] == True].groupby('reg_name').size()
-print(f"\nTreatment wards by region:")
-for region, count in treatment_summary.items():
-    print(f"  • {region}: {count} treatment wards")
-
-# **ADAPTATION 6: Verification - no more duplicate issues**
+# Treatment wards by region
+treatment_wards_flagged = gdf_relevant[gdf_relevant['is_treatment']]
 print(f"\n📋 Treatment ward verification:")
-treatment_wards_flagged = gdf_relevant[gdf_relevant['is_treatment'] == True].copy()
-
-for region in sorted(treatment_wards_flagged['reg_name'].unique()):
-    region_wards = treatment_wards_flagged[treatment_wards_flagged['reg_name'] == region]
+for region, region_wards in treatment_wards_flagged.groupby('reg_name'):
     print(f"\n{region} ({len(region_wards)} wards):")
-    for _, row in region_wards.iterrows():
-        print(f"  • {row['ward_name']} in {row['dist_name']} district")
-
-# Clean up the temporary column
-gdf_relevant = gdf_relevant.drop('ward_district_key', axis=1)
-
+    print("\n".join(f"  • {ward} in {district} district"
+                    for ward, district in zip(region_wards['ward_name'], region_wards['dist_name'])))
 
 
 # %%
@@ -440,7 +346,8 @@ print("and I have",(sum(gdf_relevant['is_program_region'])+ sum(gdf_relevant['is
 # %%
 ##exporting relevant regions for grid generation
 output_file = PROCESSED_DATA_DIR / "relevant_wards_with_flags.geojson"
-gdf_relevant.to_file(output_file)
+with track('export.geojson', rows=len(gdf_relevant)):
+    gdf_relevant.to_file(output_file)
 
 if output_file.exists():
     file_size = output_file.stat().st_size / (1024*1024)  # Convert to MB
@@ -465,10 +372,12 @@ region_info = {
     },
     'treatment_wards': {
         'total_treatment_locations': len(treatment_locations),
-        'matched_treatment_wards': len(treatment_exact_matches),
-        'treatment_ward_list': list(treatment_exact_matches),
-        'missing_treatment_wards': list(treatment_missing_pairs) if treatment_missing_pairs else [],
-        'match_rate': len(treatment_exact_matches) / len(treatment_locations) if len(treatment_locations) > 0 else 0
+        'matched_treatment_wards': int(treatment_matches['right_index'].nunique()),
+        'treatment_ward_list': sorted(treatment_matches['matched_ward'].unique()),
+        'missing_treatment_wards': list(treatment_missing[['ward', 'district']].itertuples(index=False, name=None)),
+        # A ward with several shapefile rows matches more than once; count each ward-district pair once
+        'match_rate': (len(treatment_matches[['ward', 'district']].drop_duplicates()) / len(treatment_locations)
+                       if len(treatment_locations) > 0 else 0)
 
 
     },
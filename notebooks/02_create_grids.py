@@ -0,0 +1,59 @@
+# %%
+# # Grid Creation
+# Build the 500m and 100m analysis grids over the relevant wards produced by 01_explore_districts.py
+
+# %%
+# Setup and imports
+from pathlib import Path
+import sys
+# Add project root to Python path
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from config.settings import *
+from spatial_prep import grid, tiles
+
+# %%
+wards_file = PROCESSED_DATA_DIR / "relevant_wards_with_flags.geojson"
+if not wards_file.exists():
+    raise FileNotFoundError(f"❌ {wards_file.name} not found - run 01_explore_districts.py first")
+
+wards = grid.load_wards(wards_file)
+print(f"Loaded {len(wards)} wards in {TARGET_CRS}")
+print(f"Treatment wards: {wards['is_treatment'].sum()}")
+
+# %%
+# Estimate grid sizes before generating anything
+extended_bounds = wards.total_bounds
+for cell_size in [GRID_SIZE_LARGE, GRID_SIZE_SMALL]:
+    estimate = grid.estimate_cell_count(extended_bounds, cell_size)
+    print(f"  Estimated {cell_size}m cells (bounding box): ~{estimate:,.0f}")
+print(f"Candidate cells per batch: {GRID_MAX_CELLS_PER_BATCH:,}")
+print(f"Tile size: {GRID_TILE_SIZE / 1000:.0f} km")
+
+# %%
+# Build the grids tile by tile into partitioned GeoParquet datasets.
+# Re-running resumes: tiles that are already on disk are skipped. Tiles older
+# than the wards file were cut from the previous wards, so then the grid is
+# rebuilt from scratch instead.
+wards_mtime = wards_file.stat().st_mtime_ns
+for cell_size in [GRID_SIZE_LARGE, GRID_SIZE_SMALL]:
+    output_dir = tiles.grid_dataset_dir(cell_size)
+    stale = any(path.stat().st_mtime_ns < wards_mtime for path in output_dir.glob("tile=*"))
+    if stale:
+        print(f"\n♻️ {wards_file.name} changed since the {cell_size}m grid was built - rebuilding it")
+    print(f"\n🔲 Building {cell_size}m grid into {output_dir.name}/ ...")
+    summary = tiles.build_tiled_grid(wards, cell_size, output_dir=output_dir, overwrite=stale)
+
+    print(f"✅ {summary['rows_written']:,} cell pieces in {summary['seconds']:.1f}s")
+    print(f"   Tiles written: {summary['tiles_written']} / {summary['tiles_total']}")
+    if summary['tiles_skipped']:
+        print(f"   Tiles already on disk (skipped): {summary['tiles_skipped']}")
+
+# %%
+# Quick check on the 500m grid (small enough to read back in full)
+grid_500m = tiles.read_grid(tiles.grid_dataset_dir(GRID_SIZE_LARGE), columns=['cell_id', 'is_treatment', 'geometry'])
+print(f"500m grid: {grid_500m['cell_id'].nunique():,} cells")
+print(f"   Treatment cells: {grid_500m.loc[grid_500m['is_treatment'], 'cell_id'].nunique():,}")
+
+# %%
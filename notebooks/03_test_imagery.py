@@ -0,0 +1,50 @@
+# %%
+# # Imagery Extraction
+# Sentinel-2 band statistics per grid cell from Earth Engine, using the grids built by 02_create_grids.py
+
+# %%
+# Setup and imports
+from pathlib import Path
+import sys
+# Add project root to Python path
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+from config.settings import *
+from spatial_prep import imagery, tiles
+
+# %%
+grid_dir = tiles.grid_dataset_dir(IMAGERY_CELL_SIZE)
+if not grid_dir.exists():
+    raise FileNotFoundError(f"❌ {grid_dir.name}/ not found - run 02_create_grids.py first")
+
+cell_ids = tiles.read_cell_ids(grid_dir)
+cache = imagery.ImageryCache(IMAGERY_CELL_SIZE)
+print(f"{IMAGERY_CELL_SIZE}m grid: {len(cell_ids):,} cells")
+print(f"Bands: {', '.join(IMAGERY_BANDS)} ({START_DATE} to {END_DATE}, {GEE_SCALE}m)")
+print(f"Already cached: {len(cache.cached_ids()):,} cells in {cache.path.name}/")
+
+# %%
+# Pick the service: Earth Engine by default, or an HTTP endpoint (e.g. a local stub server)
+client = imagery.HttpImageryClient(IMAGERY_CLIENT_URL) if IMAGERY_CLIENT_URL else imagery.EarthEngineClient()
+
+# %%
+# Try a small sample first to check credentials and band values
+sample_ids = cell_ids[:IMAGERY_BATCH_SIZE]
+summary = imagery.extract_imagery(sample_ids, IMAGERY_CELL_SIZE, client=client)
+print(f"✅ Sample: {summary['cells_fetched']:,} fetched, {summary['cells_cached']:,} cached, "
+      f"{summary['retries']} retries in {summary['seconds']:.1f}s")
+print(imagery.load_imagery(sample_ids, IMAGERY_CELL_SIZE).describe())
+
+# %%
+# Full grid: batches of IMAGERY_BATCH_SIZE cells, IMAGERY_WORKERS requests in flight.
+# Re-running only fetches the cells that are not cached yet.
+print(f"\n🛰️ Fetching {len(cell_ids):,} cells in batches of {IMAGERY_BATCH_SIZE} ({IMAGERY_WORKERS} workers)...")
+summary = imagery.extract_imagery(cell_ids, IMAGERY_CELL_SIZE, client=client)
+print(f"✅ {summary['cells_fetched']:,} cells fetched in {summary['batches']} batches, "
+      f"{summary['cells_cached']:,} from cache ({summary['seconds']:.1f}s, {summary['retries']} retries)")
+
+stats = imagery.load_imagery(cell_ids, IMAGERY_CELL_SIZE)
+print(f"   Cells without valid pixels: {stats[IMAGERY_BANDS].isna().all(axis=1).sum():,}")
+
+# %%
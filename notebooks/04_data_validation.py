@@ -0,0 +1,45 @@
+# %%
+# # Data Validation
+# Checks on the ward layer, the grids and the annotation sessions before they are used for matching or analysis
+
+# %%
+# Setup and imports
+from pathlib import Path
+import sys
+# Add project root to Python path
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+
+import geopandas as gpd
+
+from config.settings import *
+from spatial_prep import tiles, validation
+from utils.annotation_store import load_sessions
+
+# %%
+wards_file = PROCESSED_DATA_DIR / "relevant_wards_with_flags.geojson"
+if not wards_file.exists():
+    raise FileNotFoundError(f"❌ {wards_file.name} not found - run 01_explore_districts.py first")
+
+# The raw layer: grid.load_wards would already repair invalid geometries
+wards = gpd.read_file(wards_file)
+grid_dirs = [tiles.grid_dataset_dir(size) for size in [GRID_SIZE_LARGE, GRID_SIZE_SMALL]]
+annotations = load_sessions()
+print(f"Loaded {len(wards)} wards and {len(annotations):,} annotations "
+      f"from {annotations['session'].nunique()} sessions")
+
+# %%
+# Run all checks; every check reports its count and timing
+report = validation.run_validation(wards, grid_dirs, annotations)
+validation.print_report(report)
+
+# %%
+# Look at the examples of the checks that found something
+for check in report['checks']:
+    if check['status'] != 'pass':
+        print(f"\n{check['name']} ({check['count']:,}):")
+        print(check['details'])
+
+# %%
+report_file = validation.write_report(report, PROCESSED_DATA_DIR / "validation_report.json")
+print(f"✅ Saved {report_file.name}")
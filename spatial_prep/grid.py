@@ -0,0 +1,378 @@
+"""Vectorized grid generation over ward polygons.
+
+Cells are aligned to multiples of the cell size in TARGET_CRS, so every 100 m
+cell nests exactly inside one 500 m cell. Candidate cells are created and
+clipped in batches of at most ``max_cells`` with shapely 2 array operations;
+no Python loop ever runs per cell.
+
+Cell ids encode (col, row) arithmetically, so the cell of a point, a cell's
+parent and children at another size, its neighbours and its square are all
+integer math on id arrays, without geometry lookups. Grid datasets store full
+cells by id only (see drop_cell_geometries) and rebuild their squares on read.
+
+geopandas is only imported by the functions that build GeoDataFrames, so the
+cell id arithmetic can be used (e.g. by the app) without loading it.
+"""
+import numpy as np
+import pandas as pd
+import shapely
+
+from config.settings import GRID_MAX_CELLS_PER_BATCH, GRID_SIZE_LARGE, GRID_SIZE_SMALL, TARGET_CRS
+from utils.instrumentation import track
+
+WARD_ATTRIBUTES = ['ward_name', 'dist_name', 'reg_name']
+FLAG_COLUMNS = ['is_treatment', 'is_program_region', 'is_adjacent_region']
+
+# UTM eastings stay within [0, 1,000,000) m, which fixes the number of columns per row
+UTM_EASTING_SPAN = 1_000_000
+
+# Pieces smaller than this fraction of a cell are digitization slivers along ward boundaries
+MIN_AREA_FRAC = 1e-6
+
+
+def load_wards(path):
+    """
+    Load the flagged ward layer and prepare it for grid generation.
+
+    Args:
+        path: Path to relevant_wards_with_flags.geojson (or any file with the same columns)
+    """
+    import geopandas as gpd
+
+    return prepare_wards(gpd.read_file(path))
+
+
+def prepare_wards(wards_gdf):
+    """
+    Reproject wards to TARGET_CRS, repair invalid polygons and keep only the grid attributes.
+
+    Args:
+        wards_gdf: GeoDataFrame with ward/district/region names and treatment flags
+    """
+    with track('grid.to_crs', rows=len(wards_gdf)):
+        wards = wards_gdf.to_crs(TARGET_CRS)
+    for column in FLAG_COLUMNS:
+        if column not in wards.columns:
+            wards[column] = False
+    wards = wards[WARD_ATTRIBUTES + FLAG_COLUMNS + ['geometry']].reset_index(drop=True)
+    wards['geometry'] = shapely.make_valid(wards.geometry.values)
+    return wards
+
+
+def cell_index(x, y, cell_size):
+    """Return the (col, row) of the cell containing each coordinate in TARGET_CRS."""
+    cols = np.floor_divide(np.asarray(x, dtype=np.float64), cell_size).astype(np.int64)
+    rows = np.floor_divide(np.asarray(y, dtype=np.float64), cell_size).astype(np.int64)
+    return cols, rows
+
+
+def cell_ids(cols, rows, cell_size):
+    """Encode (col, row) pairs as int64 cell ids, unique per cell size."""
+    return np.asarray(rows, dtype=np.int64) * (UTM_EASTING_SPAN // cell_size) + np.asarray(cols, dtype=np.int64)
+
+
+def cell_coords(ids, cell_size):
+    """Decode int64 cell ids back to (col, row) pairs; the inverse of cell_ids."""
+    rows, cols = np.divmod(np.asarray(ids, dtype=np.int64), UTM_EASTING_SPAN // cell_size)
+    return cols, rows
+
+
+def cell_boxes(cols, rows, cell_size):
+    """Build square cell polygons for arrays of (col, row)."""
+    x0 = np.asarray(cols, dtype=np.float64) * cell_size
+    y0 = np.asarray(rows, dtype=np.float64) * cell_size
+    return shapely.box(x0, y0, x0 + cell_size, y0 + cell_size)
+
+
+def point_cell_ids(x, y, cell_size):
+    """Id of the cell containing each TARGET_CRS point."""
+    return cell_ids(*cell_index(x, y, cell_size), cell_size)
+
+
+def cell_polygons(ids, cell_size):
+    """Square polygons of cell ids, reconstructed from the ids alone."""
+    return cell_boxes(*cell_coords(ids, cell_size), cell_size)
+
+
+def cell_runs(ids, cell_size):
+    """
+    Rectangles covering a set of cells, one per run of adjacent cells in a row.
+
+    A compact selection of n cells becomes about sqrt(n) rectangles, which is
+    far cheaper to draw than n squares.
+
+    Returns:
+        Array of rectangle polygons in TARGET_CRS
+    """
+    ids = np.unique(np.asarray(ids, dtype=np.int64))  # sorted by row, then column
+    if not len(ids):
+        return np.empty(0, dtype=object)
+    cols, rows = cell_coords(ids, cell_size)
+    starts = np.flatnonzero(np.r_[True, (np.diff(ids) != 1) | (rows[1:] != rows[:-1])])
+    ends = np.r_[starts[1:], len(ids)] - 1
+    return shapely.box(cols[starts] * cell_size, rows[starts] * cell_size,
+                       (cols[ends] + 1) * cell_size, (rows[starts] + 1) * cell_size)
+
+
+def _nesting(cell_size, parent_size):
+    """Number of cells per parent cell edge."""
+    if parent_size % cell_size:
+        raise ValueError(f"{parent_size}m cells are not made up of whole {cell_size}m cells")
+    return parent_size // cell_size
+
+
+def parent_ids(ids, cell_size, parent_size=GRID_SIZE_LARGE):
+    """
+    Id of the parent cell at ``parent_size`` (a multiple of ``cell_size``) for each cell id.
+
+    Example: the 500m cell containing each 100m cell.
+    """
+    factor = _nesting(cell_size, parent_size)
+    cols, rows = cell_coords(ids, cell_size)
+    return cell_ids(cols // factor, rows // factor, parent_size)
+
+
+def child_ids(ids, cell_size, child_size=GRID_SIZE_SMALL):
+    """
+    Ids of the cells at ``child_size`` that make up each cell.
+
+    Returns:
+        (n, k * k) int64 array for k children per edge, row by row from the
+        south-west corner
+    """
+    factor = _nesting(child_size, cell_size)
+    cols, rows = cell_coords(np.atleast_1d(ids), cell_size)
+    d_cols, d_rows = np.meshgrid(np.arange(factor), np.arange(factor))
+    return cell_ids(cols[:, None] * factor + d_cols.ravel(), rows[:, None] * factor + d_rows.ravel(), child_size)
+
+
+def neighbour_offsets(radius=1, ring_only=False):
+    """
+    (d_col, d_row) offsets of the cells within ``radius`` cells (Chebyshev
+    distance), excluding the cell itself; only the outer ring with ``ring_only``.
+    """
+    d_cols, d_rows = np.meshgrid(np.arange(-radius, radius + 1), np.arange(-radius, radius + 1))
+    d_cols, d_rows = d_cols.ravel(), d_rows.ravel()
+    distance = np.maximum(np.abs(d_cols), np.abs(d_rows))
+    keep = distance == radius if ring_only else distance > 0
+    return d_cols[keep], d_rows[keep]
+
+
+def neighbour_ids(ids, cell_size, radius=1, ring_only=False):
+    """
+    Ids of the neighbouring cells of each cell id.
+
+    Args:
+        ids: Cell ids
+        cell_size: Cell edge length in meters
+        radius: Neighbourhood size in cells (1 gives the 8 surrounding cells)
+        ring_only: Only the cells at exactly ``radius``
+
+    Returns:
+        (n, m) int64 array, one row of neighbour ids per input id
+    """
+    d_cols, d_rows = neighbour_offsets(radius, ring_only)
+    cols, rows = cell_coords(np.atleast_1d(ids), cell_size)
+    return cell_ids(cols[:, None] + d_cols, rows[:, None] + d_rows, cell_size)
+
+
+def rollup(frame, cell_size, parent_size=GRID_SIZE_LARGE, how='sum'):
+    """
+    Aggregate per-cell values to parent cells, e.g. 100m counts to the 500m grid.
+
+    Args:
+        frame: DataFrame with a cell_id column and the values to aggregate
+        cell_size: Cell size of frame's cell ids
+        parent_size: Cell size to aggregate to
+        how: Aggregation passed to pandas (e.g. 'sum', 'mean', or a dict per column)
+
+    Returns:
+        DataFrame with the parent cell_id and the aggregated columns
+    """
+    parents = pd.Series(parent_ids(frame['cell_id'].to_numpy(), cell_size, parent_size), name='cell_id')
+    values = frame.drop(columns='cell_id').reset_index(drop=True)
+    return values.groupby(parents, sort=True).agg(how).reset_index()
+
+
+def drop_cell_geometries(pieces):
+    """
+    Store pieces by id: drop the geometry of pieces that cover their whole cell.
+
+    Only pieces cut by a ward boundary keep a geometry; restore_cell_geometries
+    rebuilds the others from their cell id.
+    """
+    pieces = pieces.copy()
+    pieces.loc[pieces['area_frac'] >= 1 - 1e-9, 'geometry'] = None
+    return pieces
+
+
+def fill_cell_geometries(geometries, ids, cell_size):
+    """
+    Fill missing geometries with the squares of their cells.
+
+    Args:
+        geometries: Geometry array with None for cells stored by id only
+        ids: Cell id of each geometry
+        cell_size: Cell edge length in meters, or one per geometry
+    """
+    geometries = np.array(geometries, dtype=object)
+    missing = shapely.is_missing(geometries)
+    if missing.any():
+        sizes = np.broadcast_to(np.asarray(cell_size), missing.shape)[missing]
+        geometries[missing] = cell_polygons(np.asarray(ids)[missing], sizes)
+    return geometries
+
+
+def restore_cell_geometries(pieces):
+    """Rebuild the geometries dropped by drop_cell_geometries (needs cell_id and cell_size)."""
+    pieces = pieces.copy()
+    pieces['geometry'] = fill_cell_geometries(pieces.geometry.values, pieces['cell_id'].to_numpy(),
+                                              pieces['cell_size'].to_numpy())
+    return pieces
+
+
+def snap_bounds(bounds, cell_size):
+    """
+    Expand bounds outward to whole cells.
+
+    Returns:
+        (col_min, row_min, col_max, row_max) with the max values exclusive
+    """
+    minx, miny, maxx, maxy = bounds
+    return (
+        int(np.floor(minx / cell_size)),
+        int(np.floor(miny / cell_size)),
+        int(np.ceil(maxx / cell_size)),
+        int(np.ceil(maxy / cell_size)),
+    )
+
+
+def estimate_cell_count(bounds, cell_size):
+    """Number of cells in the snapped bounding box (an upper bound on the clipped grid)."""
+    col_min, row_min, col_max, row_max = snap_bounds(bounds, cell_size)
+    return (col_max - col_min) * (row_max - row_min)
+
+
+def iter_blocks(bounds, cell_size, max_cells=GRID_MAX_CELLS_PER_BATCH):
+    """
+    Split snapped bounds into rectangular blocks of at most ``max_cells`` cells.
+
+    Yields:
+        (col_min, row_min, col_max, row_max) per block, max values exclusive
+    """
+    col_min, row_min, col_max, row_max = snap_bounds(bounds, cell_size)
+    block_cols = max(1, min(col_max - col_min, max_cells))
+    block_rows = max(1, max_cells // block_cols)
+    for r0 in range(row_min, row_max, block_rows):
+        for c0 in range(col_min, col_max, block_cols):
+            yield c0, r0, min(c0 + block_cols, col_max), min(r0 + block_rows, row_max)
+
+
+def empty_grid():
+    """An empty grid GeoDataFrame with the output schema."""
+    import geopandas as gpd
+
+    columns = {
+        'cell_id': pd.Series(dtype='int64'),
+        'col': pd.Series(dtype='int64'),
+        'row': pd.Series(dtype='int64'),
+        'cell_size': pd.Series(dtype='int64'),
+        'area_frac': pd.Series(dtype='float64'),
+    }
+    for column in WARD_ATTRIBUTES:
+        columns[column] = pd.Series(dtype='object')
+    for column in FLAG_COLUMNS:
+        columns[column] = pd.Series(dtype='bool')
+    return gpd.GeoDataFrame(columns, geometry=gpd.GeoSeries([], crs=TARGET_CRS), crs=TARGET_CRS)
+
+
+def clip_block(wards, tree, block, cell_size):
+    """
+    Generate the cells of one block and clip them to the wards they intersect.
+
+    A cell straddling a ward boundary yields one piece per ward, each tagged with
+    that ward's attributes and the fraction of the full cell it covers.
+
+    Args:
+        wards: Prepared ward GeoDataFrame (see prepare_wards)
+        tree: shapely STRtree built over the ward geometries, in row order
+        block: (col_min, row_min, col_max, row_max) as yielded by iter_blocks
+        cell_size: Cell edge length in meters
+    """
+    import geopandas as gpd
+
+    col_min, row_min, col_max, row_max = block
+    block_box = shapely.box(col_min * cell_size, row_min * cell_size, col_max * cell_size, row_max * cell_size)
+    if len(tree.query(block_box, predicate='intersects')) == 0:
+        return empty_grid()
+
+    cols, rows = np.meshgrid(np.arange(col_min, col_max), np.arange(row_min, row_max))
+    cols, rows = cols.ravel(), rows.ravel()
+    boxes = cell_boxes(cols, rows, cell_size)
+
+    cell_idx, ward_idx = tree.query(boxes, predicate='intersects')
+    if len(cell_idx) == 0:
+        return empty_grid()
+
+    cells = boxes[cell_idx]
+    ward_geoms = tree.geometries[ward_idx]
+    # Cells fully inside a ward keep their square; only boundary cells are intersected
+    inside = shapely.contains_properly(ward_geoms, cells)
+    pieces = cells.copy()
+    pieces[~inside] = shapely.intersection(cells[~inside], ward_geoms[~inside])
+
+    area_frac = shapely.area(pieces) / float(cell_size * cell_size)
+    keep = area_frac > MIN_AREA_FRAC
+    cell_idx, ward_idx = cell_idx[keep], ward_idx[keep]
+
+    attributes = wards.iloc[ward_idx][WARD_ATTRIBUTES + FLAG_COLUMNS].reset_index(drop=True)
+    grid = gpd.GeoDataFrame(
+        {
+            'cell_id': cell_ids(cols[cell_idx], rows[cell_idx], cell_size),
+            'col': cols[cell_idx],
+            'row': rows[cell_idx],
+            'cell_size': np.full(len(cell_idx), cell_size, dtype=np.int64),
+            'area_frac': area_frac[keep],
+            **{column: attributes[column].to_numpy() for column in attributes.columns},
+        },
+        geometry=pieces[keep],
+        crs=TARGET_CRS,
+    )
+    return grid.sort_values(['cell_id', 'ward_name', 'dist_name'], kind='stable').reset_index(drop=True)
+
+
+def iter_grid_batches(wards, cell_size, bounds=None, max_cells=GRID_MAX_CELLS_PER_BATCH):
+    """
+    Yield clipped grid batches covering the wards, one block at a time.
+
+    Peak memory is driven by ``max_cells`` rather than by the size of the study area.
+
+    Args:
+        wards: Prepared ward GeoDataFrame (see prepare_wards)
+        cell_size: Cell edge length in meters (GRID_SIZE_LARGE or GRID_SIZE_SMALL)
+        bounds: Optional (minx, miny, maxx, maxy) in TARGET_CRS, defaults to the ward extent
+        max_cells: Maximum number of candidate cells generated per batch
+    """
+    tree = shapely.STRtree(np.asarray(wards.geometry.values))
+    shapely.prepare(tree.geometries)
+    if bounds is None:
+        bounds = wards.total_bounds
+    for block in iter_blocks(bounds, cell_size, max_cells):
+        batch = clip_block(wards, tree, block, cell_size)
+        if len(batch):
+            yield batch
+
+
+def build_grid(wards, cell_size, bounds=None, max_cells=GRID_MAX_CELLS_PER_BATCH):
+    """
+    Build the full clipped grid in memory.
+
+    Suitable for the 500 m grid and for small areas at 100 m; larger runs should
+    consume iter_grid_batches directly and write each batch out.
+    """
+    import geopandas as gpd
+
+    batches = list(iter_grid_batches(wards, cell_size, bounds=bounds, max_cells=max_cells))
+    if not batches:
+        return empty_grid()
+    return gpd.GeoDataFrame(pd.concat(batches, ignore_index=True), crs=TARGET_CRS)
@@ -0,0 +1,343 @@
+"""Batched Sentinel-2 statistics per grid cell, with a local Parquet cache.
+
+Grid cells are rebuilt from their cell ids (see spatial_prep.grid), sent in
+batches of IMAGERY_BATCH_SIZE cells per request and reduced to the mean of each
+band in IMAGERY_BANDS over a cloud-masked median composite. Requests run in a
+bounded thread pool (IMAGERY_WORKERS in flight) and each batch is retried with
+exponential backoff on transient errors (quota, timeouts, dropped connections).
+
+Every finished batch is written straight away to a cache under
+``data/processed/cache/imagery/<key>/``, where the key covers the cell size,
+date range, band set, scale and cloud threshold. A rerun, or a run that was
+interrupted, only fetches the cells that are not in the cache yet.
+
+The service is behind a small client interface (``reduce_cells``), so Earth
+Engine can be swapped for any HTTP endpoint speaking the same JSON, e.g. a
+local stub server for offline runs.
+"""
+import hashlib
+import json
+from abc import ABC, abstractmethod
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyproj import Transformer
+from tenacity import Retrying, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+
+from config.settings import (CACHE_DIR, END_DATE, GEE_PROJECT, GEE_SCALE, IMAGERY_BANDS, IMAGERY_BATCH_SIZE,
+                             IMAGERY_MAX_ATTEMPTS, IMAGERY_MAX_CLOUD, IMAGERY_WORKERS, START_DATE, TARGET_CRS,
+                             WEB_CRS)
+from spatial_prep import grid
+
+IMAGERY_CACHE_DIR = CACHE_DIR / "imagery"
+TMP_PREFIX = '.'
+
+# Indices computed from the composite: name -> (band, band) for a normalized difference
+DERIVED_BANDS = {'NDVI': ('B8', 'B4'), 'NDWI': ('B3', 'B8')}
+
+
+# ---------------------------------------------------------------------------
+# Clients
+
+
+class ImageryClient(ABC):
+    """
+    Interface of an imagery service.
+
+    Subclasses implement ``reduce_cells`` (a client without it cannot be
+    created) and list the exceptions worth retrying in ``retry_on``; anything
+    else fails the run straight away.
+    """
+
+    retry_on = (OSError,)
+
+    @abstractmethod
+    def reduce_cells(self, cell_ids, geometries, bands, start_date, end_date, scale):
+        """
+        Mean of each band per cell.
+
+        Args:
+            cell_ids: List of int cell ids
+            geometries: GeoJSON polygon coordinates (WGS84) per cell
+            bands: Band names
+            start_date, end_date: Date range of the composite (YYYY-MM-DD)
+            scale: Pixel size in meters
+
+        Returns:
+            DataFrame with cell_id and one column per band; cells without
+            valid pixels may be missing or have NaN values
+        """
+
+
+class EarthEngineClient(ImageryClient):
+    """
+    Google Earth Engine client: reduceRegions over a Sentinel-2 SR composite.
+
+    Args:
+        project: Google Cloud project passed to ee.Initialize
+        max_cloud: Scenes with CLOUDY_PIXEL_PERCENTAGE above this are skipped
+    """
+
+    collection_id = 'COPERNICUS/S2_SR_HARMONIZED'
+    cloud_classes = (3, 8, 9, 10)  # scene classification: cloud shadow, medium/high cloud, cirrus
+
+    def __init__(self, project=GEE_PROJECT, max_cloud=IMAGERY_MAX_CLOUD):
+        import ee
+        ee.Initialize(project=project)
+        self.ee = ee
+        self.max_cloud = max_cloud
+        self.retry_on = (ee.EEException, OSError)
+
+    def composite(self, bands, start_date, end_date):
+        ee = self.ee
+
+        def mask_clouds(image):
+            scl = image.select('SCL')
+            clear = scl.neq(self.cloud_classes[0])
+            for value in self.cloud_classes[1:]:
+                clear = clear.And(scl.neq(value))
+            return image.updateMask(clear)
+
+        image = (
+            ee.ImageCollection(self.collection_id)
+            .filterDate(start_date, end_date)
+            .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', self.max_cloud))
+            .map(mask_clouds)
+            .median()
+        )
+        for name in bands:
+            if name in DERIVED_BANDS:
+                image = image.addBands(image.normalizedDifference(list(DERIVED_BANDS[name])).rename(name))
+        return image.select(list(bands))
+
+    def reduce_cells(self, cell_ids, geometries, bands, start_date, end_date, scale):
+        ee = self.ee
+        features = ee.FeatureCollection([
+            ee.Feature(ee.Geometry.Polygon(coords), {'cell_id': int(cell_id)})
+            for cell_id, coords in zip(cell_ids, geometries)
+        ])
+        result = self.composite(bands, start_date, end_date).reduceRegions(
+            collection=features, reducer=ee.Reducer.mean(), scale=scale,
+        ).getInfo()
+        return pd.DataFrame([feature['properties'] for feature in result['features']])
+
+
+class HttpImageryClient(ImageryClient):
+    """
+    Client for an HTTP endpoint that takes the ``reduce_cells`` arguments as a
+    JSON POST body and answers ``{"rows": [{"cell_id": ..., "<band>": ...}]}``.
+
+    Args:
+        url: Endpoint URL
+        timeout: Seconds per request
+    """
+
+    def __init__(self, url, timeout=60):
+        import requests
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.retry_on = (requests.RequestException,)
+
+    def reduce_cells(self, cell_ids, geometries, bands, start_date, end_date, scale):
+        response = self.session.post(self.url, timeout=self.timeout, json={
+            'cell_ids': [int(cell_id) for cell_id in cell_ids],
+            'geometries': geometries,
+            'bands': list(bands),
+            'start_date': start_date,
+            'end_date': end_date,
+            'scale': scale,
+        })
+        response.raise_for_status()
+        return pd.DataFrame(response.json()['rows'])
+
+
+# ---------------------------------------------------------------------------
+# Cache
+
+
+class ImageryCache:
+    """
+    Parquet cache of per-cell band statistics for one (cell size, date range,
+    band set, scale, cloud threshold) key.
+
+    Each batch is one Parquet file, written under a hidden name and renamed
+    into place, so a crashed run never leaves a partial file behind.
+    """
+
+    def __init__(self, cell_size, bands=IMAGERY_BANDS, start_date=START_DATE, end_date=END_DATE,
+                 scale=GEE_SCALE, max_cloud=IMAGERY_MAX_CLOUD, cache_dir=IMAGERY_CACHE_DIR):
+        self.bands = list(bands)
+        self.key = {
+            'cell_size': cell_size,
+            'start_date': start_date,
+            'end_date': end_date,
+            'bands': sorted(self.bands),
+            'scale': scale,
+            'max_cloud': max_cloud,
+        }
+        digest = hashlib.sha256(json.dumps(self.key, sort_keys=True).encode()).hexdigest()[:12]
+        self.path = Path(cache_dir) / f"{cell_size}m_{start_date}_{end_date}_{digest}"
+        self.schema = pa.schema([('cell_id', pa.int64())] + [(band, pa.float64()) for band in self.bands])
+
+    def _dataset(self):
+        files = sorted(str(path) for path in self.path.glob('part-*.parquet'))
+        if not files:
+            return None
+        return ds.dataset(files, schema=self.schema, format='parquet')
+
+    def cached_ids(self):
+        """Distinct cell ids already in the cache (a cell is in several files after an overlapping run)."""
+        dataset = self._dataset()
+        if dataset is None:
+            return np.array([], dtype=np.int64)
+        return np.unique(dataset.to_table(columns=['cell_id']).column('cell_id').to_numpy())
+
+    def write(self, frame):
+        """Add one batch of rows (cell_id plus the bands)."""
+        self.path.mkdir(parents=True, exist_ok=True)
+        key_file = self.path / 'key.json'
+        if not key_file.exists():
+            key_file.write_text(json.dumps(self.key, indent=2))
+        name = f"part-{uuid.uuid4().hex}.parquet"
+        table = pa.Table.from_pandas(frame[self.schema.names], schema=self.schema, preserve_index=False)
+        pq.write_table(table, self.path / (TMP_PREFIX + name))
+        (self.path / (TMP_PREFIX + name)).rename(self.path / name)
+
+    def read(self, cell_ids=None):
+        """Cached rows, optionally limited to some cell ids."""
+        dataset = self._dataset()
+        if dataset is None:
+            return self.schema.empty_table().to_pandas()
+        filter_ = ds.field('cell_id').isin(np.asarray(cell_ids, dtype=np.int64)) if cell_ids is not None else None
+        return dataset.to_table(filter=filter_).to_pandas().drop_duplicates('cell_id', keep='last')
+
+
+# ---------------------------------------------------------------------------
+# Extraction
+
+
+def cell_geometries(cell_ids, cell_size):
+    """
+    Square cell polygons as GeoJSON coordinates in WGS84.
+
+    Returns:
+        List with one ``[[[lng, lat], ...]]`` ring per cell
+    """
+    cols, rows = grid.cell_coords(cell_ids, cell_size)
+    x0 = cols.astype(np.float64) * cell_size
+    y0 = rows.astype(np.float64) * cell_size
+    # Closed ring: SW, SE, NE, NW, SW
+    xs = np.stack([x0, x0 + cell_size, x0 + cell_size, x0, x0], axis=1)
+    ys = np.stack([y0, y0, y0 + cell_size, y0 + cell_size, y0], axis=1)
+    lng, lat = Transformer.from_crs(TARGET_CRS, WEB_CRS, always_xy=True).transform(xs, ys)
+    rings = np.round(np.stack([lng, lat], axis=2), 7)
+    return [[ring] for ring in rings.tolist()]
+
+
+def _fetch_batch(client, retrying, cell_ids, cell_size, bands, start_date, end_date, scale):
+    """Fetch one batch, retrying transient errors; one row per requested cell."""
+    geometries = cell_geometries(cell_ids, cell_size)
+    frame = retrying.copy()(client.reduce_cells, cell_ids.tolist(), geometries, bands, start_date, end_date, scale)
+    frame = frame.reindex(columns=['cell_id'] + list(bands))
+    frame = frame.astype({'cell_id': np.int64}).drop_duplicates('cell_id').set_index('cell_id')
+    # Cells without pixels are kept as NaN so they are not fetched again
+    return frame.reindex(cell_ids).astype(np.float64).rename_axis('cell_id').reset_index()
+
+
+def extract_imagery(cell_ids, cell_size, client=None, bands=IMAGERY_BANDS, start_date=START_DATE,
+                    end_date=END_DATE, scale=GEE_SCALE, batch_size=IMAGERY_BATCH_SIZE, workers=IMAGERY_WORKERS,
+                    max_cloud=IMAGERY_MAX_CLOUD, max_attempts=IMAGERY_MAX_ATTEMPTS, cache_dir=IMAGERY_CACHE_DIR):
+    """
+    Fetch band statistics for the cells that are not cached yet.
+
+    Args:
+        cell_ids: Grid cell ids (see spatial_prep.grid.cell_ids)
+        cell_size: Cell edge length in meters
+        client: ImageryClient, defaults to an EarthEngineClient (created only
+            when something has to be fetched)
+        bands: Band names (Sentinel-2 bands or DERIVED_BANDS)
+        start_date, end_date: Date range of the composite
+        scale: Pixel size in meters
+        batch_size: Cells per request
+        workers: Requests in flight at once
+        max_cloud: Cloud threshold of the composite (part of the cache key)
+        max_attempts: Tries per batch before giving up
+        cache_dir: Root of the imagery cache
+
+    Returns:
+        dict with cells_total, cells_cached, cells_fetched, batches, retries and seconds
+    """
+    start = time.perf_counter()
+    cache = ImageryCache(cell_size, bands, start_date, end_date, scale, max_cloud, cache_dir)
+    cell_ids = np.unique(np.asarray(cell_ids, dtype=np.int64))
+    missing = np.setdiff1d(cell_ids, cache.cached_ids(), assume_unique=True)
+    batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+    summary = {'cells_total': len(cell_ids), 'cells_cached': len(cell_ids) - len(missing),
+               'cells_fetched': 0, 'batches': len(batches), 'retries': 0}
+
+    if batches:
+        client = client if client is not None else EarthEngineClient(max_cloud=max_cloud)
+        lock = threading.Lock()
+
+        def count_retry(retry_state):
+            with lock:
+                summary['retries'] += 1
+            print(f"  ⚠️ Retrying batch (attempt {retry_state.attempt_number}): {retry_state.outcome.exception()}")
+
+        retrying = Retrying(
+            stop=stop_after_attempt(max_attempts),
+            wait=wait_exponential_jitter(initial=1, max=60),
+            retry=retry_if_exception_type(client.retry_on),
+            before_sleep=count_retry,
+            reraise=True,
+        )
+
+        report_every = max(1, len(batches) // 20)
+        stored = []
+
+        def store(future):
+            frame = future.result()
+            cache.write(frame)
+            stored.append(len(frame))
+            summary['cells_fetched'] += len(frame)
+            if len(stored) % report_every == 0 or len(stored) == len(batches):
+                print(f"  [{summary['cells_fetched']:,}/{len(missing):,}] cells fetched")
+
+        # At most 2 * workers batches are queued, so memory stays flat for any grid size
+        pending = set()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            try:
+                for batch in batches:
+                    if len(pending) >= 2 * workers:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            store(future)
+                    pending.add(pool.submit(_fetch_batch, client, retrying, batch, cell_size, bands,
+                                            start_date, end_date, scale))
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        store(future)
+            except BaseException:
+                for future in pending:
+                    future.cancel()
+                raise
+
+    summary['seconds'] = time.perf_counter() - start
+    return summary
+
+
+def load_imagery(cell_ids, cell_size, bands=IMAGERY_BANDS, start_date=START_DATE, end_date=END_DATE,
+                 scale=GEE_SCALE, max_cloud=IMAGERY_MAX_CLOUD, cache_dir=IMAGERY_CACHE_DIR):
+    """Cached band statistics for the given cells, sorted by cell id."""
+    cache = ImageryCache(cell_size, bands, start_date, end_date, scale, max_cloud, cache_dir)
+    return cache.read(cell_ids).sort_values('cell_id').reset_index(drop=True)
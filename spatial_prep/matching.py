@@ -0,0 +1,322 @@
+"""Treatment-control matching over grid cells.
+
+Treatment cells are the cells of treatment wards (is_treatment). Candidate
+controls are the other cells, or only those in adjacent regions. Controls
+within MATCH_EXCLUSION_BUFFER of a treatment ward are dropped with one STRtree
+query, so spillover areas never serve as controls.
+
+Cells are matched to their nearest neighbours in a KD-tree (scipy cKDTree)
+built on the controls' feature matrix, using one of two methods:
+
+* 'propensity': the logit of a logistic regression of treatment on the
+  covariates, fitted with IRLS in NumPy;
+* 'covariate': the covariates whitened with the pooled covariance, so that
+  Euclidean distance in the tree is the Mahalanobis distance.
+
+Each treatment cell only queries its k nearest controls. No treated x control
+distance matrix is ever built, so millions of candidate controls fit in memory.
+Supported options: calipers, 1:k matching with or without replacement, and
+matching within blocks (e.g. districts).
+"""
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+import shapely
+from scipy.spatial import cKDTree
+
+from config.settings import (MATCH_BLOCK_BY, MATCH_CALIPER, MATCH_CONTROL_POOL, MATCH_EXCLUSION_BUFFER,
+                             MATCH_METHOD, MATCH_RATIO, MATCH_REPLACEMENT, TARGET_CRS)
+from spatial_prep import grid, tiles
+
+METHODS = ('propensity', 'covariate')
+CONTROL_POOLS = ('all', 'adjacent')
+
+
+def load_cells(cell_size, covariate_files=()):
+    """
+    One row per grid cell with its flags, centre and covariates.
+
+    A cell split by ward boundaries is a treatment cell if any of its pieces
+    is; its district and region are those of its largest piece.
+
+    Args:
+        cell_size: Cell edge length in meters
+        covariate_files: Parquet files with a cell_id column (e.g. the zonal
+            statistics), joined on cell_id
+
+    Returns:
+        DataFrame with cell_id, dist_name, reg_name, the flag columns, the
+        cell centre x / y in TARGET_CRS and the covariate columns
+    """
+    columns = ['cell_id', 'area_frac'] + grid.WARD_ATTRIBUTES[1:] + grid.FLAG_COLUMNS
+    dataset = ds.dataset(tiles.grid_dataset_dir(cell_size), format='parquet', partitioning='hive')
+    pieces = dataset.to_table(columns=columns).to_pandas()
+    pieces = pieces.sort_values(['cell_id', 'area_frac'], ascending=[True, False], kind='stable')
+    cells = pieces.groupby('cell_id', sort=True).agg(
+        dist_name=('dist_name', 'first'),
+        reg_name=('reg_name', 'first'),
+        **{flag: (flag, 'any') for flag in grid.FLAG_COLUMNS},
+    )
+    cols, rows = grid.cell_coords(cells.index.to_numpy(), cell_size)
+    cells['x'] = (cols + 0.5) * cell_size
+    cells['y'] = (rows + 0.5) * cell_size
+    for path in covariate_files:
+        cells = cells.join(pd.read_parquet(path).set_index('cell_id'))
+    return cells.reset_index()
+
+
+def near_treatment(x, y, wards, distance=MATCH_EXCLUSION_BUFFER):
+    """
+    Which points lie within ``distance`` meters of a treatment ward.
+
+    Args:
+        x, y: Point coordinates in TARGET_CRS
+        wards: Ward GeoDataFrame with is_treatment
+        distance: Buffer in meters
+    """
+    treated = wards.loc[wards['is_treatment']].to_crs(TARGET_CRS)
+    near = np.zeros(len(x), dtype=bool)
+    if len(treated) and len(x):
+        tree = shapely.STRtree(np.asarray(treated.geometry.values))
+        near[tree.query(shapely.points(x, y), predicate='dwithin', distance=distance)[0]] = True
+    return near
+
+
+def candidate_controls(cells, wards=None, pool=MATCH_CONTROL_POOL, exclusion_buffer=MATCH_EXCLUSION_BUFFER):
+    """
+    Mask of the cells that may serve as controls.
+
+    Args:
+        cells: Output of load_cells
+        wards: Ward GeoDataFrame with is_treatment, for the exclusion buffer
+            (no buffer when None)
+        pool: 'all' non-treatment cells or only 'adjacent' region cells
+        exclusion_buffer: Meters around treatment wards without controls
+    """
+    if pool not in CONTROL_POOLS:
+        raise ValueError(f"Unknown control pool {pool!r}, expected one of {list(CONTROL_POOLS)}")
+    mask = ~cells['is_treatment'].to_numpy()
+    if pool == 'adjacent':
+        mask &= cells['is_adjacent_region'].to_numpy()
+    if wards is not None and exclusion_buffer:
+        idx = np.flatnonzero(mask)
+        mask[idx[near_treatment(cells['x'].to_numpy()[idx], cells['y'].to_numpy()[idx], wards,
+                                exclusion_buffer)]] = False
+    return mask
+
+
+def fit_propensity(X, treated, max_iter=50, tol=1e-8, ridge=1e-6):
+    """
+    Logistic regression of treatment on X with iteratively reweighted least squares.
+
+    Args:
+        X: (n, p) covariate matrix (standardized for stable fits)
+        treated: Boolean array of length n
+        ridge: Small L2 penalty that keeps separable data from diverging
+
+    Returns:
+        Coefficients, intercept first
+    """
+    X1 = np.column_stack([np.ones(len(X)), X])
+    y = np.asarray(treated, dtype=np.float64)
+    beta = np.zeros(X1.shape[1])
+    penalty = ridge * np.eye(X1.shape[1])
+    for _ in range(max_iter):
+        p = 1 / (1 + np.exp(-np.clip(X1 @ beta, -30, 30)))
+        hessian = (X1 * (p * (1 - p))[:, None]).T @ X1 + penalty
+        step = np.linalg.solve(hessian, X1.T @ (y - p) - penalty @ beta)
+        beta += step
+        if np.abs(step).max() < tol:
+            break
+    return beta
+
+
+def matching_features(X, treated, method=MATCH_METHOD):
+    """
+    Feature matrix for the KD-tree, scaled so that one unit is one standard
+    deviation of the matching score (the unit of MATCH_CALIPER).
+
+    Args:
+        X: (n, p) covariates without missing values
+        treated: Boolean array of length n
+        method: 'propensity' or 'covariate'
+
+    Returns:
+        (n, 1) logit propensity scores or (n, p) whitened covariates
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown matching method {method!r}, expected one of {list(METHODS)}")
+    std = X.std(axis=0)
+    Z = (X - X.mean(axis=0)) / np.where(std > 0, std, 1)
+    if method == 'propensity':
+        logit = np.column_stack([np.ones(len(Z)), Z]) @ fit_propensity(Z, treated)
+        return (logit / (logit.std() or 1))[:, None]
+    # Mahalanobis: whiten with the Cholesky factor of the inverse covariance
+    inverse = np.linalg.pinv(np.atleast_2d(np.cov(Z, rowvar=False)))
+    return Z @ np.linalg.cholesky(inverse + 1e-12 * np.eye(len(inverse)))
+
+
+def _query(tree, features, k, caliper):
+    """k nearest controls per row as 2-D arrays (inf / tree.n where fewer are within the caliper)."""
+    upper = caliper if caliper is not None else np.inf
+    return tree.query(features, k=list(range(1, k + 1)), distance_upper_bound=upper)
+
+
+def _greedy_without_replacement(tree, features, caliper, used, k=8):
+    """
+    Match each row to its nearest unused control, closest pairs first.
+
+    Runs in rounds: every unmatched row claims its nearest free control among
+    its k nearest; when several rows claim the same control the closest one
+    gets it and the others try again. Rows whose k nearest are all taken look
+    further (k grows) until the caliper or the control pool is exhausted.
+
+    Returns:
+        (control index per row, -1 when unmatched; distance per row)
+    """
+    n_controls = tree.n
+    matched = np.full(len(features), -1, dtype=np.int64)
+    distance = np.full(len(features), np.inf)
+    todo = np.arange(len(features))
+    while len(todo) and n_controls:
+        k = min(k, n_controls)
+        d, idx = _query(tree, features[todo], k, caliper)
+        found = np.isfinite(d)
+        free = found & ~used[np.minimum(idx, n_controls - 1)]
+        has_free = free.any(axis=1)
+        widen = ~has_free & found[:, -1] & (k < n_controls)
+
+        rows = np.flatnonzero(has_free)
+        first = free[rows].argmax(axis=1)
+        candidate = idx[rows, first]
+        candidate_distance = d[rows, first]
+        order = np.argsort(candidate_distance, kind='stable')
+        _, first_claim = np.unique(candidate[order], return_index=True)
+        won = order[first_claim]
+
+        matched[todo[rows[won]]] = candidate[won]
+        distance[todo[rows[won]]] = candidate_distance[won]
+        used[candidate[won]] = True
+        lost = np.setdiff1d(np.arange(len(rows)), won, assume_unique=True)
+        todo = np.concatenate([todo[rows[lost]], todo[widen]])
+        if widen.any():
+            k *= 4
+    return matched, distance
+
+
+def _match_block(treated_features, control_features, ratio, replacement, caliper):
+    """Match within one block; returns (treated index, control index, distance) arrays of the pairs."""
+    if not len(treated_features) or not len(control_features):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, np.zeros(0)
+    tree = cKDTree(control_features)
+
+    if replacement:
+        k = min(ratio, tree.n)
+        d, idx = _query(tree, treated_features, k, caliper)
+        rows, rank = np.nonzero(np.isfinite(d))
+        return rows, idx[rows, rank], d[rows, rank]
+
+    used = np.zeros(tree.n, dtype=bool)
+    pairs = []
+    active = np.arange(len(treated_features))
+    for _ in range(ratio):
+        matched, distance = _greedy_without_replacement(tree, treated_features[active], caliper, used)
+        ok = matched >= 0
+        pairs.append((active[ok], matched[ok], distance[ok]))
+        active = active[ok]  # rows without a k-th match will not find a (k + 1)-th one
+    return tuple(np.concatenate(part) for part in zip(*pairs))
+
+
+def match_cells(cells, covariates, control_mask=None, method=MATCH_METHOD, ratio=MATCH_RATIO,
+                replacement=MATCH_REPLACEMENT, caliper=MATCH_CALIPER, block_by=MATCH_BLOCK_BY):
+    """
+    Match treatment cells to control cells.
+
+    Args:
+        cells: Output of load_cells
+        covariates: Covariate columns to match on
+        control_mask: Boolean mask of candidate controls, defaults to all
+            non-treatment cells (see candidate_controls)
+        method: 'propensity' or 'covariate'
+        ratio: Controls per treatment cell
+        replacement: Allow controls to be matched more than once
+        caliper: Maximum distance in standard deviations of the matching
+            score (None for no caliper)
+        block_by: Optional column (e.g. 'dist_name'); cells are only matched
+            within the same value
+
+    Returns:
+        DataFrame of pairs with treated_cell_id, control_cell_id, distance and
+        weight (1 / number of controls of the treatment cell); summary counts
+        are in ``.attrs``
+    """
+    treated = cells['is_treatment'].to_numpy()
+    control_mask = ~treated if control_mask is None else np.asarray(control_mask) & ~treated
+    usable = cells[covariates].notna().all(axis=1).to_numpy() & (treated | control_mask)
+
+    subset = cells.loc[usable]
+    features = matching_features(subset[covariates].to_numpy(dtype=np.float64), treated[usable], method)
+    is_treated = subset['is_treatment'].to_numpy()
+    blocks = subset[block_by].to_numpy() if block_by else np.zeros(len(subset), dtype=np.int8)
+    cell_ids = subset['cell_id'].to_numpy()
+
+    parts = []
+    for block in pd.unique(blocks[is_treated]):
+        in_block = blocks == block
+        t_idx = np.flatnonzero(in_block & is_treated)
+        c_idx = np.flatnonzero(in_block & ~is_treated)
+        rows, controls, distance = _match_block(features[t_idx], features[c_idx], ratio, replacement, caliper)
+        parts.append(pd.DataFrame({
+            'treated_cell_id': cell_ids[t_idx[rows]],
+            'control_cell_id': cell_ids[c_idx[controls]],
+            'distance': distance,
+        }))
+
+    pairs = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(
+        {'treated_cell_id': [], 'control_cell_id': [], 'distance': []}
+    ).astype({'treated_cell_id': np.int64, 'control_cell_id': np.int64})
+    pairs['weight'] = 1 / pairs.groupby('treated_cell_id')['control_cell_id'].transform('size')
+    pairs.attrs = {
+        'treated_cells': int(treated.sum()),
+        'treated_missing_covariates': int((treated & ~usable).sum()),
+        'candidate_controls': int((control_mask & usable).sum()),
+        'treated_matched': int(pairs['treated_cell_id'].nunique()),
+        'controls_used': int(pairs['control_cell_id'].nunique()),
+    }
+    return pairs
+
+
+def balance_table(cells, pairs, covariates, control_mask=None):
+    """
+    Covariate balance before and after matching.
+
+    Standardized mean differences use the pooled standard deviation of the
+    treatment cells and all candidate controls, before and after alike.
+
+    Returns:
+        DataFrame indexed by covariate with mean_treated, mean_control (all
+        candidates), mean_matched_treated, mean_matched_control (weighted by
+        the pair weights), smd_before and smd_after
+    """
+    treated = cells['is_treatment'].to_numpy()
+    control_mask = ~treated if control_mask is None else np.asarray(control_mask) & ~treated
+    indexed = cells.set_index('cell_id')[covariates]
+    treated_values = indexed[treated]
+    control_values = indexed[control_mask]
+    matched_treated = indexed.loc[pairs['treated_cell_id'].unique()]
+    matched_controls = indexed.loc[pairs['control_cell_id']]
+    weights = pairs['weight'].to_numpy()
+
+    pooled_sd = np.sqrt((treated_values.var() + control_values.var()) / 2)
+    matched_control_mean = (matched_controls.mul(weights, axis=0).sum() / weights.sum()
+                            if len(pairs) else pd.Series(np.nan, index=covariates))
+    table = pd.DataFrame({
+        'mean_treated': treated_values.mean(),
+        'mean_control': control_values.mean(),
+        'mean_matched_treated': matched_treated.mean(),
+        'mean_matched_control': matched_control_mean,
+    })
+    table['smd_before'] = (table['mean_treated'] - table['mean_control']) / pooled_sd
+    table['smd_after'] = (table['mean_matched_treated'] - table['mean_matched_control']) / pooled_sd
+    return table
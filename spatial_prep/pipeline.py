@@ -0,0 +1,496 @@
+"""Incremental runner for the data preparation stages.
+
+The notebooks/01..04 steps are modelled as stages with explicit inputs. Each
+stage gets a key: a hash of its code and of the modules it calls into, the
+settings it depends on, the content of its source files and the keys (and run
+ids) of the stages it reads from. A stage
+only runs when its key differs from the one recorded in the manifest after its
+last successful run, or when one of its outputs is missing; everything else is
+reused from data/processed.
+
+Usage:
+    python -m spatial_prep.pipeline                     # run stale stages
+    python -m spatial_prep.pipeline --status            # show what is stale
+    python -m spatial_prep.pipeline --until treatment_flags
+    python -m spatial_prep.pipeline --force grid_100m
+"""
+import argparse
+import hashlib
+import importlib.util
+import inspect
+import json
+import sys
+import time
+import uuid
+from pathlib import Path
+
+import pandas as pd
+
+import config.settings as settings
+from config.settings import PROCESSED_DATA_DIR, WARDS_FILE
+from utils.instrumentation import start_metrics_server, track
+
+MANIFEST_FILE = PROCESSED_DATA_DIR / "pipeline_manifest.json"
+PROGRAM_FILE = PROCESSED_DATA_DIR / "program_locations.json"
+COVERAGE_FILE = PROCESSED_DATA_DIR / "region_coverage_plan.json"
+MATCH_REPORT_FILE = PROCESSED_DATA_DIR / "treatment_match_report.csv"
+IMAGERY_FILE = PROCESSED_DATA_DIR / "imagery_stats.parquet"
+
+
+class Stage:
+    """
+    One step of the pipeline.
+
+    Args:
+        name: Stage name, used on the command line and in the manifest
+        run: Function producing the outputs; called with ``resume=True`` when
+            the previous attempt with the same key did not finish
+        outputs: Function returning the output paths (checked for existence)
+        upstream: Names of the stages whose outputs this stage reads
+        settings: Names of config.settings values the outputs depend on
+        sources: Function returning input files that are hashed by content
+        modules: Names of the modules holding the code the stage calls (e.g.
+            'spatial_prep.grid'); their source is part of the key, so editing
+            them makes the stage stale
+        always: Run on every execution (for cheap checks over changing inputs)
+    """
+
+    def __init__(self, name, run, outputs, upstream=(), settings=(), sources=None, modules=(), always=False):
+        self.name = name
+        self.run = run
+        self.outputs = outputs
+        self.upstream = tuple(upstream)
+        self.settings = tuple(settings)
+        self.sources = sources
+        self.modules = tuple(modules)
+        self.always = always
+
+
+STAGES = {}
+
+
+def register(stage):
+    """Add a stage; its upstream stages must already be registered."""
+    missing = [name for name in stage.upstream if name not in STAGES]
+    if missing:
+        raise ValueError(f"Stage {stage.name!r} depends on unknown stages {missing}")
+    STAGES[stage.name] = stage
+    return stage
+
+
+# ---------------------------------------------------------------------------
+# Manifest and keys
+
+
+def load_manifest(path=MANIFEST_FILE):
+    path = Path(path)
+    if not path.exists():
+        return {'stages': {}, 'files': {}}
+    return json.loads(path.read_text())
+
+
+def save_manifest(manifest, path=MANIFEST_FILE):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps(manifest, indent=2))
+    tmp.replace(path)
+
+
+def file_digest(path, manifest):
+    """SHA-256 of a file, memoized in the manifest on (mtime, size)."""
+    path = Path(path)
+    stat = path.stat()
+    stat_key = [stat.st_mtime_ns, stat.st_size]
+    memo = manifest['files'].get(str(path))
+    if memo and memo['stat_key'] == stat_key:
+        return memo['sha256']
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    manifest['files'][str(path)] = {'stat_key': stat_key, 'sha256': digest.hexdigest()}
+    return digest.hexdigest()
+
+
+def module_digest(name):
+    """SHA-256 of a module's source file, found without importing the module."""
+    spec = importlib.util.find_spec(name)
+    if spec is None or spec.origin is None:
+        raise ModuleNotFoundError(f"Stage module {name!r} not found")
+    return hashlib.sha256(Path(spec.origin).read_bytes()).hexdigest()
+
+
+def stage_key(stage, manifest):
+    """Hash of everything the stage's outputs depend on."""
+    upstream = {}
+    for name in stage.upstream:
+        record = manifest['stages'].get(name, {})
+        upstream[name] = [record.get('key'), record.get('run_id')]
+    sources = stage.sources() if stage.sources is not None else []
+    payload = {
+        'code': hashlib.sha256(inspect.getsource(stage.run).encode()).hexdigest(),
+        'modules': {name: module_digest(name) for name in stage.modules},
+        'settings': {name: repr(getattr(settings, name)) for name in stage.settings},
+        'sources': {str(path): file_digest(path, manifest) for path in sources},
+        'upstream': upstream,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def stale_reason(stage, manifest, rerun):
+    """Why a stage has to run, or None when its outputs can be reused."""
+    if stage.always:
+        return "runs on every execution"
+    upstream_rerun = [name for name in stage.upstream if name in rerun]
+    if upstream_rerun:
+        return f"upstream {', '.join(upstream_rerun)} changed"
+    record = manifest['stages'].get(stage.name)
+    if record is None or 'run_id' not in record:
+        return "never completed"
+    if record['key'] != stage_key(stage, manifest):
+        return "inputs, settings or code changed"
+    missing = [Path(path).name for path in stage.outputs() if not Path(path).exists()]
+    if missing:
+        return f"missing {', '.join(missing)}"
+    return None
+
+
+def select_stages(until=None, only=None):
+    """Stage names in run order, limited to ``until`` (and its upstream) or to ``only``."""
+    names = list(STAGES)
+    if only:
+        return [name for name in names if name in only]
+    if until is None:
+        return names
+    needed, todo = set(), [until]
+    while todo:
+        name = todo.pop()
+        if name not in needed:
+            needed.add(name)
+            todo.extend(STAGES[name].upstream)
+    return [name for name in names if name in needed]
+
+
+def run_pipeline(until=None, only=None, force=(), dry_run=False, manifest_path=MANIFEST_FILE):
+    """
+    Run the stale stages in order.
+
+    Args:
+        until: Stop after this stage (running only what it depends on)
+        only: Restrict to these stages (their upstream is not checked)
+        force: Stage names to rerun even when they are up to date
+        dry_run: Only report what would run
+
+    Returns:
+        List of (stage name, status, seconds), where status is 'reused' or the
+        reason the stage ran
+    """
+    manifest = load_manifest(manifest_path)
+    rerun, results = set(), []
+    for name in select_stages(until, only):
+        stage = STAGES[name]
+        reason = "forced" if name in force else stale_reason(stage, manifest, rerun)
+        if reason is None:
+            results.append((name, 'reused', 0.0))
+            print(f"  ✅ {name}: up to date")
+            continue
+
+        rerun.add(name)
+        if dry_run:
+            results.append((name, reason, 0.0))
+            print(f"  🔄 {name}: stale ({reason})")
+            continue
+
+        key = stage_key(stage, manifest)
+        record = manifest['stages'].get(name, {})
+        # A previous attempt with the same key was interrupted: let the stage resume
+        resume = record.get('started_key') == key and name not in force
+        manifest['stages'][name] = {**record, 'started_key': key}
+        save_manifest(manifest, manifest_path)
+
+        print(f"  🔄 {name}: running ({reason})")
+        start = time.perf_counter()
+        with track(f'pipeline.{name}', reason=reason, resume=resume):
+            stage.run(resume=resume)
+        seconds = time.perf_counter() - start
+        manifest['stages'][name] = {
+            'key': key,
+            'run_id': uuid.uuid4().hex,
+            'completed': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'seconds': round(seconds, 3),
+        }
+        save_manifest(manifest, manifest_path)
+        results.append((name, reason, seconds))
+        print(f"     done in {seconds:.1f}s")
+    return results
+
+
+# ---------------------------------------------------------------------------
+# Stages
+
+
+def _ward_sources():
+    from utils.ward_loader import find_ward_shapefile, source_files
+    return source_files(find_ward_shapefile())
+
+
+def run_wards(resume=False):
+    from utils.ward_loader import ensure_cache
+    ensure_cache()
+
+
+def wards_outputs():
+    from utils.ward_loader import LAYERS, layer_path
+    return [layer_path(layer) for layer in LAYERS]
+
+
+def run_program_regions(resume=False):
+    """Program districts, regions and treatment locations from the survey sheet."""
+    from utils.ward_loader import load_wards
+
+    df_program = pd.read_excel(settings.SURVEY_FILE, sheet_name="Villages")
+    wards = load_wards(columns=['dist_name', 'reg_name'])
+    district_region = wards.groupby('dist_name')['reg_name'].first()
+
+    districts = sorted(df_program['District'].dropna().unique())
+    program_regions = sorted(set(district_region.reindex(districts).dropna()))
+    treatment_locations = df_program[
+        (df_program['ARR'] == 1) | (df_program['REDD'] == 1)
+    ][['Ward', 'District']].drop_duplicates()
+
+    PROGRAM_FILE.write_text(json.dumps({
+        'program_districts': districts,
+        'unknown_districts': [d for d in districts if d not in district_region.index],
+        'program_regions': program_regions,
+        'treatment_locations': treatment_locations.to_dict('records'),
+    }, indent=2, default=str))
+
+
+def run_coverage(resume=False):
+    """Regions adjacent to the program regions, plus TARGET_REGIONS."""
+    from config.settings import TARGET_CRS, TARGET_REGIONS, WEB_CRS
+    from utils.geo_utils import find_adjacent, load_or_build_adjacency
+    from utils.ward_loader import load_regions
+
+    program_regions = json.loads(PROGRAM_FILE.read_text())['program_regions']
+    regions = load_regions()
+    region_edges = load_or_build_adjacency(regions, id_column='reg_name', buffer_distance=10_000)
+    adjacent_regions = sorted(set(find_adjacent(region_edges, program_regions, max_distance=1000)))
+    all_target_regions = sorted(set(program_regions) | set(adjacent_regions) | set(TARGET_REGIONS))
+
+    regions = regions.set_index('reg_name')
+    areas = regions.to_crs(TARGET_CRS).geometry.area / 1000**2
+    program_area = float(areas.reindex(program_regions).sum())
+    total_area = float(areas.reindex(all_target_regions).sum())
+
+    def lon_lat_bounds(names):
+        # Same layout as the bounds written by 01_explore_districts.py
+        west, south, east, north = regions.loc[regions.index.isin(names)].to_crs(WEB_CRS).total_bounds
+        return {'min_longitude': float(west), 'min_latitude': float(south),
+                'max_longitude': float(east), 'max_latitude': float(north)}
+
+    spatial_bounds = {'program_regions': lon_lat_bounds(program_regions),
+                      'all_regions': lon_lat_bounds(all_target_regions)}
+    if adjacent_regions:
+        spatial_bounds['adjacent_regions'] = lon_lat_bounds(adjacent_regions)
+    COVERAGE_FILE.write_text(json.dumps({
+        'program_regions': program_regions,
+        'adjacent_regions': adjacent_regions,
+        'all_target_regions': all_target_regions,
+        'coverage_stats': {
+            'program_area_km2': program_area,
+            'total_area_km2': total_area,
+            'control_buffer_ratio': total_area / program_area if program_area else None,
+        },
+        'spatial_bounds': spatial_bounds,
+    }, indent=2))
+
+
+def run_treatment_flags(resume=False):
+    """Relevant wards with treatment / program / adjacent flags and the name match report."""
+    from utils.name_matching import match_names
+    from utils.ward_loader import load_wards
+
+    program = json.loads(PROGRAM_FILE.read_text())
+    coverage = json.loads(COVERAGE_FILE.read_text())
+    treatment_locations = pd.DataFrame(program['treatment_locations'], columns=['Ward', 'District'])
+
+    wards = load_wards(regions=coverage['all_target_regions'])
+    match_report = match_names(
+        treatment_locations, wards[wards['reg_name'].isin(coverage['program_regions'])],
+        left_on=('Ward', 'District'), right_on=('ward_name', 'dist_name'),
+    )
+    match_report.to_csv(MATCH_REPORT_FILE, index=False)
+
+    accepted = match_report.loc[match_report['accepted'], 'right_index']
+    wards['is_treatment'] = wards.index.isin(accepted)
+    wards['is_program_region'] = wards['reg_name'].isin(coverage['program_regions'])
+    wards['is_adjacent_region'] = wards['reg_name'].isin(coverage['adjacent_regions'])
+    with track('export.geojson', rows=len(wards)):
+        wards.to_file(WARDS_FILE)
+
+
+def _grid_stage(cell_size):
+    def run_grid(resume=False):
+        from spatial_prep import grid, tiles
+        wards = grid.load_wards(WARDS_FILE)
+        summary = tiles.build_tiled_grid(wards, cell_size, overwrite=not resume)
+        print(f"     {summary['rows_written']:,} rows in {summary['tiles_written']} new tiles")
+
+    def outputs():
+        from spatial_prep.tiles import grid_dataset_dir
+        return [grid_dataset_dir(cell_size)]
+
+    return run_grid, outputs
+
+
+register(Stage('wards', run_wards, wards_outputs, sources=_ward_sources, modules=['utils.ward_loader']))
+register(Stage('program_regions', run_program_regions, lambda: [PROGRAM_FILE],
+               upstream=['wards'], sources=lambda: [settings.SURVEY_FILE], modules=['utils.ward_loader']))
+register(Stage('coverage', run_coverage, lambda: [COVERAGE_FILE],
+               upstream=['wards', 'program_regions'], settings=['TARGET_REGIONS'],
+               modules=['utils.geo_utils', 'utils.ward_loader']))
+register(Stage('treatment_flags', run_treatment_flags, lambda: [WARDS_FILE, MATCH_REPORT_FILE],
+               upstream=['wards', 'program_regions', 'coverage'], settings=['NAME_MATCH_THRESHOLD'],
+               modules=['utils.name_matching', 'utils.ward_loader']))
+for _name, _size, _setting in (('grid_500m', settings.GRID_SIZE_LARGE, 'GRID_SIZE_LARGE'),
+                               ('grid_100m', settings.GRID_SIZE_SMALL, 'GRID_SIZE_SMALL')):
+    _run, _outputs = _grid_stage(_size)
+    register(Stage(_name, _run, _outputs, upstream=['treatment_flags'],
+                   settings=[_setting, 'GRID_TILE_SIZE', 'TARGET_CRS'],
+                   modules=['spatial_prep.grid', 'spatial_prep.tiles']))
+
+
+def run_app_state(resume=False):
+    """Map bounds, initial view and layer index the app reads at start-up."""
+    from utils.app_state import write_app_state
+
+    write_app_state(settings.APP_STATE_FILE)
+
+
+register(Stage('app_state', run_app_state, lambda: [settings.APP_STATE_FILE],
+               upstream=['treatment_flags', 'grid_500m', 'grid_100m'],
+               settings=['MAP_WIDTH', 'MAP_HEIGHT', 'DEFAULT_MAP_CENTER', 'DEFAULT_ZOOM', 'WARD_LAYER_MIN_ZOOM',
+                         'GRID_LAYER_MIN_ZOOM'],
+               modules=['utils.app_state']))
+
+
+def run_imagery(resume=False):
+    """Sentinel-2 statistics for every cell of the IMAGERY_CELL_SIZE grid (fetched cells are cached)."""
+    from spatial_prep import imagery, tiles
+
+    cell_size = settings.IMAGERY_CELL_SIZE
+    client = imagery.HttpImageryClient(settings.IMAGERY_CLIENT_URL) if settings.IMAGERY_CLIENT_URL else None
+    cell_ids = tiles.read_cell_ids(tiles.grid_dataset_dir(cell_size))
+    summary = imagery.extract_imagery(cell_ids, cell_size, client=client)
+    print(f"     {summary['cells_fetched']:,} cells fetched, {summary['cells_cached']:,} from cache")
+    imagery.load_imagery(cell_ids, cell_size).to_parquet(IMAGERY_FILE, index=False)
+
+
+register(Stage('imagery', run_imagery, lambda: [IMAGERY_FILE],
+               upstream=['grid_500m' if settings.IMAGERY_CELL_SIZE == settings.GRID_SIZE_LARGE else 'grid_100m'],
+               settings=['IMAGERY_CELL_SIZE', 'IMAGERY_BANDS', 'IMAGERY_MAX_CLOUD', 'IMAGERY_CLIENT_URL',
+                         'START_DATE', 'END_DATE', 'GEE_SCALE'],
+               modules=['spatial_prep.imagery', 'spatial_prep.tiles']))
+
+
+def zonal_file(cell_size):
+    return PROCESSED_DATA_DIR / f"zonal_{cell_size}m.parquet"
+
+
+def _zonal_sources():
+    return [path for path in (settings.SENTINEL2_RASTER, settings.FOREST_LOSS_RASTER) if path.exists()]
+
+
+def _zonal_stage(cell_size):
+    def run_zonal(resume=False):
+        from spatial_prep import tiles, zonal
+        if not _zonal_sources():
+            raise FileNotFoundError(
+                f"❌ No rasters found - expected {settings.SENTINEL2_RASTER} and/or {settings.FOREST_LOSS_RASTER}"
+            )
+        cell_ids = tiles.read_cell_ids(tiles.grid_dataset_dir(cell_size))
+        stats = pd.DataFrame({'cell_id': cell_ids})
+        if settings.SENTINEL2_RASTER.exists():
+            band_stats = zonal.zonal_stats(settings.SENTINEL2_RASTER, cell_size, cell_ids)
+            stats = stats.merge(band_stats, on='cell_id', how='left')
+        if settings.FOREST_LOSS_RASTER.exists():
+            loss = zonal.forest_loss_fraction(settings.FOREST_LOSS_RASTER, cell_size, cell_ids)
+            stats = stats.merge(loss, on='cell_id', how='left')
+        stats.to_parquet(zonal_file(cell_size), index=False)
+        print(f"     {len(stats):,} cells, {stats.shape[1] - 1} statistics")
+
+    return run_zonal, lambda: [zonal_file(cell_size)]
+
+
+for _name, _size in (('zonal_500m', settings.GRID_SIZE_LARGE), ('zonal_100m', settings.GRID_SIZE_SMALL)):
+    _run, _outputs = _zonal_stage(_size)
+    register(Stage(_name, _run, _outputs, upstream=[_name.replace('zonal', 'grid')],
+                   settings=['TARGET_CRS'], sources=_zonal_sources,
+                   modules=['spatial_prep.zonal', 'spatial_prep.tiles']))
+
+
+MATCHED_PAIRS_FILE = PROCESSED_DATA_DIR / "matched_pairs.parquet"
+MATCH_BALANCE_FILE = PROCESSED_DATA_DIR / "match_balance.csv"
+
+
+def run_matching(resume=False):
+    """Treatment-control pairs of MATCH_CELL_SIZE grid cells, matched on the zonal statistics."""
+    from spatial_prep import grid, matching
+
+    cell_size = settings.MATCH_CELL_SIZE
+    cells = matching.load_cells(cell_size, [zonal_file(cell_size)])
+    controls = matching.candidate_controls(cells, grid.load_wards(WARDS_FILE))
+    pairs = matching.match_cells(cells, settings.MATCH_COVARIATES, controls)
+    pairs.to_parquet(MATCHED_PAIRS_FILE, index=False)
+    matching.balance_table(cells, pairs, settings.MATCH_COVARIATES, controls).to_csv(MATCH_BALANCE_FILE)
+    print(f"     {pairs.attrs['treated_matched']:,} of {pairs.attrs['treated_cells']:,} treatment cells matched "
+          f"to {pairs.attrs['controls_used']:,} controls")
+
+
+register(Stage('matching', run_matching, lambda: [MATCHED_PAIRS_FILE, MATCH_BALANCE_FILE],
+               upstream=['treatment_flags',
+                         'zonal_500m' if settings.MATCH_CELL_SIZE == settings.GRID_SIZE_LARGE else 'zonal_100m'],
+               settings=['MATCH_CELL_SIZE', 'MATCH_COVARIATES', 'MATCH_METHOD', 'MATCH_RATIO', 'MATCH_REPLACEMENT',
+                         'MATCH_CALIPER', 'MATCH_BLOCK_BY', 'MATCH_CONTROL_POOL', 'MATCH_EXCLUSION_BUFFER'],
+               modules=['spatial_prep.matching', 'spatial_prep.grid']))
+
+
+VALIDATION_REPORT_FILE = PROCESSED_DATA_DIR / "validation_report.json"
+
+
+def run_validation(resume=False):
+    """Checks over the wards, both grids and the saved annotation sessions, written as a JSON report."""
+    import geopandas as gpd
+
+    from spatial_prep import tiles, validation
+    from utils.annotation_store import load_sessions
+
+    grid_dirs = [tiles.grid_dataset_dir(size) for size in (settings.GRID_SIZE_LARGE, settings.GRID_SIZE_SMALL)]
+    # The raw layer, so that invalid geometries are reported before they are repaired
+    report = validation.run_validation(gpd.read_file(WARDS_FILE), grid_dirs, load_sessions())
+    validation.write_report(report, VALIDATION_REPORT_FILE)
+    validation.print_report(report)
+
+
+register(Stage('validation', run_validation, lambda: [VALIDATION_REPORT_FILE],
+               upstream=['treatment_flags', 'grid_500m', 'grid_100m'], always=True))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the stale data preparation stages.")
+    parser.add_argument('--status', action='store_true', help="Only show which stages would run")
+    parser.add_argument('--until', choices=list(STAGES), help="Run this stage and what it depends on")
+    parser.add_argument('--only', nargs='+', choices=list(STAGES), help="Run only these stages")
+    parser.add_argument('--force', nargs='+', default=[], choices=list(STAGES), help="Rerun these stages")
+    args = parser.parse_args(argv)
+
+    print(f"🧩 Pipeline ({len(STAGES)} stages), manifest: {MANIFEST_FILE}")
+    if start_metrics_server():
+        print(f"📈 Metrics at http://127.0.0.1:{settings.METRICS_PORT}/metrics")
+    run_pipeline(until=args.until, only=args.only, force=set(args.force), dry_run=args.status)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,231 @@
+"""Tiled grid pipeline that streams cells to a partitioned GeoParquet dataset.
+
+The study area is split into square tiles aligned to multiples of GRID_TILE_SIZE.
+Each tile is generated batch by batch (see spatial_prep.grid) and written to
+``<output_dir>/tile=<tile_id>/part-<n>.parquet``, so nothing larger than one
+batch is ever held in memory. Tiles are written to a hidden temporary directory
+(ignored by Parquet readers) and renamed into place once complete, which makes a
+crashed run safe to restart: finished tiles are skipped and half-written ones
+are discarded. Cells that lie wholly inside one ward are stored by id without
+geometry; read_grid rebuilds their squares.
+
+With ``workers > 1`` tiles are spread over a process pool. Ward geometries are
+sent to each worker once, as WKB, through the pool initializer; tasks only carry
+the tile bounds. Tile contents do not depend on which worker wrote them, so the
+dataset is identical for any number of workers.
+
+geopandas and pyarrow are imported by the functions that read datasets, so the
+path helpers (grid_dataset_dir, TMP_PREFIX) are cheap to import.
+"""
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from config.settings import GRID_MAX_CELLS_PER_BATCH, GRID_TILE_SIZE, GRID_WORKERS, PROCESSED_DATA_DIR, TARGET_CRS
+from spatial_prep import grid
+
+TMP_PREFIX = '.'
+
+# Per-process ward layer, populated by _init_worker in pool workers
+_worker_wards = None
+_worker_tree = None
+
+
+def grid_dataset_dir(cell_size):
+    """Default output directory for a grid dataset."""
+    return PROCESSED_DATA_DIR / f"grid_{cell_size}m"
+
+
+def tile_dir_name(tile_id):
+    """Hive-style partition directory name for a tile."""
+    return f"tile={tile_id}"
+
+
+def iter_tiles(bounds, tile_size=GRID_TILE_SIZE):
+    """
+    Split bounds into aligned square tiles.
+
+    Yields:
+        (tile_id, (minx, miny, maxx, maxy)) in row-major order
+    """
+    col_min, row_min, col_max, row_max = grid.snap_bounds(bounds, tile_size)
+    for row in range(row_min, row_max):
+        for col in range(col_min, col_max):
+            yield f"{col}_{row}", (col * tile_size, row * tile_size, (col + 1) * tile_size, (row + 1) * tile_size)
+
+
+def plan_tiles(wards, tile_size=GRID_TILE_SIZE):
+    """List the tiles that intersect at least one ward."""
+    tree = shapely.STRtree(np.asarray(wards.geometry.values))
+    tiles = list(iter_tiles(wards.total_bounds, tile_size))
+    if not tiles:
+        return []
+    tile_boxes = shapely.box(*np.array([bounds for _, bounds in tiles]).T)
+    hits = np.unique(tree.query(tile_boxes, predicate='intersects')[0])
+    return [tiles[i] for i in hits]
+
+
+def completed_tiles(output_dir):
+    """Tile ids already written to the dataset."""
+    output_dir = Path(output_dir)
+    if not output_dir.exists():
+        return set()
+    return {
+        path.name.split('=', 1)[1]
+        for path in output_dir.iterdir()
+        if path.is_dir() and path.name.startswith('tile=')
+    }
+
+
+def discard_partial_tiles(output_dir):
+    """Remove temporary tile directories left behind by an interrupted run."""
+    for path in Path(output_dir).glob(f"{TMP_PREFIX}tile=*"):
+        shutil.rmtree(path)
+
+
+def write_tile(wards, tree, tile, cell_size, output_dir, max_cells=GRID_MAX_CELLS_PER_BATCH):
+    """
+    Generate one tile and write it atomically.
+
+    Args:
+        wards: Prepared ward GeoDataFrame (see spatial_prep.grid.prepare_wards)
+        tree: Prepared STRtree over the ward geometries, in row order
+        tile: (tile_id, bounds) as yielded by iter_tiles
+        cell_size: Cell edge length in meters
+        output_dir: Root of the partitioned dataset
+        max_cells: Maximum number of candidate cells generated per batch
+
+    Returns:
+        Number of cell pieces written
+    """
+    tile_id, bounds = tile
+    final_dir = Path(output_dir) / tile_dir_name(tile_id)
+    tmp_dir = final_dir.with_name(TMP_PREFIX + final_dir.name)
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+
+    n_rows = 0
+    for part, block in enumerate(grid.iter_blocks(bounds, cell_size, max_cells)):
+        batch = grid.clip_block(wards, tree, block, cell_size)
+        if len(batch):
+            grid.drop_cell_geometries(batch).to_parquet(tmp_dir / f"part-{part:05d}.parquet", index=False)
+            n_rows += len(batch)
+
+    tmp_dir.rename(final_dir)
+    return n_rows
+
+
+def _init_worker(ward_wkb, ward_attributes):
+    """Rebuild the ward layer and its STRtree once per pool worker."""
+    import geopandas as gpd
+
+    global _worker_wards, _worker_tree
+    _worker_wards = gpd.GeoDataFrame(ward_attributes, geometry=shapely.from_wkb(ward_wkb), crs=TARGET_CRS)
+    _worker_tree = shapely.STRtree(np.asarray(_worker_wards.geometry.values))
+    shapely.prepare(_worker_tree.geometries)
+
+
+def _write_tile_in_worker(tile, cell_size, output_dir, max_cells):
+    return tile[0], write_tile(_worker_wards, _worker_tree, tile, cell_size, output_dir, max_cells)
+
+
+def _write_tiles_parallel(wards, pending, cell_size, output_dir, max_cells, workers):
+    """Write tiles across a process pool, returning the total number of rows."""
+    ward_wkb = shapely.to_wkb(np.asarray(wards.geometry.values))
+    ward_attributes = wards.drop(columns='geometry').to_dict('list')
+
+    rows_written = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(ward_wkb, ward_attributes)) as pool:
+        futures = [pool.submit(_write_tile_in_worker, tile, cell_size, output_dir, max_cells) for tile in pending]
+        for i, future in enumerate(as_completed(futures), start=1):
+            tile_id, n_rows = future.result()
+            rows_written += n_rows
+            print(f"  [{i}/{len(pending)}] tile {tile_id} written")
+    return rows_written
+
+
+def build_tiled_grid(wards, cell_size, output_dir=None, tile_size=GRID_TILE_SIZE,
+                     max_cells=GRID_MAX_CELLS_PER_BATCH, overwrite=False, workers=GRID_WORKERS):
+    """
+    Generate a grid tile by tile into a partitioned GeoParquet dataset.
+
+    Args:
+        wards: Prepared ward GeoDataFrame (see spatial_prep.grid.prepare_wards)
+        cell_size: Cell edge length in meters (GRID_SIZE_LARGE or GRID_SIZE_SMALL)
+        output_dir: Dataset directory, defaults to data/processed/grid_<size>m
+        tile_size: Tile edge length in meters, must be a multiple of cell_size
+        max_cells: Maximum number of candidate cells generated per batch
+        overwrite: Discard existing tiles instead of resuming
+        workers: Number of worker processes; 1 runs everything in this process
+
+    Returns:
+        dict with tiles_total, tiles_written, tiles_skipped, rows_written, workers and seconds
+    """
+    if tile_size % cell_size:
+        raise ValueError(f"tile_size ({tile_size}) must be a multiple of cell_size ({cell_size})")
+    output_dir = Path(output_dir) if output_dir is not None else grid_dataset_dir(cell_size)
+    if overwrite and output_dir.exists():
+        shutil.rmtree(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    discard_partial_tiles(output_dir)
+
+    start = time.perf_counter()
+    tiles = plan_tiles(wards, tile_size)
+    done = completed_tiles(output_dir)
+    pending = [tile for tile in tiles if tile[0] not in done]
+
+    workers = max(1, min(workers, len(pending)))
+    if workers > 1:
+        rows_written = _write_tiles_parallel(wards, pending, cell_size, output_dir, max_cells, workers)
+    else:
+        tree = shapely.STRtree(np.asarray(wards.geometry.values))
+        shapely.prepare(tree.geometries)
+        rows_written = 0
+        for i, tile in enumerate(pending, start=1):
+            rows_written += write_tile(wards, tree, tile, cell_size, output_dir, max_cells)
+            print(f"  [{i}/{len(pending)}] tile {tile[0]} written")
+
+    return {
+        'tiles_total': len(tiles),
+        'tiles_written': len(pending),
+        'tiles_skipped': len(tiles) - len(pending),
+        'rows_written': rows_written,
+        'workers': workers,
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def read_grid(output_dir, columns=None, filters=None):
+    """
+    Read a tiled grid dataset back as one GeoDataFrame (a DataFrame when
+    columns leaves out geometry).
+
+    Args:
+        output_dir: Dataset directory written by build_tiled_grid
+        columns: Optional subset of columns to read; None reads all of them
+        filters: Optional pyarrow filters, e.g. [('is_treatment', '==', True)]
+    """
+    import geopandas as gpd
+
+    if columns is not None and 'geometry' not in columns:
+        return pd.read_parquet(output_dir, columns=columns, filters=filters)
+    # Full cells are stored without geometry; their squares are rebuilt from cell_id and cell_size
+    extra = [column for column in ['cell_id', 'cell_size'] if columns is not None and column not in columns]
+    read_columns = list(columns) + extra if columns is not None else None
+    pieces = grid.restore_cell_geometries(gpd.read_parquet(output_dir, columns=read_columns, filters=filters))
+    return pieces.drop(columns=extra)
+
+
+def read_cell_ids(output_dir):
+    """Distinct cell ids in a tiled grid dataset (cells split by ward boundaries appear once)."""
+    import pyarrow.dataset as ds
+
+    table = ds.dataset(output_dir, format='parquet', partitioning='hive').to_table(columns=['cell_id'])
+    return np.unique(table.column('cell_id').to_numpy())
@@ -0,0 +1,250 @@
+"""Vectorized data checks over wards, grids and annotations, with a timed report.
+
+All checks work on whole arrays: geometry validity with shapely's vectorized
+predicates, ward overlaps with one STRtree query, grid coverage from the
+area_frac column of the grid datasets (no geometries are read), annotations in
+wards through the PointSnapper, and duplicate clicks through a spatial hash
+(points are bucketed into cells of the duplicate distance, and only points in
+neighbouring buckets are compared).
+
+run_validation returns a JSON-serializable report with one entry per check:
+its status ('pass', or the check's severity when something was found), the
+number of problems, the time it took and a few examples.
+"""
+import json
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+import shapely
+
+from config.settings import (VALIDATION_DUPLICATE_DISTANCE, VALIDATION_GAP_TOLERANCE,
+                             VALIDATION_OVERLAP_TOLERANCE)
+from spatial_prep import grid
+
+MAX_EXAMPLES = 20
+WARD_KEY = ['ward_name', 'dist_name', 'reg_name']
+
+
+def _examples(frame):
+    return json.loads(frame.head(MAX_EXAMPLES).to_json(orient='records'))
+
+
+def repair_geometries(geometries):
+    """
+    Repair invalid geometries in bulk with shapely.make_valid.
+
+    Returns:
+        (repaired geometry array, number of geometries that were invalid)
+    """
+    geometries = np.array(geometries, dtype=object)
+    invalid = ~shapely.is_valid(geometries)
+    geometries[invalid] = shapely.make_valid(geometries[invalid])
+    return geometries, int(invalid.sum())
+
+
+def check_geometries(wards):
+    """Invalid ward geometries (self-intersections, bad rings, ...) and whether make_valid repairs them."""
+    geometries = np.asarray(wards.geometry.values)
+    invalid = np.flatnonzero(~shapely.is_valid(geometries))
+    reasons = pd.Series(shapely.is_valid_reason(geometries[invalid]), dtype=object)
+    repaired, _ = repair_geometries(geometries[invalid])
+    still_invalid = ~shapely.is_valid(repaired)
+    found = wards.iloc[invalid][WARD_KEY].assign(reason=reasons.to_numpy())
+    return len(invalid), {
+        'self_intersections': int(reasons.str.contains('Self-intersection').sum()),
+        'empty': int(shapely.is_empty(geometries).sum()),
+        'repairable': int((~still_invalid).sum()),
+        'examples': _examples(found),
+    }
+
+
+def check_overlaps(wards, tolerance=VALIDATION_OVERLAP_TOLERANCE):
+    """Pairs of wards whose interiors overlap by more than ``tolerance`` m² (wards in TARGET_CRS)."""
+    geometries = np.asarray(wards.geometry.values)
+    left, right = shapely.STRtree(geometries).query(geometries, predicate='intersects')
+    keep = left < right
+    left, right = left[keep], right[keep]
+    # Neighbours that only share a boundary are the common case: skip them before computing areas
+    keep = ~shapely.touches(geometries[left], geometries[right])
+    left, right = left[keep], right[keep]
+    area = shapely.area(shapely.intersection(geometries[left], geometries[right]))
+    overlap = area > tolerance
+
+    names = wards[WARD_KEY[:2]].to_numpy()
+    found = pd.DataFrame({
+        'ward': names[left[overlap], 0], 'district': names[left[overlap], 1],
+        'other_ward': names[right[overlap], 0], 'other_district': names[right[overlap], 1],
+        'overlap_m2': area[overlap].round(1),
+    }).sort_values('overlap_m2', ascending=False)
+    return int(overlap.sum()), {'total_overlap_m2': float(area[overlap].sum()), 'examples': _examples(found)}
+
+
+def check_grid_coverage(wards, grid_dirs, tolerance=VALIDATION_GAP_TOLERANCE):
+    """
+    Wards that a grid leaves partly uncovered (wards in TARGET_CRS).
+
+    Covered area is the sum of the cell pieces' area_frac per ward, read from
+    the grid datasets without their geometries.
+    """
+    ward_area = pd.Series(shapely.area(np.asarray(wards.geometry.values)),
+                          index=pd.MultiIndex.from_frame(wards[WARD_KEY])).groupby(level=WARD_KEY).sum()
+    count, details = 0, {}
+    for grid_dir in grid_dirs:
+        if not grid_dir.exists():
+            details[grid_dir.name] = 'missing'
+            count += len(ward_area)
+            continue
+        columns = WARD_KEY + ['area_frac', 'cell_size']
+        pieces = ds.dataset(grid_dir, format='parquet', partitioning='hive').to_table(columns=columns).to_pandas()
+        covered = (pieces['area_frac'] * pieces['cell_size'] ** 2).groupby([pieces[c] for c in WARD_KEY]).sum()
+        gap = 1 - covered.reindex(ward_area.index, fill_value=0) / ward_area
+        flagged = gap[gap > tolerance].sort_values(ascending=False)
+        count += len(flagged)
+        details[grid_dir.name] = {
+            'wards_with_gaps': len(flagged),
+            'uncovered_km2': float(((gap.clip(lower=0)) * ward_area).sum() / 1e6),
+            'examples': _examples(flagged.rename('gap_fraction').round(4).reset_index()),
+        }
+    return count, details
+
+
+def spatial_hash_pairs(x, y, distance):
+    """
+    Pairs of points closer than ``distance`` (i < j), via a spatial hash.
+
+    Points are bucketed into square cells of the given size, so a close pair
+    is always in the same or a neighbouring bucket; only those are compared.
+
+    Returns:
+        (i, j) index arrays
+    """
+    points = pd.DataFrame({
+        'hx': np.floor_divide(x, distance).astype(np.int64),
+        'hy': np.floor_divide(y, distance).astype(np.int64),
+        'i': np.arange(len(x)),
+    })
+    pairs = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            shifted = points.assign(hx=points['hx'] + dx, hy=points['hy'] + dy)
+            merged = points.merge(shifted, on=['hx', 'hy'], suffixes=('', '_other'))
+            pairs.append(merged.loc[merged['i'] < merged['i_other'], ['i', 'i_other']].to_numpy())
+    i, j = np.concatenate(pairs).T if pairs else (np.zeros(0, dtype=np.int64),) * 2
+    close = np.hypot(x[i] - x[j], y[i] - y[j]) < distance
+    return i[close], j[close]
+
+
+def check_annotations_outside(annotations, ward_index):
+    """Annotations that fall outside every ward."""
+    outside = ward_index < 0
+    found = annotations.loc[outside, ['latitude', 'longitude', 'is_treatment']]
+    return int(outside.sum()), {'examples': _examples(found)}
+
+
+def check_duplicates(annotations, i, j):
+    """Clicks closer together than the duplicate distance."""
+    duplicated = np.unique(np.concatenate([i, j]))
+    found = pd.DataFrame({
+        'latitude': annotations['latitude'].to_numpy()[i], 'longitude': annotations['longitude'].to_numpy()[i],
+        'other_latitude': annotations['latitude'].to_numpy()[j],
+        'other_longitude': annotations['longitude'].to_numpy()[j],
+    })
+    return len(i), {'annotations_involved': len(duplicated), 'examples': _examples(found)}
+
+
+def check_label_conflicts(annotations, i, j, ward_index, ward_is_treatment):
+    """
+    Annotations whose label disagrees with a close click or with their ward:
+    close clicks labelled differently, and control clicks inside treatment wards.
+    """
+    is_treatment = annotations['is_treatment'].to_numpy()
+    differing = is_treatment[i] != is_treatment[j]
+    inside = ward_index >= 0
+    in_treatment_ward = np.zeros(len(annotations), dtype=bool)
+    in_treatment_ward[inside] = ward_is_treatment[ward_index[inside]]
+    control_in_treatment_ward = ~is_treatment & in_treatment_ward
+    treatment_outside_treatment_wards = is_treatment & inside & ~in_treatment_ward
+
+    conflicted = control_in_treatment_ward.copy()
+    conflicted[i[differing]] = True
+    conflicted[j[differing]] = True
+    found = annotations.loc[conflicted, ['latitude', 'longitude', 'is_treatment', 'ward_name']]
+    return int(conflicted.sum()), {
+        'close_clicks_with_different_labels': int(differing.sum()),
+        'control_in_treatment_ward': int(control_in_treatment_ward.sum()),
+        # Not a conflict by itself (the survey may miss wards), reported for review
+        'treatment_outside_treatment_wards': int(treatment_outside_treatment_wards.sum()),
+        'examples': _examples(found),
+    }
+
+
+def _run_check(report, name, severity, check, *args):
+    start = time.perf_counter()
+    count, details = check(*args)
+    report['checks'].append({
+        'name': name,
+        'status': 'pass' if count == 0 else severity,
+        'count': count,
+        'seconds': round(time.perf_counter() - start, 4),
+        'details': details,
+    })
+
+
+def run_validation(wards, grid_dirs=(), annotations=None, duplicate_distance=VALIDATION_DUPLICATE_DISTANCE):
+    """
+    Run all checks in one pass.
+
+    Args:
+        wards: Ward GeoDataFrame as written by the treatment_flags stage
+        grid_dirs: Grid dataset directories to check for coverage gaps
+        annotations: Optional annotation DataFrame (latitude, longitude,
+            is_treatment), e.g. utils.annotation_store.load_sessions(); a
+            missing ward_name column is filled from the ward each point is in
+        duplicate_distance: Meters below which two clicks are duplicates
+
+    Returns:
+        Report dict with generated, seconds, summary (checks per status) and checks
+    """
+    from utils.snapping import PointSnapper
+
+    start = time.perf_counter()
+    report = {'generated': datetime.now().isoformat(timespec='seconds'), 'checks': []}
+
+    _run_check(report, 'invalid_geometries', 'error', check_geometries, wards)
+    prepared = grid.prepare_wards(wards)  # projected and repaired with make_valid
+    _run_check(report, 'overlapping_wards', 'warning', check_overlaps, prepared)
+    if grid_dirs:
+        _run_check(report, 'grid_coverage_gaps', 'warning', check_grid_coverage, prepared, list(grid_dirs))
+
+    if annotations is not None and len(annotations):
+        annotations = annotations.reset_index(drop=True)
+        snapper = PointSnapper(prepared)
+        x, y = snapper.to_utm.transform(annotations['longitude'].to_numpy(), annotations['latitude'].to_numpy())
+        ward_index = snapper.ward_index(x, y)
+        if 'ward_name' not in annotations:
+            names = prepared['ward_name'].to_numpy(dtype=object)
+            annotations['ward_name'] = np.where(ward_index >= 0, names[ward_index], None)
+        i, j = spatial_hash_pairs(x, y, duplicate_distance)
+        _run_check(report, 'annotations_outside_wards', 'warning', check_annotations_outside, annotations, ward_index)
+        _run_check(report, 'duplicate_clicks', 'warning', check_duplicates, annotations, i, j)
+        _run_check(report, 'label_conflicts', 'error', check_label_conflicts, annotations, i, j, ward_index,
+                   prepared['is_treatment'].to_numpy(dtype=bool))
+
+    report['seconds'] = round(time.perf_counter() - start, 4)
+    report['summary'] = pd.Series([check['status'] for check in report['checks']]).value_counts().to_dict()
+    return report
+
+
+def write_report(report, path):
+    path.write_text(json.dumps(report, indent=2, default=str))
+    return path
+
+
+def print_report(report):
+    icons = {'pass': '✅', 'warning': '⚠️', 'error': '❌'}
+    for check in report['checks']:
+        print(f"  {icons[check['status']]} {check['name']}: {check['count']:,} ({check['seconds'] * 1000:.0f} ms)")
+    print(f"  Total: {report['seconds']:.2f}s")
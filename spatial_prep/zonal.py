@@ -0,0 +1,384 @@
+"""Zonal statistics per grid cell from local rasters (e.g. exported GeoTIFF mosaics).
+
+Instead of masking the raster once per cell polygon, cell ids are burned onto
+the raster grid once: every pixel centre is mapped to its grid cell with the
+integer cell scheme of spatial_prep.grid, and the index of that cell (or -1) is
+stored in a memory-mapped int32 "zone raster" under data/processed/cache/zonal/.
+The zone raster is reused for every band, statistic and later run on the same
+raster grid.
+
+Statistics are then reduced window by window, with windows aligned to the
+raster's internal blocks:
+
+* means: per-window sums and pixel counts with np.bincount, added up per cell;
+* medians: pixel values are scattered into a memory-mapped array laid out cell
+  by cell (offsets from the counts), then sorted a chunk of cells at a time.
+
+Windows are independent, so with ``workers > 1`` each pass runs over a process
+pool; workers open the raster and the memory maps once, in the pool
+initializer, and only receive window offsets.
+"""
+import hashlib
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import rasterio
+from pyproj import CRS, Transformer
+from rasterio.windows import Window
+
+from config.settings import CACHE_DIR, TARGET_CRS, ZONAL_WINDOW_SIZE, ZONAL_WORKERS
+from spatial_prep import grid
+from spatial_prep.imagery import DERIVED_BANDS
+
+ZONAL_CACHE_DIR = CACHE_DIR / "zonal"
+NO_ZONE = -1
+STATS = ('mean', 'median')
+MEDIAN_CHUNK_PIXELS = 20_000_000  # pixel values sorted at once when computing medians
+
+# Per-process state, set by _init_worker (also used in the main process when workers == 1)
+_ctx = None
+
+
+# ---------------------------------------------------------------------------
+# Channels
+
+
+def band_names(src):
+    """Band names from the raster's band descriptions, band_<n> where they are missing."""
+    return [description or f"band_{i}" for i, description in enumerate(src.descriptions, start=1)]
+
+
+def raster_channels(raster_path):
+    """
+    Channels of a multi-band raster: every band, plus the DERIVED_BANDS indices
+    (NDVI, ...) whose bands are present.
+
+    Returns:
+        dict of channel name -> spec, e.g. {'B4': ('band', 2), 'NDVI': ('ndiff', 3, 2)}
+    """
+    with rasterio.open(raster_path) as src:
+        names = band_names(src)
+    channels = {name: ('band', i) for i, name in enumerate(names)}
+    for name, (first, second) in DERIVED_BANDS.items():
+        if first in names and second in names:
+            channels[name] = ('ndiff', names.index(first), names.index(second))
+    return channels
+
+
+def _channel_values(data, spec):
+    """Evaluate a channel spec on (bands, pixels) data."""
+    kind = spec[0]
+    if kind == 'band':
+        return data[spec[1]]
+    if kind == 'ndiff':
+        first, second = data[spec[1]], data[spec[2]]
+        total = first + second
+        return np.divide(first - second, total, out=np.zeros_like(total), where=total != 0)
+    if kind == 'gt0':
+        return (data[spec[1]] > 0).astype(np.float32)
+    raise ValueError(f"Unknown channel spec {spec!r}")
+
+
+# ---------------------------------------------------------------------------
+# Windows and workers
+
+
+def iter_windows(src, window_size=ZONAL_WINDOW_SIZE):
+    """Read windows of about window_size pixels, aligned to whole raster blocks."""
+    block_height, block_width = src.block_shapes[0]
+    step_height = max(1, window_size // block_height) * block_height
+    step_width = max(1, window_size // block_width) * block_width
+    for row in range(0, src.height, step_height):
+        for col in range(0, src.width, step_width):
+            yield Window(col, row, min(step_width, src.width - col), min(step_height, src.height - row))
+
+
+def _init_worker(context):
+    """Open the raster and memory maps once per process."""
+    global _ctx
+    _ctx = dict(context)
+    _ctx['src'] = rasterio.open(context['raster_path'])
+    _ctx['zones'] = np.memmap(context['zones_path'], dtype=np.int32, mode=context.get('zones_mode', 'r'),
+                              shape=context['shape'])
+    if context.get('values_path'):
+        _ctx['values'] = np.memmap(context['values_path'], dtype=np.float32, mode='r+',
+                                   shape=(len(context['channels']), context['n_values']))
+
+
+def _close_worker():
+    global _ctx
+    if _ctx is not None:
+        _ctx['src'].close()
+        _ctx = None
+
+
+def _map_windows(task, args, context, workers):
+    """Run task(*arg) for every arg, in order, in this process or over a process pool."""
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(context,)) as pool:
+            return list(pool.map(task, *zip(*args), chunksize=4)) if args else []
+    _init_worker(context)
+    try:
+        return [task(*arg) for arg in args]
+    finally:
+        _close_worker()
+
+
+# ---------------------------------------------------------------------------
+# Zone raster
+
+
+def _zone_task(window):
+    """Burn the cell index of each pixel centre of one window into the zone raster."""
+    src = _ctx['src']
+    row_slice, col_slice = window.toslices()
+    rows, cols = np.mgrid[row_slice, col_slice]
+    x, y = src.transform * (cols + 0.5, rows + 0.5)
+    if _ctx['target_crs'] != _ctx['raster_crs']:
+        x, y = Transformer.from_crs(_ctx['raster_crs'], _ctx['target_crs'], always_xy=True).transform(x, y)
+
+    cell_size, cell_ids = _ctx['cell_size'], _ctx['cell_ids']
+    pixel_cells = grid.point_cell_ids(x, y, cell_size)
+    position = np.minimum(np.searchsorted(cell_ids, pixel_cells), len(cell_ids) - 1)
+    zones = np.where(cell_ids[position] == pixel_cells, position, NO_ZONE).astype(np.int32)
+
+    _ctx['zones'][window.toslices()] = zones
+    _ctx['zones'].flush()
+    return int((zones != NO_ZONE).sum())
+
+
+def zone_raster(raster_path, cell_size, cell_ids, window_size=ZONAL_WINDOW_SIZE, workers=ZONAL_WORKERS,
+                cache_dir=ZONAL_CACHE_DIR):
+    """
+    Memory-mapped raster of cell indices (positions in ``cell_ids``, -1 outside
+    the grid) on the pixel grid of a raster, built once and cached.
+
+    Args:
+        raster_path: GeoTIFF (any CRS; pixel centres are projected to TARGET_CRS)
+        cell_size: Cell edge length in meters
+        cell_ids: Sorted unique cell ids of the grid
+        window_size: Read window edge in pixels
+        workers: Number of worker processes
+        cache_dir: Directory of the cached zone rasters
+
+    Returns:
+        Path of the zone raster (int32, shape (height, width))
+    """
+    cell_ids = np.asarray(cell_ids, dtype=np.int64)
+    with rasterio.open(raster_path) as src:
+        raster_crs = src.crs.to_wkt()
+        shape = (src.height, src.width)
+        windows = list(iter_windows(src, window_size))
+        key = hashlib.sha256()
+        for part in (raster_crs, tuple(src.transform), shape, cell_size, TARGET_CRS):
+            key.update(repr(part).encode())
+        key.update(cell_ids.tobytes())
+
+    path = Path(cache_dir) / f"zones_{cell_size}m_{key.hexdigest()[:16]}.int32"
+    if path.exists():
+        return path
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name('.' + path.name)
+    np.memmap(tmp_path, dtype=np.int32, mode='w+', shape=shape).flush()
+    context = {
+        'raster_path': str(raster_path), 'zones_path': str(tmp_path), 'zones_mode': 'r+', 'shape': shape,
+        'cell_size': cell_size, 'cell_ids': cell_ids, 'raster_crs': raster_crs,
+        'target_crs': CRS.from_user_input(TARGET_CRS).to_wkt(),
+    }
+    # Same CRS is the common case (rasters exported in TARGET_CRS): skip the projection
+    if CRS.from_wkt(raster_crs) == CRS.from_user_input(TARGET_CRS):
+        context['raster_crs'] = context['target_crs']
+    _map_windows(_zone_task, [(window,) for window in windows], context, workers)
+    os.replace(tmp_path, path)
+    return path
+
+
+# ---------------------------------------------------------------------------
+# Reduction
+
+
+def _window_values(window):
+    """Zone index and channel values of the valid pixels in one window (None if no pixel is in a cell)."""
+    zones = np.asarray(_ctx['zones'][window.toslices()])
+    in_grid = zones != NO_ZONE
+    if not in_grid.any():
+        return None
+    src = _ctx['src']
+    data = src.read(window=window, out_dtype=np.float32)[:, in_grid]
+    valid = np.isfinite(data).all(axis=0)
+    for band, nodata in enumerate(src.nodatavals):
+        if nodata is not None:
+            valid &= data[band] != nodata
+    data = data[:, valid]
+    values = np.stack([_channel_values(data, spec) for spec in _ctx['channels'].values()])
+    return zones[in_grid][valid], values
+
+
+def _sum_task(window):
+    """Per-cell pixel counts and channel sums of one window, for the cells it touches."""
+    window_values = _window_values(window)
+    if window_values is None:
+        return None
+    zones, values = window_values
+    window_zones, inverse = np.unique(zones, return_inverse=True)
+    counts = np.bincount(inverse, minlength=len(window_zones))
+    sums = np.stack([np.bincount(inverse, weights=channel, minlength=len(window_zones)) for channel in values])
+    return window_zones, counts, sums
+
+
+def _scatter_task(window, window_zones, base):
+    """Write the pixel values of one window to their cells' slots in the values array."""
+    window_values = _window_values(window)
+    if window_values is None:
+        return 0
+    zones, values = window_values
+    order = np.argsort(zones, kind='stable')
+    zones = zones[order]
+    slot = np.searchsorted(window_zones, zones)
+    rank = np.arange(len(zones)) - np.searchsorted(zones, window_zones)[slot]
+    _ctx['values'][:, base[slot] + rank] = values[:, order]
+    _ctx['values'].flush()
+    return len(zones)
+
+
+def _float_keys(values):
+    """Map float32 values to uint32 keys with the same order (IEEE 754 sign/magnitude flip)."""
+    bits = values.view(np.uint32)
+    return np.where(bits >> 31, ~bits, bits | np.uint32(0x80000000))
+
+
+def _float_values(keys):
+    """Inverse of _float_keys."""
+    return np.where(keys >> 31, keys & np.uint32(0x7FFFFFFF), ~keys).view(np.float32)
+
+
+def _segment_medians(values, offsets, max_pixels=MEDIAN_CHUNK_PIXELS):
+    """
+    Median per cell of values laid out cell by cell (cell i in columns
+    offsets[i]:offsets[i + 1] of the (channels, pixels) array).
+
+    Each chunk is sorted within cells in one pass, on uint64 keys of
+    (cell << 32 | value key), which is exact and much faster than a lexsort.
+    """
+    n_cells, n_channels = len(offsets) - 1, values.shape[0]
+    medians = np.full((n_cells, n_channels), np.nan)
+    start = 0
+    while start < n_cells:
+        stop = int(np.searchsorted(offsets, offsets[start] + max_pixels, side='right')) - 1
+        stop = min(max(stop, start + 1), n_cells)
+        counts = np.diff(offsets[start:stop + 1])
+        cell_keys = np.repeat(np.arange(stop - start, dtype=np.uint64), counts) << np.uint64(32)
+        first = offsets[start:stop] - offsets[start]
+        has_pixels = counts > 0
+        low = (first + (counts - 1) // 2)[has_pixels]
+        high = (first + counts // 2)[has_pixels]
+        for channel in range(n_channels):
+            keys = cell_keys | _float_keys(np.asarray(values[channel, offsets[start]:offsets[stop]]))
+            keys.sort()
+            ordered = _float_values((keys & np.uint64(0xFFFFFFFF)).astype(np.uint32))
+            medians[start:stop][has_pixels, channel] = (ordered[low].astype(np.float64) + ordered[high]) / 2
+        start = stop
+    return medians
+
+
+def zonal_stats(raster_path, cell_size, cell_ids, channels=None, stats=STATS, window_size=ZONAL_WINDOW_SIZE,
+                workers=ZONAL_WORKERS, cache_dir=ZONAL_CACHE_DIR):
+    """
+    Per-cell statistics of a raster over grid cells.
+
+    A pixel belongs to the cell that contains its centre. Pixels that are
+    nodata or not finite in any band are left out.
+
+    Args:
+        raster_path: GeoTIFF path
+        cell_size: Cell edge length in meters
+        cell_ids: Cell ids of the grid (e.g. spatial_prep.tiles.read_cell_ids)
+        channels: dict of output name -> channel spec; defaults to
+            raster_channels(raster_path) (all bands plus NDVI, ...)
+        stats: Any of 'mean' and 'median'
+        window_size: Read window edge in pixels (rounded to raster blocks)
+        workers: Number of worker processes
+        cache_dir: Directory of the zone rasters and intermediate arrays
+
+    Returns:
+        DataFrame with cell_id, pixels (number of valid pixels) and
+        <channel>_<stat> columns; cells without valid pixels have NaN stats
+    """
+    unknown = set(stats) - set(STATS)
+    if unknown:
+        raise ValueError(f"Unknown statistics {sorted(unknown)}, expected any of {list(STATS)}")
+    start_time = time.perf_counter()
+    cell_ids = np.unique(np.asarray(cell_ids, dtype=np.int64))
+    channels = channels if channels is not None else raster_channels(raster_path)
+    if not len(cell_ids):
+        return pd.DataFrame({'cell_id': cell_ids, 'pixels': np.zeros(0, dtype=np.int64)})
+    zones_path = zone_raster(raster_path, cell_size, cell_ids, window_size, workers, cache_dir)
+
+    with rasterio.open(raster_path) as src:
+        shape = (src.height, src.width)
+        windows = list(iter_windows(src, window_size))
+    context = {'raster_path': str(raster_path), 'zones_path': str(zones_path), 'shape': shape, 'channels': channels}
+
+    # Pass 1: counts and sums per cell
+    partials = _map_windows(_sum_task, [(window,) for window in windows], context, workers)
+    counts = np.zeros(len(cell_ids), dtype=np.int64)
+    sums = np.zeros((len(channels), len(cell_ids)))
+    for partial in partials:
+        if partial is not None:
+            window_zones, window_counts, window_sums = partial
+            counts[window_zones] += window_counts
+            sums[:, window_zones] += window_sums
+
+    result = {'cell_id': cell_ids, 'pixels': counts}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = sums / counts
+    if 'mean' in stats:
+        for name, mean in zip(channels, means):
+            result[f"{name}_mean"] = mean
+
+    # Pass 2: values laid out cell by cell in a memory map, then sorted per cell
+    if 'median' in stats:
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        fill = offsets[:-1].copy()
+        scatter_args = []
+        for window, partial in zip(windows, partials):
+            if partial is not None:
+                window_zones, window_counts, _ = partial
+                scatter_args.append((window, window_zones, fill[window_zones].copy()))
+                fill[window_zones] += window_counts
+
+        values_path = Path(cache_dir) / f".values_{os.getpid()}_{time.time_ns()}.float32"
+        n_values = max(int(offsets[-1]), 1)
+        np.memmap(values_path, dtype=np.float32, mode='w+', shape=(len(channels), n_values)).flush()
+        try:
+            _map_windows(_scatter_task, scatter_args,
+                         {**context, 'values_path': str(values_path), 'n_values': n_values}, workers)
+            values = np.memmap(values_path, dtype=np.float32, mode='r', shape=(len(channels), n_values))
+            medians = _segment_medians(values, offsets)
+            del values
+        finally:
+            values_path.unlink(missing_ok=True)
+        for i, name in enumerate(channels):
+            result[f"{name}_median"] = medians[:, i]
+
+    frame = pd.DataFrame(result)
+    frame.attrs['seconds'] = time.perf_counter() - start_time
+    return frame
+
+
+def forest_loss_fraction(raster_path, cell_size, cell_ids, band=1, **kwargs):
+    """
+    Share of each cell's valid pixels with forest loss (value > 0, e.g. any
+    year in a Hansen lossyear raster).
+
+    Returns:
+        DataFrame with cell_id, forest_loss_pixels and forest_loss_fraction
+    """
+    frame = zonal_stats(raster_path, cell_size, cell_ids, channels={'forest_loss': ('gt0', band - 1)},
+                        stats=('mean',), **kwargs)
+    return frame.rename(columns={'pixels': 'forest_loss_pixels', 'forest_loss_mean': 'forest_loss_fraction'})
@@ -0,0 +1,111 @@
+"""Tests for utils.annotation_io."""
+import io
+
+import pandas as pd
+import pytest
+
+from utils.annotation_io import export_annotations, import_annotations
+from utils.annotation_store import AnnotationStore
+from utils.shared_store import SharedStore
+
+BAD_FILES = {
+    'wrong headers': b"lat,lon,label\n-7.1,37.0,1\n",
+    'empty file': b"",
+    'parse error': b'latitude,longitude,is_treatment\n-7.1,37.0,1\n"-7.2,37.1,0\n',
+    'header only': b"latitude,longitude,is_treatment\n",
+    'no valid rows': b"latitude,longitude,is_treatment\n999,37.0,1\n-7.1,37.0,maybe\n",
+}
+
+
+def journal_rows(path):
+    journal = AnnotationStore(path)
+    rows = len(journal)
+    journal.close()
+    return rows
+
+
+@pytest.fixture
+def stores(tmp_path):
+    """A journaled session store with two annotations, also written to a shared store."""
+    shared = SharedStore(tmp_path / "shared.sqlite")
+    store = AnnotationStore(tmp_path / "session.sqlite", shared=shared.writer('tester', 'session'))
+    store.append(-7.0, 37.0, True)
+    store.append(-7.5, 36.5, False)
+    store.shared.flush()
+    yield store, shared
+    store.close()
+    shared.close()
+
+
+@pytest.mark.parametrize('content', BAD_FILES.values(), ids=BAD_FILES.keys())
+def test_failed_import_leaves_the_store_untouched(stores, tmp_path, content):
+    store, shared = stores
+    # Small chunks, so the parse error comes after a chunk has been read
+    with pytest.raises(ValueError):
+        import_annotations(io.BytesIO(content), store, chunksize=1)
+    store.shared.flush()
+
+    assert len(store) == 2
+    assert journal_rows(tmp_path / "session.sqlite") == 2
+    assert shared.count(session='session') == 2
+
+
+def test_import_replaces_the_annotations(stores, tmp_path):
+    store, shared = stores
+    csv = b"latitude,longitude,type\n-6.9,37.2,Treatment\n-6.8,37.3,Control\n-6.7,37.4,Control\n999,37.0,Control\n"
+
+    result = import_annotations(io.BytesIO(csv), store, chunksize=2)
+    store.shared.flush()
+
+    assert (result['rows_loaded'], result['rows_rejected']) == (3, 1)
+    assert store.latitude.tolist() == [-6.9, -6.8, -6.7]
+    assert store.is_treatment.tolist() == [True, False, False]
+    assert journal_rows(tmp_path / "session.sqlite") == 3
+    assert shared.count(session='session') == 3
+
+
+def test_import_is_one_undo_batch(stores, tmp_path):
+    store, shared = stores
+    csv = b"latitude,longitude,is_treatment\n-6.9,37.2,1\n-6.8,37.3,0\n-6.7,37.4,0\n"
+
+    import_annotations(io.BytesIO(csv), store, chunksize=1)
+    store.append(-6.6, 37.5, True)
+    store.undo()
+    store.undo()
+    store.shared.flush()
+
+    assert len(store) == 0
+    assert journal_rows(tmp_path / "session.sqlite") == 0
+    assert shared.count(session='session') == 0
+
+
+def test_empty_import_clears_only_when_asked(stores):
+    store, shared = stores
+
+    result = import_annotations(io.BytesIO(BAD_FILES['header only']), store, allow_empty=True)
+    store.shared.flush()
+
+    assert result['rows_loaded'] == 0
+    assert len(store) == 0 and shared.count(session='session') == 0
+
+
+def test_import_progress_from_a_file_object(stores):
+    store, _ = stores
+    upload = io.BytesIO(b"skipped by the caller\nlatitude,longitude,is_treatment\n-6.9,37.2,1\n-6.8,37.3,0\n")
+    upload.readline()
+    upload.size = len(upload.getvalue()) - upload.tell()
+    calls = []
+
+    import_annotations(upload, store, chunksize=1, progress=lambda fraction, rows: calls.append((fraction, rows)))
+
+    assert [rows for _, rows in calls] == [1, 2]
+    assert calls[-1][0] == 1.0
+
+
+def test_csv_export_round_trip(stores, tmp_path):
+    store, _ = stores
+    path = export_annotations(store, tmp_path / "export.csv", chunksize=1)
+
+    exported = pd.read_csv(path)
+    assert exported[['latitude', 'longitude', 'is_treatment']].values.tolist() == [[-7.0, 37.0, True],
+                                                                                  [-7.5, 36.5, False]]
@@ -0,0 +1,123 @@
+"""Tests for utils.annotation_store."""
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.annotation_store import AnnotationStore, load_sessions, session_path
+
+
+def annotations(n, start=0):
+    """n annotations with distinct coordinates, alternating treatment and control."""
+    index = np.arange(start, start + n)
+    return pd.DataFrame({
+        'latitude': -7.0 - index / 1000,
+        'longitude': 37.0 + index / 1000,
+        'is_treatment': index % 2 == 0,
+        'timestamp': pd.date_range('2024-01-01', periods=n, freq='min') + pd.Timedelta(minutes=start),
+        'cell_500m': 1000 + index,
+        'ward_name': [f"Ward {i}" for i in index],
+    })
+
+
+def assert_matches(store, expected):
+    frame = store.to_frame()
+    assert len(store) == len(expected)
+    for column in ['latitude', 'longitude', 'is_treatment', 'cell_500m', 'ward_name']:
+        assert frame[column].tolist() == expected[column].tolist()
+    assert frame['timestamp'].tolist() == expected['timestamp'].tolist()
+    assert frame['type'].tolist() == np.where(expected['is_treatment'], 'Treatment', 'Control').tolist()
+
+
+def test_append_past_capacity():
+    store = AnnotationStore(capacity=2)
+    expected = annotations(5)
+
+    for row in expected.itertuples(index=False):
+        store.append(row.latitude, row.longitude, row.is_treatment, row.timestamp, cell_500m=row.cell_500m,
+                     ward_name=row.ward_name)
+    store.extend(annotations(6, start=5))
+
+    assert_matches(store, pd.concat([expected, annotations(6, start=5)], ignore_index=True))
+    # Columns not given are missing
+    assert (store['cell_100m'] == -1).all() and store.to_frame()['dist_name'].isna().all()
+    # The frame is a view on the store
+    assert np.shares_memory(store.to_frame()['latitude'].to_numpy(), store.latitude)
+
+
+def test_journal_is_replayed_after_reopening(tmp_path):
+    path = tmp_path / 'annotations.sqlite'
+    store = AnnotationStore(path, capacity=2)
+    store.extend(annotations(3))
+    store.append(-8.0, 38.0, False, pd.Timestamp('2024-02-01'))
+    store.close()
+
+    reopened = AnnotationStore(path)
+
+    expected = pd.concat([annotations(3), store.to_frame().iloc[[3]]], ignore_index=True)
+    assert_matches(reopened, expected)
+    # Batches from before the reopen cannot be undone
+    assert not reopened.can_undo and reopened.undo() == 0
+    reopened.close()
+
+
+def test_undo_removes_the_last_batch(tmp_path):
+    path = tmp_path / 'annotations.sqlite'
+    store = AnnotationStore(path, capacity=2)
+    store.extend(annotations(3))
+    store.append(-8.0, 38.0, False)
+    store.extend(annotations(4, start=3))
+    generation = store.generation
+
+    assert store.undo() == 4
+    assert store.undo() == 1
+
+    assert store.generation == generation + 2
+    assert_matches(store, annotations(3))
+    assert sqlite3.connect(path).execute("SELECT COUNT(*) FROM annotations").fetchone() == (3,)
+    # Rows added after an undo overwrite the removed ones
+    store.extend(annotations(2, start=3))
+    assert_matches(store, annotations(5))
+    store.close()
+    assert_matches(AnnotationStore(path), annotations(5))
+
+
+def test_extend_chunks_is_one_batch():
+    store = AnnotationStore()
+    store.append(-8.0, 38.0, False)
+
+    added = store.extend_chunks([annotations(2), annotations(0), annotations(3, start=2)])
+
+    assert (added, len(store)) == (5, 6)
+    assert store.undo() == 5
+    assert len(store) == 1
+
+
+def test_clear_bumps_generation_and_empties_the_journal(tmp_path):
+    path = tmp_path / 'annotations.sqlite'
+    store = AnnotationStore(path)
+    store.extend(annotations(3))
+    generation = store.generation
+
+    store.clear()
+
+    assert (len(store), store.generation, store.can_undo) == (0, generation + 1, False)
+    assert store.to_frame().empty
+    store.extend(annotations(2, start=3))
+    store.close()
+    assert_matches(AnnotationStore(path), annotations(2, start=3))
+
+
+def test_sessions(tmp_path):
+    for session, n in [('a', 2), ('b', 3)]:
+        store = AnnotationStore(session_path(session, tmp_path))
+        store.extend(annotations(n))
+        store.close()
+
+    sessions = load_sessions(tmp_path)
+
+    assert sessions['session'].tolist() == ['a', 'a', 'b', 'b', 'b']
+    assert load_sessions(tmp_path / 'none').empty
+    with pytest.raises(ValueError):
+        session_path('../escape', tmp_path)
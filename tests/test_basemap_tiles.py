@@ -0,0 +1,148 @@
+"""Tests for utils.basemap_tiles and the basemap routes of utils.tile_server against a local tile stub."""
+import io
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+from PIL import Image
+
+from utils.basemap_tiles import available_basemaps, import_tiles, plan_tiles, prefetch
+from utils.tile_server import load_basemaps, make_server
+
+BOUNDS = (36.0, -8.5, 38.5, -6.0)
+
+
+def png(z, x, y):
+    buffer = io.BytesIO()
+    Image.new('RGB', (8, 8), (z * 10, x % 255, y % 255)).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def address(tile):
+    """(z, x, y) of a mercantile tile, which is itself an (x, y, z) tuple."""
+    return tile.z, tile.x, tile.y
+
+
+def path_address(path):
+    z, x, y = path.strip('/').split('.')[0].split('/')[-3:]
+    return int(z), int(x), int(y)
+
+
+@pytest.fixture
+def tile_stub(stub_server):
+    """
+    Stub tile source: 404 for the tiles in ``empty``, 503 on the first request
+    for the tiles in ``busy`` and 403 for everything under /blocked/.
+    """
+    def respond(method, path, headers, body):
+        if path.startswith('/blocked/'):
+            return 403, {}, b'forbidden'
+        tile = path_address(path)
+        if tile in stub.empty:
+            return 404, {}, b''
+        if tile in stub.busy and stub.requests.count((method, path)) == 1:
+            return 503, {}, b'busy'
+        return 200, {'Content-Type': 'image/png'}, png(*tile)
+
+    stub = stub_server(respond)
+    stub.empty, stub.busy = set(), set()
+    stub.template = stub.url + '/{z}/{x}/{y}.png'
+    return stub
+
+
+def test_prefetch_and_resume(tile_stub, tmp_path):
+    tiles = plan_tiles(BOUNDS, 7, 8)
+    tile_stub.empty = {address(tiles[0])}
+
+    summary = prefetch('stub', tile_stub.template, BOUNDS, 7, 8, directory=tmp_path, workers=2)
+
+    assert (summary['tiles_planned'], summary['tiles_fetched'], summary['tiles_empty'], summary['tiles_failed']) \
+        == (len(tiles), len(tiles) - 1, 1, 0)
+    assert available_basemaps(tmp_path)['stub']['format'] == 'png'
+
+    requests = len(tile_stub.requests)
+    summary = prefetch('stub', tile_stub.template, BOUNDS, 7, 9, directory=tmp_path, workers=2)
+
+    # The empty tile is cached as well, so only the new zoom level is requested
+    assert summary['tiles_cached'] == len(tiles)
+    assert (summary['tiles_fetched'], summary['tiles_empty']) == (len(plan_tiles(BOUNDS, 9, 9)), 0)
+    assert len(tile_stub.requests) - requests == summary['tiles_fetched']
+
+
+def test_server_errors_are_retried(tile_stub, tmp_path):
+    tiles = plan_tiles(BOUNDS, 7, 7)
+    tile_stub.busy = {address(tiles[0])}
+
+    summary = prefetch('stub', tile_stub.template, BOUNDS, 7, 7, directory=tmp_path, max_attempts=2)
+
+    assert (summary['tiles_fetched'], summary['tiles_failed']) == (len(tiles), 0)
+    assert len(tile_stub.requests) == summary['tiles_planned'] + 1
+
+
+def test_client_errors_are_not_retried(tile_stub, tmp_path):
+    summary = prefetch('blocked', tile_stub.url + '/blocked/{z}/{x}/{y}.png', BOUNDS, 7, 7, directory=tmp_path,
+                       max_attempts=3)
+
+    assert (summary['tiles_fetched'], summary['tiles_failed']) == (0, summary['tiles_planned'])
+    assert len(tile_stub.requests) == summary['tiles_planned']
+
+
+def test_import_from_directory_and_mbtiles(tmp_path):
+    source = tmp_path / 'tiles'
+    for tile in plan_tiles(BOUNDS, 6, 7):
+        (source / str(tile.z) / str(tile.x)).mkdir(parents=True, exist_ok=True)
+        (source / str(tile.z) / str(tile.x) / f"{tile.y}.png").write_bytes(png(*address(tile)))
+    # Not a tile
+    (source / '6' / 'README.txt').write_text('notes')
+    basemaps = tmp_path / 'basemaps'
+
+    assert import_tiles('s2', source, BOUNDS, 7, 7, directory=basemaps) == len(plan_tiles(BOUNDS, 7, 7))
+    assert import_tiles('copy', basemaps / 's2.mbtiles', None, 0, 22, directory=basemaps) \
+        == len(plan_tiles(BOUNDS, 7, 7))
+    metadata = available_basemaps(basemaps)['copy']
+    assert (metadata['format'], int(metadata['minzoom']), int(metadata['maxzoom'])) == ('png', 7, 7)
+
+
+@pytest.fixture
+def basemap_server(tile_stub, tmp_path):
+    tile_stub.empty = {address(plan_tiles(BOUNDS, 7, 7)[-1])}
+    prefetch('stub', tile_stub.template, BOUNDS, 7, 7, directory=tmp_path)
+    server = make_server(None, '127.0.0.1', 0, load_basemaps(tmp_path))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+
+def get(url, **headers):
+    """(status, headers, body) of a GET, without raising on 3xx/4xx."""
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as error:
+        return error.code, error.headers, error.read()
+
+
+def test_tile_server_etag_and_revalidation(basemap_server):
+    tile = plan_tiles(BOUNDS, 7, 7)[0]
+    url = f"{basemap_server}/basemap/stub/{tile.z}/{tile.x}/{tile.y}.png"
+
+    status, headers, body = get(url)
+    assert (status, body) == (200, png(*address(tile)))
+    assert headers['Content-Type'] == 'image/png'
+    assert headers['Cache-Control'].startswith('public, max-age=')
+    etag = headers['ETag']
+
+    status, headers, body = get(url, **{'If-None-Match': etag})
+    assert (status, headers['ETag'], body) == (304, etag, b'')
+
+    status, _, _ = get(url, **{'If-None-Match': '"stale"'})
+    assert status == 200
+
+
+def test_tile_server_missing_tiles(basemap_server):
+    empty = plan_tiles(BOUNDS, 7, 7)[-1]
+    assert get(f"{basemap_server}/basemap/stub/{empty.z}/{empty.x}/{empty.y}.png")[0] == 204
+    assert get(f"{basemap_server}/basemap/stub/3/0/0.png")[0] == 204
+    assert get(f"{basemap_server}/basemap/unknown/6/0/0.png")[0] == 404
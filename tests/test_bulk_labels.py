@@ -0,0 +1,108 @@
+"""Tests for utils.bulk_labels and how bulk labels are stored and drawn."""
+import json
+
+import geopandas as gpd
+import numpy as np
+import pytest
+from shapely.geometry import Polygon, box
+
+from config.settings import TARGET_CRS
+from spatial_prep import grid
+from utils.annotation_layer import AnnotationChunk, AnnotationLayer
+from utils.annotation_store import SOURCE_CLICK, AnnotationStore, cell_source
+from utils.bulk_labels import label_shapes, select_cells, select_wards
+from utils.snapping import PointSnapper
+
+ORIGIN = (800_000, 9_200_000)
+CELL_SIZE = 100
+
+
+@pytest.fixture(scope='module')
+def snapper():
+    """Four 1 km square wards in a 2 x 2 block."""
+    x0, y0 = ORIGIN
+    squares = [box(x0 + i * 1000, y0 + j * 1000, x0 + (i + 1) * 1000, y0 + (j + 1) * 1000)
+               for j in range(2) for i in range(2)]
+    wards = gpd.GeoDataFrame({'ward_name': [f"ward_{i}" for i in range(4)], 'dist_name': 'District',
+                              'reg_name': 'Region'}, geometry=squares, crs=TARGET_CRS)
+    return PointSnapper(wards)
+
+
+def triangle():
+    """A triangle over the two southern wards that sticks out of the block to the west."""
+    x0, y0 = ORIGIN
+    return Polygon([(x0 - 500, y0 + 50), (x0 + 1750, y0 + 50), (x0 + 1750, y0 + 1250)])
+
+
+def test_select_cells_takes_the_cells_with_their_centre_inside(snapper):
+    polygon = triangle()
+
+    cells = select_cells(polygon, CELL_SIZE, snapper, is_treatment=True)
+
+    # Naive: every cell centre of the block, tested one by one
+    x0, y0 = ORIGIN
+    expected = {
+        int(grid.point_cell_ids(np.array([x]), np.array([y]), CELL_SIZE)[0])
+        for x in np.arange(x0 + 50, x0 + 2000, CELL_SIZE) for y in np.arange(y0 + 50, y0 + 2000, CELL_SIZE)
+        if polygon.contains(box(x - 1e-3, y - 1e-3, x + 1e-3, y + 1e-3))
+    }
+    assert set(cells[f'cell_{CELL_SIZE}m']) == expected and len(cells) == len(expected)
+    assert (cells['source'] == cell_source(CELL_SIZE)).all() and cells['is_treatment'].all()
+    assert set(cells['ward_name']) == {'ward_0', 'ward_1', 'ward_3'}
+
+
+def test_select_cells_refuses_large_selections(snapper):
+    with pytest.raises(ValueError, match="more than 100"):
+        select_cells(triangle(), CELL_SIZE, snapper, is_treatment=True, max_cells=100)
+
+
+def test_select_wards_skips_wards_barely_touched(snapper):
+    x0, y0 = ORIGIN
+    # All of the western wards 0 and 2 and a tenth of the eastern wards 1 and 3
+    polygon = box(x0 - 10, y0 - 10, x0 + 1100, y0 + 2010)
+
+    wards = select_wards(polygon, snapper, is_treatment=False, min_share=0.5)
+
+    assert wards['ward_name'].tolist() == ['ward_0', 'ward_2']
+    assert (wards['source'] == 'ward').all() and not wards['is_treatment'].any()
+    assert select_wards(polygon, snapper, is_treatment=False, min_share=0.05)['ward_name'].tolist() \
+        == ['ward_0', 'ward_1', 'ward_2', 'ward_3']
+
+
+def test_undo_removes_the_whole_selection(snapper):
+    store = AnnotationStore()
+    store.append(-7.0, 37.0, True, source=SOURCE_CLICK)
+    cells = select_cells(triangle(), CELL_SIZE, snapper, is_treatment=False)
+
+    store.extend(cells)
+    assert len(store) == 1 + len(cells)
+
+    assert store.undo() == len(cells)
+    assert len(store) == 1 and store['source'].tolist() == [SOURCE_CLICK]
+
+
+def test_layer_chunks_only_hold_points(snapper):
+    store = AnnotationStore()
+    layer = AnnotationLayer(chunk_size=2)
+    for i in range(3):
+        store.append(-7.0 - i / 100, 37.0, True, source=SOURCE_CLICK)
+    store.extend(select_cells(triangle(), CELL_SIZE, snapper, is_treatment=False))
+    layer.sync(store)
+    for i in range(2):
+        store.append(-7.1 - i / 100, 37.0, False, source=SOURCE_CLICK)
+
+    layer.sync(store)
+
+    scripts = [child.data for child in layer.feature_group()._children.values() if isinstance(child, AnnotationChunk)]
+    assert [len(json.loads(data)['features']) for data in scripts] == [2, 2, 1]
+    assert sum(feature['properties']['cells'] for feature in layer._cells['features']) == len(store) - 5
+
+
+def test_label_shapes_keep_the_latest_label_of_a_cell(snapper):
+    cells = select_cells(triangle(), CELL_SIZE, snapper, is_treatment=True)
+    relabelled = cells.iloc[:3].assign(is_treatment=False)
+
+    shapes = label_shapes(cells._append(relabelled, ignore_index=True), [CELL_SIZE])
+
+    counts = {feature['properties']['is_treatment']: feature['properties']['cells'] for feature in shapes['features']}
+    assert counts == {True: len(cells) - 3, False: 3}
@@ -0,0 +1,64 @@
+"""Tests for the process-wide data layer of the app (utils.data_layer)."""
+import os
+
+import pytest
+
+from benchmarks.synthetic import make_wards
+from utils import data_layer
+
+BOUNDS = (800_000, 9_200_000, 820_000, 9_220_000)
+
+
+@pytest.fixture
+def wards_file(tmp_path, monkeypatch):
+    path = tmp_path / 'relevant_wards_with_flags.geojson'
+    monkeypatch.setattr(data_layer, 'WARDS_FILE', path)
+    data_layer.clear()
+    yield path
+    data_layer.clear()
+
+
+def write_wards(path, n_wards):
+    make_wards(n_wards=n_wards, n_districts=2, n_regions=2, bounds=BOUNDS).to_crs('EPSG:4326').to_file(path)
+
+
+def test_file_version_of_a_dataset_ignores_tiles_being_written(tmp_path):
+    dataset = tmp_path / 'grid_500m'
+    (dataset / 'tile=0_0').mkdir(parents=True)
+    (dataset / 'tile=0_0' / 'part.parquet').write_bytes(b'a' * 10)
+
+    version = data_layer.file_version(dataset)
+
+    assert (version[0], version[2]) == (1, 10)
+    (dataset / '.tile=1_0').mkdir()
+    (dataset / '.tile=1_0' / 'part.parquet').write_bytes(b'b' * 5)
+    assert data_layer.file_version(dataset) == version
+    (dataset / '.tile=1_0').rename(dataset / 'tile=1_0')
+    parts, _, size = data_layer.file_version(dataset)
+    assert (parts, size) == (2, 15)
+    assert data_layer.file_version(tmp_path / 'missing') is None
+
+
+def test_ward_layer_is_shared_until_the_file_changes(wards_file):
+    assert data_layer.ward_layer() is None
+
+    write_wards(wards_file, 10)
+    layer = data_layer.ward_layer()
+
+    assert len(layer) == 10
+    assert data_layer.ward_layer() is layer
+    # A rewrite by the pipeline gives a new version, and the next call a new layer
+    stat = wards_file.stat()
+    write_wards(wards_file, 12)
+    os.utime(wards_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert len(data_layer.ward_layer()) == 12
+    assert data_layer.snapper() is data_layer.snapper()
+
+
+def test_clear_drops_the_shared_layers(wards_file):
+    write_wards(wards_file, 10)
+    layer = data_layer.ward_layer()
+
+    data_layer.clear()
+
+    assert data_layer.ward_layer() is not layer
@@ -0,0 +1,68 @@
+"""Tests for the adjacency graph of utils.geo_utils, checked against pairwise comparisons."""
+import itertools
+
+import pytest
+
+from benchmarks.synthetic import make_wards
+from utils.geo_utils import build_adjacency, find_adjacent, load_or_build_adjacency, neighbour_lists
+
+BOUNDS = (800_000, 9_200_000, 830_000, 9_230_000)
+
+
+@pytest.fixture(scope='module')
+def wards():
+    wards = make_wards(n_wards=40, n_districts=5, n_regions=2, bounds=BOUNDS)
+    # Open a gap between two neighbours, so distance and touches differ
+    wards.loc[0, 'geometry'] = wards.geometry[0].buffer(-300)
+    return wards
+
+
+def brute_force(wards, buffer_distance):
+    """(source, target) -> touches for every ordered pair of wards within buffer_distance."""
+    geoms = dict(zip(wards['ward_name'], wards.geometry))
+    return {
+        (a, b): geoms[a].touches(geoms[b])
+        for a, b in itertools.permutations(geoms, 2) if geoms[a].distance(geoms[b]) <= buffer_distance
+    }
+
+
+@pytest.mark.parametrize('buffer_distance', [0, 500, 2000])
+def test_adjacency_matches_pairwise_checks(wards, buffer_distance):
+    edges = build_adjacency(wards, 'ward_name', buffer_distance=buffer_distance)
+
+    expected = brute_force(wards, buffer_distance)
+    assert dict(zip(zip(edges['source'], edges['target']), edges['touches'])) == expected
+    assert len(edges) == len(expected)
+    assert (edges['distance_m'] <= buffer_distance).all()
+    # Ward 0 only reaches its old neighbours across the gap
+    assert not edges.loc[edges['source'] == 'Ward 0000', 'touches'].any()
+
+
+def test_adjacency_in_another_crs(wards):
+    edges = build_adjacency(wards, 'ward_name', buffer_distance=500)
+
+    reprojected = build_adjacency(wards.to_crs('EPSG:4326'), 'ward_name', buffer_distance=500)
+
+    assert set(zip(reprojected['source'], reprojected['target'])) == set(zip(edges['source'], edges['target']))
+
+
+def test_cached_adjacency(wards, tmp_path):
+    edges = load_or_build_adjacency(wards, 'ward_name', buffer_distance=500, cache_dir=tmp_path)
+
+    assert load_or_build_adjacency(wards, 'ward_name', buffer_distance=500, cache_dir=tmp_path).equals(edges)
+    assert len(list(tmp_path.glob('adjacency_ward_name_*.parquet'))) == 1
+    # A different buffer is a different cache entry
+    load_or_build_adjacency(wards, 'ward_name', buffer_distance=0, cache_dir=tmp_path)
+    assert len(list(tmp_path.glob('adjacency_ward_name_*.parquet'))) == 2
+
+
+def test_find_adjacent(wards):
+    edges = build_adjacency(wards, 'ward_name', buffer_distance=500)
+    neighbours = neighbour_lists(edges)
+    targets = ['Ward 0001', 'Ward 0002']
+
+    adjacent = find_adjacent(edges, targets)
+
+    assert adjacent == sorted((set(neighbours['Ward 0001']) | set(neighbours['Ward 0002'])) - set(targets))
+    touching = find_adjacent(edges, targets, max_distance=0)
+    assert set(touching) <= set(adjacent)
@@ -0,0 +1,66 @@
+"""Tests for the cell id arithmetic and ward clipping of spatial_prep.grid."""
+import numpy as np
+import pytest
+import shapely
+
+from benchmarks.synthetic import make_wards
+from spatial_prep import grid
+
+# Not aligned to the cells, so cells along the edge of the wards are clipped
+BOUNDS = (800_030, 9_200_070, 806_010, 9_205_950)
+
+
+@pytest.fixture(scope='module')
+def wards():
+    return grid.prepare_wards(make_wards(n_wards=15, n_districts=3, n_regions=2, bounds=BOUNDS))
+
+
+@pytest.mark.parametrize('cell_size', [100, 500])
+def test_cell_id_round_trip(cell_size):
+    rng = np.random.default_rng(0)
+    cols = rng.integers(0, 1_000_000 // cell_size, 1000)
+    rows = rng.integers(8_750_000 // cell_size, 9_850_000 // cell_size, 1000)
+
+    ids = grid.cell_ids(cols, rows, cell_size)
+
+    assert len(np.unique(ids)) == len(np.unique(np.stack([cols, rows]), axis=1).T)
+    assert [c.tolist() for c in grid.cell_coords(ids, cell_size)] == [cols.tolist(), rows.tolist()]
+    # The cell of any point inside a cell is that cell, including its south-west corner
+    x = cols * cell_size + rng.uniform(0, cell_size, 1000)
+    y = rows * cell_size + rng.uniform(0, cell_size, 1000)
+    assert (grid.point_cell_ids(x, y, cell_size) == ids).all()
+    assert (grid.point_cell_ids(cols * cell_size, rows * cell_size, cell_size) == ids).all()
+    assert shapely.contains(grid.cell_polygons(ids, cell_size), shapely.points(x, y)).all()
+
+
+def test_parent_and_child_ids():
+    ids = grid.cell_ids([8000, 8004, 8005], [92000, 92003, 92009], 100)
+
+    parents = grid.parent_ids(ids, 100, 500)
+
+    assert parents.tolist() == grid.cell_ids([1600, 1600, 1601], [18400, 18400, 18401], 500).tolist()
+    children = grid.child_ids(parents, 500, 100)
+    assert children.shape == (3, 25)
+    assert all(cell in row for cell, row in zip(ids, children))
+    assert (grid.parent_ids(children.ravel(), 100, 500) == np.repeat(parents, 25)).all()
+
+
+@pytest.mark.parametrize('cell_size', [100, 500])
+def test_clipped_cells_cover_each_ward(wards, cell_size):
+    cells = grid.build_grid(wards, cell_size, max_cells=400)
+
+    # Pieces of each ward add up to the ward, whatever the batch boundaries (up to the dropped slivers)
+    ward_areas = wards.set_index('ward_name').geometry.area
+    piece_areas = (cells['area_frac'] * cell_size ** 2).groupby(cells['ward_name']).sum()
+    assert piece_areas.reindex(ward_areas.index).to_numpy() == pytest.approx(ward_areas.to_numpy(), rel=1e-6)
+    assert cells['area_frac'].tolist() == pytest.approx((cells.geometry.area / cell_size ** 2).tolist())
+    # Pieces of one cell in different wards add up to at most the whole cell
+    assert cells.groupby('cell_id')['area_frac'].sum().max() == pytest.approx(1.0)
+    assert not cells.duplicated(['cell_id', 'ward_name']).any()
+    assert (cells['cell_id'] == grid.cell_ids(cells['col'], cells['row'], cell_size)).all()
+
+
+def test_clip_block_outside_the_wards_is_empty(wards):
+    tree = shapely.STRtree(np.asarray(wards.geometry.values))
+
+    assert grid.clip_block(wards, tree, (0, 0, 10, 10), 500).empty
@@ -0,0 +1,98 @@
+"""Tests for spatial_prep.imagery against a local stub of the HTTP imagery endpoint."""
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from spatial_prep import grid
+from spatial_prep.imagery import HttpImageryClient, ImageryCache, ImageryClient, extract_imagery, load_imagery
+
+CELL_SIZE = 500
+BANDS = ['B4', 'NDVI']
+
+
+def cell_ids(n):
+    """n adjacent grid cells near Kilosa."""
+    x = 800_000 + CELL_SIZE * np.arange(n) + CELL_SIZE / 2
+    return grid.point_cell_ids(x, np.full(n, 9_200_250.0), CELL_SIZE)
+
+
+def band_rows(ids):
+    """The values the stub answers with: B4 = cell id, NDVI = 0.5."""
+    return [{'cell_id': int(cell_id), 'B4': float(cell_id), 'NDVI': 0.5} for cell_id in ids]
+
+
+@pytest.fixture
+def imagery_stub(stub_server):
+    """Stub endpoint that fails with 503 on every request listed in ``fail``."""
+    def respond(method, path, headers, body):
+        stub.calls += 1
+        if stub.calls in stub.fail:
+            return 503, {}, b'busy'
+        request = json.loads(body)
+        assert request['bands'] == BANDS and len(request['geometries']) == len(request['cell_ids'])
+        return 200, {'Content-Type': 'application/json'}, json.dumps({'rows': band_rows(request['cell_ids'])}).encode()
+
+    stub = stub_server(respond)
+    stub.calls, stub.fail = 0, set()
+    return stub
+
+
+def extract(ids, stub, cache_dir, **kwargs):
+    return extract_imagery(ids, CELL_SIZE, client=HttpImageryClient(stub.url, timeout=5), bands=BANDS,
+                           batch_size=4, workers=2, cache_dir=cache_dir, **kwargs)
+
+
+def test_transient_errors_are_retried(imagery_stub, tmp_path):
+    imagery_stub.fail = {1}
+    ids = cell_ids(3)
+
+    summary = extract(ids, imagery_stub, tmp_path, max_attempts=3)
+
+    assert (summary['cells_fetched'], summary['retries']) == (3, 1)
+    stats = load_imagery(ids, CELL_SIZE, bands=BANDS, cache_dir=tmp_path)
+    assert stats['B4'].tolist() == sorted(float(cell_id) for cell_id in ids)
+
+
+def test_failing_batch_fails_the_run_after_max_attempts(imagery_stub, tmp_path):
+    imagery_stub.fail = {1, 2}
+
+    with pytest.raises(Exception, match='503'):
+        extract(cell_ids(3), imagery_stub, tmp_path, max_attempts=2)
+    assert imagery_stub.calls == 2
+
+
+def test_rerun_only_fetches_missing_cells(imagery_stub, tmp_path):
+    ids = cell_ids(10)
+    extract(ids[:6], imagery_stub, tmp_path)
+    calls = imagery_stub.calls
+
+    summary = extract(ids, imagery_stub, tmp_path)
+
+    assert (summary['cells_cached'], summary['cells_fetched'], summary['batches']) == (6, 4, 1)
+    assert imagery_stub.calls == calls + 1
+    assert len(load_imagery(ids, CELL_SIZE, bands=BANDS, cache_dir=tmp_path)) == 10
+
+
+def test_duplicate_ids_in_the_cache(imagery_stub, tmp_path):
+    ids = cell_ids(8)
+    cache = ImageryCache(CELL_SIZE, BANDS, cache_dir=tmp_path)
+    # The same cells written by two overlapping runs
+    cached = pd.DataFrame(band_rows(ids[[0, 2, 4]]))
+    cache.write(cached)
+    cache.write(cached)
+
+    summary = extract(ids, imagery_stub, tmp_path)
+
+    assert (summary['cells_cached'], summary['cells_fetched']) == (3, 5)
+    stats = load_imagery(ids, CELL_SIZE, bands=BANDS, cache_dir=tmp_path)
+    assert stats['cell_id'].tolist() == sorted(ids.tolist())
+
+
+def test_incomplete_client_fails_when_created():
+    class NoReduceClient(ImageryClient):
+        retry_on = (ConnectionError,)
+
+    with pytest.raises(TypeError, match='reduce_cells'):
+        NoReduceClient()
@@ -0,0 +1,47 @@
+"""Tests for utils.instrumentation."""
+import gc
+import threading
+import time
+
+import pytest
+
+from utils.instrumentation import track
+
+
+@pytest.fixture(autouse=True)
+def no_metrics_log(monkeypatch):
+    # Keep test runs out of METRICS_LOG_FILE
+    monkeypatch.setattr('utils.instrumentation._log_configured', True)
+
+
+def wait_for_threads(count, timeout=5):
+    deadline = time.monotonic() + timeout
+    while threading.active_count() > count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return threading.active_count()
+
+
+def test_stop_records_the_step():
+    with track('test.step', rows=3, cell_size=100) as step:
+        sum(range(1000))
+
+    assert step.result['step'] == 'test.step'
+    assert (step.result['rows'], step.result['cell_size'], step.result['error']) == (3, 100, False)
+    assert step.stop() is step.result  # stopping twice records once
+
+
+def test_error_is_recorded():
+    with pytest.raises(RuntimeError):
+        with track('test.failing') as step:
+            raise RuntimeError
+
+    assert step.result['error'] is True
+
+
+def test_unstopped_trackers_do_not_leak_sampler_threads():
+    before = threading.active_count()
+    for _ in range(50):
+        track('test.interrupted').start()  # dropped without stop(), like an interrupted app rerun
+    gc.collect()
+
+    assert wait_for_threads(before) == before
@@ -0,0 +1,141 @@
+"""Tests for spatial_prep.matching on small synthetic cell tables."""
+import numpy as np
+import pandas as pd
+import pytest
+
+from spatial_prep.matching import balance_table, candidate_controls, match_cells, matching_features
+
+
+def make_cells(n_treated=20, n_controls=200, n_districts=3, seed=0):
+    """Cells with two covariates; the treated ones sit higher on both."""
+    rng = np.random.default_rng(seed)
+    n = n_treated + n_controls
+    treated = np.arange(n) < n_treated
+    return pd.DataFrame({
+        'cell_id': np.arange(1000, 1000 + n),
+        'dist_name': [f"District {i}" for i in rng.integers(0, n_districts, n)],
+        'is_treatment': treated,
+        'is_adjacent_region': ~treated & (np.arange(n) % 2 == 0),
+        'x': rng.uniform(0, 10_000, n),
+        'y': rng.uniform(0, 10_000, n),
+        'forest': rng.normal(0, 1, n) + treated,
+        'slope': rng.normal(0, 1, n) + 0.5 * treated,
+    })
+
+
+def features_by_cell(cells, covariates, method):
+    """Matching features by cell id, as match_cells computes them when every cell is usable."""
+    features = matching_features(cells[covariates].to_numpy(dtype=np.float64), cells['is_treatment'].to_numpy(),
+                                 method)
+    return dict(zip(cells['cell_id'], features))
+
+
+def nearest_controls(cells, features, cell_id, k, block_by=None):
+    """Brute force: the k nearest control cell ids of a treated cell."""
+    controls = cells[~cells['is_treatment']]
+    if block_by:
+        block = cells.loc[cells['cell_id'] == cell_id, block_by].item()
+        controls = controls[controls[block_by] == block]
+    distances = {c: np.linalg.norm(features[cell_id] - features[c]) for c in controls['cell_id']}
+    return sorted(distances, key=distances.get)[:k]
+
+
+@pytest.mark.parametrize('method, caliper', [('propensity', 0.05), ('covariate', 0.5)])
+def test_caliper_bounds_every_distance(method, caliper):
+    cells = make_cells()
+    features = features_by_cell(cells, ['forest', 'slope'], method)
+
+    pairs = match_cells(cells, ['forest', 'slope'], method=method, ratio=1, replacement=True, caliper=caliper,
+                        block_by=None)
+
+    # Tight enough that some treated cells stay unmatched
+    assert 0 < pairs['treated_cell_id'].nunique() < 20
+    assert (pairs['distance'] <= caliper).all()
+    for treated, control, distance in pairs[['treated_cell_id', 'control_cell_id', 'distance']].itertuples(
+            index=False):
+        assert distance == pytest.approx(np.linalg.norm(features[treated] - features[control]))
+    # A treated cell is unmatched exactly when no control lies within the caliper
+    for treated in cells.loc[cells['is_treatment'], 'cell_id']:
+        nearest = nearest_controls(cells, features, treated, 1)[0]
+        within = np.linalg.norm(features[treated] - features[nearest]) <= caliper
+        assert within == (treated in set(pairs['treated_cell_id']))
+
+
+def test_no_control_is_reused_without_replacement():
+    # Few controls, so treated cells compete for the same ones
+    cells = make_cells(n_treated=30, n_controls=60)
+
+    pairs = match_cells(cells, ['forest', 'slope'], method='covariate', ratio=2, replacement=False, caliper=None,
+                        block_by=None)
+
+    assert pairs['control_cell_id'].is_unique
+    assert len(pairs) == 60
+    assert pairs.attrs['controls_used'] == 60
+
+
+def test_with_replacement_every_treated_cell_gets_its_nearest_controls():
+    cells = make_cells()
+    features = features_by_cell(cells, ['forest', 'slope'], 'covariate')
+
+    pairs = match_cells(cells, ['forest', 'slope'], method='covariate', ratio=3, replacement=True, caliper=None,
+                        block_by=None)
+
+    assert len(pairs) == 3 * 20
+    assert pairs['weight'].tolist() == pytest.approx([1 / 3] * 60)
+    for treated, group in pairs.groupby('treated_cell_id'):
+        assert group['control_cell_id'].tolist() == nearest_controls(cells, features, treated, 3)
+
+
+def test_ratio_without_replacement_gives_each_treated_cell_distinct_controls():
+    cells = make_cells()
+
+    pairs = match_cells(cells, ['forest', 'slope'], method='propensity', ratio=3, replacement=False, caliper=None,
+                        block_by=None)
+
+    assert pairs.groupby('treated_cell_id').size().tolist() == [3] * 20
+    assert pairs['control_cell_id'].is_unique
+    assert (pairs.groupby('treated_cell_id')['distance'].apply(lambda d: d.is_monotonic_increasing)).all()
+
+
+@pytest.mark.parametrize('replacement', [True, False])
+def test_matches_stay_within_a_block(replacement):
+    cells = make_cells(n_districts=4)
+    features = features_by_cell(cells, ['forest', 'slope'], 'covariate')
+
+    pairs = match_cells(cells, ['forest', 'slope'], method='covariate', ratio=1, replacement=replacement,
+                        caliper=None, block_by='dist_name')
+
+    district = cells.set_index('cell_id')['dist_name']
+    assert (district[pairs['treated_cell_id']].to_numpy() == district[pairs['control_cell_id']].to_numpy()).all()
+    assert pairs.attrs['treated_matched'] == 20
+    if replacement:
+        for treated, control in pairs[['treated_cell_id', 'control_cell_id']].itertuples(index=False):
+            assert [control] == nearest_controls(cells, features, treated, 1, block_by='dist_name')
+
+
+def test_candidate_controls_pool():
+    cells = make_cells()
+
+    assert candidate_controls(cells, pool='all').tolist() == (~cells['is_treatment']).tolist()
+    assert candidate_controls(cells, pool='adjacent').tolist() == cells['is_adjacent_region'].tolist()
+    with pytest.raises(ValueError):
+        candidate_controls(cells, pool='everywhere')
+
+
+def test_balance_table():
+    cells = pd.DataFrame({
+        'cell_id': [1, 2, 3, 4, 5],
+        'is_treatment': [True, True, False, False, False],
+        'forest': [4.0, 6.0, 1.0, 3.0, 5.0],
+    })
+    pairs = pd.DataFrame({'treated_cell_id': [1, 2, 2], 'control_cell_id': [4, 4, 5], 'weight': [1, 0.5, 0.5]})
+
+    table = balance_table(cells, pairs, ['forest'])
+
+    row = table.loc['forest']
+    pooled_sd = np.sqrt((np.var([4, 6], ddof=1) + np.var([1, 3, 5], ddof=1)) / 2)
+    assert (row['mean_treated'], row['mean_control'], row['mean_matched_treated']) == (5.0, 3.0, 5.0)
+    # Weighted: 3 * 1 + 3 * 0.5 + 5 * 0.5 over a total weight of 2
+    assert row['mean_matched_control'] == pytest.approx(3.5)
+    assert row['smd_before'] == pytest.approx(2 / pooled_sd)
+    assert row['smd_after'] == pytest.approx(1.5 / pooled_sd)
@@ -0,0 +1,79 @@
+"""Tests for utils.mvt: tiles are decoded with the reference decoder (mapbox-vector-tile)."""
+import mapbox_vector_tile
+import mercantile
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+from shapely.geometry import shape
+
+from utils import mvt
+
+TILE = mercantile.Tile(4, 4, 3)
+BOUNDS = tuple(mercantile.xy_bounds(TILE))
+
+
+def mercator(u, v):
+    """EPSG:3857 coordinates of the fractions (u, v) of TILE, with v counted from the top."""
+    west, south, east, north = BOUNDS
+    return west + (east - west) * np.asarray(u), north - (north - south) * np.asarray(v)
+
+
+def decode(data):
+    return mapbox_vector_tile.decode(data, default_options={'y_coord_down': True})
+
+
+def test_points_with_properties_and_ids():
+    points = shapely.points(*mercator([0.25, 0.75], [0.25, 0.5]))
+    properties = pd.DataFrame({'name': ['a', 'b'], 'n': [1, -2], 'share': [0.5, 1.5], 'flag': [True, False]})
+
+    layer = decode(mvt.encode_tile([('points', points, properties, np.array([10, 11]))], BOUNDS))['points']
+
+    assert (layer['extent'], layer['version']) == (mvt.EXTENT, 2)
+    assert [f['geometry']['coordinates'] for f in layer['features']] == [[1024, 1024], [3072, 2048]]
+    assert [f['id'] for f in layer['features']] == [10, 11]
+    assert [f['properties'] for f in layer['features']] == properties.to_dict('records')
+
+
+def test_polygons_are_clipped_to_the_buffer_and_keep_holes():
+    x, y = mercator([0, 0.5, 0.1, 0.2], [1, 0.5, 0.9, 0.8])
+    square = shapely.Polygon([(x[0], y[0]), (x[1], y[0]), (x[1], y[1]), (x[0], y[1])],
+                             [[(x[2], y[2]), (x[3], y[2]), (x[3], y[3]), (x[2], y[3])]])
+    # Reaches one tile past the north-east corner
+    outside = shapely.box(*mercator(0.5, 0.5), *mercator(2, -1))
+    properties = pd.DataFrame({'status': ['control', None]})
+
+    layer = decode(mvt.encode_tile([('wards', np.array([outside, square]), properties, None)], BOUNDS))['wards']
+
+    clipped, holed = (shape(f['geometry']) for f in layer['features'])
+    edge = mvt.EXTENT + mvt.BUFFER
+    assert clipped.equals(shapely.box(2048, -mvt.BUFFER, edge, 2048))
+    assert holed.equals(shapely.Polygon([(0, 4096), (2048, 4096), (2048, 2048), (0, 2048)],
+                                        [[(410, 3686), (819, 3686), (819, 3277), (410, 3277)]]))
+    # Missing values are left out rather than written as a value
+    assert [f['properties'] for f in layer['features']] == [{'status': 'control'}, {}]
+
+
+def test_extent_and_empty_layers():
+    points = shapely.points(*mercator([0.5], [0.5]))
+    far_away = shapely.points(*mercator([5.0], [5.0]))
+
+    tile = decode(mvt.encode_tile([('near', points, pd.DataFrame(index=[0]), None),
+                                   ('far', far_away, pd.DataFrame(index=[0]), None),
+                                   ('none', np.array([], dtype=object), pd.DataFrame(), None)],
+                                  BOUNDS, extent=512))
+
+    assert list(tile) == ['near']
+    assert tile['near']['extent'] == 512
+    assert tile['near']['features'][0]['geometry']['coordinates'] == [256, 256]
+    assert mvt.encode_tile([('far', far_away, pd.DataFrame(index=[0]), None)], BOUNDS) == b''
+
+
+@pytest.mark.parametrize('value', [0, 1, 127, 128, 300, 2 ** 35, 2 ** 63 - 1])
+def test_varints_match_single_encoding(value):
+    values = np.array([value, 5, value], dtype=np.uint64)
+
+    buffer, offsets = mvt._varints(values)
+
+    assert buffer == b''.join(mvt._varint(int(v)) for v in values)
+    assert buffer[offsets[0]:offsets[1]] == mvt._varint(value)
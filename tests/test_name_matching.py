@@ -0,0 +1,53 @@
+"""Tests for utils.name_matching."""
+import pandas as pd
+
+from utils.name_matching import match_names, normalize_names
+
+
+def wards_layer():
+    """Shapefile-like wards; Ulaya and Kidodi appear twice (e.g. split polygons)."""
+    return pd.DataFrame({
+        'ward_name': ['Mikumi', 'Ulaya', 'Ulaya', 'Kidodi', 'Kidodi', 'Ruaha', 'Ulaya'],
+        'dist_name': ['Kilosa', 'Kilosa', 'Kilosa', 'Kilosa', 'Kilosa', 'Kilosa', 'Mvomero'],
+    }, index=[3, 14, 15, 20, 21, 9, 30])
+
+
+def flagged(report, wards):
+    """Treatment flags as set by the pipeline and notebook 01."""
+    return wards.index.isin(report.loc[report['accepted'], 'right_index'])
+
+
+def test_normalize_names():
+    names = pd.Series(["Kilosa District", "KILLOSA", " kilosa-ward ", "Mlali Kata"])
+
+    assert normalize_names(names).tolist() == ['KILOSA', 'KILOSA', 'KILOSA', 'MLALI']
+
+
+def test_exact_match_flags_every_duplicate_row():
+    wards = wards_layer()
+    survey = pd.DataFrame({'Ward': ['ULAYA', 'Ulaya'], 'District': ['Kilosa', 'Kilosa District']})
+
+    report = match_names(survey, wards)
+
+    assert wards.index[flagged(report, wards)].tolist() == [14, 15]
+    assert set(report['match_type']) == {'exact'}
+
+
+def test_fuzzy_match_flags_every_duplicate_row():
+    wards = wards_layer()
+    survey = pd.DataFrame({'Ward': ['Kidodie'], 'District': ['Kilosa']})
+
+    report = match_names(survey, wards)
+
+    assert wards.index[flagged(report, wards)].tolist() == [20, 21]
+    assert report.loc[report['accepted'], 'match_type'].eq('fuzzy').all()
+
+
+def test_matches_stay_within_the_district():
+    wards = wards_layer()
+    survey = pd.DataFrame({'Ward': ['Ulaya', 'Nowhere'], 'District': ['Mvomero', 'Kilosa']})
+
+    report = match_names(survey, wards)
+
+    assert wards.index[flagged(report, wards)].tolist() == [30]
+    assert report.loc[report['ward'] == 'Nowhere', 'match_type'].tolist() == ['unmatched']
@@ -0,0 +1,38 @@
+"""Tests for the stage keys of spatial_prep.pipeline."""
+import pytest
+
+from spatial_prep.pipeline import STAGES, Stage, module_digest, stage_key
+
+
+def run_example(resume=False):
+    pass
+
+
+@pytest.fixture
+def helper_module(tmp_path, monkeypatch):
+    """A helper module on sys.path that a stage calls into."""
+    path = tmp_path / "stage_helper.py"
+    path.write_text("def build():\n    return 1\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+    return path
+
+
+def test_editing_a_helper_module_changes_the_key(helper_module):
+    stage = Stage('example', run_example, lambda: [], modules=['stage_helper'])
+    manifest = {'stages': {}, 'files': {}}
+    key = stage_key(stage, manifest)
+
+    assert stage_key(stage, manifest) == key
+    helper_module.write_text("def build():\n    return 2\n")
+    assert stage_key(stage, manifest) != key
+
+
+def test_registered_stage_modules_exist():
+    for stage in STAGES.values():
+        for name in stage.modules:
+            assert module_digest(name)
+
+
+def test_unknown_module():
+    with pytest.raises(ModuleNotFoundError):
+        module_digest('spatial_prep.no_such_module')
@@ -0,0 +1,132 @@
+"""Tests for utils.shared_store."""
+import threading
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.annotation_store import AnnotationStore, frame_columns
+from utils.shared_store import SharedStore
+
+
+def columns(latitude, longitude, is_treatment=True):
+    latitude = np.atleast_1d(latitude)
+    frame = pd.DataFrame({'latitude': latitude, 'longitude': np.atleast_1d(longitude),
+                          'is_treatment': np.broadcast_to(is_treatment, latitude.shape)})
+    return frame_columns(frame)
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SharedStore(tmp_path / 'shared.sqlite')
+    yield store
+    store.close()
+
+
+def test_changes_since_returns_additions_and_tombstones(store):
+    first = store.add(columns([-7.0, -7.1], [37.0, 37.1]), 'amina', 's1')
+    second = store.add(columns(-7.2, 37.2, False), 'juma', 's2')
+    ids = store.to_frame()['id'].tolist()
+
+    deleted = store.delete(ids=ids[:1])
+    changes, version = store.changes_since(second)
+
+    assert (first, second, deleted, version) == (1, 2, 3, 3)
+    assert changes[['id', 'deleted', 'version']].values.tolist() == [[ids[0], True, 3]]
+    changes, _ = store.changes_since(0)
+    assert changes['deleted'].tolist() == [True, False, False]
+    assert store.to_frame()['id'].tolist() == ids[1:]
+    assert store.changes_since(version)[0].empty
+
+
+def test_query_bbox(store):
+    store.add(columns([-7.0, -7.5, -9.0], [37.0, 37.5, 39.0]), 'amina', 's1')
+    store.add(columns(-7.2, 37.2), 'juma', 's2')
+    store.delete(ids=[2])
+
+    found = store.query_bbox((36.5, -8.0, 38.0, -6.5))
+
+    assert found['latitude'].tolist() == [-7.2, -7.0]
+    assert store.query_bbox((36.5, -8.0, 38.0, -6.5), exclude_session='s2')['latitude'].tolist() == [-7.0]
+    assert len(store.query_bbox((36.5, -8.0, 38.0, -6.5), limit=1)) == 1
+    # On the edge of the box
+    assert store.query_bbox((37.2, -7.2, 37.3, -7.1))['id'].tolist() == [4]
+
+
+def test_clear_by_session_and_annotator_counts(store):
+    amina = store.writer('amina', 's1')
+    juma = store.writer('juma', 's2')
+    amina.add(columns([-7.0, -7.1], [37.0, 37.1], [True, False]))
+    juma.add(columns(-7.2, 37.2))
+    juma.flush()
+    counts = store.annotator_counts()
+
+    amina.clear()
+    amina.flush()
+
+    assert counts.values.tolist() == [['amina', 1, 1], ['juma', 1, 0]]
+    assert store.annotator_counts().values.tolist() == [['juma', 1, 0]]
+    assert store.to_frame()['session'].tolist() == ['s2']
+
+
+def test_concurrent_writers(tmp_path):
+    # One connection per thread, like separate server processes
+    stores = [SharedStore(tmp_path / 'shared.sqlite') for _ in range(4)]
+
+    def write(i, store):
+        for j in range(25):
+            store.add(columns([-7.0 - i / 10] * 3, [37.0 + j / 100] * 3), f"annotator {i}", f"s{i}")
+
+    threads = [threading.Thread(target=write, args=(i, store)) for i, store in enumerate(stores)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    rows = stores[0].to_frame()
+    assert len(rows) == 4 * 25 * 3 and rows['id'].is_unique
+    # Every batch got its own version
+    assert sorted(rows['version'].unique().tolist()) == list(range(1, 101))
+    assert stores[0].annotator_counts()['treatment'].tolist() == [75] * 4
+    for store in stores:
+        store.close()
+
+
+def test_failed_write_is_raised_and_not_undone(store, monkeypatch):
+    add = store.add
+
+    def failing_add(columns, annotator, session=None):
+        if len(columns['latitude']) == 2:
+            raise RuntimeError("disk full")
+        return add(columns, annotator, session)
+
+    monkeypatch.setattr(store, 'add', failing_add)
+    annotations = AnnotationStore(shared=store.writer('amina', 's1'))
+    annotations.append(-7.0, 37.0, True)
+    annotations.extend(pd.DataFrame({'latitude': [-7.1, -7.2], 'longitude': [37.1, 37.2], 'is_treatment': True}))
+
+    with pytest.raises(RuntimeError, match="disk full"):
+        annotations.shared.flush()
+    annotations.shared.flush()
+    assert store.count() == 1
+
+    # Undoing the failed batch leaves the shared store alone; the next undo removes the click
+    annotations.undo()
+    annotations.shared.flush()
+    assert store.count() == 1
+    annotations.undo()
+    annotations.shared.flush()
+    assert (len(annotations), store.count()) == (0, 0)
+
+
+def test_failures_are_reported_once(store, monkeypatch):
+    monkeypatch.setattr(store, 'add', lambda *args: 1 / 0)
+    writer = store.writer('amina', 's1')
+
+    future = writer.add(columns(-7.0, 37.0))
+    with pytest.raises(ZeroDivisionError):
+        future.result()
+
+    assert [type(error) for error in writer.failures()] == [ZeroDivisionError]
+    assert writer.failures() == []
+    writer.flush()
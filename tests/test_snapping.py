@@ -0,0 +1,28 @@
+"""Tests for utils.snapping."""
+import geopandas as gpd
+import numpy as np
+from shapely.geometry import box
+
+from config.settings import TARGET_CRS
+from utils.snapping import PointSnapper
+
+
+def strip_of_wards(n):
+    """n adjacent 100 m wide wards in TARGET_CRS, each sharing its east edge with the next."""
+    geometries = [box(800_000 + i * 100, 9_200_000, 800_000 + (i + 1) * 100, 9_201_000) for i in range(n)]
+    return gpd.GeoDataFrame({'ward_name': [f"ward_{i}" for i in range(n)], 'dist_name': 'District',
+                             'reg_name': 'Region'}, geometry=geometries, crs=TARGET_CRS)
+
+
+def test_shared_boundary_goes_to_the_first_ward_in_the_layer():
+    snapper = PointSnapper(strip_of_wards(50))
+    x = 800_000 + 100 * np.arange(1, 50, dtype=float)  # the edge between ward i and ward i + 1
+    y = np.full(len(x), 9_200_500.0)
+
+    assert (snapper.ward_index(x, y) == np.arange(49)).all()
+
+
+def test_points_outside_all_wards():
+    snapper = PointSnapper(strip_of_wards(3))
+
+    assert snapper.ward_index(np.array([700_000.0]), np.array([9_200_500.0])).tolist() == [-1]
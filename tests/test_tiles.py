@@ -0,0 +1,55 @@
+"""Tests for the tiled grid datasets of spatial_prep.tiles."""
+import pytest
+
+from benchmarks.synthetic import make_wards
+from spatial_prep import grid
+from spatial_prep.tiles import build_tiled_grid, read_cell_ids, read_grid
+
+CELL_SIZE = 500
+
+
+@pytest.fixture(scope='module')
+def wards():
+    return grid.prepare_wards(make_wards(n_wards=20, n_districts=4, n_regions=2,
+                                         bounds=(800_000, 9_200_000, 820_000, 9_220_000)))
+
+
+@pytest.fixture(scope='module')
+def grid_dir(wards, tmp_path_factory):
+    """A small 500 m grid over synthetic wards, in tiles of 10 km."""
+    output_dir = tmp_path_factory.mktemp('grid') / "grid_500m"
+    build_tiled_grid(wards, CELL_SIZE, output_dir=output_dir, tile_size=10_000)
+    return output_dir
+
+
+@pytest.mark.parametrize('columns', [None, ['cell_id', 'ward_name', 'geometry'], ['ward_name', 'geometry']])
+def test_read_grid_restores_full_cell_geometries(grid_dir, columns):
+    cells = read_grid(grid_dir, columns=columns)
+
+    assert len(cells) and cells.geometry.notna().all()
+    assert list(cells.columns) == (columns if columns is not None else list(cells.columns))
+    assert (cells.geometry.area <= CELL_SIZE ** 2 + 1e-6).all()
+
+
+def test_read_grid_without_geometry(grid_dir):
+    cells = read_grid(grid_dir, columns=['cell_id', 'is_treatment'])
+
+    assert list(cells.columns) == ['cell_id', 'is_treatment']
+
+
+def test_grid_covers_the_wards(grid_dir):
+    cells = read_grid(grid_dir)
+
+    # Pieces of a cell split by ward boundaries add up to the whole cell
+    assert cells.geometry.area.sum() == pytest.approx(20_000 ** 2, rel=1e-6)
+    assert len(read_cell_ids(grid_dir)) == (20_000 // CELL_SIZE) ** 2
+
+
+def test_workers_write_the_same_dataset(wards, grid_dir, tmp_path):
+    summary = build_tiled_grid(wards, CELL_SIZE, output_dir=tmp_path / "grid", tile_size=10_000, workers=2)
+
+    assert (summary['workers'], summary['tiles_written']) == (2, 4)
+    single = read_grid(grid_dir).sort_values(['cell_id', 'ward_name']).reset_index(drop=True)
+    pooled = read_grid(tmp_path / "grid").sort_values(['cell_id', 'ward_name']).reset_index(drop=True)
+    assert pooled.drop(columns='geometry').equals(single.drop(columns='geometry'))
+    assert pooled.geometry.geom_equals_exact(single.geometry, tolerance=0).all()
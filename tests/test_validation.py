@@ -0,0 +1,37 @@
+"""Tests for spatial_prep.validation."""
+import pandas as pd
+
+from benchmarks.synthetic import make_annotations, make_wards
+from spatial_prep.validation import run_validation
+
+
+def checks(report):
+    return {check['name']: check for check in report['checks']}
+
+
+def conflicting_annotations(n):
+    """n random annotations, the first one clicked twice with different labels."""
+    annotations = make_annotations(n)
+    first = annotations.iloc[:1].assign(is_treatment=~annotations['is_treatment'].iloc[:1])
+    return pd.concat([annotations, first], ignore_index=True)
+
+
+def test_annotations_without_ward_names():
+    wards = make_wards(n_wards=60, n_districts=6, n_regions=2)
+    annotations = conflicting_annotations(200)
+
+    report = checks(run_validation(wards, annotations=annotations))
+
+    assert 'ward_name' not in annotations  # the caller's frame is left as it was
+    examples = pd.DataFrame(report['label_conflicts']['details']['examples'])
+    assert len(examples) and examples['ward_name'].str.startswith('Ward ').all()
+
+
+def test_close_clicks_with_different_labels():
+    wards = make_wards(n_wards=60, n_districts=6, n_regions=2)
+
+    report = checks(run_validation(wards, annotations=conflicting_annotations(2)))
+
+    assert report['duplicate_clicks']['count'] == 1
+    assert report['label_conflicts']['details']['close_clicks_with_different_labels'] == 1
+    assert report['label_conflicts']['status'] == 'error'
@@ -0,0 +1,171 @@
+"""Tests for utils.vector_tiles, utils.mbtiles and the vector tile route of utils.tile_server."""
+import gzip
+import sqlite3
+import threading
+import urllib.error
+import urllib.request
+
+import mapbox_vector_tile
+import mercantile
+import pytest
+from pyproj import Transformer
+
+from benchmarks.synthetic import make_annotations, make_wards
+from config.settings import TARGET_CRS, WEB_CRS
+from spatial_prep import grid
+from spatial_prep.tiles import build_tiled_grid, read_cell_ids
+from utils.mbtiles import MBTiles, tms_row
+from utils.shared_store import SharedStore
+from utils.tile_server import LiveSource, MBTilesSource, make_server
+from utils.vector_tiles import GridDatasetSource, VectorLayerSource, add_status, build_mbtiles, render_tile
+
+BOUNDS = (800_000, 9_200_000, 820_000, 9_220_000)
+CELL_SIZE = 1000
+ZOOM = 11
+
+
+@pytest.fixture(scope='module')
+def wards():
+    return add_status(make_wards(n_wards=12, n_districts=3, n_regions=2, bounds=BOUNDS))
+
+
+@pytest.fixture(scope='module')
+def annotations():
+    return make_annotations(40, bounds=BOUNDS)
+
+
+def covering_tiles(zoom=ZOOM):
+    west, south, east, north = Transformer.from_crs(TARGET_CRS, WEB_CRS, always_xy=True).transform_bounds(*BOUNDS)
+    return list(mercantile.tiles(west, south, east, north, zooms=zoom))
+
+
+def decode(data):
+    return mapbox_vector_tile.decode(gzip.decompress(data))
+
+
+def get(url, **headers):
+    """(status, headers, body) of a GET, without raising on 3xx/4xx."""
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as error:
+        return error.code, error.headers, error.read()
+
+
+def ward_source(wards, annotations=None):
+    return VectorLayerSource('wards', wards, ['ward_name', 'status'], annotation_counts=annotations)
+
+
+def test_mbtiles_stores_tms_rows(tmp_path):
+    with MBTiles(tmp_path / 'tiles.mbtiles', mode='w') as mbtiles:
+        mbtiles.put_tiles([(3, 1, 2, b'a'), (3, 1, 5, b'b'), (0, 0, 0, b'c')])
+
+    stored = sqlite3.connect(tmp_path / 'tiles.mbtiles').execute(
+        "SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles ORDER BY zoom_level, tile_row").fetchall()
+    # Row 0 is the southernmost row in TMS and the northernmost in XYZ
+    assert stored == [(0, 0, 0, b'c'), (3, 1, 2, b'b'), (3, 1, 5, b'a')]
+    with MBTiles(tmp_path / 'tiles.mbtiles') as mbtiles:
+        assert (mbtiles.get_tile(3, 1, 2), mbtiles.get_tile(3, 1, 5), mbtiles.get_tile(3, 1, 3)) == (b'a', b'b', None)
+        assert mbtiles.tile_addresses(3) == {(1, 2), (1, 5)}
+        assert sorted(mbtiles.tiles()) == [(0, 0, 0, b'c'), (3, 1, 2, b'a'), (3, 1, 5, b'b')]
+    assert [tms_row(2, tms_row(2, y)) for y in range(4)] == [0, 1, 2, 3]
+
+
+def test_ward_tiles_carry_status_and_annotation_counts(wards, annotations):
+    source = ward_source(wards, annotations)
+
+    features = {}
+    for tile in covering_tiles():
+        data = render_tile([source], tile.z, tile.x, tile.y)
+        for feature in decode(data)['wards']['features'] if data else []:
+            features[feature['properties']['ward_name']] = feature['properties']
+
+    assert set(features) == set(wards['ward_name'])
+    assert all(features[ward]['status'] == status for ward, status in zip(wards['ward_name'], wards['status']))
+    assert sum(p['n_treatment_annotations'] for p in features.values()) == annotations['is_treatment'].sum()
+    assert sum(p['n_control_annotations'] for p in features.values()) == (~annotations['is_treatment']).sum()
+    assert render_tile([source], ZOOM, 0, 0) is None
+
+
+def test_grid_tiles_hold_every_cell(tmp_path, wards, annotations):
+    dataset_dir = tmp_path / 'grid'
+    build_tiled_grid(grid.prepare_wards(wards), CELL_SIZE, output_dir=dataset_dir, tile_size=10_000)
+    source = GridDatasetSource('grid', dataset_dir, CELL_SIZE, annotation_counts=annotations)
+
+    cell_ids, treatment = set(), 0
+    for tile in covering_tiles():
+        data = render_tile([source], tile.z, tile.x, tile.y)
+        for feature in decode(data)['grid']['features'] if data else []:
+            # A cell on a tile edge is in both tiles
+            if feature['id'] not in cell_ids:
+                treatment += feature['properties']['n_treatment_annotations']
+            cell_ids.add(feature['id'])
+
+    assert cell_ids == set(read_cell_ids(dataset_dir).tolist())
+    assert treatment == annotations['is_treatment'].sum()
+
+
+def test_build_mbtiles(tmp_path, wards):
+    summary = build_mbtiles([ward_source(wards)], tmp_path / 'tiles.mbtiles', min_zoom=9, max_zoom=ZOOM)
+
+    with MBTiles(tmp_path / 'tiles.mbtiles') as mbtiles:
+        assert mbtiles.tile_count() == summary['tiles_written'] > 0
+        assert mbtiles.metadata()['format'] == 'pbf'
+        assert mbtiles.zoom_range() == (9, ZOOM)
+        tile = covering_tiles()[0]
+        assert 'wards' in decode(mbtiles.get_tile(tile.z, tile.x, tile.y))
+
+
+@pytest.fixture
+def serve():
+    """Starts a tile server for a vector tile source; returns its URL."""
+    servers = []
+
+    def start(tile_source):
+        servers.append(make_server(tile_source, '127.0.0.1', 0))
+        threading.Thread(target=servers[-1].serve_forever, daemon=True).start()
+        return f"http://127.0.0.1:{servers[-1].server_address[1]}"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def test_mbtiles_tiles_are_revalidated_with_etags(tmp_path, wards, serve):
+    build_mbtiles([ward_source(wards)], tmp_path / 'tiles.mbtiles', min_zoom=ZOOM, max_zoom=ZOOM)
+    tile = covering_tiles()[0]
+    base = serve(MBTilesSource(tmp_path / 'tiles.mbtiles'))
+    url = f"{base}/{tile.z}/{tile.x}/{tile.y}.pbf"
+
+    status, headers, body = get(url)
+    assert status == 200
+    assert (headers['Content-Type'], headers['Content-Encoding']) == ('application/x-protobuf', 'gzip')
+    assert headers['Cache-Control'].startswith('public, max-age=')
+    assert 'wards' in decode(body)
+
+    status, headers, body = get(url, **{'If-None-Match': headers['ETag']})
+    assert (status, body) == (304, b'')
+    # Only zoom ZOOM was rendered
+    assert get(f"{base}/0/0/0.pbf")[0] == 204
+
+
+def test_live_tiles_follow_the_shared_store(tmp_path, wards, annotations, serve):
+    store = SharedStore(tmp_path / 'shared.sqlite')
+    tile = covering_tiles()[0]
+    base = serve(LiveSource(lambda annotations: [ward_source(wards, annotations)], store))
+    url = f"{base}/{tile.z}/{tile.x}/{tile.y}.pbf"
+
+    status, headers, _ = get(url)
+    assert (status, headers['Cache-Control']) == (200, 'no-cache')
+    etag = headers['ETag']
+    assert get(url, **{'If-None-Match': etag})[0] == 304
+
+    store.add(annotations, 'tester')
+    status, headers, body = get(url, **{'If-None-Match': etag})
+
+    assert status == 200 and headers['ETag'] != etag
+    counts = [f['properties']['n_treatment_annotations'] + f['properties']['n_control_annotations']
+              for f in decode(body)['wards']['features']]
+    assert sum(counts) > 0
+    store.close()
@@ -0,0 +1,75 @@
+"""Tests for the GeoParquet ward cache of utils.ward_loader."""
+import json
+import os
+
+import pytest
+
+from benchmarks.synthetic import make_wards
+from config.settings import TARGET_CRS
+from utils import ward_loader
+
+BOUNDS = (800_000, 9_200_000, 820_000, 9_220_000)
+
+
+@pytest.fixture
+def shapefile(tmp_path):
+    """A ward shapefile in WGS84, like the national one."""
+    path = tmp_path / 'shapefile' / 'wards.shp'
+    path.parent.mkdir()
+    wards = make_wards(n_wards=20, n_districts=4, n_regions=2, bounds=BOUNDS)
+    wards[['ward_name', 'dist_name', 'reg_name', 'geometry']].to_crs('EPSG:4326').to_file(path)
+    return path
+
+
+def test_cache_is_rebuilt_on_content_change_only(shapefile, tmp_path):
+    cache_dir = tmp_path / 'cache'
+
+    assert ward_loader.ensure_cache(shapefile, cache_dir)
+    assert not ward_loader.ensure_cache(shapefile, cache_dir)
+
+    # Touching the files changes their mtime but not their content
+    for path in ward_loader.source_files(shapefile):
+        os.utime(path, ns=(path.stat().st_atime_ns, path.stat().st_mtime_ns + 10 ** 9))
+    assert not ward_loader.ensure_cache(shapefile, cache_dir)
+    # ... and the manifest now holds the new stat key, so the hash is not computed again
+    manifest = json.loads((cache_dir / ward_loader.MANIFEST_NAME).read_text())
+    assert manifest['stat_key'] == ward_loader._stat_key(shapefile)
+
+    wards = ward_loader.load_wards(shp_file=shapefile, cache_dir=cache_dir)
+    wards.loc[0, 'ward_name'] = 'Renamed'
+    wards.to_file(shapefile)
+    assert ward_loader.ensure_cache(shapefile, cache_dir)
+    assert 'Renamed' in ward_loader.load_wards(shp_file=shapefile, cache_dir=cache_dir)['ward_name'].tolist()
+
+
+def test_interrupted_conversion_is_redone(shapefile, tmp_path):
+    cache_dir = tmp_path / 'cache'
+    ward_loader.build_cache(shapefile, cache_dir)
+
+    ward_loader.layer_path('districts', cache_dir).unlink()
+
+    assert ward_loader.ensure_cache(shapefile, cache_dir)
+
+
+def test_load_layers_with_pushdown(shapefile, tmp_path):
+    cache_dir = tmp_path / 'cache'
+    wards = ward_loader.load_wards(shp_file=shapefile, cache_dir=cache_dir)
+    district = wards['dist_name'].iloc[0]
+
+    subset = ward_loader.load_wards(columns=['ward_name'], districts=[district], shp_file=shapefile,
+                                    cache_dir=cache_dir)
+
+    assert list(subset.columns) == ['ward_name', 'geometry']
+    assert subset['ward_name'].tolist() == wards.loc[wards['dist_name'] == district, 'ward_name'].tolist()
+    regions = ward_loader.load_regions(shp_file=shapefile, cache_dir=cache_dir)
+    assert sorted(regions['reg_name']) == sorted(wards['reg_name'].unique())
+    assert regions.to_crs(TARGET_CRS).area.sum() == pytest.approx(wards.to_crs(TARGET_CRS).area.sum())
+    districts = ward_loader.load_districts(shp_file=shapefile, cache_dir=cache_dir)
+    assert len(districts) == wards[['reg_name', 'dist_name']].drop_duplicates().shape[0]
+    # Only wards whose bounding box meets the bbox are read
+    minx, miny, maxx, maxy = wards.total_bounds
+    corner = ward_loader.load_wards(bbox=(minx, miny, minx + 0.01, miny + 0.01), shp_file=shapefile,
+                                    cache_dir=cache_dir)
+    assert 0 < len(corner) < len(wards)
+    with pytest.raises(ValueError):
+        ward_loader.load_layer('villages', shp_file=shapefile, cache_dir=cache_dir)
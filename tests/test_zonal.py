@@ -0,0 +1,115 @@
+"""Tests for spatial_prep.zonal on a small synthetic GeoTIFF, checked against a per-cell naive computation."""
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+
+from config.settings import TARGET_CRS
+from spatial_prep import grid
+from spatial_prep.zonal import forest_loss_fraction, raster_channels, zonal_stats
+
+CELL_SIZE = 100
+PIXEL_SIZE = 10
+SIZE = 48  # pixels per edge, three 16 pixel blocks
+# Not aligned to the cells, so cells on the raster edge are partly covered
+ORIGIN = (800_035, 9_200_465)
+NODATA = 0
+
+
+@pytest.fixture(scope='module')
+def raster(tmp_path_factory):
+    """A tiled 3-band (B4, B8, B2) uint16 GeoTIFF with nodata pixels; returns (path, data)."""
+    rng = np.random.default_rng(0)
+    data = rng.integers(1, 5000, (3, SIZE, SIZE)).astype(np.uint16)
+    # Nodata in a single band masks the pixel for every channel
+    data[0, 5:9, 20:30] = NODATA
+    data[1, 30:33, 2:4] = NODATA
+    # A whole corner without data
+    data[:, 38:, 38:] = NODATA
+    path = tmp_path_factory.mktemp('zonal') / 's2.tif'
+    profile = dict(driver='GTiff', width=SIZE, height=SIZE, count=3, dtype='uint16', crs=TARGET_CRS,
+                   transform=from_origin(*ORIGIN, PIXEL_SIZE, PIXEL_SIZE), tiled=True, blockxsize=16,
+                   blockysize=16, nodata=NODATA)
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(data)
+        for band, name in enumerate(['B4', 'B8', 'B2'], start=1):
+            dst.set_band_description(band, name)
+    return path, data
+
+
+def pixel_cells(transform):
+    """Cell id of every pixel centre."""
+    rows, cols = np.mgrid[0:SIZE, 0:SIZE]
+    x, y = transform * (cols + 0.5, rows + 0.5)
+    return grid.cell_ids(*grid.cell_index(x, y, CELL_SIZE), CELL_SIZE)
+
+
+def naive_stats(data, cells, cell_id):
+    """pixels and mean/median of B4 and NDVI over the valid pixels of one cell."""
+    mask = (cells == cell_id) & (data != NODATA).all(axis=0)
+    b4, b8 = data[0][mask].astype(np.float64), data[1][mask].astype(np.float64)
+    if not mask.any():
+        return {'pixels': 0, 'B4_mean': np.nan, 'B4_median': np.nan, 'NDVI_mean': np.nan, 'NDVI_median': np.nan}
+    ndvi = (b8 - b4) / (b8 + b4)
+    return {'pixels': int(mask.sum()), 'B4_mean': b4.mean(), 'B4_median': np.median(b4),
+            'NDVI_mean': ndvi.mean(), 'NDVI_median': np.median(ndvi)}
+
+
+def test_raster_channels_add_ndvi(raster):
+    path, _ = raster
+
+    assert raster_channels(path) == {'B4': ('band', 0), 'B8': ('band', 1), 'B2': ('band', 2),
+                                     'NDVI': ('ndiff', 1, 0)}
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_zonal_stats_match_naive_computation(raster, tmp_path, workers):
+    path, data = raster
+    with rasterio.open(path) as src:
+        cells = pixel_cells(src.transform)
+    covered = np.unique(cells)
+    # Leave some covered cells out of the grid and add one the raster does not reach
+    cell_ids = np.concatenate([covered[::3], [cells[-1, -1]], grid.cell_ids([0], [0], CELL_SIZE)])
+
+    # Small windows, so cells span several windows
+    stats = zonal_stats(path, CELL_SIZE, cell_ids, window_size=16, workers=workers, cache_dir=tmp_path)
+
+    assert stats['cell_id'].tolist() == sorted(set(cell_ids.tolist()))
+    assert {'B8_mean', 'B2_median', 'NDVI_mean', 'NDVI_median'} <= set(stats.columns)
+    assert (stats['pixels'] == 0).sum() >= 2  # the cell off the raster and the nodata corner
+    for row in stats.itertuples(index=False):
+        expected = naive_stats(data, cells, row.cell_id)
+        assert row.pixels == expected['pixels']
+        for column in ('B4_mean', 'B4_median'):
+            assert getattr(row, column) == pytest.approx(expected[column], nan_ok=True)
+        for column in ('NDVI_mean', 'NDVI_median'):
+            assert getattr(row, column) == pytest.approx(expected[column], abs=1e-6, nan_ok=True)
+
+
+def test_workers_give_the_same_result(raster, tmp_path):
+    path, _ = raster
+    with rasterio.open(path) as src:
+        cell_ids = np.unique(pixel_cells(src.transform))
+
+    single = zonal_stats(path, CELL_SIZE, cell_ids, window_size=16, workers=1, cache_dir=tmp_path / 'single')
+    pooled = zonal_stats(path, CELL_SIZE, cell_ids, window_size=16, workers=2, cache_dir=tmp_path / 'pooled')
+
+    assert single.equals(pooled)
+    # The cached zone raster is reused
+    assert zonal_stats(path, CELL_SIZE, cell_ids, window_size=16, cache_dir=tmp_path / 'single').equals(single)
+    assert len(list((tmp_path / 'single').glob('zones_*'))) == 1
+
+
+def test_forest_loss_fraction(raster, tmp_path):
+    path, data = raster
+    with rasterio.open(path) as src:
+        cells = pixel_cells(src.transform)
+    cell_ids = np.unique(cells)
+
+    loss = forest_loss_fraction(path, CELL_SIZE, cell_ids, band=3, window_size=16, cache_dir=tmp_path)
+
+    # Band 3 has no zeros among its valid pixels, so every valid pixel counts as loss
+    valid = (data != NODATA).all(axis=0)
+    expected = [valid[cells == cell_id].sum() for cell_id in cell_ids]
+    assert loss['forest_loss_pixels'].tolist() == expected
+    assert loss.loc[loss['forest_loss_pixels'] > 0, 'forest_loss_fraction'].eq(1).all()
@@ -0,0 +1,219 @@
+"""Chunked import and export of annotation files.
+
+Imports read a CSV in chunks of ANNOTATION_IO_CHUNK_SIZE rows, twice. The
+first pass only parses and validates the file, so a file that fails to parse
+(or has no valid rows) leaves the annotations, and the journal and shared store
+behind them, untouched. The second pass coerces each chunk to the store's
+dtypes, drops invalid rows, snaps the rest to grid cells and wards and appends
+it to the AnnotationStore in place, so no more than one chunk is held on top of
+the store.
+
+Exports are written from the store's columns chunk by chunk to a file (CSV,
+Parquet, or GeoParquet with point geometries), and only when requested; the
+Parquet writer, shapely and pyproj are only imported then.
+"""
+import json
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from config.settings import ANNOTATION_IO_CHUNK_SIZE, WEB_CRS
+
+EXPORT_FORMATS = {
+    'CSV': ('.csv', 'text/csv'),
+    'Parquet': ('.parquet', 'application/vnd.apache.parquet'),
+    'GeoParquet': ('.parquet', 'application/vnd.apache.parquet'),
+}
+TRUE_VALUES = {'true', '1', 'yes', 'y', 't', 'treatment'}
+FALSE_VALUES = {'false', '0', 'no', 'n', 'f', 'control'}
+
+
+def parse_treatment(values):
+    """
+    Parse treatment flags written as booleans, 0/1 or text (true/false, yes/no,
+    Treatment/Control).
+
+    Returns:
+        Float Series with 1.0 / 0.0, NaN where the value is not recognised
+    """
+    text = values.astype(str).str.strip().str.lower()
+    return pd.Series(
+        np.select([text.isin(TRUE_VALUES), text.isin(FALSE_VALUES)], [1.0, 0.0], default=np.nan),
+        index=values.index,
+    )
+
+
+def _parse_chunk(chunk):
+    """Parsed latitude, longitude and treatment flag of a chunk, and which rows are valid."""
+    latitude = pd.to_numeric(chunk['latitude'], errors='coerce')
+    longitude = pd.to_numeric(chunk['longitude'], errors='coerce')
+    treatment = parse_treatment(chunk['is_treatment'] if 'is_treatment' in chunk else chunk['type'])
+    valid = latitude.between(-90, 90) & longitude.between(-180, 180) & treatment.notna()
+    return latitude, longitude, treatment, valid
+
+
+def coerce_chunk(chunk):
+    """
+    Coerce one chunk of an annotation CSV to the store's dtypes.
+
+    The treatment flag is taken from is_treatment, or from the type column
+    (Treatment / Control) when is_treatment is missing.
+
+    Returns:
+        (DataFrame of valid rows, number of rejected rows)
+    """
+    latitude, longitude, treatment, valid = _parse_chunk(chunk)
+
+    coerced = chunk.loc[valid].copy()
+    coerced['latitude'] = latitude[valid]
+    coerced['longitude'] = longitude[valid]
+    coerced['is_treatment'] = treatment[valid].astype(bool)
+    if 'timestamp' in coerced:
+        # Unparseable timestamps are replaced by the import time
+        timestamp = pd.to_datetime(coerced['timestamp'], errors='coerce', format='mixed')
+        coerced['timestamp'] = timestamp.fillna(pd.Timestamp.now())
+    return coerced.reset_index(drop=True), int((~valid).sum())
+
+
+def _read_chunks(source, chunksize):
+    """Chunks of an annotation CSV, after checking the columns of the first."""
+    for i, chunk in enumerate(pd.read_csv(source, chunksize=chunksize)):
+        if i == 0:
+            missing = {'latitude', 'longitude'} - set(chunk.columns)
+            if missing or not {'is_treatment', 'type'} & set(chunk.columns):
+                raise ValueError(
+                    "Annotation files need latitude, longitude and is_treatment (or type) columns, "
+                    f"got {list(chunk.columns)}"
+                )
+        yield chunk
+
+
+def import_annotations(source, store, snapper=None, chunksize=ANNOTATION_IO_CHUNK_SIZE, progress=None,
+                       allow_empty=False):
+    """
+    Replace the contents of an AnnotationStore with an annotation CSV.
+
+    Either the whole file is imported or, when it cannot be read, the store is
+    left as it was. The imported rows are one batch for undo.
+
+    Args:
+        source: Path or binary file object (e.g. a Streamlit UploadedFile)
+        store: AnnotationStore to fill
+        snapper: Optional PointSnapper; when given, grid cells and wards are
+            recomputed instead of taken from the file
+        chunksize: Rows read per chunk
+        progress: Optional callback(fraction, rows_loaded), called after each
+            chunk added to the store; the fraction is only known for sized file objects
+        allow_empty: Accept a file without valid rows, which clears the store
+
+    Returns:
+        Dict with rows_loaded, rows_rejected and seconds
+
+    Raises:
+        ValueError: If the file lacks latitude/longitude or a treatment column,
+            has no valid rows (unless allow_empty), or is not a readable CSV
+            (pandas' ParserError and EmptyDataError)
+    """
+    start = time.perf_counter()
+    size = getattr(source, 'size', None)
+    offset = source.tell() if hasattr(source, 'seek') else None
+
+    rows_valid = rows_rejected = 0
+    for chunk in _read_chunks(source, chunksize):
+        valid = _parse_chunk(chunk)[3]
+        rows_valid += int(valid.sum())
+        rows_rejected += int((~valid).sum())
+    if not rows_valid and not allow_empty:
+        raise ValueError(f"The file has no valid annotations ({rows_rejected:,} rows rejected); nothing was imported")
+    if offset is not None:
+        source.seek(offset)
+
+    def snapped_chunks():
+        rows_loaded = 0
+        for chunk in _read_chunks(source, chunksize):
+            chunk, _ = coerce_chunk(chunk)
+            if snapper is not None and len(chunk):
+                chunk = pd.concat([
+                    chunk.drop(columns=snapper.snap_columns, errors='ignore'),
+                    snapper.snap(chunk['latitude'], chunk['longitude']),
+                ], axis=1)
+            yield chunk
+            rows_loaded += len(chunk)
+            if progress is not None:
+                fraction = min((source.tell() - offset) / size, 1.0) if size else None
+                progress(fraction, rows_loaded)
+
+    store.clear()
+    rows_loaded = store.extend_chunks(snapped_chunks())
+    return {'rows_loaded': rows_loaded, 'rows_rejected': rows_rejected, 'seconds': time.perf_counter() - start}
+
+
+def _geo_metadata():
+    """GeoParquet 1.0 metadata for a WKB point column in WEB_CRS."""
+    from pyproj import CRS
+
+    return json.dumps({
+        'version': '1.0.0',
+        'primary_column': 'geometry',
+        'columns': {
+            'geometry': {
+                'encoding': 'WKB',
+                'geometry_types': ['Point'],
+                'crs': CRS.from_user_input(WEB_CRS).to_json_dict(),
+            },
+        },
+    })
+
+
+def _arrow_schema(frame):
+    """Arrow schema of the store columns; text columns that are still empty are typed as strings."""
+    schema = pa.Schema.from_pandas(frame.iloc[:0], preserve_index=False)
+    return pa.schema(
+        [field.with_type(pa.string()) if pa.types.is_null(field.type) else field for field in schema],
+        metadata=schema.metadata,
+    )
+
+
+def export_annotations(store, path, fmt='CSV', chunksize=ANNOTATION_IO_CHUNK_SIZE):
+    """
+    Write the annotations in a store to a file, one chunk of rows at a time.
+
+    Args:
+        store: AnnotationStore
+        path: Output file
+        fmt: One of EXPORT_FORMATS
+        chunksize: Rows per chunk (and per Parquet row group)
+
+    Returns:
+        The output path
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format {fmt!r}, expected one of {list(EXPORT_FORMATS)}")
+    frame = store.to_frame()  # views on the store, sliced per chunk below
+    chunks = (frame.iloc[i:i + chunksize] for i in range(0, max(len(frame), 1), chunksize))
+
+    if fmt == 'CSV':
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            for i, chunk in enumerate(chunks):
+                chunk.to_csv(f, header=i == 0, index=False)
+        return path
+
+    import pyarrow.parquet as pq
+    import shapely
+
+    schema = _arrow_schema(frame)
+    output_schema = schema
+    if fmt == 'GeoParquet':
+        output_schema = schema.append(pa.field('geometry', pa.binary())).with_metadata(
+            {**schema.metadata, b'geo': _geo_metadata().encode()}
+        )
+    with pq.ParquetWriter(path, output_schema) as writer:
+        for chunk in chunks:
+            table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+            if fmt == 'GeoParquet':
+                points = shapely.points(chunk['longitude'].to_numpy(), chunk['latitude'].to_numpy())
+                table = table.append_column('geometry', pa.array(shapely.to_wkb(points), type=pa.binary()))
+            writer.write_table(table.replace_schema_metadata(output_schema.metadata))
+    return path
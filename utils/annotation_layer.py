@@ -0,0 +1,169 @@
+"""Batched annotation layer for the Streamlit map.
+
+Annotations are drawn as GeoJSON point features styled in the browser (red for
+treatment, blue for control) instead of one folium.CircleMarker per point. The
+features are serialized in fixed-size chunks: a full chunk never changes again,
+so its JSON is built once and reused on every rerun, and a new click only
+re-serializes the last, partially filled chunk. The layer is handed to st_folium
+as a feature group, which updates the existing Leaflet map in place instead of
+re-rendering it.
+
+Bulk labels of grid cells (see utils.bulk_labels) are not drawn as points but
+as one shape per cell size and label, rebuilt only when such labels change.
+"""
+import folium
+import numpy as np
+import pandas as pd
+from branca.element import Element, MacroElement
+from jinja2 import Template
+
+from config.settings import ANNOTATION_CHUNK_SIZE, GRID_SIZE_LARGE, GRID_SIZE_SMALL
+from utils.annotation_store import cell_source
+
+TREATMENT_COLOR = 'red'
+CONTROL_COLOR = 'blue'
+CELL_SIZES = (GRID_SIZE_LARGE, GRID_SIZE_SMALL)
+CELL_SOURCES = [cell_source(size) for size in CELL_SIZES]
+
+
+class _RawScript(Element):
+    """Already rendered JavaScript, added to the figure without compiling it as a template."""
+
+    def __init__(self, script):
+        super().__init__()
+        self.script = script
+
+    def render(self, **kwargs):
+        return self.script
+
+
+class AnnotationChunk(MacroElement):
+    """One pre-serialized GeoJSON FeatureCollection of annotation points."""
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        var {{ this.get_name() }} = L.geoJson({{ this.data }}, {
+            pointToLayer: function(feature, latlng) {
+                var color = feature.properties.is_treatment ? "{{ this.treatment_color }}" : "{{ this.control_color }}";
+                return L.circleMarker(latlng, {radius: 8, color: color, fillColor: color, fillOpacity: 0.7});
+            },
+            onEachFeature: function(feature, layer) {
+                var latlng = layer.getLatLng();
+                layer.bindPopup(
+                    (feature.properties.is_treatment ? "Treatment" : "Control") + " Area"
+                    + "<br>Lat: " + latlng.lat.toFixed(6) + "<br>Lng: " + latlng.lng.toFixed(6)
+                );
+            }
+        }).addTo({{ this._parent.get_name() }});
+        {% endmacro %}
+    """)
+
+    def __init__(self, data, treatment_color=TREATMENT_COLOR, control_color=CONTROL_COLOR):
+        super().__init__()
+        self._name = 'AnnotationChunk'
+        self.data = data
+        self.treatment_color = treatment_color
+        self.control_color = control_color
+
+    def render(self, **kwargs):
+        # MacroElement.render wraps the script in a new Element, which compiles
+        # the whole (multi-megabyte) GeoJSON string as a Jinja template
+        script = self._template.module.__dict__['script'](self, kwargs)
+        self.get_root().script.add_child(_RawScript(script), name=self.get_name())
+
+
+def features_json(latitude, longitude, is_treatment):
+    """
+    Serialize annotation points to a compact GeoJSON FeatureCollection string.
+
+    Args:
+        latitude, longitude: Array-likes of WGS84 coordinates
+        is_treatment: Array-like of booleans
+
+    Returns:
+        JSON string
+    """
+    latitude = np.asarray(latitude, dtype='float64')
+    longitude = np.asarray(longitude, dtype='float64')
+    flags = np.where(np.asarray(is_treatment, dtype=bool), 'true', 'false')
+    features = ','.join(
+        f'{{"type":"Feature","geometry":{{"type":"Point","coordinates":[{lng:.7f},{lat:.7f}]}},'
+        f'"properties":{{"is_treatment":{flag}}}}}'
+        for lat, lng, flag in zip(latitude.tolist(), longitude.tolist(), flags.tolist())
+    )
+    return f'{{"type":"FeatureCollection","features":[{features}]}}'
+
+
+class AnnotationLayer:
+    """
+    Incrementally serialized annotation points, kept per session.
+
+    Follows an AnnotationStore: rows appended since the last ``sync`` are
+    serialized, and everything is rebuilt after rows were removed (clear or
+    undo). Bulk-labelled cells are left out of the points and drawn as shapes,
+    so chunks hold chunk_size points however many cells were labelled.
+
+    Args:
+        chunk_size: Number of points per serialized chunk
+    """
+
+    def __init__(self, chunk_size=ANNOTATION_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.reset()
+
+    def reset(self):
+        self._chunks = []  # JSON of full chunks, never rebuilt
+        self._tail_json = None
+        self._cells = None  # GeoJSON of the bulk-labelled cells
+        self._generation = None
+        self._point_rows = np.array([], dtype=np.int64)  # store rows drawn as points
+        self.n_features = 0  # store rows synced so far
+
+    def sync(self, store):
+        """
+        Serialize the annotations added to the store since the last call.
+
+        Args:
+            store: AnnotationStore
+        """
+        if store.generation != self._generation:
+            self.reset()
+            self._generation = store.generation
+        n = len(store)
+        if n == self.n_features:
+            return
+        new_is_cell = pd.Series(store['source'][self.n_features:n]).isin(CELL_SOURCES).to_numpy()
+        self._point_rows = np.concatenate([self._point_rows, self.n_features + np.flatnonzero(~new_is_cell)])
+
+        def points_json(rows):
+            return features_json(store.latitude[rows], store.longitude[rows], store.is_treatment[rows])
+
+        points, size = self._point_rows, self.chunk_size
+        n_full = len(points) // size
+        for i in range(len(self._chunks), n_full):
+            self._chunks.append(points_json(points[i * size:(i + 1) * size]))
+        self._tail_json = points_json(points[n_full * size:]) if len(points) % size else None
+
+        if new_is_cell.any():
+            from utils.bulk_labels import label_shapes
+
+            is_cell = pd.Series(store['source']).isin(CELL_SOURCES).to_numpy()
+            self._cells = label_shapes(store.to_frame()[is_cell], CELL_SIZES)
+        self.n_features = n
+
+    def feature_group(self, name="Annotations"):
+        """A FeatureGroup holding the bulk-labelled cells and one element per serialized chunk."""
+        group = folium.FeatureGroup(name=name)
+        if self._cells is not None:
+            folium.GeoJson(
+                self._cells,
+                style_function=lambda f: {
+                    'color': TREATMENT_COLOR if f['properties']['is_treatment'] else CONTROL_COLOR,
+                    'weight': 0,
+                    'fillOpacity': 0.3,
+                },
+            ).add_to(group)
+        chunks = self._chunks + ([self._tail_json] if self._tail_json else [])
+        for data in chunks:
+            group.add_child(AnnotationChunk(data))
+        return group
@@ -0,0 +1,340 @@
+"""Columnar annotation store with an append-only journal.
+
+Annotations are kept as NumPy columns (float64 latitude/longitude, bool
+treatment flag, datetime64 timestamp, the snapped grid cells and ward, and a
+categorical type) that grow by doubling, so adding a click is amortized O(1) and
+``to_frame`` returns a DataFrame over the filled part of the arrays without
+copying them.
+
+With a path, every append is also written to a SQLite journal in WAL mode: one
+small INSERT per click instead of rewriting a file, and a browser refresh replays
+the journal. The app keys journals on a ``session`` query parameter.
+
+The app also attaches a writer for the shared multi-annotator store (see
+utils.shared_store), so every batch added here reaches the other sessions.
+"""
+import re
+import sqlite3
+import uuid
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from config.settings import GRID_SIZE_LARGE, GRID_SIZE_SMALL, SESSION_DIR
+
+TYPE_CATEGORIES = ['Treatment', 'Control']
+
+# Stored columns and their dtypes. The grid cells and ward are snapped when an
+# annotation is added (see utils.snapping); -1 / None when unknown. The source
+# says how the label was made (SOURCE_CLICK, a bulk label of cells or wards, or
+# None for uploaded files). The 'type' column of to_frame() is derived from
+# is_treatment.
+COLUMNS = {
+    'latitude': 'float64',
+    'longitude': 'float64',
+    'is_treatment': 'bool',
+    'timestamp': 'datetime64[us]',
+    f'cell_{GRID_SIZE_LARGE}m': 'int64',
+    f'cell_{GRID_SIZE_SMALL}m': 'int64',
+    'ward_name': 'object',
+    'dist_name': 'object',
+    'reg_name': 'object',
+    'source': 'object',
+}
+MISSING = {'int64': -1, 'object': None}
+SQL_TYPES = {'float64': 'REAL', 'bool': 'INTEGER', 'datetime64[us]': 'INTEGER', 'int64': 'INTEGER', 'object': 'TEXT'}
+
+SOURCE_CLICK = 'click'
+SOURCE_WARD = 'ward'
+
+
+def cell_source(cell_size):
+    """Source of annotations that label whole grid cells of a size (one annotation per cell, at its centre)."""
+    return f"cells_{cell_size}m"
+
+
+def new_session_id():
+    return uuid.uuid4().hex
+
+
+def session_path(session_id, session_dir=SESSION_DIR):
+    """Journal file for a session id; ids are restricted to safe file names."""
+    if not re.fullmatch(r'[A-Za-z0-9_-]{1,64}', session_id):
+        raise ValueError(f"Invalid session id: {session_id!r}")
+    return Path(session_dir) / f"annotations_{session_id}.sqlite"
+
+
+def load_sessions(session_dir=SESSION_DIR):
+    """
+    Annotations of all session journals in a directory.
+
+    Returns:
+        DataFrame with the store columns plus the session id
+    """
+    frames = []
+    for path in sorted(Path(session_dir).glob("annotations_*.sqlite")):
+        store = AnnotationStore(path)
+        frames.append(store.to_frame().assign(session=path.stem.removeprefix("annotations_")))
+        store.close()
+    if not frames:
+        return AnnotationStore().to_frame().assign(session=pd.Series(dtype=object))
+    return pd.concat(frames, ignore_index=True)
+
+
+def frame_columns(frame):
+    """
+    Store columns from a DataFrame with latitude, longitude and is_treatment
+    columns, and optionally timestamp and the snapped columns.
+
+    Returns:
+        Dict of NumPy arrays with the dtypes of COLUMNS; missing columns are
+        filled with the missing value (timestamps with the local time now)
+    """
+    columns = {}
+    for column, dtype in COLUMNS.items():
+        if column == 'timestamp':
+            values = (
+                pd.to_datetime(frame['timestamp'], format='mixed').to_numpy(dtype)
+                if 'timestamp' in frame else np.full(len(frame), np.datetime64(datetime.now(), 'us'))
+            )
+        elif column in frame:
+            values = frame[column].where(frame[column].notna(), MISSING.get(dtype)).to_numpy(dtype)
+        else:
+            values = np.full(len(frame), MISSING[dtype], dtype=dtype)
+        columns[column] = values
+    return columns
+
+
+def add_missing_columns(conn, table='annotations'):
+    """Add the store columns that a table written before they existed lacks, filled with the missing value."""
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    for column, dtype in COLUMNS.items():
+        if column not in existing:
+            default = MISSING.get(dtype)
+            conn.execute(
+                f"ALTER TABLE {table} ADD COLUMN {column} {SQL_TYPES[dtype]}"
+                + (f" DEFAULT {default}" if default is not None else "")
+            )
+
+
+def _to_sql(values, dtype):
+    if dtype == 'datetime64[us]':
+        return values.astype('int64').tolist()
+    if dtype == 'bool':
+        return values.astype(int).tolist()
+    return values.tolist()
+
+
+def _from_sql(values, dtype):
+    if dtype == 'datetime64[us]':
+        return np.array(values, dtype='int64').astype(dtype)
+    return np.array(values, dtype=dtype)
+
+
+class AnnotationStore:
+    """
+    Growable columns of annotations, optionally journaled to SQLite.
+
+    Args:
+        path: Journal file; existing annotations in it are loaded. None keeps
+            the store in memory only
+        capacity: Initial number of rows allocated
+        shared: Optional utils.shared_store.AnnotatorWriter; added and cleared
+            annotations are also written to the shared store under its annotator
+    """
+
+    def __init__(self, path=None, capacity=1024, shared=None):
+        self.shared = shared
+        self._n = 0
+        # Start row of every batch added since the store was opened, for undo
+        self._batches = []
+        self._columns = {column: np.empty(capacity, dtype=dtype) for column, dtype in COLUMNS.items()}
+        self._type_codes = np.empty(capacity, dtype='int8')
+        # Bumped whenever rows are removed, so consumers that follow the store
+        # incrementally (e.g. the map layer) know to start over
+        self.generation = 0
+
+        self.path = Path(path) if path is not None else None
+        self._conn = None
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._create_journal()
+            self._load_journal()
+
+    def _create_journal(self):
+        definitions = ', '.join(f"{column} {SQL_TYPES[dtype]}" for column, dtype in COLUMNS.items())
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS annotations ({definitions})")
+        add_missing_columns(self._conn)
+        self._conn.commit()
+
+    def _load_journal(self):
+        rows = self._conn.execute(f"SELECT {', '.join(COLUMNS)} FROM annotations ORDER BY rowid").fetchall()
+        if rows:
+            self._write_rows({
+                column: _from_sql(values, dtype) for (column, dtype), values in zip(COLUMNS.items(), zip(*rows))
+            })
+
+    def _reserve(self, n_rows):
+        """Grow the arrays (by doubling) until n_rows fit."""
+        capacity = len(self._type_codes)
+        if n_rows <= capacity:
+            return
+        while capacity < n_rows:
+            capacity *= 2
+        for column, values in self._columns.items():
+            grown = np.empty(capacity, dtype=values.dtype)
+            grown[:self._n] = values[:self._n]
+            self._columns[column] = grown
+        grown = np.empty(capacity, dtype='int8')
+        grown[:self._n] = self._type_codes[:self._n]
+        self._type_codes = grown
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, column):
+        """A view of one column over the filled rows."""
+        return self._columns[column][:self._n]
+
+    @property
+    def latitude(self):
+        return self['latitude']
+
+    @property
+    def longitude(self):
+        return self['longitude']
+
+    @property
+    def is_treatment(self):
+        return self['is_treatment']
+
+    def _write_rows(self, columns):
+        start, end = self._n, self._n + len(columns['latitude'])
+        self._reserve(end)
+        for column, values in columns.items():
+            self._columns[column][start:end] = values
+        self._type_codes[start:end] = np.where(columns['is_treatment'], 0, 1)
+        self._n = end
+
+    def _journal(self, columns):
+        if self._conn is None:
+            return
+        values = [_to_sql(columns[column], dtype) for column, dtype in COLUMNS.items()]
+        with self._conn:
+            self._conn.executemany(
+                f"INSERT INTO annotations ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})",
+                zip(*values),
+            )
+
+    def _add(self, columns, new_batch=True):
+        if new_batch:
+            self._batches.append(self._n)
+        self._write_rows(columns)
+        self._journal(columns)
+        if self.shared is not None:
+            self.shared.add(columns, new_batch=new_batch)
+
+    def append(self, latitude, longitude, is_treatment, timestamp=None, **snapped):
+        """
+        Add one annotation; the timestamp defaults to the local time now.
+
+        Args:
+            snapped: Optional cell and ward columns (cell_500m, ward_name, ...)
+        """
+        values = {
+            'latitude': latitude,
+            'longitude': longitude,
+            'is_treatment': is_treatment,
+            'timestamp': datetime.now() if timestamp is None else timestamp,
+            **snapped,
+        }
+        self._add({
+            column: np.array([values.get(column, MISSING.get(dtype))], dtype=dtype)
+            for column, dtype in COLUMNS.items()
+        })
+
+    def extend(self, frame):
+        """
+        Add annotations from a DataFrame with latitude, longitude and
+        is_treatment columns, and optionally timestamp and the snapped columns.
+        """
+        if frame.empty:
+            return
+        self._add(frame_columns(frame))
+
+    def extend_chunks(self, frames):
+        """
+        Add annotations from an iterable of DataFrames (as for extend) as one
+        batch, which undo removes as a whole. Only one DataFrame is held at a
+        time, so a large file can be added without loading it first.
+
+        Returns:
+            Number of annotations added
+        """
+        added = 0
+        for frame in frames:
+            if not frame.empty:
+                self._add(frame_columns(frame), new_batch=added == 0)
+                added += len(frame)
+        return added
+
+    def clear(self):
+        """Remove all annotations (also from the journal and this session's rows in the shared store)."""
+        self._n = 0
+        self._batches = []
+        self.generation += 1
+        if self._conn is not None:
+            with self._conn:
+                self._conn.execute("DELETE FROM annotations")
+        if self.shared is not None:
+            self.shared.clear()
+
+    @property
+    def can_undo(self):
+        return bool(self._batches)
+
+    def undo(self):
+        """
+        Remove the annotations of the last append or extend (also from the
+        journal and the shared store). Only batches added since the store was
+        opened can be undone; a bulk label is one batch.
+
+        Returns:
+            Number of annotations removed
+        """
+        if not self._batches:
+            return 0
+        start = self._batches.pop()
+        removed = self._n - start
+        self._n = start
+        self.generation += 1
+        if self._conn is not None:
+            with self._conn:
+                self._conn.execute(
+                    "DELETE FROM annotations WHERE rowid IN "
+                    "(SELECT rowid FROM annotations ORDER BY rowid DESC LIMIT ?)", (removed,)
+                )
+        if self.shared is not None:
+            self.shared.undo()
+        return removed
+
+    def replace(self, frame):
+        """Replace all annotations with those in a DataFrame."""
+        self.clear()
+        self.extend(frame)
+
+    def to_frame(self):
+        """The annotations as a DataFrame whose columns are views on the store."""
+        frame = {column: self[column] for column in COLUMNS}
+        frame['type'] = pd.Categorical.from_codes(self._type_codes[:self._n], categories=TYPE_CATEGORIES)
+        return pd.DataFrame(frame, copy=False)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
@@ -0,0 +1,131 @@
+"""Start-up state of the annotation app, precomputed by the pipeline.
+
+The first run of app.py should draw the map without reading any geodata (no
+geopandas, shapely or pyproj, no GeoJSON to parse). What it needs from the
+processed data is small and only changes when the pipeline runs, so the
+pipeline's app_state stage writes it to APP_STATE_FILE:
+
+  * ``bounds``: (west, south, east, north) of the relevant wards in degrees,
+  * ``center`` and ``zoom``: the map view that fits those bounds into the
+    app's MAP_WIDTH x MAP_HEIGHT map,
+  * ``layers``: an index of the layers the app can show (wards and grids), with
+    their path relative to data/processed, feature count, treatment count and
+    the zoom level they are drawn from.
+
+load_app_state reads it with the json module only. Before the pipeline has run
+it falls back to DEFAULT_MAP_CENTER / DEFAULT_ZOOM and finds the layers by their
+files; layers whose files have been removed since are left out of the index.
+
+    python -m utils.app_state      # rebuild the file by hand, e.g. after running the notebooks
+"""
+import json
+import math
+import sys
+from datetime import datetime
+from pathlib import Path
+
+from config.settings import (APP_STATE_FILE, DEFAULT_MAP_CENTER, DEFAULT_ZOOM, GRID_LAYER_MIN_ZOOM,
+                             GRID_SIZE_LARGE, GRID_SIZE_SMALL, MAP_HEIGHT, MAP_WIDTH, PROCESSED_DATA_DIR,
+                             WARD_LAYER_MIN_ZOOM, WARDS_FILE, WEB_CRS)
+
+TILE_PIXELS = 256
+MAX_FIT_ZOOM = 18
+
+
+def layer_paths():
+    """Files of the layers in the index, by layer name."""
+    from spatial_prep.tiles import grid_dataset_dir
+
+    grids = {f"grid_{size}m": grid_dataset_dir(size) for size in (GRID_SIZE_LARGE, GRID_SIZE_SMALL)}
+    return {'wards': WARDS_FILE, **grids}
+
+
+def fit_zoom(bounds, width=MAP_WIDTH, height=MAP_HEIGHT):
+    """Highest web map zoom level at which (west, south, east, north) fits into width x height pixels."""
+    west, south, east, north = bounds
+
+    def mercator_y(lat):
+        return math.log(math.tan(math.pi / 4 + math.radians(lat) / 2))
+
+    x_fraction = max(east - west, 1e-9) / 360
+    y_fraction = max(mercator_y(north) - mercator_y(south), 1e-9) / (2 * math.pi)
+    zoom = math.log2(min(width / x_fraction, height / y_fraction) / TILE_PIXELS)
+    return int(min(max(math.floor(zoom), 0), MAX_FIT_ZOOM))
+
+
+def build_app_state():
+    """
+    Compute the start-up state from the processed data.
+
+    Returns:
+        dict with created, bounds, center, zoom and layers (see the module docstring)
+    """
+    import geopandas as gpd
+    import pyarrow.dataset as ds
+
+    paths = layer_paths()
+    state = {'created': datetime.now().isoformat(timespec='seconds'), 'bounds': None,
+             'center': list(DEFAULT_MAP_CENTER), 'zoom': DEFAULT_ZOOM, 'layers': {}}
+    if WARDS_FILE.exists():
+        wards = gpd.read_file(WARDS_FILE).to_crs(WEB_CRS)
+        bounds = [float(v) for v in wards.total_bounds]
+        west, south, east, north = bounds
+        state.update(bounds=bounds, center=[(south + north) / 2, (west + east) / 2], zoom=fit_zoom(bounds))
+        state['layers']['wards'] = {
+            'path': WARDS_FILE.name,
+            'features': len(wards),
+            'treatment': int(wards['is_treatment'].sum()) if 'is_treatment' in wards else 0,
+            'min_zoom': WARD_LAYER_MIN_ZOOM,
+        }
+    for name, path in paths.items():
+        if name == 'wards' or not path.exists():
+            continue
+        # Parquet footers only; tiles still being written are in hidden directories and ignored
+        dataset = ds.dataset(path, format='parquet', partitioning='hive')
+        state['layers'][name] = {
+            'path': path.name,
+            'features': dataset.count_rows(),
+            'treatment': dataset.count_rows(filter=ds.field('is_treatment')),
+            'min_zoom': GRID_LAYER_MIN_ZOOM,
+        }
+    return state
+
+
+def write_app_state(path=APP_STATE_FILE):
+    """Build the start-up state and write it (atomically) to path; returns the state."""
+    path = Path(path)
+    state = build_app_state()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    tmp.write_text(json.dumps(state, indent=2))
+    tmp.replace(path)
+    return state
+
+
+def load_app_state(path=APP_STATE_FILE):
+    """
+    Read the start-up state; see the module docstring for the fallback without the file.
+
+    Returns:
+        dict with bounds, center, zoom and layers
+    """
+    path = Path(path)
+    if not path.exists():
+        return {'bounds': None, 'center': list(DEFAULT_MAP_CENTER), 'zoom': DEFAULT_ZOOM,
+                'layers': {name: {'path': layer_path.name} for name, layer_path in layer_paths().items()
+                           if layer_path.exists()}}
+    state = json.loads(path.read_text())
+    state['layers'] = {name: layer for name, layer in state['layers'].items()
+                       if (PROCESSED_DATA_DIR / layer['path']).exists()}
+    return state
+
+
+def main():
+    state = write_app_state()
+    layers = ', '.join(f"{name} ({layer['features']:,})" for name, layer in state['layers'].items())
+    print(f"✅ App state written to {APP_STATE_FILE}")
+    print(f"   zoom {state['zoom']} at {state['center']}; layers: {layers or 'none'}")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
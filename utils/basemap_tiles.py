@@ -0,0 +1,352 @@
+"""Offline basemaps: raster tiles of the study area in local MBTiles files.
+
+In the field there is often no connection to fetch a basemap. ``python -m
+utils.basemap_tiles`` fills one MBTiles file per basemap in BASEMAP_DIR
+(``osm.mbtiles``, ``sentinel2.mbtiles``, ...) with every tile from
+BASEMAP_MIN_ZOOM to BASEMAP_MAX_ZOOM over the bounds of the coverage plan
+(``spatial_bounds`` in region_coverage_plan.json, written by the pipeline's
+coverage stage). Tiles are enumerated with mercantile. A source is either a
+provider name from xyzservices, the provider catalogue behind
+``contextily.providers`` (e.g. ``OpenStreetMap.Mapnik`` or
+``Esri.WorldImagery``), or a URL template with {z}, {x} and {y}, such as the
+EOX Sentinel-2 cloudless mosaic or a local stand-in tile server.
+
+Tiles can also be imported instead of downloaded, from a directory tree
+``{z}/{x}/{y}.<ext>`` or another MBTiles file, e.g. a Sentinel-2 RGB composite
+rendered elsewhere.
+
+Tiles already in the file are skipped, so an interrupted prefetch resumes where
+it stopped and a second run only fetches what is missing. Tiles the source does
+not have (204/404, e.g. open sea) are stored as zero-length rows, so they count
+as cached too instead of being requested on every run. Downloads run on
+BASEMAP_WORKERS threads and are retried with exponential backoff; the file is
+written from the main thread, a batch of tiles per transaction.
+
+The tile server (utils.tile_server) serves the files at
+``/basemap/<name>/{z}/{x}/{y}.<format>`` with HTTP caching headers, and the app
+offers them as basemaps:
+
+    python -m utils.basemap_tiles                          # every source in BASEMAP_SOURCES
+    python -m utils.basemap_tiles osm --max-zoom 10
+    python -m utils.basemap_tiles --import sentinel2=path/to/tiles
+"""
+import argparse
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import mercantile
+
+from config.settings import (BASEMAP_ATTRIBUTION, BASEMAP_BOUNDS, BASEMAP_DIR, BASEMAP_MAX_ATTEMPTS,
+                             BASEMAP_MAX_ZOOM, BASEMAP_MIN_ZOOM, BASEMAP_SOURCES, BASEMAP_WORKERS, WEB_CRS)
+from utils.instrumentation import track
+from utils.mbtiles import MBTiles
+
+USER_AGENT = "rubeho-mapper basemap prefetch"
+BATCH_SIZE = 256  # tiles per download round and per write transaction
+WORLD_BOUNDS = (-180.0, -85.0511, 180.0, 85.0511)  # web mercator limits
+
+
+def basemap_path(name, directory=BASEMAP_DIR):
+    """MBTiles file of a basemap."""
+    return Path(directory) / f"{name}.mbtiles"
+
+
+def tile_format(data):
+    """'png', 'jpg' or 'webp' from the first bytes of a tile, or None."""
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if data[:3] == b'\xff\xd8\xff':
+        return 'jpg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+
+def resolve_source(source):
+    """
+    URL template and attribution of a tile source.
+
+    Args:
+        source: xyzservices provider name (e.g. 'Esri.WorldImagery') or a URL template
+
+    Returns:
+        (url template with {z}/{x}/{y}, attribution or None)
+    """
+    if '{z}' in source:
+        return source, None
+    import xyzservices.providers as providers
+
+    provider = providers.query_name(source)
+    return provider.build_url(), provider.get('attribution')
+
+
+def coverage_bounds(key=BASEMAP_BOUNDS, plan_file=None):
+    """
+    (west, south, east, north) in degrees of one of the coverage plan's spatial bounds.
+
+    Plans written before the pipeline recorded bounds only list the regions;
+    their bounds are then taken from the region layer.
+
+    Args:
+        key: 'all_regions', 'program_regions', ... (see run_coverage in spatial_prep.pipeline)
+        plan_file: Coverage plan; defaults to the pipeline's
+    """
+    if plan_file is None:
+        from spatial_prep.pipeline import COVERAGE_FILE as plan_file
+    plan_file = Path(plan_file)
+    if not plan_file.exists():
+        raise FileNotFoundError(f"{plan_file} not found; run `python -m spatial_prep.pipeline --until coverage` "
+                                "or pass --bounds")
+    plan = json.loads(plan_file.read_text())
+    bounds = plan.get('spatial_bounds', {}).get(key)
+    if bounds is not None:
+        return (bounds['min_longitude'], bounds['min_latitude'], bounds['max_longitude'], bounds['max_latitude'])
+
+    from utils.ward_loader import load_regions
+
+    names = plan['program_regions'] if key == 'program_regions' else plan['all_target_regions']
+    return tuple(float(v) for v in load_regions(regions=names).to_crs(WEB_CRS).total_bounds)
+
+
+def plan_tiles(bounds, min_zoom=BASEMAP_MIN_ZOOM, max_zoom=BASEMAP_MAX_ZOOM):
+    """Every XYZ tile from min_zoom to max_zoom that intersects (west, south, east, north)."""
+    return list(mercantile.tiles(*bounds, zooms=range(min_zoom, max_zoom + 1)))
+
+
+def is_transient(error):
+    """Whether a failed tile request is worth retrying: connection errors, timeouts and 429/5xx answers."""
+    import requests
+
+    if isinstance(error, requests.HTTPError):
+        status = error.response.status_code if error.response is not None else None
+        return status == 429 or (status is not None and status >= 500)
+    return isinstance(error, requests.RequestException)
+
+
+class TileDownloader:
+    """
+    Fetches tiles from a URL template over one HTTP session.
+
+    Args:
+        url: Template with {z}, {x} and {y} (and optionally {s}, {r})
+        max_attempts: Tries per tile; connection errors and 429/5xx answers are retried,
+            other errors (e.g. 401/403 from a source that blocks us) fail the tile at once
+        timeout: Seconds per request
+    """
+
+    def __init__(self, url, max_attempts=BASEMAP_MAX_ATTEMPTS, timeout=30):
+        import requests
+        from tenacity import Retrying, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+
+        self.url = url.replace('{s}', 'a').replace('{r}', '')
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers['User-Agent'] = USER_AGENT
+        self.retrying = Retrying(
+            stop=stop_after_attempt(max_attempts),
+            wait=wait_exponential_jitter(initial=1, max=30),
+            retry=retry_if_exception(is_transient),
+            reraise=True,
+        )
+
+    def _get(self, tile):
+        response = self.session.get(self.url.format(z=tile.z, x=tile.x, y=tile.y), timeout=self.timeout)
+        if response.status_code in (204, 404):
+            # No tile here (e.g. open sea); not an error
+            return b''
+        response.raise_for_status()
+        return response.content
+
+    def fetch(self, tile):
+        """
+        Tile data; b'' for a tile the source does not have, None when every attempt failed.
+        """
+        try:
+            return self.retrying.copy()(self._get, tile)
+        except Exception as error:
+            print(f"  ⚠️ {tile.z}/{tile.x}/{tile.y}: {error}")
+            return None
+
+
+def _write_metadata(mbtiles, name, bounds, attribution, fmt):
+    metadata = mbtiles.metadata()
+    min_zoom, max_zoom = mbtiles.zoom_range()
+    values = {'name': name, 'type': 'baselayer', 'bounds': ','.join(f"{v:.6f}" for v in bounds)}
+    if min_zoom is not None:
+        values.update(minzoom=min_zoom, maxzoom=max_zoom)
+    if fmt or 'format' not in metadata:
+        values['format'] = fmt or 'png'
+    if attribution:
+        values['attribution'] = attribution
+    mbtiles.set_metadata(**values)
+
+
+def prefetch(name, source, bounds, min_zoom=BASEMAP_MIN_ZOOM, max_zoom=BASEMAP_MAX_ZOOM, directory=BASEMAP_DIR,
+             workers=BASEMAP_WORKERS, max_attempts=BASEMAP_MAX_ATTEMPTS, refresh=False, attribution=None):
+    """
+    Download the tiles of a basemap over an area into its MBTiles file.
+
+    Args:
+        name: Basemap name; the file is <directory>/<name>.mbtiles
+        source: Provider name or URL template (see resolve_source)
+        bounds: (west, south, east, north) in degrees
+        min_zoom: Lowest zoom level to fetch
+        max_zoom: Highest zoom level to fetch
+        directory: Where the MBTiles files live
+        workers: Concurrent downloads
+        max_attempts: Tries per tile
+        refresh: Download tiles that are already in the file again
+        attribution: Attribution text; defaults to the provider's or BASEMAP_ATTRIBUTION
+
+    Returns:
+        dict with tiles_planned, tiles_cached (already in the file, including empty
+        tiles), tiles_fetched, tiles_empty, tiles_failed and seconds
+    """
+    start = time.perf_counter()
+    url, provider_attribution = resolve_source(source)
+    attribution = attribution or provider_attribution or BASEMAP_ATTRIBUTION.get(name)
+    tiles = plan_tiles(bounds, min_zoom, max_zoom)
+    summary = {'tiles_planned': len(tiles), 'tiles_cached': 0, 'tiles_fetched': 0, 'tiles_empty': 0,
+               'tiles_failed': 0}
+
+    with track(f'basemap.{name}') as step, MBTiles(basemap_path(name, directory), mode='w') as mbtiles:
+        if not refresh:
+            stored = {z: mbtiles.tile_addresses(z) for z in range(min_zoom, max_zoom + 1)}
+            missing = [t for t in tiles if (t.x, t.y) not in stored[t.z]]
+            summary['tiles_cached'] = len(tiles) - len(missing)
+            tiles = missing
+
+        fmt = None
+        if tiles:
+            downloader = TileDownloader(url, max_attempts)
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for i in range(0, len(tiles), BATCH_SIZE):
+                    batch = tiles[i:i + BATCH_SIZE]
+                    rows = []
+                    for tile, data in zip(batch, executor.map(downloader.fetch, batch)):
+                        if data is None:
+                            summary['tiles_failed'] += 1
+                            continue
+                        # An empty tile is stored as a zero-length row, so it is not requested again
+                        rows.append((tile.z, tile.x, tile.y, data))
+                        if data:
+                            summary['tiles_fetched'] += 1
+                            fmt = fmt or tile_format(data)
+                        else:
+                            summary['tiles_empty'] += 1
+                    mbtiles.put_tiles(rows)
+                    print(f"  {name}: {i + len(batch):,} / {len(tiles):,} tiles")
+        _write_metadata(mbtiles, name, bounds, attribution, fmt)
+        step.rows = summary['tiles_fetched']
+
+    summary['seconds'] = round(time.perf_counter() - start, 3)
+    return summary
+
+
+def _source_tiles(path):
+    """(z, x, y, data) of every tile in a directory tree {z}/{x}/{y}.<ext> or an MBTiles file."""
+    path = Path(path)
+    if path.is_dir():
+        for file in sorted(path.glob('*/*/*.*')):
+            z, x, y = file.parent.parent.name, file.parent.name, file.stem
+            if z.isdigit() and x.isdigit() and y.isdigit():
+                yield int(z), int(x), int(y), file.read_bytes()
+        return
+    with MBTiles(path, mode='r') as source:
+        yield from source.tiles()
+
+
+def import_tiles(name, path, bounds=None, min_zoom=BASEMAP_MIN_ZOOM, max_zoom=BASEMAP_MAX_ZOOM,
+                 directory=BASEMAP_DIR, attribution=None):
+    """
+    Copy tiles from a local directory tree or MBTiles file into a basemap.
+
+    Args:
+        name: Basemap name
+        path: Directory laid out as {z}/{x}/{y}.<ext>, or an .mbtiles file
+        bounds: Only import tiles intersecting (west, south, east, north); None for all
+        min_zoom: Lowest zoom level to import
+        max_zoom: Highest zoom level to import
+
+    Returns:
+        Number of tiles imported
+    """
+    wanted = {(t.z, t.x, t.y) for t in plan_tiles(bounds, min_zoom, max_zoom)} if bounds is not None else None
+    count, fmt, batch = 0, None, []
+    with track(f'basemap.import_{name}') as step, MBTiles(basemap_path(name, directory), mode='w') as mbtiles:
+        for z, x, y, data in _source_tiles(path):
+            if not min_zoom <= z <= max_zoom or (wanted is not None and (z, x, y) not in wanted):
+                continue
+            fmt = fmt or tile_format(data)
+            batch.append((z, x, y, data))
+            if len(batch) == BATCH_SIZE:
+                mbtiles.put_tiles(batch)
+                count, batch = count + len(batch), []
+        mbtiles.put_tiles(batch)
+        count += len(batch)
+        _write_metadata(mbtiles, name, bounds or WORLD_BOUNDS, attribution or BASEMAP_ATTRIBUTION.get(name), fmt)
+        step.rows = count
+    return count
+
+
+def available_basemaps(directory=BASEMAP_DIR):
+    """
+    Offline basemaps on disk.
+
+    Returns:
+        dict of name -> MBTiles metadata (format, minzoom, maxzoom, attribution, ...)
+    """
+    basemaps = {}
+    for path in sorted(Path(directory).glob('*.mbtiles')):
+        with MBTiles(path, mode='r') as mbtiles:
+            metadata = mbtiles.metadata()
+        if 'minzoom' in metadata:
+            basemaps[path.stem] = metadata
+    return basemaps
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Download or import basemap tiles for offline use.")
+    parser.add_argument('names', nargs='*', help=f"Basemaps to prefetch (default: {', '.join(BASEMAP_SOURCES)})")
+    parser.add_argument('--source', help="Provider name or URL template, instead of the one in BASEMAP_SOURCES")
+    parser.add_argument('--import', dest='imports', nargs='+', default=[], metavar='NAME=PATH',
+                        help="Import a {z}/{x}/{y} directory or an MBTiles file as basemap NAME")
+    parser.add_argument('--bounds', nargs=4, type=float, metavar=('WEST', 'SOUTH', 'EAST', 'NORTH'),
+                        help=f"Area in degrees (default: '{BASEMAP_BOUNDS}' of the coverage plan)")
+    parser.add_argument('--min-zoom', type=int, default=BASEMAP_MIN_ZOOM)
+    parser.add_argument('--max-zoom', type=int, default=BASEMAP_MAX_ZOOM)
+    parser.add_argument('--workers', type=int, default=BASEMAP_WORKERS)
+    parser.add_argument('--refresh', action='store_true', help="Download tiles that are already cached again")
+    parser.add_argument('--directory', type=Path, default=BASEMAP_DIR)
+    args = parser.parse_args(argv)
+
+    bounds = tuple(args.bounds) if args.bounds else coverage_bounds()
+    print(f"🗺️ Basemap tiles for {', '.join(f'{v:.3f}' for v in bounds)}, zoom {args.min_zoom}-{args.max_zoom}: "
+          f"{len(plan_tiles(bounds, args.min_zoom, args.max_zoom)):,} tiles per basemap")
+
+    for spec in args.imports:
+        name, _, path = spec.partition('=')
+        count = import_tiles(name, path, bounds, args.min_zoom, args.max_zoom, args.directory)
+        print(f"✅ Imported {count:,} tiles from {path} into {basemap_path(name, args.directory)}")
+
+    names = args.names or ([] if args.imports else list(BASEMAP_SOURCES))
+    failed = False
+    for name in names:
+        source = args.source or BASEMAP_SOURCES.get(name)
+        if source is None:
+            parser.error(f"No source for basemap {name!r}; add it to BASEMAP_SOURCES or pass --source")
+        summary = prefetch(name, source, bounds, args.min_zoom, args.max_zoom, args.directory, args.workers,
+                           refresh=args.refresh)
+        print(f"✅ {name}: {summary['tiles_fetched']:,} fetched, {summary['tiles_cached']:,} already cached, "
+              f"{summary['tiles_empty']:,} empty, {summary['tiles_failed']:,} failed ({summary['seconds']:.1f}s)")
+        failed = failed or summary['tiles_failed'] > 0
+    if failed:
+        print("⚠️ Some tiles failed; run the same command again to fetch only those")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,157 @@
+"""Bulk labels: every grid cell or ward inside a drawn or picked area at once.
+
+A selection (a polygon or rectangle drawn with folium's Draw plugin, or a
+picked ward) is resolved in TARGET_CRS without reading a grid dataset. Cell ids
+are arithmetic on coordinates (see spatial_prep.grid), so the candidate cells
+follow from the selection's bounds, block by block, and a vectorized
+point-in-polygon test on their centres keeps those inside. The ward of each
+cell, and the wards covered by a selection, come from the PointSnapper's
+STRtree.
+
+The result is one DataFrame with an annotation per cell (at its centre) or per
+ward (at a point inside it), which AnnotationStore.extend adds as a single
+batch and AnnotationStore.undo removes again. On the map, labelled cells are
+drawn as one merged shape per cell size and label (see label_shapes) instead of
+one marker per cell.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import Transformer
+
+from config.settings import BULK_MAX_CELLS, BULK_WARD_MIN_SHARE, TARGET_CRS, WEB_CRS
+from spatial_prep import grid
+from utils.annotation_store import SOURCE_WARD, cell_source
+
+TO_WEB = Transformer.from_crs(TARGET_CRS, WEB_CRS, always_xy=True)
+
+
+def _transform(geometry, transformer):
+    return shapely.transform(geometry, lambda xy: np.column_stack(transformer.transform(xy[:, 0], xy[:, 1])))
+
+
+def drawing_polygon(drawing, snapper):
+    """
+    Polygon in TARGET_CRS of a shape drawn on the map.
+
+    Args:
+        drawing: GeoJSON feature, e.g. ``last_active_drawing`` from st_folium
+        snapper: PointSnapper, for its projection
+
+    Returns:
+        Polygon, or None when the drawing is not a (multi)polygon
+    """
+    geometry = (drawing or {}).get('geometry')
+    if not geometry or geometry.get('type') not in ('Polygon', 'MultiPolygon'):
+        return None
+    polygon = shapely.make_valid(_transform(shapely.from_geojson(json.dumps(geometry)), snapper.to_utm))
+    return polygon if not polygon.is_empty else None
+
+
+def ward_labels(snapper):
+    """'Ward (District, Region)' of every ward in the snapper, by ward index."""
+    names = snapper.attributes
+    return [f"{ward} ({district}, {region})"
+            for ward, district, region in zip(names['ward_name'], names['dist_name'], names['reg_name'])]
+
+
+def ward_polygon(snapper, index):
+    """Geometry in TARGET_CRS of a ward, by its index in ward_labels."""
+    return snapper.tree.geometries[index]
+
+
+def _annotations(x, y, snapper, is_treatment, source):
+    """Snapped annotations at TARGET_CRS points; the timestamp is left to the store (now)."""
+    longitude, latitude = TO_WEB.transform(x, y)
+    return pd.concat([
+        pd.DataFrame({
+            'latitude': latitude,
+            'longitude': longitude,
+            'is_treatment': np.full(len(x), is_treatment),
+            'source': source,
+        }),
+        snapper.snap(latitude, longitude),
+    ], axis=1)
+
+
+def select_cells(polygon, cell_size, snapper, is_treatment, max_cells=BULK_MAX_CELLS):
+    """
+    Annotations for the grid cells whose centre lies inside a polygon.
+
+    Args:
+        polygon: Selection in TARGET_CRS
+        cell_size: Grid cell size in meters
+        snapper: PointSnapper with the wards; cells outside all wards are left out
+        is_treatment: Label for the cells
+        max_cells: Largest selection allowed
+
+    Returns:
+        DataFrame of annotations, one per cell, with source cells_<size>m
+
+    Raises:
+        ValueError: If the selection covers more than max_cells cells
+    """
+    if polygon.area / cell_size ** 2 > max_cells:
+        raise ValueError(f"The selection covers about {polygon.area / cell_size ** 2:,.0f} {cell_size}m cells, "
+                         f"more than {max_cells:,}; draw a smaller area or use larger cells")
+    shapely.prepare(polygon)
+    xs, ys = [], []
+    for col_min, row_min, col_max, row_max in grid.iter_blocks(polygon.bounds, cell_size):
+        cols, rows = np.meshgrid(np.arange(col_min, col_max), np.arange(row_min, row_max))
+        x = (cols.ravel() + 0.5) * cell_size
+        y = (rows.ravel() + 0.5) * cell_size
+        inside = shapely.contains_xy(polygon, x, y)
+        xs.append(x[inside])
+        ys.append(y[inside])
+    frame = _annotations(np.concatenate(xs), np.concatenate(ys), snapper, is_treatment, cell_source(cell_size))
+    return frame[frame['ward_name'].notna()].reset_index(drop=True)
+
+
+def select_wards(polygon, snapper, is_treatment, min_share=BULK_WARD_MIN_SHARE):
+    """
+    Annotations for the wards a polygon covers.
+
+    A ward is selected when at least ``min_share`` of its area lies inside the
+    polygon, so a selection that crosses a neighbouring ward's edge does not
+    label that ward.
+
+    Returns:
+        DataFrame of annotations, one per ward at a point inside it, with source 'ward'
+    """
+    geometries = snapper.tree.geometries
+    candidates = snapper.tree.query(polygon, predicate='intersects')
+    share = shapely.area(shapely.intersection(geometries[candidates], polygon)) / shapely.area(geometries[candidates])
+    selected = np.sort(candidates[share >= min_share])
+    points = shapely.point_on_surface(geometries[selected])
+    frame = _annotations(shapely.get_x(points), shapely.get_y(points), snapper, is_treatment, SOURCE_WARD)
+    # A point on a shared boundary may snap to the neighbour; the selected ward is known
+    for column, values in snapper.attributes.items():
+        frame[column] = values[selected]
+    return frame
+
+
+def label_shapes(frame, cell_sizes):
+    """
+    GeoJSON FeatureCollection of the bulk-labelled cells in an annotation frame:
+    one MultiPolygon per cell size and label, made of runs of cells.
+
+    Args:
+        frame: Annotations with source, is_treatment and the cell columns
+        cell_sizes: Cell sizes whose bulk labels are drawn
+    """
+    features = []
+    for cell_size in cell_sizes:
+        # A cell labelled again keeps its latest label
+        cells = frame[frame['source'] == cell_source(cell_size)].drop_duplicates(f'cell_{cell_size}m', keep='last')
+        for is_treatment, group in cells.groupby('is_treatment'):
+            runs = grid.cell_runs(group[f'cell_{cell_size}m'].to_numpy(), cell_size)
+            shape = _transform(shapely.multipolygons(runs), TO_WEB)
+            features.append({
+                'type': 'Feature',
+                'geometry': json.loads(shapely.to_geojson(shape, indent=None)),
+                'properties': {'is_treatment': bool(is_treatment), 'cells': int(group.shape[0]),
+                               'cell_size': cell_size},
+            })
+    return {'type': 'FeatureCollection', 'features': features}
@@ -0,0 +1,128 @@
+"""Process-wide data layer for the Streamlit app.
+
+Streamlit runs app.py from the top for every session and every rerun. The heavy
+objects built from data/processed (the ward and grid layers with their STRtrees,
+and the point snapper with its STRtree and pyproj transformer) are therefore
+created through ``st.cache_resource``: once per server process and shared by all
+sessions, so ten annotators use the memory of one.
+
+Each loader is keyed on the version of its source files: modification time and
+size of a file, or of every Parquet part of a grid dataset. That costs a few
+stat calls per rerun. When the pipeline rewrites data/processed the key
+changes and the next rerun builds the new object; ``max_entries`` makes
+Streamlit drop the stale one instead of keeping both. ``clear`` drops
+everything at once.
+
+Per-viewport query results are memoized inside each ViewportLayer, bounded by
+VIEWPORT_CACHE_MAX_MB (see utils.map_layers).
+
+The shared annotation store (utils.shared_store) is opened once per process as
+well; its SQLite connection is shared by all sessions and serializes their writes.
+
+Nothing here imports geopandas, shapely or the grid modules until a loader
+runs, so importing the data layer is cheap (see benchmarks/bench_startup.py).
+"""
+from pathlib import Path
+
+import streamlit as st
+
+from config.settings import (BASEMAP_DIR, GRID_LAYER_MIN_ZOOM, GRID_SIZE_LARGE, SHARED_STORE_FILE,
+                             WARD_LAYER_MIN_ZOOM, WARDS_FILE)
+
+
+def file_version(path):
+    """
+    Cache key for a file or dataset directory.
+
+    Returns:
+        (mtime_ns, size) of a file; (number of parts, latest mtime_ns, total
+        size) of the Parquet parts of a directory; None when the path is missing
+    """
+    path = Path(path)
+    if not path.exists():
+        return None
+    if not path.is_dir():
+        stat = path.stat()
+        return stat.st_mtime_ns, stat.st_size
+    from spatial_prep.tiles import TMP_PREFIX
+
+    # Tiles still being written live in hidden directories and are not read
+    stats = [part.stat() for part in path.rglob('*.parquet')
+             if not any(name.startswith(TMP_PREFIX) for name in part.relative_to(path).parts)]
+    return len(stats), max((s.st_mtime_ns for s in stats), default=0), sum(s.st_size for s in stats)
+
+
+@st.cache_resource(max_entries=1, show_spinner="Loading ward boundaries...")
+def _ward_layer(version):
+    import geopandas as gpd
+
+    from utils.map_layers import ViewportLayer
+
+    wards = gpd.read_file(WARDS_FILE)
+    return ViewportLayer(wards, ['ward_name', 'dist_name', 'reg_name', 'is_treatment'], min_zoom=WARD_LAYER_MIN_ZOOM)
+
+
+@st.cache_resource(max_entries=2, show_spinner="Loading grid cells...")
+def _grid_layer(cell_size, version):
+    from spatial_prep.tiles import grid_dataset_dir, read_grid
+    from utils.map_layers import ViewportLayer
+
+    cells = read_grid(grid_dataset_dir(cell_size), columns=['cell_id', 'ward_name', 'is_treatment', 'geometry'])
+    return ViewportLayer(cells, ['cell_id', 'ward_name', 'is_treatment'], min_zoom=GRID_LAYER_MIN_ZOOM)
+
+
+@st.cache_resource(max_entries=1, show_spinner="Loading wards for snapping...")
+def _snapper(version):
+    from utils.snapping import PointSnapper
+
+    return PointSnapper.from_file(WARDS_FILE)
+
+
+@st.cache_resource(max_entries=1)
+def _basemaps(versions):
+    from utils.basemap_tiles import available_basemaps
+
+    return available_basemaps(BASEMAP_DIR)
+
+
+@st.cache_resource
+def _shared_store(path):
+    from utils.shared_store import SharedStore
+
+    return SharedStore(path)
+
+
+def ward_layer():
+    """Relevant wards behind a spatial index, or None before 01_explore_districts.py has run."""
+    version = file_version(WARDS_FILE)
+    return _ward_layer(version) if version is not None else None
+
+
+def grid_layer(cell_size=GRID_SIZE_LARGE):
+    """Grid cells behind a spatial index, or None when the grid dataset does not exist."""
+    from spatial_prep.tiles import grid_dataset_dir
+
+    version = file_version(grid_dataset_dir(cell_size))
+    return _grid_layer(cell_size, version) if version is not None else None
+
+
+def snapper():
+    """Grid cell and ward lookup for new annotations, or None without the ward layer."""
+    version = file_version(WARDS_FILE)
+    return _snapper(version) if version is not None else None
+
+
+def basemaps():
+    """Offline basemaps served by the tile server: name -> MBTiles metadata (see utils.basemap_tiles)."""
+    return _basemaps(tuple((path.name, file_version(path)) for path in sorted(BASEMAP_DIR.glob('*.mbtiles'))))
+
+
+def shared_store():
+    """The annotation store all sessions write to."""
+    return _shared_store(str(SHARED_STORE_FILE))
+
+
+def clear():
+    """Drop all shared data; it is reloaded on the next rerun of any session."""
+    for loader in (_ward_layer, _grid_layer, _snapper, _basemaps):
+        loader.clear()
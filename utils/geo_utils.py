@@ -0,0 +1,106 @@
+"""Geospatial helper functions shared by the processing scripts and the app."""
+import hashlib
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from config.settings import CACHE_DIR, TARGET_CRS
+from utils.instrumentation import timed, track
+
+EDGE_COLUMNS = ['source', 'target', 'distance_m', 'touches']
+
+
+@timed('adjacency.build', count_rows=True)
+def build_adjacency(gdf, id_column=None, buffer_distance=1000):
+    """
+    Build a neighbour graph between polygons in one STRtree pass.
+
+    Two polygons are neighbours when they lie within ``buffer_distance`` meters of
+    each other (the buffer absorbs digitization gaps between boundaries). The graph
+    is returned as an edge list with both directions present.
+
+    Args:
+        gdf: GeoDataFrame of regions, districts or wards (any CRS)
+        id_column: Column identifying each polygon; defaults to the index
+        buffer_distance: Maximum gap in meters for two polygons to count as adjacent
+
+    Returns:
+        DataFrame with source, target, distance_m and touches columns
+    """
+    with track('adjacency.to_crs', rows=len(gdf)):
+        utm = gdf.to_crs(TARGET_CRS)
+    ids = utm.index.to_numpy() if id_column is None else utm[id_column].to_numpy()
+    geoms = np.asarray(utm.geometry.values)
+
+    tree = shapely.STRtree(geoms)
+    left, right = tree.query(geoms, predicate='dwithin', distance=buffer_distance)
+    not_self = left != right
+    left, right = left[not_self], right[not_self]
+
+    edges = pd.DataFrame({
+        'source': ids[left],
+        'target': ids[right],
+        'distance_m': shapely.distance(geoms[left], geoms[right]),
+        'touches': shapely.touches(geoms[left], geoms[right]),
+    })
+    return edges.sort_values(['source', 'target'], kind='stable').reset_index(drop=True)
+
+
+def adjacency_cache_key(gdf, id_column=None, buffer_distance=1000):
+    """Content hash of the geometries, ids and buffer used for an adjacency graph."""
+    ids = gdf.index if id_column is None else gdf[id_column]
+    digest = hashlib.sha256()
+    digest.update(f"{gdf.crs}|{id_column}|{buffer_distance}".encode())
+    digest.update(pd.util.hash_pandas_object(pd.Series(ids).astype(str), index=False).to_numpy().tobytes())
+    for wkb in shapely.to_wkb(np.asarray(gdf.geometry.values)):
+        digest.update(wkb)
+    return digest.hexdigest()[:16]
+
+
+def load_or_build_adjacency(gdf, id_column=None, buffer_distance=1000, cache_dir=None):
+    """
+    Same as build_adjacency, but reuse a cached edge list when the inputs are unchanged.
+
+    The cache file name embeds a hash of the geometries, ids and buffer distance, so
+    edited boundaries or a different buffer simply produce a new cache entry.
+
+    Args:
+        gdf: GeoDataFrame of regions, districts or wards (any CRS)
+        id_column: Column identifying each polygon; defaults to the index
+        buffer_distance: Maximum gap in meters for two polygons to count as adjacent
+        cache_dir: Directory for cached edge lists, defaults to data/processed/cache
+    """
+    cache_dir = Path(cache_dir) if cache_dir is not None else CACHE_DIR
+    key = adjacency_cache_key(gdf, id_column, buffer_distance)
+    cache_file = cache_dir / f"adjacency_{id_column or 'index'}_{key}.parquet"
+    if cache_file.exists():
+        return pd.read_parquet(cache_file)
+
+    edges = build_adjacency(gdf, id_column, buffer_distance)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    edges.to_parquet(cache_file, index=False)
+    return edges
+
+
+def find_adjacent(edges, targets, max_distance=None):
+    """
+    List the neighbours of a set of polygons, excluding the polygons themselves.
+
+    Args:
+        edges: Edge list from build_adjacency / load_or_build_adjacency
+        targets: Iterable of ids to find neighbours for
+        max_distance: Optional tighter distance in meters than the one the graph was built with
+    """
+    targets = set(targets)
+    selected = edges['source'].isin(targets)
+    if max_distance is not None:
+        selected &= edges['distance_m'] <= max_distance
+    neighbours = edges.loc[selected, 'target']
+    return sorted(set(neighbours) - targets)
+
+
+def neighbour_lists(edges):
+    """Convert an edge list into a {id: [neighbour ids]} mapping."""
+    return edges.groupby('source')['target'].agg(list).to_dict()
@@ -0,0 +1,210 @@
+"""Timing, CPU, memory and row-count instrumentation for processing steps and app reruns.
+
+``track(name)`` measures a block of code (as a context manager, or started and
+stopped explicitly where a block does not fit, such as a whole Streamlit
+rerun); ``timed(name)`` does the same for a function. Each measurement records
+wall time, CPU time of the process, peak RSS (sampled by a background thread
+while the block runs) and optionally a row count, and is
+
+  * added to Prometheus metrics (``rubeho_step_*``, labelled by step name),
+    served on localhost at ``/metrics`` when METRICS_PORT is set, and
+  * appended as one JSON object per line to METRICS_LOG_FILE.
+
+Step names are dotted, e.g. ``wards.shapefile_load``, ``pipeline.grid_100m`` or
+``app.rerun``. A step that raises is recorded with ``"error": true``. A tracker
+started explicitly and never stopped (e.g. a Streamlit run interrupted by the
+next interaction) is not recorded; its memory sampler stops once the tracker is
+garbage collected.
+"""
+import functools
+import json
+import logging
+import threading
+import time
+import weakref
+from datetime import datetime
+
+import psutil
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from config.settings import METRICS_LOG_FILE, METRICS_PORT
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+STEP_SECONDS = Histogram('rubeho_step_duration_seconds', "Wall time per step", ['step'], buckets=DURATION_BUCKETS)
+STEP_CPU_SECONDS = Counter('rubeho_step_cpu_seconds', "Process CPU time spent in each step", ['step'])
+STEP_PEAK_RSS = Gauge('rubeho_step_peak_rss_bytes', "Peak resident memory during the last run of each step", ['step'])
+STEP_ROWS = Counter('rubeho_step_rows', "Rows produced by each step", ['step'])
+STEP_ERRORS = Counter('rubeho_step_errors', "Runs of each step that raised", ['step'])
+
+logger = logging.getLogger('rubeho.metrics')
+_setup_lock = threading.Lock()
+_log_configured = False
+_server_started = False
+
+
+class PeakRss:
+    """Context manager sampling the resident set size of this process in a background thread."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.peak = self.start = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def cancel(self):
+        """Stop the sampling thread without waiting for it."""
+        self._stop.set()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.process.memory_info().rss)
+
+    def __enter__(self):
+        self.start = self.peak = self.process.memory_info().rss
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps(record.msg, default=str)
+
+
+def _configure_log():
+    """Attach the JSON lines handler on first use (not at import, so importing writes nothing)."""
+    global _log_configured
+    with _setup_lock:
+        if _log_configured:
+            return
+        if METRICS_LOG_FILE is not None:
+            METRICS_LOG_FILE.parent.mkdir(parents=True, exist_ok=True)
+            handler = logging.FileHandler(METRICS_LOG_FILE, encoding='utf-8')
+            handler.setFormatter(_JsonFormatter())
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+        logger.propagate = False
+        _log_configured = True
+
+
+def start_metrics_server(port=METRICS_PORT, addr='127.0.0.1'):
+    """
+    Serve the Prometheus metrics on http://<addr>:<port>/metrics, once per process.
+
+    Returns:
+        True if the server is running, False when no port is configured
+    """
+    global _server_started
+    if port is None:
+        return False
+    with _setup_lock:
+        if not _server_started:
+            start_http_server(port, addr=addr)
+            _server_started = True
+    return True
+
+
+class Tracker:
+    """
+    Measurement of one step; see track.
+
+    Args:
+        name: Dotted step name, used as the metric label
+        rows: Row count, if already known; can also be set on the object
+        **fields: Extra values for the JSON log (e.g. cell_size=100)
+    """
+
+    def __init__(self, name, rows=None, **fields):
+        self.name = name
+        self.rows = rows
+        self.fields = fields
+        self.result = None
+        self._rss = None
+
+    def start(self):
+        self._rss = PeakRss().__enter__()
+        # Stops the sampling thread if this tracker is dropped without stop()
+        self._finalizer = weakref.finalize(self, self._rss.cancel)
+        self._wall, self._cpu = time.perf_counter(), time.process_time()
+        return self
+
+    def stop(self, error=False):
+        """Record the step; returns the logged measurement. Stopping twice records it once."""
+        if self._rss is None:
+            return self.result
+        wall, cpu = time.perf_counter() - self._wall, time.process_time() - self._cpu
+        self._rss.__exit__(None, None, None)
+        self._finalizer.detach()
+        peak = self._rss.peak
+        self._rss = None
+
+        STEP_SECONDS.labels(self.name).observe(wall)
+        STEP_CPU_SECONDS.labels(self.name).inc(max(cpu, 0.0))
+        STEP_PEAK_RSS.labels(self.name).set(peak)
+        if self.rows is not None:
+            STEP_ROWS.labels(self.name).inc(self.rows)
+        if error:
+            STEP_ERRORS.labels(self.name).inc()
+
+        self.result = {
+            'time': datetime.now().isoformat(timespec='milliseconds'),
+            'step': self.name,
+            'seconds': round(wall, 6),
+            'cpu_seconds': round(cpu, 6),
+            'peak_rss_mb': round(peak / 2**20, 1),
+            'rows': self.rows,
+            'error': error,
+            **self.fields,
+        }
+        _configure_log()
+        logger.info(self.result)
+        return self.result
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop(error=exc_type is not None)
+        return False
+
+
+def track(name, rows=None, **fields):
+    """
+    Measure a step.
+
+    Use as ``with track('wards.dissolve') as step: ...; step.rows = len(regions)``,
+    or call ``start()`` and ``stop()`` where a with-block does not fit.
+
+    Args:
+        name: Dotted step name, used as the metric label
+        rows: Row count, if already known; can also be set on the returned Tracker
+        **fields: Extra values for the JSON log (e.g. cell_size=100)
+    """
+    return Tracker(name, rows, **fields)
+
+
+def timed(name, count_rows=False):
+    """
+    Decorator measuring every call of a function as step ``name``.
+
+    Args:
+        name: Dotted step name
+        count_rows: Record len() of the return value as the row count
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with track(name) as step:
+                result = func(*args, **kwargs)
+                if count_rows:
+                    step.rows = len(result)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,157 @@
+"""Viewport-driven map layers for the Streamlit app.
+
+A ViewportLayer keeps one layer (wards, 500 m grid cells, ...) in WEB_CRS behind
+an STRtree and returns only the features that intersect the map viewport. The
+viewport is split into XYZ web-map tiles at the current zoom; each (tile, zoom)
+result is simplified to roughly one screen pixel and memoized, so panning only
+queries the tiles that have not been seen yet.
+
+Layers are shared by all sessions of the app (see utils.data_layer), so the memo
+is an LRU cache bounded by the estimated memory of its results rather than by
+an entry count, guarded by a lock for concurrent reruns.
+
+The app imports this module on every run for bounds_from_map_data, so shapely
+is only imported once a layer is built.
+"""
+import json
+import threading
+
+import mercantile
+import numpy as np
+from cachetools import LRUCache
+
+from config.settings import VIEWPORT_CACHE_MAX_MB, WEB_CRS
+
+TILE_PIXELS = 256
+
+
+def bounds_from_map_data(map_bounds):
+    """
+    Convert the ``bounds`` returned by st_folium to (west, south, east, north).
+
+    Returns None when the map has not reported its bounds yet.
+    """
+    if not map_bounds or not map_bounds.get('_southWest') or not map_bounds.get('_northEast'):
+        return None
+    south_west, north_east = map_bounds['_southWest'], map_bounds['_northEast']
+    if south_west.get('lng') is None or north_east.get('lng') is None:
+        return None
+    return (
+        max(south_west['lng'], -180.0),
+        max(south_west['lat'], -85.0),
+        min(north_east['lng'], 180.0),
+        min(north_east['lat'], 85.0),
+    )
+
+
+def _result_size(result):
+    """Approximate memory of a memoized tile result in bytes (16 per coordinate, plus object overhead)."""
+    import shapely
+
+    idx, geometries = result
+    return idx.nbytes + 16 * int(shapely.get_num_coordinates(geometries).sum()) + 64 * len(geometries)
+
+
+def simplify_tolerance(zoom):
+    """Half a screen pixel at the given zoom, in degrees."""
+    return 0.5 * 360.0 / (TILE_PIXELS * 2 ** zoom)
+
+
+class ViewportLayer:
+    """
+    Spatially indexed layer that serves GeoJSON for the current viewport.
+
+    Args:
+        gdf: GeoDataFrame with the layer features (any CRS)
+        properties: Columns to include as GeoJSON feature properties
+        min_zoom: Below this zoom level the layer returns no features
+        cache_mb: Memory budget of the (tile, zoom) query results kept, in MB;
+            least recently used results are evicted first
+    """
+
+    def __init__(self, gdf, properties, min_zoom=0, cache_mb=VIEWPORT_CACHE_MAX_MB):
+        import shapely
+
+        gdf = gdf.to_crs(WEB_CRS).reset_index(drop=True)
+        self.min_zoom = min_zoom
+        self.geometries = np.asarray(gdf.geometry.values)
+        self.properties = gdf[list(properties)].to_dict('records')
+        self.tree = shapely.STRtree(self.geometries)
+        self._cache = LRUCache(maxsize=cache_mb * 1024 * 1024, getsizeof=_result_size)
+        self._lock = threading.Lock()
+        self._hits = self._misses = 0
+
+    def __len__(self):
+        return len(self.geometries)
+
+    def _tile_query(self, x, y, z):
+        """Memoized _query_tile."""
+        key = (x, y, z)
+        with self._lock:
+            result = self._cache.get(key)
+            if result is not None:
+                self._hits += 1
+                return result
+            self._misses += 1
+        result = self._query_tile(x, y, z)
+        with self._lock:
+            try:
+                self._cache[key] = result
+            except ValueError:
+                pass  # a single result larger than the whole budget is not kept
+        return result
+
+    def _query_tile(self, x, y, z):
+        """Indices and simplified geometries of the features in one XYZ tile."""
+        import shapely
+
+        west, south, east, north = mercantile.bounds(x, y, z)
+        idx = np.sort(self.tree.query(shapely.box(west, south, east, north), predicate='intersects'))
+        simplified = shapely.simplify(self.geometries[idx], simplify_tolerance(z), preserve_topology=True)
+        return idx, simplified
+
+    def tiles(self, bounds, zoom):
+        """XYZ tiles covering the viewport at the given zoom."""
+        west, south, east, north = bounds
+        return list(mercantile.tiles(west, south, east, north, zooms=int(zoom)))
+
+    def query(self, bounds, zoom):
+        """
+        GeoJSON FeatureCollection of the features visible in the viewport.
+
+        Args:
+            bounds: (west, south, east, north) in WEB_CRS, see bounds_from_map_data
+            zoom: Current map zoom level
+        """
+        import shapely
+
+        if bounds is None or zoom is None or zoom < self.min_zoom:
+            return {'type': 'FeatureCollection', 'features': []}
+
+        results = [self._tile_query(tile.x, tile.y, tile.z) for tile in self.tiles(bounds, zoom)]
+        if not results:
+            return {'type': 'FeatureCollection', 'features': []}
+        idx = np.concatenate([r[0] for r in results])
+        geoms = np.concatenate([r[1] for r in results])
+        # Features spanning several tiles are returned once
+        idx, first = np.unique(idx, return_index=True)
+
+        features = [
+            {
+                'type': 'Feature',
+                'geometry': json.loads(geojson),
+                'properties': self.properties[i],
+            }
+            for i, geojson in zip(idx, shapely.to_geojson(geoms[first]))
+        ]
+        return {'type': 'FeatureCollection', 'features': features}
+
+    def cache_info(self):
+        """Hit/miss statistics and memory use of the per-tile memo."""
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses, 'entries': len(self._cache),
+                    'bytes': self._cache.currsize, 'max_bytes': self._cache.maxsize}
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
@@ -0,0 +1,112 @@
+"""Minimal MBTiles (SQLite) reader/writer.
+
+Follows the MBTiles 1.3 layout: a ``metadata`` name/value table and a ``tiles``
+table keyed by (zoom_level, tile_column, tile_row) with TMS row numbering, i.e.
+the y axis flipped relative to the XYZ scheme used by Leaflet and mercantile.
+"""
+import sqlite3
+from pathlib import Path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS tiles (
+    zoom_level INTEGER,
+    tile_column INTEGER,
+    tile_row INTEGER,
+    tile_data BLOB,
+    PRIMARY KEY (zoom_level, tile_column, tile_row)
+);
+"""
+
+
+def tms_row(z, y):
+    """Convert an XYZ row to the TMS row stored in MBTiles (the conversion is its own inverse)."""
+    return (1 << z) - 1 - y
+
+
+class MBTiles:
+    """
+    An MBTiles file opened for reading or writing.
+
+    Args:
+        path: Location of the .mbtiles file
+        mode: 'r' to read an existing file, 'w' to create or update one
+    """
+
+    def __init__(self, path, mode='r'):
+        self.path = Path(path)
+        if mode == 'r':
+            if not self.path.exists():
+                raise FileNotFoundError(self.path)
+            self.conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+        elif mode == 'w':
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(self.path, check_same_thread=False)
+            self.conn.executescript(SCHEMA)
+        else:
+            raise ValueError(f"mode must be 'r' or 'w', got {mode!r}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def metadata(self):
+        """All metadata entries as a dict."""
+        return dict(self.conn.execute("SELECT name, value FROM metadata"))
+
+    def set_metadata(self, **values):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)",
+            [(name, str(value)) for name, value in values.items()],
+        )
+        self.conn.commit()
+
+    def get_tile(self, z, x, y):
+        """Tile data for an XYZ address (b'' for a tile stored as empty), or None when the tile is missing."""
+        row = self.conn.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (z, x, tms_row(z, y)),
+        ).fetchone()
+        return row[0] if row else None
+
+    def has_tile(self, z, x, y):
+        return self.conn.execute(
+            "SELECT 1 FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (z, x, tms_row(z, y)),
+        ).fetchone() is not None
+
+    def tiles(self):
+        """Iterate over all tiles as (z, x, y, data) with XYZ addressing."""
+        for z, x, row, data in self.conn.execute("SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles"):
+            yield z, x, tms_row(z, row), data
+
+    def tile_addresses(self, z):
+        """XYZ (x, y) of every tile stored at zoom level z, as a set."""
+        return {(x, tms_row(z, row)) for x, row in self.conn.execute(
+            "SELECT tile_column, tile_row FROM tiles WHERE zoom_level = ?", (z,))}
+
+    def put_tiles(self, tiles):
+        """
+        Insert or replace tiles in a single transaction.
+
+        Args:
+            tiles: Iterable of (z, x, y, data) with XYZ addressing
+        """
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)",
+                ((z, x, tms_row(z, y), sqlite3.Binary(data)) for z, x, y, data in tiles),
+            )
+
+    def tile_count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+
+    def zoom_range(self):
+        """(lowest, highest) zoom level with tiles, or (None, None) for an empty file."""
+        return self.conn.execute("SELECT MIN(zoom_level), MAX(zoom_level) FROM tiles").fetchone()
@@ -0,0 +1,308 @@
+"""Mapbox Vector Tile encoding.
+
+A small, dependency-free encoder for the parts of the MVT 2.1 specification the
+project uses: point, line and polygon layers with scalar properties. Geometries
+come in as shapely arrays in Web Mercator (EPSG:3857); they are clipped to the
+tile plus a buffer, snapped to the integer tile grid and written as protobuf.
+
+Geometry commands, property tags and their varint encodings are built for the
+whole layer at once with NumPy; the only per-feature Python work is slicing the
+resulting byte buffers into feature messages.
+"""
+import struct
+
+import numpy as np
+import pandas as pd
+import shapely
+
+EXTENT = 4096
+BUFFER = 64  # tile units drawn outside the tile edge so strokes do not show seams
+
+# Protobuf wire types
+VARINT, FIXED64, LENGTH_DELIMITED = 0, 1, 2
+
+# MVT geometry types and commands
+POINT, LINESTRING, POLYGON = 1, 2, 3
+MOVE_TO, LINE_TO, CLOSE_PATH = 1, 2, 7
+
+_GEOMETRY_TYPES = {0: POINT, 4: POINT, 1: LINESTRING, 5: LINESTRING, 3: POLYGON, 6: POLYGON}
+
+
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _varints(values):
+    """
+    Varint-encode an array of non-negative integers.
+
+    Returns:
+        (buffer, offsets) where the encoding of values[i] is buffer[offsets[i]:offsets[i + 1]]
+    """
+    values = np.asarray(values, dtype=np.uint64)
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        n_bytes += (values >> np.uint64(7 * k)) > 0
+    offsets = np.concatenate([[0], np.cumsum(n_bytes)])
+    if len(values) == 0:
+        return b'', offsets
+    k = np.arange(n_bytes.max())
+    groups = ((values[:, None] >> (7 * k).astype(np.uint64)) & np.uint64(0x7F)).astype(np.uint8)
+    groups |= np.where(k[None, :] < n_bytes[:, None] - 1, 0x80, 0).astype(np.uint8)
+    return groups[k[None, :] < n_bytes[:, None]].tobytes(), offsets
+
+
+def _key(number, wire_type):
+    return _varint((number << 3) | wire_type)
+
+
+def _length_delimited(number, payload):
+    return _key(number, LENGTH_DELIMITED) + _varint(len(payload)) + payload
+
+
+def _zigzag(values):
+    values = np.asarray(values, dtype=np.int64)
+    return (values << 1) ^ (values >> 63)
+
+
+def _command(command_id, count):
+    return (command_id & 0x7) | (np.asarray(count, dtype=np.int64) << 3)
+
+
+def _encode_value(value):
+    """Encode a property value as an MVT Value message."""
+    if isinstance(value, (bool, np.bool_)):
+        return _key(7, VARINT) + _varint(int(value))
+    if isinstance(value, (int, np.integer)):
+        return _key(6, VARINT) + _varint(int(_zigzag(int(value))))
+    if isinstance(value, (float, np.floating)):
+        return _key(3, FIXED64) + struct.pack('<d', float(value))
+    return _length_delimited(1, str(value).encode('utf-8'))
+
+
+def to_tile_coords(geoms, bounds, extent=EXTENT, buffer=BUFFER):
+    """
+    Clip Web Mercator geometries to a tile and convert them to integer tile coordinates.
+
+    Polygons are re-oriented so exterior rings are clockwise with the y axis pointing
+    down, as the spec requires. Geometries that collapse at this resolution come back empty.
+
+    Args:
+        geoms: Array of shapely geometries in EPSG:3857
+        bounds: (minx, miny, maxx, maxy) of the tile in EPSG:3857
+    """
+    minx, miny, maxx, maxy = bounds
+    scale_x = extent / (maxx - minx)
+    scale_y = extent / (maxy - miny)
+    pad_x, pad_y = buffer / scale_x, buffer / scale_y
+    geoms = np.asarray(geoms, dtype=object).copy()
+    invalid = ~shapely.is_valid(geoms)
+    geoms[invalid] = shapely.make_valid(geoms[invalid])
+    clipped = shapely.clip_by_rect(geoms, minx - pad_x, miny - pad_y, maxx + pad_x, maxy + pad_y)
+
+    def transform(coords):
+        return np.column_stack([(coords[:, 0] - minx) * scale_x, (maxy - coords[:, 1]) * scale_y])
+
+    tile_geoms = shapely.set_precision(shapely.transform(clipped, transform), 1.0)
+    # With y pointing down, a counter-clockwise ring in numeric terms is clockwise on screen
+    return shapely.orient_polygons(tile_geoms, exterior_cw=False)
+
+
+def _paths(geoms, geom_type):
+    """
+    Flatten geometries into paths (rings or lines) of integer coordinates.
+
+    Returns:
+        coords (m, 2), coord_path (m,), path_feature (p,) with closing ring vertices dropped
+    """
+    parts, part_feature = shapely.get_parts(geoms, return_index=True)
+    if geom_type == POLYGON:
+        paths, path_part = shapely.get_rings(parts, return_index=True)
+    else:
+        paths, path_part = parts, np.arange(len(parts))
+    coords, coord_path = shapely.get_coordinates(paths, return_index=True)
+    coords = coords.astype(np.int64)
+    path_feature = part_feature[path_part]
+    if len(coords) == 0:
+        return coords, coord_path, path_feature[:0]
+
+    if geom_type == POLYGON:
+        # ClosePath implies the last vertex
+        last = np.r_[coord_path[1:] != coord_path[:-1], True]
+        coords, coord_path = coords[~last], coord_path[~last]
+    min_vertices = 3 if geom_type == POLYGON else 2
+    sizes = np.bincount(coord_path, minlength=len(paths))
+    keep_path = sizes >= min_vertices
+    keep = keep_path[coord_path]
+    new_ids = np.cumsum(keep_path) - 1
+    return coords[keep], new_ids[coord_path[keep]], path_feature[keep_path]
+
+
+def _geometry_commands(geoms, geom_type, n_features):
+    """
+    Command integers for every feature of a layer.
+
+    Returns:
+        (commands, feature_offsets) where feature i owns commands[offsets[i]:offsets[i + 1]]
+    """
+    if geom_type == POINT:
+        coords, coord_feature = shapely.get_coordinates(geoms, return_index=True)
+        coords = coords.astype(np.int64)
+        counts = np.bincount(coord_feature, minlength=n_features)
+        first = np.r_[True, coord_feature[1:] != coord_feature[:-1]]
+        previous = np.vstack([np.zeros((1, 2), dtype=np.int64), coords[:-1]])
+        previous[first] = 0
+        deltas = _zigzag(coords - previous)
+        lengths = np.where(counts > 0, 1 + 2 * counts, 0)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        commands = np.empty(offsets[-1], dtype=np.int64)
+        has = counts > 0
+        commands[offsets[:-1][has]] = _command(MOVE_TO, counts[has])
+        feature_first_coord = np.concatenate([[0], np.cumsum(counts)])[:-1]
+        rank = np.arange(len(coords)) - feature_first_coord[coord_feature]
+        base = offsets[:-1][coord_feature] + 1 + 2 * rank
+        commands[base] = deltas[:, 0]
+        commands[base + 1] = deltas[:, 1]
+        return commands, offsets
+
+    close = geom_type == POLYGON
+    coords, coord_path, path_feature = _paths(geoms, geom_type)
+    n_paths = len(path_feature)
+    sizes = np.bincount(coord_path, minlength=n_paths)
+
+    # The cursor carries over between paths of a feature and resets for each new feature
+    feature_of_coord = path_feature[coord_path]
+    first_of_feature = np.r_[True, feature_of_coord[1:] != feature_of_coord[:-1]] if len(coords) else np.array([], bool)
+    previous = np.vstack([np.zeros((1, 2), dtype=np.int64), coords[:-1]]) if len(coords) else coords
+    previous[first_of_feature] = 0
+    deltas = _zigzag(coords - previous)
+
+    # Per path: MoveTo, dx, dy, [LineTo(n-1), 2(n-1) params], [ClosePath]
+    path_lengths = 3 + np.where(sizes > 1, 1 + 2 * (sizes - 1), 0) + int(close)
+    path_offsets = np.concatenate([[0], np.cumsum(path_lengths)])
+    commands = np.empty(path_offsets[-1], dtype=np.int64)
+    starts = path_offsets[:-1]
+    commands[starts] = _command(MOVE_TO, 1)
+    path_first_coord = np.concatenate([[0], np.cumsum(sizes)])[:-1]
+    commands[starts + 1] = deltas[path_first_coord, 0]
+    commands[starts + 2] = deltas[path_first_coord, 1]
+    multi = sizes > 1
+    commands[starts[multi] + 3] = _command(LINE_TO, sizes[multi] - 1)
+    rank = np.arange(len(coords)) - path_first_coord[coord_path]
+    rest = rank > 0
+    base = starts[coord_path[rest]] + 4 + 2 * (rank[rest] - 1)
+    commands[base] = deltas[rest, 0]
+    commands[base + 1] = deltas[rest, 1]
+    if close:
+        commands[path_offsets[1:] - 1] = _command(CLOSE_PATH, 1)
+
+    feature_lengths = np.bincount(path_feature, weights=path_lengths, minlength=n_features).astype(np.int64)
+    return commands, np.concatenate([[0], np.cumsum(feature_lengths)])
+
+
+def _tags(properties):
+    """
+    Key/value tables and tag integers for every feature.
+
+    Returns:
+        (keys, values, tags, feature_offsets) with values already encoded as Value messages
+    """
+    keys, values, columns = [], [], []
+    for name in properties.columns:
+        codes, uniques = pd.factorize(properties[name], use_na_sentinel=True)
+        if len(uniques) == 0:
+            continue
+        present = codes >= 0
+        columns.append(np.column_stack([np.where(present, len(keys), -1), np.where(present, codes + len(values), -1)]))
+        keys.append(str(name))
+        values.extend(_encode_value(value) for value in uniques)
+    if not columns:
+        return keys, values, np.array([], dtype=np.int64), np.zeros(len(properties) + 1, dtype=np.int64)
+
+    pairs = np.stack(columns, axis=1)  # (features, columns, 2)
+    present = pairs[:, :, 0] >= 0
+    tags = pairs[present].ravel()
+    counts = 2 * present.sum(axis=1)
+    return keys, values, tags, np.concatenate([[0], np.cumsum(counts)])
+
+
+def encode_layer(name, geoms, properties, ids=None, extent=EXTENT):
+    """
+    Encode one MVT layer.
+
+    Args:
+        name: Layer name as seen by the client
+        geoms: Array of shapely geometries already in tile coordinates
+        properties: DataFrame of feature properties, one row per geometry
+        ids: Optional integer feature ids
+    """
+    geoms = np.asarray(geoms, dtype=object)
+    type_ids = shapely.get_type_id(geoms)
+    non_empty = ~shapely.is_empty(geoms) & np.isin(type_ids, list(_GEOMETRY_TYPES))
+    if not non_empty.any():
+        return b''
+    # A layer holds one geometry type; take the most common one and drop the rest
+    types = np.array([_GEOMETRY_TYPES.get(t, 0) for t in type_ids])
+    geom_type = np.bincount(types[non_empty]).argmax()
+    selected = np.flatnonzero(non_empty & (types == geom_type))
+
+    geoms = geoms[selected]
+    properties = properties.iloc[selected].reset_index(drop=True)
+    commands, command_offsets = _geometry_commands(geoms, geom_type, len(geoms))
+    keys, values, tags, tag_offsets = _tags(properties)
+
+    command_bytes, command_byte_offsets = _varints(commands)
+    tag_bytes, tag_byte_offsets = _varints(tags)
+    geometry_header = _key(3, VARINT) + _varint(int(geom_type))
+    tags_key, geometry_key = _key(2, LENGTH_DELIMITED), _key(4, LENGTH_DELIMITED)
+
+    features = []
+    for i in range(len(geoms)):
+        c0, c1 = command_byte_offsets[command_offsets[i]], command_byte_offsets[command_offsets[i + 1]]
+        if c0 == c1:
+            continue
+        t0, t1 = tag_byte_offsets[tag_offsets[i]], tag_byte_offsets[tag_offsets[i + 1]]
+        feature = _key(1, VARINT) + _varint(int(ids[selected[i]])) if ids is not None else b''
+        feature += tags_key + _varint(t1 - t0) + tag_bytes[t0:t1]
+        feature += geometry_header + geometry_key + _varint(c1 - c0) + command_bytes[c0:c1]
+        features.append(_length_delimited(2, feature))
+
+    if not features:
+        return b''
+    layer = _key(15, VARINT) + _varint(2) + _length_delimited(1, name.encode('utf-8'))
+    layer += b''.join(features)
+    layer += b''.join(_length_delimited(3, key.encode('utf-8')) for key in keys)
+    layer += b''.join(_length_delimited(4, value) for value in values)
+    layer += _key(5, VARINT) + _varint(extent)
+    return layer
+
+
+def encode_tile(layers, bounds, extent=EXTENT, buffer=BUFFER):
+    """
+    Encode a vector tile from several layers.
+
+    Args:
+        layers: Iterable of (name, geoms, properties, ids) with geoms in EPSG:3857 and
+            properties as a DataFrame with one row per geometry
+        bounds: (minx, miny, maxx, maxy) of the tile in EPSG:3857
+
+    Returns:
+        Uncompressed protobuf bytes (empty when no layer has features)
+    """
+    tile = b''
+    for name, geoms, properties, ids in layers:
+        if len(geoms) == 0:
+            continue
+        tile_geoms = to_tile_coords(geoms, bounds, extent, buffer)
+        layer = encode_layer(name, tile_geoms, properties, ids, extent)
+        if layer:
+            tile += _length_delimited(3, layer)
+    return tile
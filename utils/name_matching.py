@@ -0,0 +1,200 @@
+"""Vectorized matching of ward/district names against the ward shapefile.
+
+Names from survey sheets and the shapefile are normalized with pandas string
+operations (case, whitespace, punctuation, diacritics and common spelling
+variants) into match keys. Pairs are then matched in two passes:
+
+1. exact: a hash join on (ward key, district key);
+2. fuzzy: for the rows left over, trigram similarity (Jaccard) against wards in
+   the same district only. Trigrams are joined through a (district, trigram)
+   index, so candidates from other districts are never scored.
+
+Districts that do not match exactly are first resolved to the most similar
+shapefile district. Every input pair ends up in the report, ranked by score,
+including the ones that could not be matched. Shapefile rows with the same
+(ward key, district key), e.g. a ward split into several polygons, are one
+candidate: a match reports (and accepts) every one of those rows.
+"""
+import numpy as np
+import pandas as pd
+
+from config.settings import NAME_MATCH_THRESHOLD
+from utils.instrumentation import timed
+
+# Regex replacements applied to upper-case names, in order
+SPELLING_VARIANTS = [
+    (r'[^A-Z0-9 ]', ' '),                          # punctuation, hyphens, apostrophes
+    (r'\b(DISTRICT COUNCIL|DISTRICT|WARD|KATA)$', ''),  # administrative suffixes
+    (r'([A-Z])\1+', r'\1'),                         # doubled letters (Kilosa / Killosa)
+    (r'\s+', ' '),
+]
+
+
+def normalize_names(names):
+    """
+    Normalize names to match keys: ASCII upper case without diacritics,
+    punctuation, administrative suffixes or doubled letters.
+
+    Args:
+        names: Series of names
+
+    Returns:
+        Series of keys with the same index
+    """
+    keys = (
+        names.astype(str)
+        .str.normalize('NFKD')
+        .str.encode('ascii', errors='ignore')
+        .str.decode('ascii')
+        .str.upper()
+        .str.strip()
+    )
+    for pattern, replacement in SPELLING_VARIANTS:
+        keys = keys.str.replace(pattern, replacement, regex=True).str.strip()
+    return keys
+
+
+def trigrams(keys):
+    """
+    Distinct character trigrams per key (padded with a space on both sides).
+
+    Returns:
+        DataFrame with the key's index label in 'id' and the trigram in 'gram'
+    """
+    padded = ' ' + keys + ' '
+    lengths = padded.str.len().to_numpy()
+    parts = []
+    for start in range(int(lengths.max(initial=0)) - 2):
+        has_gram = lengths >= start + 3
+        parts.append(pd.DataFrame({'id': keys.index[has_gram], 'gram': padded[has_gram].str[start:start + 3]}))
+    if not parts:
+        return pd.DataFrame({'id': keys.index[:0], 'gram': pd.Series([], dtype=object)})
+    return pd.concat(parts, ignore_index=True).drop_duplicates()
+
+
+def similarity(left_keys, right_keys, left_blocks=None, right_blocks=None, top_k=3):
+    """
+    Trigram Jaccard similarity between keys, restricted to equal blocks.
+
+    Args:
+        left_keys, right_keys: Series of match keys, indexed by row id
+        left_blocks, right_blocks: Optional Series (same index as the keys) with
+            the block of each key; only pairs in the same block are compared
+        top_k: Number of best candidates kept per left key
+
+    Returns:
+        DataFrame with left_id, right_id, score and rank (1 = best)
+    """
+    left = trigrams(left_keys)
+    right = trigrams(right_keys)
+    left['block'] = left_blocks.reindex(left['id']).to_numpy() if left_blocks is not None else 0
+    right['block'] = right_blocks.reindex(right['id']).to_numpy() if right_blocks is not None else 0
+
+    pairs = left.merge(right, on=['block', 'gram'], suffixes=('_left', '_right'))
+    shared = pairs.groupby(['id_left', 'id_right']).size().rename('shared').reset_index()
+    shared['n_left'] = left.groupby('id').size().reindex(shared['id_left']).to_numpy()
+    shared['n_right'] = right.groupby('id').size().reindex(shared['id_right']).to_numpy()
+    shared['score'] = shared['shared'] / (shared['n_left'] + shared['n_right'] - shared['shared'])
+
+    shared = shared.sort_values(['id_left', 'score'], ascending=[True, False], kind='stable')
+    shared['rank'] = shared.groupby('id_left').cumcount() + 1
+    shared = shared[shared['rank'] <= top_k]
+    return shared.rename(columns={'id_left': 'left_id', 'id_right': 'right_id'})[
+        ['left_id', 'right_id', 'score', 'rank']
+    ].reset_index(drop=True)
+
+
+def _resolve_districts(left_districts, right_districts, threshold):
+    """Map each distinct left district key to a right district key (exact, else most similar)."""
+    left_unique = pd.Series(left_districts.unique())
+    right_unique = pd.Series(right_districts.unique())
+    resolved = pd.Series(
+        np.where(left_unique.isin(set(right_unique)), left_unique, None), index=left_unique.to_numpy(), dtype=object
+    )
+    missing = left_unique[resolved.isna().to_numpy()]
+    if len(missing):
+        candidates = similarity(missing, right_unique, top_k=1)
+        candidates = candidates[candidates['score'] >= threshold]
+        resolved.loc[missing[candidates['left_id']].to_numpy()] = right_unique[candidates['right_id']].to_numpy()
+    return resolved
+
+
+@timed('flags.match_names', count_rows=True)
+def match_names(left, right, left_on=('Ward', 'District'), right_on=('ward_name', 'dist_name'),
+                threshold=NAME_MATCH_THRESHOLD, top_k=3):
+    """
+    Match (ward, district) name pairs in ``left`` to rows of ``right``.
+
+    Args:
+        left: DataFrame with ward and district name columns (e.g. a survey sheet)
+        right: DataFrame with ward and district name columns (e.g. the wards layer)
+        left_on, right_on: (ward column, district column) in each frame
+        threshold: Minimum trigram similarity for fuzzy matches (and for
+            resolving districts that do not match exactly)
+        top_k: Number of ranked fuzzy candidates reported per pair
+
+    Returns:
+        Match report with one row per distinct left pair and candidate row of
+        ``right``: ward, district, match_type ('exact', 'fuzzy' or
+        'unmatched'), rank, score, right_index (index label in ``right``),
+        matched_ward, matched_district and accepted (True for the best
+        candidate of an exact match or of a fuzzy match at or above the
+        threshold). Rows of ``right`` with the same normalized names share a
+        rank, so all of them are accepted together. Left rows map to report
+        rows through the (ward, district) columns.
+    """
+    ward_col, district_col = left_on
+    right_ward_col, right_district_col = right_on
+
+    # Distinct pairs only; survey sheets repeat the same ward for every village
+    pairs = left[[ward_col, district_col]].drop_duplicates().reset_index(drop=True)
+    pairs.columns = ['ward', 'district']
+    pairs['ward_key'] = normalize_names(pairs['ward'])
+    pairs['district_key'] = normalize_names(pairs['district'])
+
+    targets = pd.DataFrame({
+        'right_index': right.index,
+        'matched_ward': right[right_ward_col].to_numpy(),
+        'matched_district': right[right_district_col].to_numpy(),
+    })
+    targets['ward_key'] = normalize_names(targets['matched_ward'])
+    targets['district_key'] = normalize_names(targets['matched_district'])
+
+    resolved = _resolve_districts(pairs['district_key'], targets['district_key'], threshold)
+    pairs['block'] = resolved.reindex(pairs['district_key']).to_numpy()
+
+    # 1. Exact: hash join on the normalized keys
+    exact = pairs.reset_index(names='pair_id').merge(
+        targets, left_on=['ward_key', 'block'], right_on=['ward_key', 'district_key'], suffixes=('', '_target'),
+    )
+    exact = exact.assign(match_type='exact', rank=1, score=1.0)
+
+    # 2. Fuzzy: trigram similarity within the resolved district, scored once per
+    # distinct target key and then expanded to every row with that key
+    remaining = pairs[~pairs.index.isin(exact['pair_id']) & pairs['block'].notna()]
+    target_keys = targets[['ward_key', 'district_key']].drop_duplicates().reset_index(drop=True)
+    fuzzy = similarity(
+        remaining['ward_key'], target_keys['ward_key'],
+        left_blocks=remaining['block'], right_blocks=target_keys['district_key'], top_k=top_k,
+    )
+    fuzzy = fuzzy.merge(pairs, left_on='left_id', right_index=True).merge(
+        target_keys, left_on='right_id', right_index=True, suffixes=('', '_target'),
+    ).merge(
+        targets[['right_index', 'matched_ward', 'matched_district', 'ward_key', 'district_key']],
+        left_on=['ward_key_target', 'district_key_target'], right_on=['ward_key', 'district_key'],
+        suffixes=('', '_matched'),
+    ).rename(columns={'left_id': 'pair_id'}).assign(match_type='fuzzy')
+
+    report = pd.concat([exact, fuzzy], ignore_index=True)
+    unmatched = pairs.index.difference(report['pair_id'])
+    report = pd.concat([
+        report,
+        pairs.loc[unmatched].reset_index(names='pair_id').assign(match_type='unmatched', rank=1, score=0.0),
+    ], ignore_index=True)
+
+    report['accepted'] = (report['rank'] == 1) & (
+        (report['match_type'] == 'exact') | ((report['match_type'] == 'fuzzy') & (report['score'] >= threshold))
+    )
+    columns = ['ward', 'district', 'match_type', 'rank', 'score', 'right_index', 'matched_ward',
+               'matched_district', 'accepted']
+    return report.sort_values(['pair_id', 'rank'], kind='stable')[columns].reset_index(drop=True)
@@ -0,0 +1,414 @@
+"""Shared annotation store for all annotators, in one SQLite database.
+
+Every app session writes its annotations to SHARED_STORE_FILE next to its own
+journal, attributed to an annotator name and the session id. The database runs
+in WAL mode, so readers never block the writer, and writers wait up to
+SHARED_STORE_BUSY_TIMEOUT for each other instead of failing; sessions of one
+server process share a connection (see utils.data_layer), other processes open
+their own.
+
+Tables:
+  * annotations: the store columns (see utils.annotation_store.COLUMNS) plus
+    annotator, session, a deleted flag, the version of the last change and
+    the batch (the version that inserted the row, used for undo)
+  * annotations_rtree: an R*Tree over the points, so the annotations in a map
+    viewport are found without scanning the table
+  * meta: the current version
+
+Each write (a batch of annotations inserted with one executemany, a batch
+deleted, or a session reassigned to another annotator) is one transaction that
+takes the next version number and stamps it on every row it touches. Writes
+run under BEGIN IMMEDIATE, so versions are committed in order and
+``changes_since(n)`` returns exactly the rows changed after version n.
+Deleted rows are kept as tombstones with the deleted flag set, so followers
+also learn about removals. ``annotator_counts`` (the progress table of the
+app) is one GROUP BY, cached until the version changes, so sessions do not
+keep their own copy of everyone's annotations.
+
+App sessions write through an AnnotatorWriter, which hands each write to one
+background thread per store: the rerun does not wait for a large batch (R*Tree
+inserts cost about 20 µs per row), and writes still run in the order they were
+made. Other sessions see a batch once it is committed. A write that fails is
+logged, reported by ``failures`` and raised by ``flush``.
+"""
+import contextlib
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from config.settings import SHARED_STORE_BUSY_TIMEOUT, SHARED_STORE_FILE
+from utils.annotation_store import COLUMNS, SQL_TYPES, _from_sql, _to_sql, add_missing_columns, frame_columns
+
+# Columns of every query result, besides the store columns
+META_COLUMNS = ['id', 'annotator', 'session', 'version', 'deleted']
+
+logger = logging.getLogger(__name__)
+
+
+def _log_failure(future):
+    if future.exception() is not None:
+        logger.error("Write to the shared annotation store failed", exc_info=future.exception())
+
+
+def _rows_frame(rows):
+    """DataFrame from query rows in the order META_COLUMNS + COLUMNS."""
+    columns = list(zip(*rows)) if rows else [()] * (len(META_COLUMNS) + len(COLUMNS))
+    values = dict(zip(META_COLUMNS + list(COLUMNS), columns))
+    frame = {
+        'id': np.array(values['id'], dtype='int64'),
+        'annotator': np.array(values['annotator'], dtype=object),
+        'session': np.array(values['session'], dtype=object),
+        'version': np.array(values['version'], dtype='int64'),
+        'deleted': np.array(values['deleted'], dtype=bool),
+    }
+    for column, dtype in COLUMNS.items():
+        frame[column] = _from_sql(values[column], dtype)
+    return pd.DataFrame(frame)
+
+
+class SharedStore:
+    """
+    Annotations of all annotators in one SQLite database.
+
+    Args:
+        path: Database file, created if missing
+        busy_timeout: Seconds a write waits for other writers before failing
+    """
+
+    def __init__(self, path=SHARED_STORE_FILE, busy_timeout=SHARED_STORE_BUSY_TIMEOUT):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # Transactions are managed explicitly (BEGIN IMMEDIATE for writes)
+        self._conn = sqlite3.connect(self.path, timeout=busy_timeout, isolation_level=None,
+                                     check_same_thread=False)
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._create_tables()
+        self._background = ThreadPoolExecutor(max_workers=1, thread_name_prefix='shared-store')
+        self._counts = None  # (version, annotator_counts frame)
+
+    def _create_tables(self):
+        definitions = ', '.join(f"{column} {SQL_TYPES[dtype]}" for column, dtype in COLUMNS.items())
+        with self._write():
+            self._conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS annotations (
+                    id INTEGER PRIMARY KEY,
+                    annotator TEXT NOT NULL,
+                    session TEXT,
+                    version INTEGER NOT NULL,
+                    deleted INTEGER NOT NULL DEFAULT 0,
+                    batch INTEGER,
+                    {definitions}
+                )""")
+            add_missing_columns(self._conn)
+            if 'batch' not in {row[1] for row in self._conn.execute("PRAGMA table_info(annotations)")}:
+                self._conn.execute("ALTER TABLE annotations ADD COLUMN batch INTEGER")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS annotations_version ON annotations (version)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS annotations_session ON annotations (session, deleted)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS annotations_batch ON annotations (batch)")
+            self._conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS annotations_rtree "
+                               "USING rtree(id, min_lon, max_lon, min_lat, max_lat)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER)")
+            self._conn.execute("INSERT OR IGNORE INTO meta VALUES ('version', 0)")
+
+    @contextlib.contextmanager
+    def _write(self):
+        """Write transaction; BEGIN IMMEDIATE takes the database lock up front, so no two writers share a version."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _next_version(self, conn):
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'version'")
+        return conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    @property
+    def version(self):
+        """Version of the last committed change (0 for an empty store)."""
+        with self._lock:
+            return self._conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+
+    def add(self, columns, annotator, session=None):
+        """
+        Insert a batch of annotations in one transaction.
+
+        Args:
+            columns: Dict of store columns (NumPy arrays), as built by
+                utils.annotation_store.frame_columns, or a DataFrame
+            annotator: Name the annotations are attributed to
+            session: Optional session id of the writer
+
+        Returns:
+            Version of the batch, or None when it was empty
+        """
+        if isinstance(columns, pd.DataFrame):
+            columns = frame_columns(columns)
+        n = len(columns['latitude'])
+        if n == 0:
+            return None
+        values = [_to_sql(columns[column], dtype) for column, dtype in COLUMNS.items()]
+        with self._write() as conn:
+            version = self._next_version(conn)
+            first = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM annotations").fetchone()[0]
+            ids = range(first, first + n)
+            conn.executemany(
+                f"INSERT INTO annotations (id, annotator, session, version, batch, {', '.join(COLUMNS)}) "
+                f"VALUES (?, ?, ?, ?, ?, {', '.join('?' * len(COLUMNS))})",
+                zip(ids, [annotator] * n, [session] * n, [version] * n, [version] * n, *values),
+            )
+            conn.executemany(
+                "INSERT INTO annotations_rtree VALUES (?, ?, ?, ?, ?)",
+                zip(ids, values[1], values[1], values[0], values[0]),
+            )
+        return version
+
+    def delete(self, ids=None, annotator=None, session=None, batch=None):
+        """
+        Mark annotations as deleted: by id, and/or all of an annotator, a
+        session or a batch (the version returned by ``add``).
+
+        Returns:
+            Version of the change, or None when nothing matched
+        """
+        conditions, params = ["deleted = 0"], []
+        if ids is not None:
+            ids = [int(i) for i in ids]
+            conditions.append("id IN (SELECT value FROM json_each(?))")
+            params.append(str(ids))
+        if annotator is not None:
+            conditions.append("annotator = ?")
+            params.append(annotator)
+        if session is not None:
+            conditions.append("session = ?")
+            params.append(session)
+        if batch is not None:
+            conditions.append("batch = ?")
+            params.append(int(batch))
+        if len(conditions) == 1:
+            raise ValueError("delete needs ids, an annotator, a session or a batch")
+        where = ' AND '.join(conditions)
+        with self._write() as conn:
+            matched = [row[0] for row in conn.execute(f"SELECT id FROM annotations WHERE {where}", params)]
+            if not matched:
+                return None
+            version = self._next_version(conn)
+            conn.executemany("UPDATE annotations SET deleted = 1, version = ? WHERE id = ?",
+                             ((version, i) for i in matched))
+            conn.executemany("DELETE FROM annotations_rtree WHERE id = ?", ((i,) for i in matched))
+        return version
+
+    def _frame(self, sql, params=()):
+        with self._lock:
+            return _rows_frame(self._conn.execute(sql, params).fetchall())
+
+    def _select(self, where='', joins=''):
+        columns = ', '.join(f"a.{column}" for column in META_COLUMNS + list(COLUMNS))
+        return f"SELECT {columns} FROM annotations a {joins} {where}"
+
+    def to_frame(self, annotator=None):
+        """All current (not deleted) annotations, optionally of one annotator."""
+        if annotator is None:
+            return self._frame(self._select("WHERE a.deleted = 0 ORDER BY a.id"))
+        return self._frame(self._select("WHERE a.deleted = 0 AND a.annotator = ? ORDER BY a.id"), (annotator,))
+
+    def query_bbox(self, bounds, exclude_session=None, limit=None):
+        """
+        Current annotations inside a (west, south, east, north) box, via the R*Tree.
+
+        Args:
+            bounds: Box in WGS84 degrees, e.g. from map_layers.bounds_from_map_data
+            exclude_session: Leave out the annotations of this session (drawn by the session itself)
+            limit: Return at most this many (the most recent)
+
+        Returns:
+            DataFrame with the store columns and id, annotator, session, version, deleted
+        """
+        west, south, east, north = bounds
+        # The R*Tree keeps 32-bit floats (rounded outwards); the exact test runs on its candidates only
+        where = ("WHERE r.min_lon <= ? AND r.max_lon >= ? AND r.min_lat <= ? AND r.max_lat >= ?"
+                 " AND a.longitude BETWEEN ? AND ? AND a.latitude BETWEEN ? AND ?")
+        params = [east, west, north, south, west, east, south, north]
+        if exclude_session is not None:
+            where += " AND a.session IS NOT ?"
+            params.append(exclude_session)
+        where += " ORDER BY a.id DESC"
+        if limit is not None:
+            where += " LIMIT ?"
+            params.append(int(limit))
+        return self._frame(self._select(where, joins="JOIN annotations_rtree r ON r.id = a.id"), params)
+
+    def changes_since(self, version):
+        """
+        Rows added or deleted after a version.
+
+        Returns:
+            (DataFrame of changed rows, deleted ones with deleted=True, version
+            they bring a follower up to)
+        """
+        # Read in one transaction so the rows and the version are consistent
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                current = self._conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+                rows = self._conn.execute(self._select("WHERE a.version > ? ORDER BY a.id"), (version,)).fetchall()
+            finally:
+                self._conn.execute("COMMIT")
+        return _rows_frame(rows), current
+
+    def count(self, session=None):
+        """Number of current annotations, of one session or of all."""
+        with self._lock:
+            if session is None:
+                return self._conn.execute("SELECT COUNT(*) FROM annotations WHERE deleted = 0").fetchone()[0]
+            return self._conn.execute("SELECT COUNT(*) FROM annotations WHERE session = ? AND deleted = 0",
+                                      (session,)).fetchone()[0]
+
+    def annotator_counts(self):
+        """
+        Current annotations per annotator, computed again only after a change.
+
+        Returns:
+            DataFrame with annotator, treatment and control, ordered by annotator
+        """
+        with self._lock:
+            version = self._conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+            if self._counts is None or self._counts[0] != version:
+                rows = self._conn.execute(
+                    "SELECT annotator, SUM(is_treatment), SUM(NOT is_treatment) FROM annotations "
+                    "WHERE deleted = 0 GROUP BY annotator ORDER BY annotator").fetchall()
+                counts = pd.DataFrame(rows, columns=['annotator', 'treatment', 'control'])
+                self._counts = (version, counts.astype({'treatment': 'int64', 'control': 'int64'}))
+            return self._counts[1].copy()
+
+    def reassign(self, session, annotator):
+        """
+        Attribute all current annotations of a session to another annotator.
+
+        Returns:
+            Version of the change, or None when the session has no annotations
+            or they already belong to the annotator
+        """
+        with self._write() as conn:
+            where = "session = ? AND deleted = 0 AND annotator != ?"
+            found = conn.execute(f"SELECT 1 FROM annotations WHERE {where} LIMIT 1", (session, annotator)).fetchone()
+            if found is None:
+                return None
+            version = self._next_version(conn)
+            conn.execute(f"UPDATE annotations SET annotator = ?, version = ? WHERE {where}",
+                         (annotator, version, session, annotator))
+        return version
+
+    def writer(self, annotator, session=None):
+        """An AnnotatorWriter that attributes everything it writes to one annotator and session."""
+        return AnnotatorWriter(self, annotator, session)
+
+    def submit(self, func, *args):
+        """Run a write in the background thread, after the writes submitted before it; returns a Future."""
+        future = self._background.submit(func, *args)
+        future.add_done_callback(_log_failure)
+        return future
+
+    def close(self):
+        """Finish the submitted writes and close the connection."""
+        self._background.shutdown(wait=True)
+        with self._lock:
+            self._conn.close()
+
+
+class AnnotatorWriter:
+    """
+    Writes one session's annotations to the shared store in the background;
+    attached to an AnnotationStore as ``shared``.
+
+    Args:
+        store: SharedStore
+        annotator: Name new annotations are attributed to (can be changed)
+        session: Session id; ``clear`` deletes this session's annotations
+    """
+
+    def __init__(self, store, annotator, session=None):
+        self.store = store
+        self.annotator = annotator
+        self.session = session
+        # One entry per AnnotationStore batch, recorded when it is submitted so
+        # undo stays in step with the AnnotationStore; the background writes add
+        # the versions they committed (none when they failed or were empty)
+        self._batches = []
+        self._pending = []
+
+    def _submit(self, func, *args):
+        # Successful writes are forgotten; failed ones are kept for failures/flush
+        self._pending = [f for f in self._pending if not f.done() or f.exception() is not None]
+        future = self.store.submit(func, *args)
+        self._pending.append(future)
+        return future
+
+    def _add(self, batch, columns, annotator):
+        version = self.store.add(columns, annotator, self.session)
+        if version is not None:
+            batch.append(version)
+
+    def _undo(self, batch):
+        for version in batch:
+            self.store.delete(batch=version)
+
+    def _clear(self, annotator):
+        if self.session is None:
+            self.store.delete(annotator=annotator)
+        else:
+            self.store.delete(session=self.session)
+
+    def add(self, columns, new_batch=True):
+        """
+        Insert store columns.
+
+        Args:
+            columns: Dict of store columns
+            new_batch: False to add them to the last batch, so undo removes both together
+        """
+        if new_batch or not self._batches:
+            self._batches.append([])
+        return self._submit(self._add, self._batches[-1], columns, self.annotator)
+
+    def undo(self):
+        """Delete the last batch added through this writer (nothing if that write failed)."""
+        if self._batches:
+            return self._submit(self._undo, self._batches.pop())
+
+    def clear(self):
+        """Delete all annotations of the session (or of the annotator, without a session)."""
+        self._batches = []
+        return self._submit(self._clear, self.annotator)
+
+    def failures(self):
+        """
+        Errors of the writes that failed since the last call, without waiting for
+        the writes still running.
+        """
+        failed = [f for f in self._pending if f.done() and f.exception() is not None]
+        self._pending = [f for f in self._pending if f not in failed]
+        return [f.exception() for f in failed]
+
+    def flush(self):
+        """
+        Wait until everything written so far is committed.
+
+        Raises:
+            The error of the first write that failed since the last flush
+        """
+        pending, self._pending = self._pending, []
+        errors = [error for error in (f.exception() for f in pending) if error is not None]
+        if errors:
+            raise errors[0]
+
@@ -0,0 +1,93 @@
+"""Snap annotation points to grid cells and wards.
+
+Points are projected once to TARGET_CRS; grid cell ids then follow from integer
+division (the same scheme as spatial_prep.grid, so they match the cell_id column
+of the grid datasets) and wards are found with an STRtree point-in-polygon query.
+Everything works on arrays, so a single click and a bulk CSV upload take the
+same path.
+"""
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import Transformer
+
+from config.settings import GRID_SIZE_LARGE, GRID_SIZE_SMALL, TARGET_CRS, WARDS_FILE, WEB_CRS
+from spatial_prep import grid
+
+CELL_SIZES = (GRID_SIZE_LARGE, GRID_SIZE_SMALL)
+NO_CELL = -1
+
+
+def cell_column(cell_size):
+    return f"cell_{cell_size}m"
+
+
+class PointSnapper:
+    """
+    Finds the grid cells and ward of WGS84 points.
+
+    Args:
+        wards: Ward GeoDataFrame with ward_name, dist_name and reg_name
+        cell_sizes: Grid cell sizes (meters) to compute cell ids for
+    """
+
+    def __init__(self, wards, cell_sizes=CELL_SIZES):
+        wards = wards.to_crs(TARGET_CRS)
+        self.cell_sizes = cell_sizes
+        self.snap_columns = [cell_column(size) for size in cell_sizes] + grid.WARD_ATTRIBUTES
+        self.attributes = {column: wards[column].to_numpy(dtype=object) for column in grid.WARD_ATTRIBUTES}
+        self.tree = shapely.STRtree(np.asarray(wards.geometry.values))
+        shapely.prepare(self.tree.geometries)
+        self.to_utm = Transformer.from_crs(WEB_CRS, TARGET_CRS, always_xy=True)
+
+    @classmethod
+    def from_file(cls, path=WARDS_FILE):
+        return cls(grid.load_wards(path))
+
+    def ward_index(self, x, y):
+        """
+        Index of the ward containing each TARGET_CRS point, -1 outside all wards.
+
+        Points on a shared boundary go to the first ward in the layer.
+        """
+        index = np.full(len(x), -1, dtype=np.int64)
+        point_idx, ward_idx = self.tree.query(shapely.points(x, y), predicate='intersects')
+        if len(point_idx):
+            # The order of the wards within a point follows the tree, not the layer,
+            # so sort by point and ward index and keep the lowest ward per point
+            order = np.lexsort((ward_idx, point_idx))
+            point_idx, ward_idx = point_idx[order], ward_idx[order]
+            first = np.r_[True, point_idx[1:] != point_idx[:-1]]
+            index[point_idx[first]] = ward_idx[first]
+        return index
+
+    def snap(self, latitude, longitude):
+        """
+        Snap arrays of WGS84 coordinates.
+
+        Returns:
+            DataFrame with one cell id column per cell size (cell_500m, ...) and
+            ward_name, dist_name and reg_name (None outside the wards)
+        """
+        latitude = np.asarray(latitude, dtype=np.float64)
+        longitude = np.asarray(longitude, dtype=np.float64)
+        x, y = self.to_utm.transform(longitude, latitude)
+        valid = np.isfinite(x) & np.isfinite(y)
+
+        snapped = {}
+        for cell_size in self.cell_sizes:
+            ids = grid.point_cell_ids(np.where(valid, x, 0), np.where(valid, y, 0), cell_size)
+            snapped[cell_column(cell_size)] = np.where(valid, ids, NO_CELL)
+
+        ward_idx = np.full(len(x), -1, dtype=np.int64)
+        ward_idx[valid] = self.ward_index(x[valid], y[valid])
+        inside = ward_idx >= 0
+        for column, values in self.attributes.items():
+            names = np.full(len(x), None, dtype=object)
+            names[inside] = values[ward_idx[inside]]
+            snapped[column] = names
+        return pd.DataFrame(snapped)
+
+    def snap_one(self, latitude, longitude):
+        """Snap a single point; returns a dict of the snap columns."""
+        return {column: values[0] for column, values in self.snap([latitude], [longitude]).items()}
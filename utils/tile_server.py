@@ -0,0 +1,198 @@
+"""Local tile server for the annotation map.
+
+Serves vector tiles at ``/{z}/{x}/{y}.pbf`` either from a pre-generated MBTiles
+file or, in live mode, by rendering tiles on demand from the processed data
+and the shared annotation store (rendered tiles are kept in an in-memory LRU
+cache). The offline basemaps in
+BASEMAP_DIR (see utils.basemap_tiles) are served as raster tiles at
+``/basemap/<name>/{z}/{x}/{y}.<format>``. Start it next to the Streamlit app:
+
+    python -m utils.tile_server            # serve data/processed/vector_tiles.mbtiles and the basemaps
+    python -m utils.tile_server --live     # render vector tiles on demand
+
+Every tile carries an ETag (a hash of its bytes) and a Cache-Control header, so
+the browser keeps tiles for TILE_CACHE_MAX_AGE seconds and afterwards
+revalidates them with If-None-Match, answered by 304 Not Modified when the tile
+is unchanged. Live tiles carry the annotation counts of the shared store
+(utils.shared_store); they are re-rendered once its version changes and are
+always revalidated.
+"""
+import argparse
+import hashlib
+import re
+import sys
+import threading
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from config.settings import BASEMAP_DIR, TILE_CACHE_MAX_AGE, TILE_SERVER_HOST, TILE_SERVER_PORT
+from utils.mbtiles import MBTiles
+
+TILE_PATH = re.compile(r'^/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.pbf$')
+BASEMAP_PATH = re.compile(r'^/basemap/(?P<name>[\w-]+)/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)\.(?P<ext>png|jpe?g|webp)$')
+MEDIA_TYPES = {'png': 'image/png', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'webp': 'image/webp'}
+
+
+class MBTilesSource:
+    """Tiles read from an MBTiles file; they only change when the file is regenerated."""
+
+    max_age = TILE_CACHE_MAX_AGE
+
+    def __init__(self, path):
+        self.mbtiles = MBTiles(path, mode='r')
+
+    def get(self, z, x, y):
+        return self.mbtiles.get_tile(z, x, y)
+
+
+class LiveSource:
+    """
+    Tiles rendered on demand from the processed layers, memoized per (z, x, y).
+
+    Args:
+        make_sources: Function of the annotations (DataFrame or None) that returns
+            the layer sources, e.g. utils.vector_tiles.default_sources
+        store: Optional SharedStore; the layers then carry its annotation counts
+            and are rebuilt, and the rendered tiles dropped, when its version changes
+        cache_size: Rendered tiles kept in memory
+    """
+
+    max_age = 0
+
+    def __init__(self, make_sources, store=None, cache_size=4096):
+        from utils.vector_tiles import render_tile
+
+        self.make_sources = make_sources
+        self.store = store
+        self.version = None
+        self.sources = ()
+        self._lock = threading.Lock()
+        # Keyed on the sources too, so a tile rendered from replaced sources is never served
+        self._render = lru_cache(maxsize=cache_size)(lambda sources, z, x, y: render_tile(sources, z, x, y))
+
+    def _current_sources(self):
+        version = self.store.version if self.store is not None else 0
+        with self._lock:
+            if version != self.version:
+                annotations = self.store.to_frame() if self.store is not None else None
+                self.sources = tuple(self.make_sources(annotations))
+                self._render.cache_clear()
+                self.version = version
+            return self.sources
+
+    def get(self, z, x, y):
+        return self._render(self._current_sources(), z, x, y)
+
+
+def load_basemaps(directory=BASEMAP_DIR):
+    """MBTilesSource and media type of every basemap in a directory, by name."""
+    from utils.basemap_tiles import available_basemaps
+
+    return {name: (MBTilesSource(Path(directory) / f"{name}.mbtiles"), MEDIA_TYPES[metadata.get('format', 'png')])
+            for name, metadata in available_basemaps(directory).items()}
+
+
+class TileRequestHandler(BaseHTTPRequestHandler):
+    """Answers tile requests from the sources attached to the server."""
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        match = TILE_PATH.match(path)
+        if match and self.server.tile_source is not None:
+            self._send_tile(self.server.tile_source, match, 'application/x-protobuf', gzip=True)
+            return
+        match = BASEMAP_PATH.match(path)
+        if match and match['name'] in self.server.basemaps:
+            source, media_type = self.server.basemaps[match['name']]
+            self._send_tile(source, match, media_type)
+            return
+        self.send_error(404, "Expected /{z}/{x}/{y}.pbf or /basemap/<name>/{z}/{x}/{y}.<format>")
+
+    def _send_tile(self, source, match, media_type, gzip=False):
+        z, x, y = (int(match[k]) for k in ('z', 'x', 'y'))
+        data = source.get(z, x, y)
+        if not data:
+            # Empty tiles are normal outside the study area; basemaps store them as zero-length rows
+            self.send_response(204)
+            self._send_common_headers(source)
+            self.end_headers()
+            return
+        etag = f'"{hashlib.blake2b(data, digest_size=12).hexdigest()}"'
+        if etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            self._send_common_headers(source, etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self._send_common_headers(source, etag)
+        self.send_header('Content-Type', media_type)
+        if gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_common_headers(self, source, etag=None):
+        # The map is served by Streamlit on another port
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Cache-Control', f"public, max-age={source.max_age}" if source.max_age else 'no-cache')
+        if etag is not None:
+            self.send_header('ETag', etag)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(tile_source, host=TILE_SERVER_HOST, port=TILE_SERVER_PORT, basemaps=None):
+    """
+    Create (but do not start) a threaded tile server.
+
+    Args:
+        tile_source: MBTilesSource or LiveSource for the vector tiles, or None to serve only basemaps
+        basemaps: dict of name -> (source, media type), see load_basemaps
+    """
+    server = ThreadingHTTPServer((host, port), TileRequestHandler)
+    server.tile_source = tile_source
+    server.basemaps = basemaps or {}
+    return server
+
+
+def main(argv=None):
+    from utils.vector_tiles import TILES_FILE, default_sources
+
+    parser = argparse.ArgumentParser(description="Serve vector tiles and offline basemaps for the annotation map.")
+    parser.add_argument('--mbtiles', type=Path, default=TILES_FILE)
+    parser.add_argument('--live', action='store_true', help="Render tiles on demand instead of reading MBTiles")
+    parser.add_argument('--basemaps', type=Path, default=BASEMAP_DIR, help="Directory with basemap MBTiles files")
+    parser.add_argument('--host', default=TILE_SERVER_HOST)
+    parser.add_argument('--port', type=int, default=TILE_SERVER_PORT)
+    args = parser.parse_args(argv)
+
+    if args.live:
+        from utils.shared_store import SharedStore
+
+        tile_source = LiveSource(default_sources, SharedStore())
+        print("🧱 Rendering tiles on demand from data/processed and the shared annotations")
+    elif args.mbtiles.exists():
+        tile_source = MBTilesSource(args.mbtiles)
+        print(f"🧱 Serving {args.mbtiles}")
+    else:
+        tile_source = None
+        print(f"⚠️ {args.mbtiles} not found; serving basemaps only (run `python -m utils.vector_tiles`)")
+    basemaps = load_basemaps(args.basemaps)
+    if basemaps:
+        print(f"🗺️ Basemaps: {', '.join(basemaps)}")
+
+    server = make_server(tile_source, args.host, args.port, basemaps)
+    print(f"Tile server running at http://{args.host}:{args.port}/{{z}}/{{x}}/{{y}}.pbf")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,276 @@
+"""Vector tiles (MVT) for the ward layer and the generated grids.
+
+Layers are served to the app as Mapbox Vector Tiles, either pre-generated into an
+MBTiles file with ``python -m utils.vector_tiles`` or rendered on demand by the
+local tile server (utils/tile_server.py). Every feature carries its
+treatment/control status and, when annotations are given, annotation counts.
+
+The ward layer is small enough to keep in memory behind an STRtree. Grid cells
+are read per tile from the partitioned GeoParquet datasets, using the col/row
+columns to prune the scan, so the 100m grid is never loaded in full.
+"""
+import argparse
+import gzip
+import json
+import sys
+import time
+from pathlib import Path
+
+import geopandas as gpd
+import mercantile
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+import shapely
+from pyproj import Transformer
+
+from config.settings import (GRID_LAYER_MIN_ZOOM, GRID_SIZE_LARGE, GRID_SIZE_SMALL, GRID_SMALL_LAYER_MIN_ZOOM,
+                             PROCESSED_DATA_DIR, TARGET_CRS, VECTOR_TILE_MAX_ZOOM, VECTOR_TILE_MIN_ZOOM, WARDS_FILE,
+                             WEB_CRS)
+from spatial_prep import grid
+from utils import mvt
+from utils.mbtiles import MBTiles
+
+WEB_MERCATOR = "EPSG:3857"
+TILES_FILE = PROCESSED_DATA_DIR / "vector_tiles.mbtiles"
+
+STATUS_PROPERTIES = ['is_treatment', 'is_program_region', 'is_adjacent_region']
+
+
+def add_status(df):
+    """Add a single 'status' column: treatment, control (adjacent region) or program."""
+    df = df.copy()
+    df['status'] = np.select(
+        [df['is_treatment'].astype(bool), df['is_adjacent_region'].astype(bool)],
+        ['treatment', 'control'],
+        default='program',
+    )
+    return df
+
+
+def tile_mercator_bounds(tile, buffer=mvt.BUFFER, extent=mvt.EXTENT):
+    """EPSG:3857 bounds of a tile, and the same bounds padded by the render buffer."""
+    bounds = mercantile.xy_bounds(tile)
+    pad = (bounds.right - bounds.left) * buffer / extent
+    return tuple(bounds), (bounds.left - pad, bounds.bottom - pad, bounds.right + pad, bounds.top + pad)
+
+
+class VectorLayerSource:
+    """
+    An in-memory layer behind an STRtree, stored in Web Mercator.
+
+    Args:
+        name: Layer name in the tiles
+        gdf: GeoDataFrame with the features (any CRS)
+        properties: Columns written as feature properties
+        min_zoom: Lowest zoom level the layer appears at
+        annotation_counts: Optional DataFrame of annotations (latitude, longitude, is_treatment)
+    """
+
+    def __init__(self, name, gdf, properties, min_zoom=0, annotation_counts=None):
+        gdf = gdf.to_crs(WEB_MERCATOR).reset_index(drop=True)
+        self.name = name
+        self.min_zoom = min_zoom
+        self.geometries = np.asarray(gdf.geometry.values)
+        self.tree = shapely.STRtree(self.geometries)
+        props = gdf[list(properties)].copy()
+        if annotation_counts is not None:
+            props = props.join(self._count_annotations(annotation_counts))
+        self.properties = props.reset_index(drop=True)
+
+    def _count_annotations(self, annotations):
+        to_mercator = Transformer.from_crs(WEB_CRS, WEB_MERCATOR, always_xy=True)
+        x, y = to_mercator.transform(annotations['longitude'].to_numpy(), annotations['latitude'].to_numpy())
+        point_idx, feature_idx = self.tree.query(shapely.points(x, y), predicate='intersects')
+        is_treatment = annotations['is_treatment'].astype(bool).to_numpy()[point_idx]
+        n = len(self.geometries)
+        return pd.DataFrame({
+            'n_treatment_annotations': np.bincount(feature_idx[is_treatment], minlength=n),
+            'n_control_annotations': np.bincount(feature_idx[~is_treatment], minlength=n),
+        })
+
+    def bounds(self):
+        return tuple(shapely.total_bounds(self.geometries))
+
+    def features(self, tile):
+        _, padded = tile_mercator_bounds(tile)
+        idx = np.sort(self.tree.query(shapely.box(*padded), predicate='intersects'))
+        return self.geometries[idx], self.properties.iloc[idx], None
+
+
+class GridDatasetSource:
+    """
+    Grid cells read per tile from a tiled GeoParquet dataset (see spatial_prep.tiles).
+
+    Args:
+        name: Layer name in the tiles
+        dataset_dir: Partitioned grid dataset directory
+        cell_size: Cell edge length in meters
+        min_zoom: Lowest zoom level the layer appears at
+        annotation_counts: Optional DataFrame of annotations (latitude, longitude, is_treatment)
+    """
+
+    def __init__(self, name, dataset_dir, cell_size, min_zoom=0, annotation_counts=None):
+        self.name = name
+        self.cell_size = cell_size
+        self.min_zoom = min_zoom
+        self.dataset = ds.dataset(dataset_dir, format='parquet', partitioning='hive')
+        self.to_utm = Transformer.from_crs(WEB_CRS, TARGET_CRS, always_xy=True)
+        self.to_mercator = Transformer.from_crs(TARGET_CRS, WEB_MERCATOR, always_xy=True)
+        self.counts = self._count_annotations(annotation_counts) if annotation_counts is not None else None
+
+    def _count_annotations(self, annotations):
+        """Annotation counts per cell id, computed arithmetically from the UTM coordinates."""
+        x, y = self.to_utm.transform(annotations['longitude'].to_numpy(), annotations['latitude'].to_numpy())
+        counts = pd.DataFrame({
+            'cell_id': grid.point_cell_ids(x, y, self.cell_size),
+            'is_treatment': annotations['is_treatment'].astype(bool).to_numpy(),
+        })
+        return counts.groupby('cell_id')['is_treatment'].agg(
+            n_treatment_annotations='sum', n_control_annotations=lambda s: int((~s).sum()),
+        )
+
+    def bounds(self):
+        table = self.dataset.to_table(columns=['col', 'row'])
+        cols, rows = table['col'].to_numpy(), table['row'].to_numpy()
+        minx, miny = cols.min() * self.cell_size, rows.min() * self.cell_size
+        maxx, maxy = (cols.max() + 1) * self.cell_size, (rows.max() + 1) * self.cell_size
+        return self.to_mercator.transform_bounds(minx, miny, maxx, maxy)
+
+    def features(self, tile):
+        west, south, east, north = mercantile.bounds(tile)
+        minx, miny, maxx, maxy = self.to_utm.transform_bounds(west, south, east, north)
+        col_min, row_min, col_max, row_max = grid.snap_bounds((minx, miny, maxx, maxy), self.cell_size)
+        predicate = (
+            (ds.field('col') >= col_min) & (ds.field('col') < col_max)
+            & (ds.field('row') >= row_min) & (ds.field('row') < row_max)
+        )
+        columns = ['cell_id', 'ward_name'] + STATUS_PROPERTIES + ['geometry']
+        table = self.dataset.to_table(filter=predicate, columns=columns)
+        if table.num_rows == 0:
+            return np.array([], dtype=object), pd.DataFrame(), None
+
+        cells = add_status(table.drop(['geometry']).to_pandas())
+        if self.counts is not None:
+            cells = cells.join(self.counts, on='cell_id')
+            cells[['n_treatment_annotations', 'n_control_annotations']] = (
+                cells[['n_treatment_annotations', 'n_control_annotations']].fillna(0).astype(int)
+            )
+        geoms = shapely.from_wkb(table['geometry'].to_numpy(zero_copy_only=False))
+        geoms = grid.fill_cell_geometries(geoms, cells['cell_id'].to_numpy(), self.cell_size)
+        geoms = shapely.transform(geoms, lambda c: np.column_stack(self.to_mercator.transform(c[:, 0], c[:, 1])))
+        return geoms, cells.drop(columns='cell_id'), cells['cell_id'].to_numpy()
+
+
+def default_sources(annotations=None):
+    """The ward layer and whichever grid datasets exist under data/processed."""
+    sources = []
+    if WARDS_FILE.exists():
+        wards = add_status(gpd.read_file(WARDS_FILE))
+        sources.append(VectorLayerSource(
+            'wards', wards, ['ward_name', 'dist_name', 'reg_name', 'status'] + STATUS_PROPERTIES,
+            min_zoom=VECTOR_TILE_MIN_ZOOM, annotation_counts=annotations,
+        ))
+    for cell_size, min_zoom in [(GRID_SIZE_LARGE, GRID_LAYER_MIN_ZOOM), (GRID_SIZE_SMALL, GRID_SMALL_LAYER_MIN_ZOOM)]:
+        dataset_dir = PROCESSED_DATA_DIR / f"grid_{cell_size}m"
+        if dataset_dir.exists():
+            sources.append(GridDatasetSource(
+                f"grid_{cell_size}m", dataset_dir, cell_size, min_zoom=min_zoom, annotation_counts=annotations,
+            ))
+    return sources
+
+
+def render_tile(sources, z, x, y):
+    """
+    Render one tile from the given sources.
+
+    Returns:
+        gzip-compressed MVT bytes, or None when the tile has no features
+    """
+    tile = mercantile.Tile(x, y, z)
+    bounds, _ = tile_mercator_bounds(tile)
+    layers = []
+    for source in sources:
+        if z >= source.min_zoom:
+            geoms, properties, ids = source.features(tile)
+            layers.append((source.name, geoms, properties, ids))
+    data = mvt.encode_tile(layers, bounds)
+    return gzip.compress(data) if data else None
+
+
+def vector_layers_metadata(sources, max_zoom):
+    return [{'id': s.name, 'minzoom': s.min_zoom, 'maxzoom': max_zoom, 'fields': {}} for s in sources]
+
+
+def build_mbtiles(sources, output=TILES_FILE, min_zoom=VECTOR_TILE_MIN_ZOOM, max_zoom=VECTOR_TILE_MAX_ZOOM,
+                  batch_size=500):
+    """
+    Pre-generate all tiles covering the sources into an MBTiles file.
+
+    Args:
+        sources: Layer sources (see default_sources)
+        output: MBTiles file to write
+        min_zoom, max_zoom: Zoom range to render
+        batch_size: Tiles written per SQLite transaction
+
+    Returns:
+        dict with tiles_written and seconds
+    """
+    if not sources:
+        raise ValueError("No layers to render - run the processing scripts first")
+    start = time.perf_counter()
+    bounds = np.array([s.bounds() for s in sources])
+    to_lonlat = Transformer.from_crs(WEB_MERCATOR, WEB_CRS, always_xy=True)
+    west, south, east, north = to_lonlat.transform_bounds(
+        bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(), bounds[:, 3].max()
+    )
+
+    output = Path(output)
+    if output.exists():
+        output.unlink()
+    tiles_written = 0
+    with MBTiles(output, mode='w') as mbtiles:
+        mbtiles.set_metadata(
+            name=output.stem,
+            format='pbf',
+            type='overlay',
+            minzoom=min_zoom,
+            maxzoom=max_zoom,
+            bounds=f"{west},{south},{east},{north}",
+            center=f"{(west + east) / 2},{(south + north) / 2},{min_zoom}",
+            json=json.dumps({'vector_layers': vector_layers_metadata(sources, max_zoom)}),
+        )
+        for z in range(min_zoom, max_zoom + 1):
+            batch = []
+            for tile in mercantile.tiles(west, south, east, north, zooms=z):
+                data = render_tile(sources, tile.z, tile.x, tile.y)
+                if data:
+                    batch.append((tile.z, tile.x, tile.y, data))
+                if len(batch) >= batch_size:
+                    mbtiles.put_tiles(batch)
+                    tiles_written += len(batch)
+                    batch = []
+            mbtiles.put_tiles(batch)
+            tiles_written += len(batch)
+            print(f"  zoom {z}: {tiles_written:,} tiles so far")
+
+    return {'tiles_written': tiles_written, 'seconds': time.perf_counter() - start}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-generate vector tiles for wards and grids into MBTiles.")
+    parser.add_argument('--output', type=Path, default=TILES_FILE)
+    parser.add_argument('--min-zoom', type=int, default=VECTOR_TILE_MIN_ZOOM)
+    parser.add_argument('--max-zoom', type=int, default=VECTOR_TILE_MAX_ZOOM)
+    parser.add_argument('--annotations', type=Path, help="Annotation CSV to add annotation counts per feature")
+    args = parser.parse_args(argv)
+
+    annotations = pd.read_csv(args.annotations) if args.annotations else None
+    sources = default_sources(annotations)
+    print(f"🧱 Rendering layers {[s.name for s in sources]} at zoom {args.min_zoom}-{args.max_zoom}...")
+    summary = build_mbtiles(sources, args.output, args.min_zoom, args.max_zoom)
+    print(f"✅ {summary['tiles_written']:,} tiles written to {args.output} in {summary['seconds']:.1f}s")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
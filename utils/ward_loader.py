@@ -0,0 +1,178 @@
+"""Cached, columnar loading of the national ward shapefile.
+
+The shapefile is converted once into GeoParquet under data/processed/cache,
+together with region and district layers dissolved from it. Later loads read
+only the requested columns through Arrow and can push bbox and attribute
+filters down into the Parquet scan.
+
+The cache is keyed on the source files: a cheap (mtime, size) check is done on
+every load, and the content hash is only recomputed when that check fails, so
+touching or copying the shapefile does not force a reconversion.
+"""
+import hashlib
+import json
+from pathlib import Path
+
+import geopandas as gpd
+import pyogrio
+
+from config.settings import CACHE_DIR, WARD_SHAPEFILE_DIR
+from utils.instrumentation import track
+
+LAYERS = ('wards', 'regions', 'districts')
+MANIFEST_NAME = 'wards_manifest.json'
+
+
+def find_ward_shapefile(shapefile_dir=WARD_SHAPEFILE_DIR):
+    """Return the first .shp file in the ward shapefile directory."""
+    shp_files = sorted(Path(shapefile_dir).glob("*.shp"))
+    if not shp_files:
+        raise FileNotFoundError(f"No .shp file found in {shapefile_dir}")
+    return shp_files[0]
+
+
+def source_files(shp_file):
+    """The .shp and its sidecar files (.dbf, .shx, .prj, .cpg, ...)."""
+    shp_file = Path(shp_file)
+    return sorted(p for p in shp_file.parent.glob(f"{shp_file.stem}.*") if p.is_file())
+
+
+def _stat_key(shp_file):
+    return {p.name: [p.stat().st_mtime_ns, p.stat().st_size] for p in source_files(shp_file)}
+
+
+def _content_hash(shp_file):
+    digest = hashlib.sha256()
+    for path in source_files(shp_file):
+        digest.update(path.name.encode())
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def layer_path(layer, cache_dir=CACHE_DIR):
+    """Location of a cached layer."""
+    return Path(cache_dir) / f"{layer}.parquet"
+
+
+def _cache_is_current(shp_file, cache_dir):
+    """Check the manifest against the source files, refreshing the stat key if only metadata changed."""
+    manifest_file = Path(cache_dir) / MANIFEST_NAME
+    if not manifest_file.exists() or not all(layer_path(layer, cache_dir).exists() for layer in LAYERS):
+        return False
+    manifest = json.loads(manifest_file.read_text())
+    if manifest.get('source') != str(shp_file):
+        return False
+
+    stat_key = _stat_key(shp_file)
+    if manifest.get('stat_key') == stat_key:
+        return True
+    if manifest.get('sha256') != _content_hash(shp_file):
+        return False
+    manifest['stat_key'] = stat_key
+    manifest_file.write_text(json.dumps(manifest, indent=2))
+    return True
+
+
+def build_cache(shp_file=None, cache_dir=CACHE_DIR):
+    """
+    Convert the shapefile to GeoParquet and write the dissolved region and district layers.
+
+    Args:
+        shp_file: Ward shapefile, defaults to the first .shp in WARD_SHAPEFILE_DIR
+        cache_dir: Cache directory, defaults to data/processed/cache
+    """
+    shp_file = Path(shp_file) if shp_file is not None else find_ward_shapefile()
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+
+    with track('wards.shapefile_load') as step:
+        wards = pyogrio.read_dataframe(shp_file, use_arrow=True)
+        step.rows = len(wards)
+    with track('wards.dissolve') as step:
+        regions = wards[['reg_name', 'geometry']].dissolve(by='reg_name').reset_index()
+        districts = wards[['reg_name', 'dist_name', 'geometry']].dissolve(by=['reg_name', 'dist_name']).reset_index()
+        step.rows = len(regions) + len(districts)
+
+    with track('wards.cache_write', rows=len(wards) + len(regions) + len(districts)):
+        for layer, gdf in zip(LAYERS, (wards, regions, districts)):
+            gdf.to_parquet(layer_path(layer, cache_dir), index=False, write_covering_bbox=True)
+
+    # The manifest is written last, so an interrupted conversion is redone on the next load
+    manifest = {
+        'source': str(shp_file),
+        'stat_key': _stat_key(shp_file),
+        'sha256': _content_hash(shp_file),
+        'rows': {'wards': len(wards), 'regions': len(regions), 'districts': len(districts)},
+    }
+    (cache_dir / MANIFEST_NAME).write_text(json.dumps(manifest, indent=2))
+
+
+def ensure_cache(shp_file=None, cache_dir=CACHE_DIR):
+    """
+    Make sure the cached layers match the shapefile, converting it if needed.
+
+    Returns:
+        True if the cache was (re)built, False if it was already current
+    """
+    shp_file = Path(shp_file) if shp_file is not None else find_ward_shapefile()
+    if _cache_is_current(shp_file, cache_dir):
+        return False
+    build_cache(shp_file, cache_dir)
+    return True
+
+
+def _attribute_filters(regions=None, districts=None):
+    filters = []
+    if regions is not None:
+        filters.append(('reg_name', 'in', list(regions)))
+    if districts is not None:
+        filters.append(('dist_name', 'in', list(districts)))
+    return filters or None
+
+
+def load_layer(layer, columns=None, bbox=None, regions=None, districts=None, shp_file=None, cache_dir=CACHE_DIR):
+    """
+    Load a cached layer, converting the shapefile first if the cache is stale.
+
+    Args:
+        layer: One of 'wards', 'regions' or 'districts'
+        columns: Attribute columns to read; geometry is always included
+        bbox: Optional (minx, miny, maxx, maxy) in the shapefile CRS
+        regions: Optional region names to keep (pushed down as reg_name in [...])
+        districts: Optional district names to keep (pushed down as dist_name in [...])
+        shp_file: Ward shapefile, defaults to the first .shp in WARD_SHAPEFILE_DIR
+        cache_dir: Cache directory, defaults to data/processed/cache
+    """
+    if layer not in LAYERS:
+        raise ValueError(f"Unknown layer {layer!r}, expected one of {LAYERS}")
+    rebuilt = ensure_cache(shp_file, cache_dir)
+    if columns is not None:
+        columns = [c for c in columns if c != 'geometry'] + ['geometry']
+    if layer == 'regions' and districts is not None:
+        raise ValueError("The regions layer has no dist_name column to filter on")
+
+    read_kwargs = {}
+    filters = _attribute_filters(regions, districts)
+    if filters is not None:
+        read_kwargs['filters'] = filters
+    with track(f'wards.load_{layer}', cold=rebuilt) as step:
+        gdf = gpd.read_parquet(layer_path(layer, cache_dir), columns=columns, bbox=bbox, **read_kwargs)
+        step.rows = len(gdf)
+    return gdf
+
+
+def load_wards(columns=None, bbox=None, regions=None, districts=None, shp_file=None, cache_dir=CACHE_DIR):
+    """Load ward polygons from the cache (see load_layer)."""
+    return load_layer('wards', columns, bbox, regions, districts, shp_file, cache_dir)
+
+
+def load_regions(bbox=None, regions=None, shp_file=None, cache_dir=CACHE_DIR):
+    """Load the region layer dissolved from the wards (see load_layer)."""
+    return load_layer('regions', None, bbox, regions, None, shp_file, cache_dir)
+
+
+def load_districts(bbox=None, regions=None, districts=None, shp_file=None, cache_dir=CACHE_DIR):
+    """Load the district layer dissolved from the wards (see load_layer)."""
+    return load_layer('districts', None, bbox, regions, districts, shp_file, cache_dir)